@@ -26,22 +26,41 @@ from oslo_log import log as logging
 from sqlalchemy import event
 from sqlalchemy import func as sql_func
 from sqlalchemy import and_, asc, desc, orm, or_, not_
+from sqlalchemy import inspect as sa_inspect
+from sqlalchemy import select as sa_select
 from sqlalchemy.orm import class_mapper
 
 from quark.db import models
+from quark.db import replica
 from quark.db import sqlalchemy_adapter as quark_sa
+from quark import ip_policy_index
 from quark import network_strategy
 from quark import protocols
+from quark import utils
 
 
 STRATEGY = network_strategy.STRATEGY
 LOG = logging.getLogger(__name__)
 CONF = cfg.CONF
 
+quark_opts = [
+    cfg.BoolOpt("db_keyset_pagination",
+                default=False,
+                help=_("Page ports, subnets and networks by seeking past the"
+                       " marker on the sort keys instead of with an OFFSET"
+                       " style scan, and load their related rows with one"
+                       " extra query per page instead of joins."))
+]
+
+CONF.register_opts(quark_opts, "QUARK")
 
 ONE = "one"
 ALL = "all"
 
+# NOTE: Key in session.info of the subnet counter changes waiting for the
+#       transaction to commit, see subnet_update_ip_counts.
+PENDING_IP_COUNTS = "quark_pending_ip_counts"
+
 
 # NOTE(jkoelker) init event listener that will ensure id is filled in
 #                on object creation (prior to commit).
@@ -82,76 +101,141 @@ def _model_attrs(model):
     return model_attrs
 
 
+EQ_FILTERS = ("address", "cidr", "claim_token", "deallocated", "ip_version",
+              "mac_address_range_id", "transaction_id")
+IN_FILTERS = ("device_id", "device_owner", "group_id", "id", "mac_address",
+              "name", "network_id", "segment_id", "subnet_id",
+              "used_by_tenant_id", "version")
+SG_RULE_EQ_FILTERS = ("direction", "port_range_max", "port_range_min")
+
+
+def _in_filter(column):
+    return lambda value: column.in_(value)
+
+
+def _eq_filter(column):
+    return lambda value: column == value
+
+
+def _deallocated_filter(model):
+    def build(value):
+        if value:
+            return model._deallocated == 1
+        return model._deallocated != 1
+    return build
+
+
+def _ethertype_filter(model):
+    def build(value):
+        etypes = []
+        for etype in value:
+            etypes.append(protocols.translate_ethertype(etype))
+        return model.ethertype.in_(etypes)
+    return build
+
+
+def _ip_address_filter(model):
+    return lambda value: model.address.in_([ip.ipv6().value for ip in value])
+
+
+def _protocol_filter(model):
+    def build(value):
+        pnums = []
+        for version in (protocols.PROTOCOLS_V4, protocols.PROTOCOLS_V6):
+            pnums.extend([y for x, y in version.items() if x in value])
+        return model.protocol.in_(pnums)
+    return build
+
+
+def _reuse_after_filter(model):
+    def build(value):
+        reuse = (timeutils.utcnow() - datetime.timedelta(seconds=value))
+        # NOTE(asadoughi): should this allow for deallocated_at = null?
+        return model.deallocated_at <= reuse
+    return build
+
+
+def _tenant_filter(model):
+    if model == models.IPAddress:
+        return _in_filter(model.used_by_tenant_id)
+    # NOTE: Looked up late, models without a tenant_id only fail when a
+    #       tenant is actually injected.
+    return lambda value: model.tenant_id.in_(value)
+
+
+class _FilterPlan(object):
+    """The filters _model_query knows for one model, compiled once.
+
+    builders maps every filter key usable on the model to a callable
+    turning a filter value into a clause. Keys missing from it are
+    silently dropped.
+    """
+    def __init__(self, model):
+        keys = set(_model_attrs(model))
+        # NOTE: When the filter key != attribute key, it must be added here.
+        if model == models.IPAddress:
+            keys.update(["tenant_id", "ip_address"])
+        if model in (models.IPAddress, models.MacAddress):
+            keys.add("reuse_after")
+
+        eq_filters = EQ_FILTERS
+        if model == models.SecurityGroupRule:
+            eq_filters += SG_RULE_EQ_FILTERS
+        special = {"_deallocated": _deallocated_filter,
+                   "ethertype": _ethertype_filter,
+                   "ip_address": _ip_address_filter,
+                   "protocol": _protocol_filter,
+                   "reuse_after": _reuse_after_filter}
+
+        self.builders = {}
+        for key in keys:
+            if key in IN_FILTERS:
+                self.builders[key] = _in_filter(getattr(model, key))
+            elif key in eq_filters:
+                self.builders[key] = _eq_filter(getattr(model, key))
+            elif key in special:
+                self.builders[key] = special[key](model)
+        self.accepts_tenant_id = "tenant_id" in keys
+        self.tenant_filter = _tenant_filter(model)
+
+
+_FILTER_PLANS = {}
+
+
+def _filter_plan(model):
+    # NOTE: Plans are built on first use rather than at import, when the
+    #       mappers may not all be configured yet.
+    plan = _FILTER_PLANS.get(model)
+    if plan is None:
+        plan = _FILTER_PLANS[model] = _FilterPlan(model)
+    return plan
+
+
 def _model_query(context, model, filters, fields=None):
     filters = filters or {}
+    plan = _filter_plan(model)
     model_filters = []
-    eq_filters = ["address", "cidr", "deallocated", "ip_version",
-                  "mac_address_range_id", "transaction_id"]
-    in_filters = ["device_id", "device_owner", "group_id", "id", "mac_address",
-                  "name", "network_id", "segment_id", "subnet_id",
-                  "used_by_tenant_id", "version"]
-
-    # Sanitize incoming filters to only attributes that exist in the model.
-    # NOTE: Filters for unusable attributes are silently dropped here.
-    # NOTE: When the filter key != attribute key, a conditional must be added
-    #       here.
-    model_attrs = _model_attrs(model)
-    filters = {x: y for x, y in filters.items()
-               if x in model_attrs or
-               (x == "tenant_id" and model == models.IPAddress) or
-               (x == "ip_address" and model == models.IPAddress) or
-               (x == "reuse_after" and model in (models.IPAddress,
-                                                 models.MacAddress))}
+
+    builders = plan.builders
+    for key, value in filters.items():
+        # This is mostly for unittests, as they're configured to send in None
+        if value is None or key == "tenant_id":
+            continue
+        builder = builders.get(key)
+        if builder is not None:
+            model_filters.append(builder(value))
 
     # Inject the tenant id if none is set. We don't need unqualified queries.
     # This works even when a non-shared, other-tenant owned network is passed
     # in because the authZ checks that happen in Neutron above us yank it back
     # out of the result set.
-    if not filters.get("tenant_id") and not context.is_admin:
-        filters["tenant_id"] = [context.tenant_id]
-
-    if model == models.SecurityGroupRule:
-        sg_rule_attribs = ["direction", "port_range_max", "port_range_min"]
-        eq_filters.extend(sg_rule_attribs)
-
-    for key, value in filters.items():
-        # This is mostly for unittests, as they're configured to send in None
-        if value is None:
-            continue
-        if key in in_filters:
-            model_type = getattr(model, key)
-            model_filters.append(model_type.in_(value))
-        elif key in eq_filters:
-            model_type = getattr(model, key)
-            model_filters.append(model_type == value)
-        elif key == "_deallocated":
-            if value:
-                model_filters.append(model._deallocated == 1)
-            else:
-                model_filters.append(model._deallocated != 1)
-        elif key == "ethertype":
-            etypes = []
-            for etype in value:
-                etypes.append(protocols.translate_ethertype(etype))
-            model_filters.append(model.ethertype.in_(etypes))
-        elif key == "ip_address":
-            model_filters.append(model.address.in_(
-                [ip.ipv6().value for ip in value]))
-        elif key == 'protocol':
-            pnums = []
-            for version in (protocols.PROTOCOLS_V4, protocols.PROTOCOLS_V6):
-                pnums.extend([y for x, y in version.items() if x in value])
-            model_filters.append(model.protocol.in_(pnums))
-        elif key == "reuse_after":
-            reuse = (timeutils.utcnow() -
-                     datetime.timedelta(seconds=value))
-            # NOTE(asadoughi): should this allow for deallocated_at = null?
-            model_filters.append(model.deallocated_at <= reuse)
-        elif key == "tenant_id":
-            if model == models.IPAddress:
-                model_filters.append(model.used_by_tenant_id.in_(value))
-            else:
-                model_filters.append(model.tenant_id.in_(value))
+    tenant_id = None
+    if plan.accepts_tenant_id:
+        tenant_id = filters.get("tenant_id")
+    if not tenant_id and not context.is_admin:
+        tenant_id = [context.tenant_id]
+    if tenant_id is not None:
+        model_filters.append(plan.tenant_filter(tenant_id))
 
     return model_filters
 
@@ -166,6 +250,11 @@ def scoped(f):
         _listify(kwargs)
 
         res = f(*args, **kwargs)
+        if isinstance(res, list):
+            # NOTE: Pages are loaded already, an empty one is still a page.
+            if scope == ONE:
+                return res[0] if res else None
+            return res
         if not res:
             return
         if "order_by" in kwargs:
@@ -183,11 +272,188 @@ def scoped(f):
     return wrapped
 
 
+def _use_keyset(limit, marker):
+    return CONF.QUARK.db_keyset_pagination and bool(limit or marker)
+
+
+def _keyset_sorts(sorts):
+    # NOTE: Directions are booleans for ascending like paginate_query's,
+    #       but the API also hands over 'asc' and 'desc'.
+    sorts = [(key, direction != "desc" and bool(direction))
+             for key, direction in sorts or [("created_at", True)]]
+    if "id" not in [key for key, _ in sorts]:
+        sorts.append(("id", sorts[-1][1]))
+    return sorts
+
+
+def _keyset_page(query, model, limit, sorts, marker):
+    """Returns the page of query after marker, seeking on the sort keys.
+
+    sorts are (key, ascending) pairs like paginate_query's, defaulting to
+    created_at, with id appended to break ties. The first key is also
+    bounded on its own so an index on the sort keys is range scanned from
+    the marker, however deep the page. marker is a model instance or id.
+    """
+    sorts = _keyset_sorts(sorts)
+    columns = [(getattr(model, key), ascending) for key, ascending in sorts]
+    query = query.order_by(*[asc(column) if ascending else desc(column)
+                             for column, ascending in columns])
+    if marker is not None:
+        if not isinstance(marker, model):
+            marker = query.session.query(model).get(marker)
+            if marker is None:
+                return []
+        values = [getattr(marker, key) for key, _ in sorts]
+        criteria = []
+        for i, (column, ascending) in enumerate(columns):
+            clause = [columns[j][0] == values[j] for j in xrange(i)]
+            if ascending:
+                clause.append(column > values[i])
+            else:
+                clause.append(column < values[i])
+            criteria.append(and_(*clause))
+        first, ascending = columns[0]
+        if ascending:
+            query = query.filter(first >= values[0])
+        else:
+            query = query.filter(first <= values[0])
+        query = query.filter(or_(*criteria))
+    if limit:
+        query = query.limit(limit)
+    return query.all()
+
+
+def _load_collection(context, parents, attr, *options):
+    """Loads the collection attr of every parent with one IN query.
+
+    Stands in for a joinedload on keyset pages, where joining the
+    collection would multiply the rows the LIMIT counts. options apply to
+    the query of the children. Collections that are loaded already are
+    left alone.
+    """
+    key = attr.property.key
+    parents = [parent for parent in parents
+               if key in sa_inspect(parent).unloaded]
+    if not parents:
+        return
+    prop = attr.property
+    local, remote = prop.synchronize_pairs[0]
+    children = dict((getattr(parent, local.key), []) for parent in parents)
+
+    # NOTE: Loaded on the session the parents came from, which may be
+    #       the replica's.
+    query = orm.object_session(parents[0]).query(remote, prop.mapper.class_)
+    if prop.secondary is not None:
+        query = query.filter(prop.secondaryjoin)
+    query = query.filter(remote.in_(children.keys())).options(*options)
+    if prop.order_by:
+        query = query.order_by(*prop.order_by)
+    for parent_id, child in query:
+        children[parent_id].append(child)
+
+    for parent in parents:
+        orm.attributes.set_committed_value(
+            parent, key, children[getattr(parent, local.key)])
+
+
+def _unique(objs):
+    unique = []
+    seen = set()
+    for obj in objs:
+        if obj is not None and id(obj) not in seen:
+            seen.add(id(obj))
+            unique.append(obj)
+    return unique
+
+
+def _load_related(context, parents, attr):
+    """Loads the many-to-one attr of every parent with one IN query.
+
+    A row shared by many parents is loaded once. Returns the distinct
+    related rows of all the parents.
+    """
+    key = attr.property.key
+    unloaded = [parent for parent in parents
+                if key in sa_inspect(parent).unloaded]
+    local, remote = attr.property.local_remote_pairs[0]
+    ids = set(getattr(parent, local.key) for parent in unloaded)
+    ids.discard(None)
+    related = {}
+    if ids:
+        query = orm.object_session(unloaded[0]).query(
+            attr.property.mapper.class_)
+        related = dict((getattr(row, remote.key), row)
+                       for row in query.filter(remote.in_(ids)))
+    for parent in unloaded:
+        orm.attributes.set_committed_value(
+            parent, key, related.get(getattr(parent, local.key)))
+    return _unique(getattr(parent, key) for parent in parents)
+
+
+# NOTE: Attributes of the views built from columns named otherwise.
+FIELD_COLUMNS = {
+    models.Subnet: {"cidr": ("_cidr",),
+                    "shared": ("network_id",),
+                    "allocation_pools": ("_allocation_pool_cache", "_cidr",
+                                         "ip_policy_id")}}
+
+
+def _load_only(query, model, requested):
+    """Loads only the columns of model the requested attributes need."""
+    if requested is None:
+        return query
+    columns = set(["id"])
+    column_attrs = [attr.key for attr in class_mapper(model).column_attrs]
+    renamed = FIELD_COLUMNS.get(model, {})
+    for field in requested:
+        if field in column_attrs:
+            columns.add(field)
+        columns.update(renamed.get(field, ()))
+    return query.options(orm.load_only(*columns))
+
+
+def _load_port_relations(context, ports, fields=None,
+                         join_security_groups=False):
+    """Loads what building the dicts of ports needs, one query per relation.
+
+    Joining the relations instead returns a row for every combination of
+    address, route and nameserver of every port. Subnets shared by the
+    addresses of the ports are loaded once, along with their routes and
+    nameservers. Relations the fields don't ask for aren't loaded.
+    """
+    requested = utils.requested_fields(fields)
+    if (join_security_groups and
+            utils.field_requested(requested, "security_groups")):
+        _load_collection(context, ports, models.Port.security_groups)
+    if not utils.field_requested(requested, "fixed_ips"):
+        return
+    _load_collection(context, ports, models.Port.ip_addresses)
+    addresses = _unique(address for port in ports
+                        for address in port.ip_addresses)
+    _load_collection(context, addresses, models.IPAddress.associations)
+    if fields and "port_subnets" in fields:
+        subnets = _load_related(context, addresses, models.IPAddress.subnet)
+        _load_collection(context, subnets, models.Subnet.dns_nameservers)
+        _load_collection(context, subnets, models.Subnet.routes)
+
+
 @scoped
 def port_find(context, limit=None, sorts=None, marker_obj=None, fields=None,
               **filters):
-    query = context.session.query(models.Port).options(
-        orm.joinedload(models.Port.ip_addresses))
+    if _use_keyset(limit, marker_obj):
+        return _port_find_page(context, limit, sorts, marker_obj, fields,
+                               **filters)
+    query = replica.get_session(context).query(models.Port)
+    query = _load_only(query, models.Port, utils.requested_fields(fields))
+    model_filters = _port_filters(context, filters)
+    ports = paginate_query(query.filter(*model_filters), models.Port, limit,
+                           sorts, marker_obj).all()
+    _load_port_relations(context, ports, fields,
+                         "join_security_groups" in filters)
+    return ports
+
+
+def _port_filters(context, filters):
     model_filters = _model_query(context, models.Port, filters)
     if filters.get("ip_address_id"):
         model_filters.append(models.Port.ip_addresses.any(
@@ -195,30 +461,30 @@ def port_find(context, limit=None, sorts=None, marker_obj=None, fields=None,
 
     if filters.get("device_id"):
         model_filters.append(models.Port.device_id.in_(filters["device_id"]))
+    return model_filters
 
-    if "join_security_groups" in filters:
-        query = query.options(orm.joinedload(models.Port.security_groups))
 
-    if fields and "port_subnets" in fields:
-        query = query.options(orm.joinedload("ip_addresses.subnet"))
-        query = query.options(
-            orm.joinedload("ip_addresses.subnet.dns_nameservers"))
-        query = query.options(
-            orm.joinedload("ip_addresses.subnet.routes"))
-    return paginate_query(query.filter(*model_filters), models.Port, limit,
-                          sorts, marker_obj)
+def _port_find_page(context, limit, sorts, marker, fields, **filters):
+    query = replica.get_session(context).query(models.Port)
+    query = _load_only(query, models.Port, utils.requested_fields(fields))
+    ports = _keyset_page(query.filter(*_port_filters(context, filters)),
+                         models.Port, limit, sorts, marker)
+    _load_port_relations(context, ports, fields,
+                         "join_security_groups" in filters)
+    return ports
 
 
 @scoped
 def port_find_by_ip_address(context, **filters):
-    query = context.session.query(models.IPAddress).options(
+    query = replica.get_session(context).query(models.IPAddress).options(
         orm.joinedload(models.IPAddress.ports))
     model_filters = _model_query(context, models.IPAddress, filters)
     return query.filter(*model_filters)
 
 
 def port_count_all(context, **filters):
-    query = context.session.query(sql_func.count(models.Port.id))
+    query = replica.get_session(context).query(
+        sql_func.count(models.Port.id))
     model_filters = _model_query(context, models.Port, filters)
     return query.filter(*model_filters).scalar()
 
@@ -277,7 +543,14 @@ def port_delete(context, port):
 
 
 def ip_address_update(context, address, **kwargs):
+    was_deallocated = bool(address["_deallocated"])
     address.update(kwargs)
+    is_deallocated = bool(address["_deallocated"])
+    if was_deallocated != is_deallocated:
+        delta = 1 if is_deallocated else -1
+        subnet_update_ip_counts(context, address["subnet_id"],
+                                allocated=-delta, deallocated=delta,
+                                ip_version=address["version"])
     context.session.add(address)
     return address
 
@@ -292,12 +565,62 @@ def ip_address_create(context, **address_dict):
     ip_address["_deallocated"] = 0
     ip_address["allocated_at"] = timeutils.utcnow()
     context.session.add(ip_address)
+    subnet_update_ip_counts(context, ip_address["subnet_id"], allocated=1,
+                            ip_version=ip_address["version"])
     return ip_address
 
 
+def ip_address_create_bulk(context, addresses, subnet, **address_dict):
+    """Inserts an allocated address in subnet for each of addresses.
+
+    The rows go in with a single executemany and are read back with one
+    query, in the order given.
+    """
+    if not addresses:
+        return []
+    now = timeutils.utcnow()
+    rows = []
+    for address in addresses:
+        row = dict(address_dict)
+        row.update(id=uuidutils.generate_uuid(),
+                   address=int(address.ipv6()),
+                   address_readable=str(address),
+                   subnet_id=subnet["id"],
+                   network_id=subnet["network_id"],
+                   version=subnet["ip_version"],
+                   used_by_tenant_id=context.tenant_id,
+                   _deallocated=False,
+                   allocated_at=now)
+        rows.append(row)
+    context.session.execute(models.IPAddress.__table__.insert(), rows)
+    subnet_update_ip_counts(context, subnet["id"], allocated=len(rows),
+                            ip_version=subnet["ip_version"])
+
+    query = context.session.query(models.IPAddress)
+    query = query.filter(models.IPAddress.id.in_([r["id"] for r in rows]))
+    created = dict((address["id"], address) for address in query)
+    return [created[row["id"]] for row in rows]
+
+
+def ip_address_find_taken(context, subnet_id, addresses):
+    """Returns which of addresses already exist in the subnet.
+
+    The result holds the addresses' v6 integers, as they are stored.
+    """
+    if not addresses:
+        return set()
+    query = context.session.query(models.IPAddress.address)
+    query = query.filter(models.IPAddress.subnet_id == subnet_id)
+    query = query.filter(models.IPAddress.address.in_(
+        [int(address.ipv6()) for address in addresses]))
+    return set(int(address) for (address,) in query)
+
+
 @scoped
 def ip_address_find(context, lock_mode=False, **filters):
-    query = context.session.query(models.IPAddress)
+    # NOTE: Rows are only locked on the database.
+    session = context.session if lock_mode else replica.get_session(context)
+    query = session.query(models.IPAddress)
 
     if lock_mode:
         query = query.with_lockmode("update")
@@ -319,6 +642,112 @@ def ip_address_find(context, lock_mode=False, **filters):
     return query.filter(*model_filters)
 
 
+def ip_address_delete(context, address):
+    if address["_deallocated"]:
+        subnet_update_ip_counts(context, address["subnet_id"], deallocated=-1,
+                                ip_version=address["version"])
+    else:
+        subnet_update_ip_counts(context, address["subnet_id"], allocated=-1,
+                                ip_version=address["version"])
+    context.session.delete(address)
+
+
+def ip_address_port_counts(context, addresses):
+    """Counts the ports associated with each of addresses by id.
+
+    Addresses whose ports are already loaded are counted in memory, the
+    rest with a single grouped query instead of a lazy load apiece.
+    """
+    counts = {}
+    unloaded = []
+    for address in addresses:
+        if "ports" in orm.attributes.instance_state(address).unloaded:
+            unloaded.append(address["id"])
+        else:
+            counts[address["id"]] = len(address["ports"])
+    if unloaded:
+        assoc = models.port_ip_association_table
+        query = context.session.query(assoc.c.ip_address_id,
+                                      sql_func.count(assoc.c.port_id))
+        query = query.filter(assoc.c.ip_address_id.in_(unloaded))
+        query = query.group_by(assoc.c.ip_address_id)
+        counts.update(dict.fromkeys(unloaded, 0))
+        counts.update(dict(query.all()))
+    return counts
+
+
+def ip_address_deallocate_bulk(context, addresses):
+    """Marks addresses deallocated with a single UPDATE.
+
+    The subnet counters are shifted once per subnet, and the addresses in
+    the session are brought up to date without being flushed again.
+    """
+    if not addresses:
+        return 0
+    values = {"_deallocated": True,
+              "deallocated_at": timeutils.utcnow(),
+              "allocated_at": None,
+              "address_type": None}
+    query = context.session.query(models.IPAddress)
+    query = query.filter(models.IPAddress.id.in_(
+        [address["id"] for address in addresses]))
+    count = query.update(values, synchronize_session=False)
+
+    flipped = {}
+    for address in addresses:
+        if not address["_deallocated"]:
+            key = (address["subnet_id"], address["version"])
+            flipped[key] = flipped.get(key, 0) + 1
+        for key, value in values.items():
+            orm.attributes.set_committed_value(address, key, value)
+    for (subnet_id, ip_version), flips in flipped.items():
+        subnet_update_ip_counts(context, subnet_id, allocated=-flips,
+                                deallocated=flips, ip_version=ip_version)
+    return count
+
+
+def _ip_address_unassociated():
+    assoc = models.port_ip_association_table
+    return ~models.IPAddress.id.in_(sa_select([assoc.c.ip_address_id]))
+
+
+def ip_address_reap_candidates(context, subnet_id, limit, marker=None):
+    """Returns (id, address) of deallocated, unassociated addresses.
+
+    Rows are ordered by id and start after marker, so a subnet can be
+    walked a batch at a time without holding any locks in between.
+    """
+    query = context.session.query(models.IPAddress.id,
+                                  models.IPAddress.address)
+    query = query.filter(models.IPAddress.subnet_id == subnet_id,
+                         models.IPAddress._deallocated == 1,
+                         _ip_address_unassociated())
+    if marker:
+        query = query.filter(models.IPAddress.id > marker)
+    query = query.order_by(asc(models.IPAddress.id)).limit(limit)
+    return [(row[0], int(row[1])) for row in query.all()]
+
+
+def ip_address_reap(context, subnet_id, address_ids, ip_version=None):
+    """Deletes the given addresses if they are still deallocated.
+
+    Rows reallocated or associated with a port since they were picked are
+    left alone. Returns the number deleted, which is taken off the subnet's
+    deallocated counter.
+    """
+    if not address_ids:
+        return 0
+    query = context.session.query(models.IPAddress)
+    query = query.filter(models.IPAddress.id.in_(address_ids),
+                         models.IPAddress.subnet_id == subnet_id,
+                         models.IPAddress._deallocated == 1,
+                         _ip_address_unassociated())
+    count = query.delete(synchronize_session=False)
+    subnet_update_ip_counts(context, subnet_id, deallocated=-count,
+                            ip_version=ip_version)
+    return count
+
+
 @scoped
 def ip_address_reallocate(context, update_kwargs, **filters):
     LOG.debug("ip_address_reallocate %s", filters)
@@ -330,16 +759,90 @@ def ip_address_reallocate(context, update_kwargs, **filters):
     return row_count == 1
 
 
-def ip_address_reallocate_find(context, transaction_id):
+def ip_address_reallocate_find(context, transaction_id=None,
+                               claim_token=None):
     address = ip_address_find(context, transaction_id=transaction_id,
-                              scope=ONE)
+                              claim_token=claim_token, scope=ONE)
     if not address:
-        LOG.warn("Couldn't find IP address with transaction_id %s",
-                 transaction_id)
+        LOG.warn("Couldn't find IP address with transaction_id %s or "
+                 "claim_token %s", transaction_id, claim_token)
         return
+    return _ip_address_reallocate_check(context, address)
+
+
+def ip_address_reallocate_candidates(context, limit, skip_locked=False,
+                                     **filters):
+    """Returns ids of the longest deallocated addresses matching filters.
+
+    With skip_locked the rows are locked FOR UPDATE SKIP LOCKED, so they
+    belong to the caller's transaction and concurrent callers get
+    disjoint sets. Otherwise nothing is locked and the caller is expected
+    to claim them with ip_address_reallocate_claim.
+    """
+    query = context.session.query(models.IPAddress.id)
+    model_filters = _model_query(context, models.IPAddress, filters)
+    query = query.filter(*model_filters)
+    query = query.order_by(asc(models.IPAddress.deallocated_at)).limit(limit)
+    if skip_locked:
+        statement = quark_sa.skip_locked(query.statement)
+        return [row[0] for row in context.session.execute(statement)]
+    return [row[0] for row in query.all()]
+
+
+def ip_address_reallocate_claim(context, address_id, update_kwargs,
+                                **filters):
+    """Claims one candidate if it still matches filters.
 
+    This is a compare-and-swap on the reallocation filters: of several
+    workers racing for the same id exactly one sees a row count of 1.
+    """
+    query = context.session.query(models.IPAddress)
+    model_filters = _model_query(context, models.IPAddress, filters)
+    query = query.filter(models.IPAddress.id == address_id, *model_filters)
+    return quark_sa.update(query, update_kwargs) == 1
+
+
+def ip_address_reallocate_bulk(context, count, claim_token, update_kwargs,
+                               **filters):
+    """Claims up to count of the longest deallocated matches at once.
+
+    The candidates are read first so the UPDATE is bounded on every
+    database, then claimed and tagged with claim_token in one statement
+    and read back by it. Returns the claimed addresses that pass the same
+    checks as ip_address_reallocate_find.
+    """
+    candidates = ip_address_reallocate_candidates(context, count, **filters)
+    if not candidates:
+        return []
+    update_kwargs = dict(update_kwargs)
+    update_kwargs[models.IPAddress.claim_token] = claim_token
+    query = context.session.query(models.IPAddress)
+    model_filters = _model_query(context, models.IPAddress, filters)
+    query = query.filter(models.IPAddress.id.in_(candidates),
+                         *model_filters)
+    if not quark_sa.update(query, update_kwargs):
+        return []
+    addresses = ip_address_find(context, claim_token=claim_token,
+                                scope=ALL)
+    return [address for address in addresses
+            if _ip_address_reallocate_check(context, address)]
+
+
+def ip_address_reallocate_claimed(context, address_id):
+    address = ip_address_find(context, id=address_id, scope=ONE)
+    if not address:
+        LOG.warn("Couldn't find claimed IP address %s", address_id)
+        return
+    return _ip_address_reallocate_check(context, address)
+
+
+def _ip_address_reallocate_check(context, address):
     LOG.info("Potentially reallocatable IP found: "
              "{0}".format(address["address_readable"]))
+    # NOTE: Reallocation only ever claims deallocated rows, and the
+    #       claimed row now counts as allocated whatever happens below.
+    subnet_update_ip_counts(context, address["subnet_id"], allocated=1,
+                            deallocated=-1, ip_version=address["version"])
     subnet = address.get('subnet')
     if not subnet:
         LOG.debug("No subnet associated with address")
@@ -356,12 +859,11 @@ def ip_address_reallocate_find(context, transaction_id):
 
     # TODO(amir): performance test replacing this with SQL in
     #             ip_address_reallocate's UPDATE statement
-    policy = models.IPPolicy.get_ip_policy_cidrs(subnet)
-    if policy is not None and addr in policy:
+    if addr in ip_policy_index.for_subnet(subnet):
         LOG.info("Deleting Address {0} due to policy "
                  "violation".format(
                      address["address_readable"]))
-        context.session.delete(address)
+        ip_address_delete(context, address)
         return
 
     # TODO(amir): performance test replacing this with SQL in
@@ -371,7 +873,7 @@ def ip_address_reallocate_find(context, transaction_id):
         LOG.info("Address {0} isn't in the subnet "
                  "it claims to be in".format(
                      address["address_readable"]))
-        context.session.delete(address)
+        ip_address_delete(context, address)
         return
 
     return address
@@ -379,7 +881,9 @@ def ip_address_reallocate_find(context, transaction_id):
 
 @scoped
 def mac_address_find(context, lock_mode=False, **filters):
-    query = context.session.query(models.MacAddress)
+    # NOTE: Rows are only locked on the database.
+    session = context.session if lock_mode else replica.get_session(context)
+    query = session.query(models.MacAddress)
     if lock_mode:
         query = query.with_lockmode("update")
     model_filters = _model_query(context, models.MacAddress, filters)
@@ -387,6 +891,12 @@ def mac_address_find(context, lock_mode=False, **filters):
 
 
 def mac_address_delete(context, mac_address):
+    if mac_address["deallocated"]:
+        mac_range_update_counts(context, mac_address["mac_address_range_id"],
+                                deallocated=-1)
+    else:
+        mac_range_update_counts(context, mac_address["mac_address_range_id"],
+                                allocated=-1)
     context.session.delete(mac_address)
 
 
@@ -402,14 +912,80 @@ def mac_address_reallocate(context, update_kwargs, **filters):
     return row_count == 1
 
 
-def mac_address_reallocate_find(context, transaction_id):
+def mac_address_reallocate_find(context, transaction_id=None,
+                                claim_token=None):
     mac = mac_address_find(context, transaction_id=transaction_id,
-                           scope=ONE)
+                           claim_token=claim_token, scope=ONE)
     if not mac:
-        LOG.warn("Couldn't find MAC address with transaction_id %s",
-                 transaction_id)
+        LOG.warn("Couldn't find MAC address with transaction_id %s or "
+                 "claim_token %s", transaction_id, claim_token)
         return
 
+    return _mac_address_reallocate_check(context, mac)
+
+
+def mac_address_reallocate_candidates(context, limit, skip_locked=False,
+                                      **filters):
+    """Returns the longest deallocated MAC addresses matching filters.
+
+    See ip_address_reallocate_candidates.
+    """
+    query = context.session.query(models.MacAddress.address)
+    model_filters = _model_query(context, models.MacAddress, filters)
+    query = query.filter(*model_filters)
+    query = query.order_by(asc(models.MacAddress.deallocated_at)).limit(limit)
+    if skip_locked:
+        statement = quark_sa.skip_locked(query.statement)
+        return [row[0] for row in context.session.execute(statement)]
+    return [row[0] for row in query.all()]
+
+
+def mac_address_reallocate_claim(context, address, update_kwargs, **filters):
+    """Claims one candidate MAC if it still matches filters.
+
+    See ip_address_reallocate_claim.
+    """
+    query = context.session.query(models.MacAddress)
+    model_filters = _model_query(context, models.MacAddress, filters)
+    query = query.filter(models.MacAddress.address == address,
+                         *model_filters)
+    return quark_sa.update(query, update_kwargs) == 1
+
+
+def mac_address_reallocate_claimed(context, address):
+    mac = mac_address_find(context, address=address, scope=ONE)
+    if not mac:
+        LOG.warn("Couldn't find claimed MAC address %s", address)
+        return
+    return _mac_address_reallocate_check(context, mac)
+
+
+def mac_address_reallocate_bulk(context, count, claim_token, update_kwargs,
+                                **filters):
+    """Claims up to count of the longest deallocated MACs at once.
+
+    See ip_address_reallocate_bulk.
+    """
+    candidates = mac_address_reallocate_candidates(context, count, **filters)
+    if not candidates:
+        return []
+    update_kwargs = dict(update_kwargs, claim_token=claim_token)
+    query = context.session.query(models.MacAddress)
+    model_filters = _model_query(context, models.MacAddress, filters)
+    query = query.filter(models.MacAddress.address.in_(candidates),
+                         *model_filters)
+    if not quark_sa.update(query, update_kwargs):
+        return []
+    macs = mac_address_find(context, claim_token=claim_token, scope=ALL)
+    return [mac for mac in macs
+            if _mac_address_reallocate_check(context, mac)]
+
+
+def _mac_address_reallocate_check(context, mac):
+    # NOTE: As with IPs, the claimed row now counts as allocated whatever
+    #       happens below.
+    mac_range_update_counts(context, mac["mac_address_range_id"],
+                            allocated=1, deallocated=-1)
     # NOTE(mdietz): This is a HACK. Please see RM11043 for details
     if mac["mac_address_range"] and mac["mac_address_range"]["do_not_use"]:
         mac_address_delete(context, mac)
@@ -423,11 +999,15 @@ def mac_address_reallocate_find(context, transaction_id):
 
 def mac_address_range_find_allocation_counts(context, address=None,
                                              use_forbidden_mac_range=False):
-    count = sql_func.count(models.MacAddress.address)
+    """Finds and locks the fullest MAC range that isn't marked full.
+
+    Returns a (range, count) pair, where count is the number of MACs ever
+    generated in the range, read from its denormalized counters.
+    """
+    count = (models.MacAddressRange.allocated_count +
+             models.MacAddressRange.deallocated_count).label("count")
     query = context.session.query(models.MacAddressRange,
-                                  count.label("count")).with_lockmode("update")
-    query = query.outerjoin(models.MacAddress)
-    query = query.group_by(models.MacAddressRange.id)
+                                  count).with_lockmode("update")
     query = query.order_by(desc(count))
     if address:
         query = query.filter(models.MacAddressRange.last_address >= address)
@@ -439,9 +1019,25 @@ def mac_address_range_find_allocation_counts(context, address=None,
     return query.first()
 
 
+def mac_address_range_find_for_lease(context, use_forbidden_mac_range=False):
+    """Finds and locks the MAC range to reserve a block of new MACs from.
+
+    Unlike mac_address_range_find_allocation_counts this doesn't count the
+    range's MACs, next_auto_assign_mac alone tells how far it has filled.
+    """
+    query = context.session.query(models.MacAddressRange)
+    query = query.with_lockmode("update")
+    query = query.filter(models.MacAddressRange.next_auto_assign_mac != -1)
+    if not use_forbidden_mac_range:
+        query = query.filter(models.MacAddressRange.do_not_use == '0')  # noqa
+    query = query.order_by(desc(models.MacAddressRange.next_auto_assign_mac -
+                                models.MacAddressRange.first_address))
+    return query.first()
+
+
 @scoped
 def mac_address_range_find(context, **filters):
-    query = context.session.query(models.MacAddressRange)
+    query = replica.get_session(context).query(models.MacAddressRange)
     model_filters = _model_query(context, models.MacAddressRange, filters)
     return query.filter(*model_filters)
 
@@ -463,7 +1059,7 @@ def mac_address_range_update(context, mac_range, **kwargs):
     return mac_range
 
 
-def mac_range_update_next_auto_assign_mac(context, mac_range):
+def mac_range_update_next_auto_assign_mac(context, mac_range, count=1):
     query = context.session.query(models.MacAddressRange)
     query = query.filter(models.MacAddressRange.id == mac_range["id"])
     query = query.filter(models.MacAddressRange.next_auto_assign_mac != -1)
@@ -472,13 +1068,29 @@ def mac_range_update_next_auto_assign_mac(context, mac_range):
     # http://docs.sqlalchemy.org/en/rel_0_8/orm/query.html
     query = query.update(
         {"next_auto_assign_mac":
-         models.MacAddressRange.next_auto_assign_mac + 1},
+         models.MacAddressRange.next_auto_assign_mac + count},
         synchronize_session=False)
 
     # Returns a count of the rows matched in the update
     return query
 
 
+def mac_range_return_next_auto_assign_mac(context, mac_range_id, leased_to,
+                                          returned_from):
+    """Rewinds next_auto_assign_mac if nobody has advanced it since a lease.
+
+    See subnet_return_next_auto_assign_ip.
+    """
+    query = context.session.query(models.MacAddressRange)
+    query = query.filter(models.MacAddressRange.id == mac_range_id)
+    query = query.filter(
+        models.MacAddressRange.next_auto_assign_mac == leased_to + 1)
+    query = query.update(
+        {"next_auto_assign_mac": returned_from},
+        synchronize_session=False)
+    return query
+
+
 def mac_range_update_set_full(context, mac_range):
     query = context.session.query(models.MacAddressRange)
     query = query.filter_by(id=mac_range["id"])
@@ -494,8 +1106,72 @@ def mac_range_update_set_full(context, mac_range):
     return query
 
 
+def mac_range_update_counts(context, mac_range_id, allocated=0,
+                            deallocated=0):
+    if not mac_range_id or not (allocated or deallocated):
+        return 0
+    values = {}
+    if allocated:
+        values["allocated_count"] = (
+            models.MacAddressRange.allocated_count + allocated)
+    if deallocated:
+        values["deallocated_count"] = (
+            models.MacAddressRange.deallocated_count + deallocated)
+    query = context.session.query(models.MacAddressRange)
+    query = query.filter(models.MacAddressRange.id == mac_range_id)
+    return query.update(values, synchronize_session=False)
+
+
+def mac_range_count_macs(context, mac_range_ids=None):
+    """Counts generated MACs per range straight from quark_mac_addresses.
+
+    Returns a dict of mac_address_range_id -> (allocated, deallocated).
+    """
+    range_id = models.MacAddress.mac_address_range_id
+    deallocated = models.MacAddress.deallocated
+    query = context.session.query(range_id, deallocated,
+                                  sql_func.count(models.MacAddress.address))
+    if mac_range_ids is not None:
+        query = query.filter(range_id.in_(mac_range_ids))
+    query = query.group_by(range_id, deallocated)
+
+    counts = {}
+    for mac_range_id, is_deallocated, count in query.all():
+        allocated_count, deallocated_count = counts.get(mac_range_id, (0, 0))
+        if is_deallocated:
+            deallocated_count += count
+        else:
+            allocated_count += count
+        counts[mac_range_id] = (allocated_count, deallocated_count)
+    return counts
+
+
+def mac_range_repair_counts(context, mac_range_id):
+    """Recounts a MAC range's MACs under its row lock and stores the result.
+
+    Returns the (allocated, deallocated) pair that was stored, or None if
+    the range no longer exists.
+    """
+    query = context.session.query(models.MacAddressRange)
+    query = query.with_lockmode("update")
+    mac_range = query.filter(models.MacAddressRange.id == mac_range_id).first()
+    if not mac_range:
+        return None
+    counts = mac_range_count_macs(context, [mac_range_id]).get(mac_range_id,
+                                                               (0, 0))
+    mac_range["allocated_count"], mac_range["deallocated_count"] = counts
+    context.session.add(mac_range)
+    return counts
+
+
 def mac_address_update(context, mac, **kwargs):
+    was_deallocated = bool(mac["deallocated"])
     mac.update(kwargs)
+    is_deallocated = bool(mac["deallocated"])
+    if was_deallocated != is_deallocated:
+        delta = 1 if is_deallocated else -1
+        mac_range_update_counts(context, mac["mac_address_range_id"],
+                                allocated=-delta, deallocated=delta)
     context.session.add(mac)
     return mac
 
@@ -507,9 +1183,43 @@ def mac_address_create(context, **mac_dict):
     mac_address["deallocated"] = False
     mac_address["deallocated_at"] = None
     context.session.add(mac_address)
+    mac_range_update_counts(context, mac_address["mac_address_range_id"],
+                            allocated=1)
     return mac_address
 
 
+def mac_address_create_bulk(context, addresses, mac_address_range_id):
+    """Inserts a MAC in the range for each of addresses.
+
+    The rows go in with a single executemany and are read back with one
+    query, in the order given.
+    """
+    if not addresses:
+        return []
+    rows = [dict(address=address,
+                 mac_address_range_id=mac_address_range_id,
+                 tenant_id=context.tenant_id,
+                 deallocated=False,
+                 deallocated_at=None) for address in addresses]
+    context.session.execute(models.MacAddress.__table__.insert(), rows)
+    mac_range_update_counts(context, mac_address_range_id,
+                            allocated=len(rows))
+
+    query = context.session.query(models.MacAddress)
+    query = query.filter(models.MacAddress.address.in_(addresses))
+    created = dict((mac["address"], mac) for mac in query)
+    return [created[address] for address in addresses]
+
+
+def mac_address_find_taken(context, addresses):
+    """Returns which of addresses already exist."""
+    if not addresses:
+        return set()
+    query = context.session.query(models.MacAddress.address)
+    query = query.filter(models.MacAddress.address.in_(addresses))
+    return set(address for (address,) in query)
+
+
 INVERT_DEFAULTS = 'invert_defaults'
 
 
@@ -542,8 +1252,12 @@ def network_find(context, limit=None, sorts=None, marker=None,
 
 def _network_find(context, limit, sorts, marker, page_reverse, fields,
                   defaults=None, **filters):
-    query = context.session.query(models.Network)
+    requested = utils.requested_fields(fields)
+    query = replica.get_session(context).query(models.Network)
+    query = _load_only(query, models.Network, requested)
     model_filters = _model_query(context, models.Network, filters, query)
+    join_subnets = ("join_subnets" in filters and
+                    utils.field_requested(requested, "subnets"))
 
     if defaults:
         invert_defaults = False
@@ -562,7 +1276,13 @@ def _network_find(context, limit, sorts, marker, page_reverse, fields,
     else:
         query = query.filter(*model_filters)
 
-    if "join_subnets" in filters:
+    if _use_keyset(limit, marker):
+        nets = _keyset_page(query, models.Network, limit, sorts, marker)
+        if join_subnets:
+            _load_collection(context, nets, models.Network.subnets)
+        return nets
+
+    if join_subnets:
         query = query.options(orm.joinedload(models.Network.subnets))
 
     return paginate_query(query, models.Network, limit, sorts, marker)
@@ -582,7 +1302,8 @@ def network_update(context, network, **kwargs):
 
 
 def network_count_all(context):
-    query = context.session.query(sql_func.count(models.Network.id))
+    query = replica.get_session(context).query(
+        sql_func.count(models.Network.id))
     return query.filter(
         models.Network.tenant_id == context.tenant_id).scalar()
 
@@ -591,13 +1312,15 @@ def network_delete(context, network):
     context.session.delete(network)
 
 
-def subnet_find_ordered_by_most_full(context, net_id, **filters):
-    count = sql_func.count(models.IPAddress.address).label("count")
+def subnet_find_ordered_by_most_full(context, net_id, lock_mode=True,
+                                     **filters):
+    count = (models.Subnet.allocated_count +
+             models.Subnet.deallocated_reusable_count).label("count")
     size = (models.Subnet.last_ip - models.Subnet.first_ip)
-    query = context.session.query(models.Subnet, count).with_lockmode('update')
+    query = context.session.query(models.Subnet, count)
+    if lock_mode:
+        query = query.with_lockmode('update')
     query = query.filter_by(do_not_use=False)
-    query = query.outerjoin(models.Subnet.generated_ips)
-    query = query.group_by(models.Subnet.id)
     query = query.order_by(
         asc(models.Subnet.ip_version),
         asc(size - count))
@@ -614,7 +1337,19 @@ def subnet_find_ordered_by_most_full(context, net_id, **filters):
     return query
 
 
-def subnet_update_next_auto_assign_ip(context, subnet):
+def subnet_lock(context, subnet):
+    """Locks a subnet that isn't full and reloads it.
+
+    Returns None if the subnet has been marked full since it was read.
+    """
+    query = context.session.query(models.Subnet).with_lockmode('update')
+    query = query.populate_existing()
+    query = query.filter(models.Subnet.id == subnet["id"])
+    query = query.filter(models.Subnet.next_auto_assign_ip != -1)
+    return query.first()
+
+
+def subnet_update_next_auto_assign_ip(context, subnet, count=1):
     query = context.session.query(models.Subnet)
     query = query.filter(models.Subnet.id == subnet["id"])
     query = query.filter(models.Subnet.next_auto_assign_ip != -1)
@@ -623,13 +1358,40 @@ def subnet_update_next_auto_assign_ip(context, subnet):
     # http://docs.sqlalchemy.org/en/rel_0_8/orm/query.html
     query = query.update(
         {"next_auto_assign_ip":
-         models.Subnet.next_auto_assign_ip + 1},
+         models.Subnet.next_auto_assign_ip + count},
         synchronize_session=False)
 
     # Returns a count of the rows matched in the update
     return query
 
 
+def subnet_update_next_auto_assign_ip_past(context, subnet, ip):
+    """Moves next_auto_assign_ip just past ip, unless it already is."""
+    query = context.session.query(models.Subnet)
+    query = query.filter(models.Subnet.id == subnet["id"])
+    query = query.filter(models.Subnet.next_auto_assign_ip != -1)
+    query = query.filter(models.Subnet.next_auto_assign_ip <= ip)
+    query = query.update({"next_auto_assign_ip": ip + 1},
+                         synchronize_session=False)
+    return query
+
+
+def subnet_return_next_auto_assign_ip(context, subnet_id, leased_to,
+                                      returned_from):
+    """Rewinds next_auto_assign_ip if nobody has advanced it since a lease.
+
+    Only succeeds when next_auto_assign_ip still points just past the
+    leased block, i.e. no other worker leased or allocated after us.
+    """
+    query = context.session.query(models.Subnet)
+    query = query.filter(models.Subnet.id == subnet_id)
+    query = query.filter(models.Subnet.next_auto_assign_ip == leased_to + 1)
+    query = query.update(
+        {"next_auto_assign_ip": returned_from},
+        synchronize_session=False)
+    return query
+
+
 def subnet_update_set_full(context, subnet):
     query = context.session.query(models.Subnet)
     query = query.filter_by(id=subnet["id"])
@@ -645,9 +1407,112 @@ def subnet_update_set_full(context, subnet):
     return query
 
 
+def subnet_update_ip_counts(context, subnet_id, allocated=0, deallocated=0,
+                            ip_version=None):
+    """Queues a change to a subnet's IP counters.
+
+    The changes queued in a session are applied just before its
+    transaction commits, with one UPDATE per subnet in subnet_id order, so
+    the subnet rows are locked briefly and always in the same order.
+    Outside a transaction the change is written at once. v6 subnets aren't
+    counted, so v6 allocations never lock the subnet row.
+    """
+    if not subnet_id or ip_version == 6 or not (allocated or deallocated):
+        return
+    session = context.session
+    if session.transaction is None:
+        _update_ip_counts(session, subnet_id, allocated, deallocated)
+        return
+    pending = session.info.setdefault(PENDING_IP_COUNTS, {})
+    counts = pending.setdefault(subnet_id, [0, 0])
+    counts[0] += allocated
+    counts[1] += deallocated
+
+
+def _update_ip_counts(session, subnet_id, allocated, deallocated):
+    values = {}
+    if allocated:
+        values["allocated_count"] = models.Subnet.allocated_count + allocated
+    if deallocated:
+        values["deallocated_reusable_count"] = (
+            models.Subnet.deallocated_reusable_count + deallocated)
+    if not values:
+        return
+    query = session.query(models.Subnet)
+    query = query.filter(models.Subnet.id == subnet_id)
+    query.update(values, synchronize_session=False)
+
+
+def _apply_ip_counts(session):
+    pending = session.info.pop(PENDING_IP_COUNTS, None)
+    for subnet_id in sorted(pending or {}):
+        allocated, deallocated = pending[subnet_id]
+        _update_ip_counts(session, subnet_id, allocated, deallocated)
+
+
+def _discard_ip_counts(session, previous_transaction):
+    # NOTE: Subtransactions and savepoints roll back into a transaction
+    #       that may still commit, only the outermost one takes the
+    #       queued changes with it.
+    if previous_transaction._parent is None:
+        session.info.pop(PENDING_IP_COUNTS, None)
+
+
+event.listen(orm.Session, "after_soft_rollback", _discard_ip_counts)
+
+
+def subnet_count_ips(context, subnet_ids=None):
+    """Counts generated IPs per subnet straight from quark_ip_addresses.
+
+    Returns a dict of subnet_id -> (allocated, deallocated).
+    """
+    deallocated = models.IPAddress._deallocated
+    query = context.session.query(models.IPAddress.subnet_id, deallocated,
+                                  sql_func.count(models.IPAddress.id))
+    if subnet_ids is not None:
+        query = query.filter(models.IPAddress.subnet_id.in_(subnet_ids))
+    query = query.group_by(models.IPAddress.subnet_id, deallocated)
+
+    counts = {}
+    for subnet_id, is_deallocated, count in query.all():
+        allocated_count, deallocated_count = counts.get(subnet_id, (0, 0))
+        if is_deallocated:
+            deallocated_count += count
+        else:
+            allocated_count += count
+        counts[subnet_id] = (allocated_count, deallocated_count)
+    return counts
+
+
+def subnet_repair_ip_counts(context, subnet_id):
+    """Recounts a subnet's IPs under its row lock and stores the result.
+
+    Returns the (allocated, deallocated) pair that was stored, or None if
+    the subnet no longer exists. v6 subnets aren't counted and are reset
+    to zero.
+    """
+    query = context.session.query(models.Subnet).with_lockmode("update")
+    subnet = query.filter(models.Subnet.id == subnet_id).first()
+    if not subnet:
+        return None
+    counts = (0, 0)
+    if subnet["ip_version"] != 6:
+        counts = subnet_count_ips(context, [subnet_id]).get(subnet_id,
+                                                            (0, 0))
+    subnet["allocated_count"], subnet["deallocated_reusable_count"] = counts
+    context.session.add(subnet)
+    return counts
+
+
 def subnet_update_set_alloc_pool_cache(context, subnet, cache_data=None):
     if cache_data is not None:
         cache_data = json.dumps(cache_data)
+    if orm.object_session(subnet) not in (None, context.session):
+        # NOTE: Read from the replica, which is never written to. Its copy
+        #       is refreshed and the database's updated instead.
+        orm.attributes.set_committed_value(subnet, "_allocation_pool_cache",
+                                           cache_data)
+        subnet = context.session.query(models.Subnet).get(subnet["id"])
     subnet["_allocation_pool_cache"] = cache_data
     subnet = subnet_update(context, subnet)
     LOG.debug("Setting alloc pool cache to %s" % cache_data)
@@ -656,23 +1521,42 @@ def subnet_update_set_alloc_pool_cache(context, subnet, cache_data=None):
 
 @scoped
 def subnet_find(context, limit=None, page_reverse=False, sorts=None,
-                marker_obj=None, **filters):
+                marker_obj=None, fields=None, **filters):
     if "shared" in filters and True in filters["shared"]:
         return []
-    query = context.session.query(models.Subnet)
+    requested = utils.requested_fields(fields)
+    query = replica.get_session(context).query(models.Subnet)
+    query = _load_only(query, models.Subnet, requested)
     model_filters = _model_query(context, models.Subnet, filters)
-
-    if "join_dns" in filters:
+    join_dns = ("join_dns" in filters and
+                utils.field_requested(requested, "dns_nameservers"))
+    join_routes = ("join_routes" in filters and
+                   utils.field_requested(requested, "gateway_ip",
+                                         "host_routes"))
+
+    # NOTE: get_subnets hands the marker over as a filter.
+    marker_obj = marker_obj or filters.get("marker")
+    if _use_keyset(limit, marker_obj):
+        subnets = _keyset_page(query.filter(*model_filters), models.Subnet,
+                               limit, sorts, marker_obj)
+        if join_dns:
+            _load_collection(context, subnets, models.Subnet.dns_nameservers)
+        if join_routes:
+            _load_collection(context, subnets, models.Subnet.routes)
+        return subnets
+
+    if join_dns:
         query = query.options(orm.joinedload(models.Subnet.dns_nameservers))
 
-    if "join_routes" in filters:
+    if join_routes:
         query = query.options(orm.joinedload(models.Subnet.routes))
     return paginate_query(query.filter(*model_filters), models.Subnet, limit,
                           sorts, marker_obj)
 
 
 def subnet_count_all(context, **filters):
-    query = context.session.query(sql_func.count(models.Subnet.id))
+    query = replica.get_session(context).query(
+        sql_func.count(models.Subnet.id))
     if filters.get("network_id"):
         query = query.filter(
             models.Subnet.network_id == filters["network_id"])
@@ -700,7 +1584,7 @@ def subnet_update(context, subnet, **kwargs):
 
 @scoped
 def route_find(context, fields=None, **filters):
-    query = context.session.query(models.Route)
+    query = replica.get_session(context).query(models.Route)
     model_filters = _model_query(context, models.Route, filters)
     return query.filter(*model_filters)
 
@@ -739,7 +1623,7 @@ def dns_delete(context, dns):
 
 @scoped
 def security_group_find(context, **filters):
-    query = context.session.query(models.SecurityGroup).options(
+    query = replica.get_session(context).query(models.SecurityGroup).options(
         orm.joinedload(models.SecurityGroup.rules))
     model_filters = _model_query(context, models.SecurityGroup, filters)
     return query.filter(*model_filters)
@@ -747,7 +1631,8 @@ def security_group_find(context, **filters):
 
 @scoped
 def security_group_count(context, **filters):
-    query = context.session.query(sql_func.count(models.SecurityGroup.id))
+    query = replica.get_session(context).query(
+        sql_func.count(models.SecurityGroup.id))
     model_filters = _model_query(context, models.SecurityGroup, filters)
     return query.filter(*model_filters).scalar()
 
@@ -787,7 +1672,7 @@ def security_group_delete(context, group):
 
 @scoped
 def security_group_rule_find(context, **filters):
-    query = context.session.query(models.SecurityGroupRule)
+    query = replica.get_session(context).query(models.SecurityGroupRule)
     model_filters = _model_query(context, models.SecurityGroupRule, filters)
     return query.filter(*model_filters)
 
@@ -825,7 +1710,7 @@ def ip_policy_create(context, **ip_policy_dict):
 
 @scoped
 def ip_policy_find(context, **filters):
-    query = context.session.query(models.IPPolicy)
+    query = replica.get_session(context).query(models.IPPolicy)
     model_filters = _model_query(context, models.IPPolicy, filters)
     return query.filter(*model_filters)
 
@@ -845,11 +1730,14 @@ def ip_policy_update(context, ip_policy, **ip_policy_dict):
         ip_policy_dict["size"] = ip_set.size
 
     ip_policy.update(ip_policy_dict)
+    ip_policy["revision"] = models.IPPolicy.revision + 1
     context.session.add(ip_policy)
+    ip_policy_index.IP_POLICY_INDEXES.invalidate(ip_policy["id"])
     return ip_policy
 
 
 def ip_policy_delete(context, ip_policy):
+    ip_policy_index.IP_POLICY_INDEXES.invalidate(ip_policy["id"])
     context.session.delete(ip_policy)
 
 
@@ -857,3 +1745,28 @@ def transaction_create(context):
     transaction = models.Transaction()
     context.session.add(transaction)
     return transaction
+
+
+def transaction_id_range(context):
+    query = context.session.query(sql_func.min(models.Transaction.id),
+                                  sql_func.max(models.Transaction.id))
+    return query.one()
+
+
+def transaction_prune(context, first_id, last_id):
+    """Deletes the quark_transactions rows with ids in [first_id, last_id].
+
+    A transaction id is only needed until the row it tagged has been read
+    back, so older references are cleared first rather than blocking the
+    delete on the foreign keys. Returns the number of rows deleted.
+    """
+    for model in (models.IPAddress, models.MacAddress):
+        query = context.session.query(model).filter(
+            model.transaction_id >= first_id,
+            model.transaction_id <= last_id)
+        query.update({model.transaction_id: None},
+                     synchronize_session=False)
+    query = context.session.query(models.Transaction).filter(
+        models.Transaction.id >= first_id,
+        models.Transaction.id <= last_id)
+    return query.delete(synchronize_session=False)
@@ -0,0 +1,23 @@
+"""Add a deallocated, deallocated_at index to quark_mac_addresses
+
+Revision ID: 1acd075bd7e1
+Revises: 3a47813ce501
+Create Date: 2015-05-15 11:20:33.804512
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '1acd075bd7e1'
+down_revision = '3a47813ce501'
+
+from alembic import op
+
+
+def upgrade():
+    op.create_index('idx_mac_addresses_reuse', 'quark_mac_addresses',
+                    ['deallocated', 'deallocated_at'])
+
+
+def downgrade():
+    op.drop_index('idx_mac_addresses_reuse',
+                  table_name='quark_mac_addresses')
@@ -0,0 +1,29 @@
+"""Add claim_token to quark_ip_addresses and quark_mac_addresses
+
+Revision ID: 2e9cf60b0ef6
+Revises: f4fda2dfefca
+Create Date: 2015-05-12 15:02:41.118530
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '2e9cf60b0ef6'
+down_revision = 'f4fda2dfefca'
+
+from alembic import op
+import sqlalchemy as sa
+
+
+def upgrade():
+    for table in ('quark_ip_addresses', 'quark_mac_addresses'):
+        op.add_column(table,
+                      sa.Column('claim_token', sa.String(length=36),
+                                nullable=True))
+        op.create_index(op.f('ix_%s_claim_token' % table), table,
+                        ['claim_token'], unique=False)
+
+
+def downgrade():
+    for table in ('quark_ip_addresses', 'quark_mac_addresses'):
+        op.drop_index(op.f('ix_%s_claim_token' % table), table_name=table)
+        op.drop_column(table, 'claim_token')
@@ -0,0 +1,56 @@
+"""Add allocated and deallocated MAC counts to quark_mac_address_ranges
+
+Revision ID: 3a47813ce501
+Revises: 2e9cf60b0ef6
+Create Date: 2015-05-14 10:41:07.512204
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '3a47813ce501'
+down_revision = '2e9cf60b0ef6'
+
+from alembic import op
+from sqlalchemy.sql import and_, column, func, or_, select, table
+import sqlalchemy as sa
+
+
+def upgrade():
+    op.add_column('quark_mac_address_ranges',
+                  sa.Column('allocated_count', sa.BigInteger(),
+                            nullable=False, server_default='0'))
+    op.add_column('quark_mac_address_ranges',
+                  sa.Column('deallocated_count', sa.BigInteger(),
+                            nullable=False, server_default='0'))
+    op.create_index('idx_mac_address_ranges_counts',
+                    'quark_mac_address_ranges',
+                    ['do_not_use', 'allocated_count', 'deallocated_count'])
+
+    mac_ranges = table('quark_mac_address_ranges',
+                       column('id', sa.String(length=36)),
+                       column('allocated_count', sa.BigInteger()),
+                       column('deallocated_count', sa.BigInteger()))
+    macs = table('quark_mac_addresses',
+                 column('address', sa.BigInteger()),
+                 column('mac_address_range_id', sa.String(length=36)),
+                 column('deallocated', sa.Boolean()))
+
+    allocated = select([func.count(macs.c.address)]).where(and_(
+        macs.c.mac_address_range_id == mac_ranges.c.id,
+        or_(macs.c.deallocated.is_(None),
+            macs.c.deallocated == 0))).as_scalar()
+    deallocated = select([func.count(macs.c.address)]).where(and_(
+        macs.c.mac_address_range_id == mac_ranges.c.id,
+        macs.c.deallocated == 1)).as_scalar()
+
+    connection = op.get_bind()
+    connection.execute(mac_ranges.update().values(
+        allocated_count=allocated,
+        deallocated_count=deallocated))
+
+
+def downgrade():
+    op.drop_index('idx_mac_address_ranges_counts',
+                  table_name='quark_mac_address_ranges')
+    op.drop_column('quark_mac_address_ranges', 'deallocated_count')
+    op.drop_column('quark_mac_address_ranges', 'allocated_count')
@@ -0,0 +1,27 @@
+"""Add tenant_id, created_at, id indexes for keyset pagination
+
+Revision ID: 4f0c5a1d2b77
+Revises: 1acd075bd7e1
+Create Date: 2015-05-19 14:02:51.271834
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '4f0c5a1d2b77'
+down_revision = '1acd075bd7e1'
+
+from alembic import op
+
+INDEXES = (('idx_ports_tenant_created', 'quark_ports'),
+           ('idx_subnets_tenant_created', 'quark_subnets'),
+           ('idx_networks_tenant_created', 'quark_networks'))
+
+
+def upgrade():
+    for name, table in INDEXES:
+        op.create_index(name, table, ['tenant_id', 'created_at', 'id'])
+
+
+def downgrade():
+    for name, table in INDEXES:
+        op.drop_index(name, table_name=table)
@@ -0,0 +1,57 @@
+"""Add allocated and deallocated IP counts to quark_subnets
+
+Revision ID: 59b03336714d
+Revises: 356d6c0623c8
+Create Date: 2015-05-04 16:12:41.392817
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '59b03336714d'
+down_revision = '356d6c0623c8'
+
+from alembic import op
+from sqlalchemy.sql import and_, column, func, or_, select, table
+import sqlalchemy as sa
+
+
+def upgrade():
+    op.add_column('quark_subnets',
+                  sa.Column('allocated_count', sa.BigInteger(),
+                            nullable=False, server_default='0'))
+    op.add_column('quark_subnets',
+                  sa.Column('deallocated_reusable_count', sa.BigInteger(),
+                            nullable=False, server_default='0'))
+    op.create_index('idx_subnets_network_version', 'quark_subnets',
+                    ['network_id', 'ip_version'])
+
+    subnets = table('quark_subnets',
+                    column('id', sa.String(length=36)),
+                    column('ip_version', sa.Integer()),
+                    column('allocated_count', sa.BigInteger()),
+                    column('deallocated_reusable_count', sa.BigInteger()))
+    ip_addresses = table('quark_ip_addresses',
+                         column('id', sa.String(length=36)),
+                         column('subnet_id', sa.String(length=36)),
+                         column('_deallocated', sa.Boolean()))
+
+    allocated = select([func.count(ip_addresses.c.id)]).where(and_(
+        ip_addresses.c.subnet_id == subnets.c.id,
+        or_(ip_addresses.c._deallocated.is_(None),
+            ip_addresses.c._deallocated == 0))).as_scalar()
+    deallocated = select([func.count(ip_addresses.c.id)]).where(and_(
+        ip_addresses.c.subnet_id == subnets.c.id,
+        ip_addresses.c._deallocated == 1)).as_scalar()
+
+    # NOTE: v6 subnets aren't counted and keep their zero counters.
+    connection = op.get_bind()
+    connection.execute(subnets.update().where(
+        subnets.c.ip_version == 4).values(
+        allocated_count=allocated,
+        deallocated_reusable_count=deallocated))
+
+
+def downgrade():
+    op.drop_index('idx_subnets_network_version', table_name='quark_subnets')
+    op.drop_column('quark_subnets', 'deallocated_reusable_count')
+    op.drop_column('quark_subnets', 'allocated_count')
@@ -0,0 +1,24 @@
+"""Add revision to quark_ip_policy
+
+Revision ID: f4fda2dfefca
+Revises: 59b03336714d
+Create Date: 2015-05-07 11:24:09.615283
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = 'f4fda2dfefca'
+down_revision = '59b03336714d'
+
+from alembic import op
+import sqlalchemy as sa
+
+
+def upgrade():
+    op.add_column('quark_ip_policy',
+                  sa.Column('revision', sa.Integer(), nullable=False,
+                            server_default='0'))
+
+
+def downgrade():
+    op.drop_column('quark_ip_policy', 'revision')
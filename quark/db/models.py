@@ -28,6 +28,7 @@ from sqlalchemy import orm
 
 from quark.db import custom_types
 from quark.db import ip_types
+from quark import ip_policy_index
 # NOTE(mdietz): This is the only way to actually create the quotas table,
 #              regardless if we need it. This is how it's done upstream.
 # NOTE(jhammond): If it isn't obvious quota_driver is unused and that's ok.
@@ -166,6 +167,7 @@ class IPAddress(BASEV2, models.HasId):
     transaction_id = sa.Column(sa.Integer(),
                                sa.ForeignKey("quark_transactions.id"),
                                nullable=True)
+    claim_token = sa.Column(sa.String(36), index=True, nullable=True)
 
     def enabled_for_port(self, port):
         for assoc in self["associations"]:
@@ -213,28 +215,6 @@ class DNSNameserver(BASEV2, models.HasTenant, models.HasId, IsHazTags):
                                                        ondelete="CASCADE"))
 
 
-def _pools_from_cidr(cidr):
-    cidrs = cidr.iter_cidrs()
-    if len(cidrs) == 0:
-        return []
-    if len(cidrs) == 1:
-        return [dict(start=str(cidrs[0][0]),
-                     end=str(cidrs[0][-1]))]
-
-    pool_start = cidrs[0][0]
-    prev_cidr_end = cidrs[0][-1]
-    pools = []
-    for cidr in cidrs[1:]:
-        cidr_start = cidr[0]
-        if prev_cidr_end + 1 != cidr_start:
-            pools.append(dict(start=str(pool_start),
-                              end=str(prev_cidr_end)))
-            pool_start = cidr_start
-        prev_cidr_end = cidr[-1]
-    pools.append(dict(start=str(pool_start), end=str(prev_cidr_end)))
-    return pools
-
-
 class Subnet(BASEV2, models.HasId, IsHazTags):
     """Upstream model for IPs.
 
@@ -269,10 +249,17 @@ class Subnet(BASEV2, models.HasId, IsHazTags):
             pools = json.loads(_cache)
             return pools
         else:
-            ip_policy_cidrs = IPPolicy.get_ip_policy_cidrs(self)
-            cidr = netaddr.IPSet([netaddr.IPNetwork(self["cidr"])])
-            allocatable = cidr - ip_policy_cidrs
-            pools = _pools_from_cidr(allocatable)
+            policy = ip_policy_index.for_subnet(self)
+            cidr = netaddr.IPNetwork(self["cidr"])
+            v6_cidr = cidr.ipv6()
+            pools = []
+            for first, last in policy.allowed_ranges(v6_cidr.first,
+                                                     v6_cidr.last):
+                start = netaddr.IPAddress(first, 6)
+                end = netaddr.IPAddress(last, 6)
+                if cidr.version == 4:
+                    start, end = start.ipv4(), end.ipv4()
+                pools.append(dict(start=str(start), end=str(end)))
             return pools
 
     @cidr.setter
@@ -313,6 +300,17 @@ class Subnet(BASEV2, models.HasId, IsHazTags):
                              sa.ForeignKey("quark_ip_policy.id"))
     # Legacy data
     do_not_use = sa.Column(sa.Boolean(), default=False)
+    # Denormalized counts of generated IPs so subnet selection doesn't have
+    # to join and count quark_ip_addresses on every allocation
+    allocated_count = sa.Column(sa.BigInteger(), default=0, nullable=False,
+                                server_default='0')
+    deallocated_reusable_count = sa.Column(sa.BigInteger(), default=0,
+                                           nullable=False, server_default='0')
+
+sa.Index("idx_subnets_network_version", Subnet.__table__.c.network_id,
+         Subnet.__table__.c.ip_version)
+sa.Index("idx_subnets_tenant_created", Subnet.__table__.c.tenant_id,
+         Subnet.__table__.c.created_at, Subnet.__table__.c.id)
 
 
 port_group_association_table = sa.Table(
@@ -395,6 +393,8 @@ sa.Index("idx_ports_1", Port.__table__.c.device_id, Port.__table__.c.tenant_id)
 sa.Index("idx_ports_2", Port.__table__.c.device_owner,
          Port.__table__.c.network_id)
 sa.Index("idx_ports_3", Port.__table__.c.tenant_id)
+sa.Index("idx_ports_tenant_created", Port.__table__.c.tenant_id,
+         Port.__table__.c.created_at, Port.__table__.c.id)
 
 
 class MacAddress(BASEV2, models.HasTenant):
@@ -410,6 +410,11 @@ class MacAddress(BASEV2, models.HasTenant):
     transaction_id = sa.Column(sa.Integer(),
                                sa.ForeignKey("quark_transactions.id"),
                                nullable=True)
+    claim_token = sa.Column(sa.String(36), index=True, nullable=True)
+
+# Serves reallocation, which picks the longest deallocated MACs first
+sa.Index("idx_mac_addresses_reuse", MacAddress.__table__.c.deallocated,
+         MacAddress.__table__.c.deallocated_at)
 
 
 class MacAddressRange(BASEV2, models.HasId):
@@ -425,6 +430,17 @@ class MacAddressRange(BASEV2, models.HasId):
                                       backref="mac_address_range")
     do_not_use = sa.Column(sa.Boolean(), default=False, nullable=False,
                            server_default='0')
+    # Denormalized counts of generated MACs so range selection doesn't have
+    # to join and count quark_mac_addresses on every allocation
+    allocated_count = sa.Column(sa.BigInteger(), default=0, nullable=False,
+                                server_default='0')
+    deallocated_count = sa.Column(sa.BigInteger(), default=0, nullable=False,
+                                  server_default='0')
+
+sa.Index("idx_mac_address_ranges_counts",
+         MacAddressRange.__table__.c.do_not_use,
+         MacAddressRange.__table__.c.allocated_count,
+         MacAddressRange.__table__.c.deallocated_count)
 
 
 class IPPolicy(BASEV2, models.HasId, models.HasTenant):
@@ -444,6 +460,10 @@ class IPPolicy(BASEV2, models.HasId, models.HasTenant):
     name = sa.Column(sa.String(255), nullable=True)
     description = sa.Column(sa.String(255), nullable=True)
     size = sa.Column(custom_types.INET())
+    # NOTE: Bumped on every update so compiled copies of the exclusions can
+    #       be cached per revision. See quark.ip_policy_index.
+    revision = sa.Column(sa.Integer(), default=0, nullable=False,
+                         server_default='0')
 
     @staticmethod
     def get_ip_policy_cidrs(subnet):
@@ -475,6 +495,10 @@ class Network(BASEV2, models.HasId):
     tenant_id = sa.Column(sa.String(255), index=True)
 
 
+sa.Index("idx_networks_tenant_created", Network.__table__.c.tenant_id,
+         Network.__table__.c.created_at, Network.__table__.c.id)
+
+
 class Transaction(BASEV2):
     __tablename__ = "quark_transactions"
     id = sa.Column(sa.Integer, primary_key=True)
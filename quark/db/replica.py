@@ -0,0 +1,136 @@
+# Copyright 2015 Openstack Foundation
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+"""
+Routes the finds of read only requests to a read replica of the database
+"""
+
+import contextlib
+import time
+
+from oslo.config import cfg
+from oslo.db.sqlalchemy import session as db_session
+from oslo_log import log as logging
+from sqlalchemy import orm
+
+CONF = cfg.CONF
+LOG = logging.getLogger(__name__)
+
+quark_opts = [
+    cfg.StrOpt("db_replica_connection",
+               default="",
+               secret=True,
+               help=_("SQLAlchemy URL of a read replica of the database."
+                      " The finds of read only requests run on it. Empty"
+                      " runs everything on the database.")),
+    cfg.IntOpt("db_replica_write_grace",
+               default=5,
+               help=_("Seconds after a tenant's last write during which its"
+                      " reads stay on the database, so they see the write"
+                      " however far the replica lags behind."))
+]
+
+CONF.register_opts(quark_opts, "QUARK")
+
+_facade = None
+_sessionmaker = None
+
+# NOTE: Tenants whose writes the replica may not have caught up with yet,
+#       by the time of their last write in this process.
+_last_writes = {}
+
+
+def _make_session():
+    global _facade, _sessionmaker
+    if _sessionmaker is None:
+        _facade = db_session.EngineFacade(CONF.QUARK.db_replica_connection,
+                                          autocommit=True,
+                                          expire_on_commit=False)
+        # NOTE: Nothing is ever flushed to the replica. Changes made to
+        #       the rows read from it are dropped with the session.
+        _sessionmaker = orm.sessionmaker(bind=_facade.get_engine(),
+                                         autocommit=True, autoflush=False,
+                                         expire_on_commit=False)
+    return _sessionmaker()
+
+
+def reset():
+    global _facade, _sessionmaker
+    _facade = None
+    _sessionmaker = None
+    _last_writes.clear()
+
+
+@contextlib.contextmanager
+def request(context, read_only):
+    """Runs a plugin request on context, read only or not.
+
+    Requests made from within another one keep its mode. Once a request
+    that isn't read only is done, its tenant counts as just written.
+    """
+    if getattr(context, "_quark_read_only", None) is not None:
+        yield
+        return
+    context._quark_read_only = read_only
+    try:
+        yield
+    finally:
+        context._quark_read_only = None
+        session = getattr(context, "_quark_replica_session", None)
+        if session is not None:
+            session.close()
+            context._quark_replica_session = None
+        if not read_only:
+            mark_written(context)
+
+
+def mark_written(context):
+    if CONF.QUARK.db_replica_connection:
+        _last_writes[context.tenant_id] = time.time()
+
+
+def _recently_written(context):
+    written = _last_writes.get(context.tenant_id)
+    if written is None:
+        return False
+    if time.time() - written < CONF.QUARK.db_replica_write_grace:
+        return True
+    _last_writes.pop(context.tenant_id, None)
+    return False
+
+
+def _writing(context):
+    session = getattr(context, "_session", None)
+    if session is None:
+        return False
+    return bool(session.transaction is not None or session.new or
+                session.dirty or session.deleted)
+
+
+def get_session(context):
+    """The session the finds of context run on.
+
+    That is the replica's for read only requests, unless the request is
+    inside a transaction or has changes pending on the database, or its
+    tenant wrote less than db_replica_write_grace seconds ago.
+    """
+    if (not CONF.QUARK.db_replica_connection or
+            not getattr(context, "_quark_read_only", None) or
+            _writing(context) or _recently_written(context)):
+        return context.session
+    session = getattr(context, "_quark_replica_session", None)
+    if session is None:
+        session = context._quark_replica_session = _make_session()
+    return session
@@ -1,5 +1,9 @@
+from sqlalchemy.ext.compiler import compiles
 from sqlalchemy.orm.persistence import BulkUpdate
 from sqlalchemy import sql
+from sqlalchemy.sql.expression import Select
+
+SKIP_LOCKED_DIALECTS = ("mysql", "postgresql")
 
 
 # NOTE(asadoughi): based on https://github.com/zzzeek/sqlalchemy/pull/164
@@ -23,3 +27,26 @@ def update(query, values, update_args=None):
     update_op = BulkUpdateArgs(query, values, update_args)
     update_op.exec_()
     return update_op.rowcount
+
+
+class SkipLockedSelect(Select):
+    """A SELECT ... FOR UPDATE that skips the rows others have locked."""
+
+
+# NOTE: SKIP LOCKED isn't exposed by this version of sqlalchemy, so selects
+#       made by skip_locked() get it appended after FOR UPDATE. Dialects
+#       without row locks (sqlite) render neither. Every other select
+#       compiles as usual.
+@compiles(SkipLockedSelect)
+def _compile_skip_locked(select, compiler, **kwargs):
+    text = compiler.visit_select(select, **kwargs)
+    if compiler.dialect.name in SKIP_LOCKED_DIALECTS:
+        text += " SKIP LOCKED"
+    return text
+
+
+def skip_locked(select):
+    select = select.with_for_update()
+    locked = SkipLockedSelect.__new__(SkipLockedSelect)
+    locked.__dict__ = select.__dict__.copy()
+    return locked
@@ -83,6 +83,11 @@ class IPAddressPolicyRetryableFailure(IPAddressRetryableFailure):
                 "due to policy retrying...")
 
 
+class IpamLockTimeout(exceptions.Conflict):
+    message = _("Timed out after %(timeout)s seconds waiting for IPAM lock "
+                "%(name)s")
+
+
 class IPAddressNotInSubnet(exceptions.InvalidInput):
     message = _("Requested IP %(ip_addr)s not in subnet %(subnet_id)s")
 
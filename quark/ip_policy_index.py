@@ -0,0 +1,167 @@
+# Copyright 2015 Openstack Foundation
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+"""
+Compiled IP policy exclusions for the IPAM hot paths
+"""
+
+import bisect
+import collections
+import numbers
+import threading
+
+import netaddr
+from oslo.config import cfg
+
+CONF = cfg.CONF
+
+quark_opts = [
+    cfg.IntOpt("ip_policy_index_cache_size",
+               default=1024,
+               help=_("Number of compiled IP policies each worker keeps in"
+                      " memory. 0 disables the cache."))
+]
+
+CONF.register_opts(quark_opts, "QUARK")
+
+
+def _ip_to_int(ip):
+    # NOTE: Policy exclusions are always stored as v6 integers, v4 included,
+    #       so addresses are compared in the same space.
+    if isinstance(ip, netaddr.IPAddress):
+        return ip.ipv6().value
+    return int(ip)
+
+
+class IPPolicyIndex(object):
+    """A policy's exclusions as merged, sorted v6 integer intervals."""
+    def __init__(self, intervals=None):
+        self.firsts = []
+        self.lasts = []
+        for first, last in sorted(intervals or []):
+            if self.lasts and first <= self.lasts[-1] + 1:
+                self.lasts[-1] = max(self.lasts[-1], last)
+                continue
+            self.firsts.append(first)
+            self.lasts.append(last)
+        self.size = sum(last - first + 1
+                        for first, last in zip(self.firsts, self.lasts))
+
+    @classmethod
+    def from_policy(cls, ip_policy):
+        intervals = []
+        for policy_cidr in (ip_policy or {}).get("exclude") or []:
+            first, last = policy_cidr["first_ip"], policy_cidr["last_ip"]
+            if first is None or last is None:
+                cidr = netaddr.IPNetwork(policy_cidr["cidr"]).ipv6()
+                first, last = cidr.first, cidr.last
+            intervals.append((int(first), int(last)))
+        return cls(intervals)
+
+    def __len__(self):
+        return len(self.firsts)
+
+    def __iter__(self):
+        return iter(zip(self.firsts, self.lasts))
+
+    def __contains__(self, ip):
+        value = _ip_to_int(ip)
+        i = bisect.bisect_right(self.firsts, value) - 1
+        return i >= 0 and value <= self.lasts[i]
+
+    def skip(self, ip):
+        """Finds the first v6 integer at or after ip outside every interval.
+
+        Returns that integer and the start of the next exclusion after it, or
+        None if there isn't one. Intervals are merged, so one step suffices.
+        """
+        value = _ip_to_int(ip)
+        i = bisect.bisect_right(self.firsts, value) - 1
+        if i >= 0 and value <= self.lasts[i]:
+            value = self.lasts[i] + 1
+        i += 1
+        if i < len(self.firsts):
+            return value, self.firsts[i]
+        return value, None
+
+    def allowed_ranges(self, first, last):
+        """Yields the (first, last) runs of [first, last] not excluded."""
+        start = first
+        i = max(bisect.bisect_right(self.firsts, first) - 1, 0)
+        for excl_first, excl_last in zip(self.firsts[i:], self.lasts[i:]):
+            if excl_first > last:
+                break
+            if excl_last < start:
+                continue
+            if excl_first > start:
+                yield start, excl_first - 1
+            start = excl_last + 1
+        if start <= last:
+            yield start, last
+
+
+EMPTY_INDEX = IPPolicyIndex()
+
+
+class IPPolicyIndexCache(object):
+    """LRU of compiled policies keyed on (ip_policy_id, revision)."""
+    def __init__(self):
+        self._indexes = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, ip_policy):
+        if not ip_policy:
+            return EMPTY_INDEX
+        key = (ip_policy.get("id"), ip_policy.get("revision"))
+        max_size = CONF.QUARK.ip_policy_index_cache_size
+        # NOTE: Policies that haven't been flushed yet have no revision to
+        #       key on (or a pending revision + 1 expression), and their
+        #       exclusions may still change.
+        if (key[0] is None or not isinstance(key[1], numbers.Integral) or
+                max_size <= 0):
+            return IPPolicyIndex.from_policy(ip_policy)
+
+        with self._lock:
+            index = self._indexes.pop(key, None)
+            if index is not None:
+                self._indexes[key] = index
+                return index
+
+        index = IPPolicyIndex.from_policy(ip_policy)
+        with self._lock:
+            self._indexes[key] = index
+            while len(self._indexes) > max_size:
+                self._indexes.popitem(last=False)
+        return index
+
+    def invalidate(self, ip_policy_id):
+        with self._lock:
+            for key in [k for k in self._indexes if k[0] == ip_policy_id]:
+                del self._indexes[key]
+
+    def clear(self):
+        with self._lock:
+            self._indexes.clear()
+
+
+IP_POLICY_INDEXES = IPPolicyIndexCache()
+
+
+def for_policy(ip_policy):
+    return IP_POLICY_INDEXES.get(ip_policy)
+
+
+def for_subnet(subnet):
+    return IP_POLICY_INDEXES.get(subnet["ip_policy"])
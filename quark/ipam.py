@@ -17,25 +17,32 @@
 Quark Pluggable IPAM
 """
 
-import functools
+import atexit
+import contextlib
+import datetime
 import itertools
+import json
 import random
 import time
 import uuid
 
 import netaddr
 from neutron.common import exceptions
-from neutron.common import rpc as n_rpc
+from neutron import context as neutron_context
 from oslo.config import cfg
 from oslo.db import exception as db_exception
 from oslo.utils import timeutils
-from oslo_concurrency import lockutils
 from oslo_log import log as logging
 
 from quark.db import api as db_api
 from quark.db import ip_types
 from quark.db import models
 from quark import exceptions as q_exc
+from quark import ip_policy_index
+from quark import ipam_leases
+from quark import ipam_locks
+from quark import ipam_metrics
+from quark import ipam_notifications
 from quark import utils
 
 LOG = logging.getLogger(__name__)
@@ -56,10 +63,64 @@ quark_opts = [
                default=20,
                help=_("Number of times to attempt to allocate a new IP"
                       " address before giving up.")),
-    cfg.BoolOpt("ipam_use_synchronization",
+    cfg.IntOpt("ipam_v4_lease_size",
+               default=0,
+               help=_("Number of sequential v4 addresses a worker reserves"
+                      " from a subnet at a time and hands out without"
+                      " touching the subnet row again. 0 or 1 disables"
+                      " leasing.")),
+    cfg.IntOpt("ipam_lease_ttl",
+               default=60,
+               help=_("Seconds a worker holds on to a leased block before"
+                      " returning the unused part of it.")),
+    cfg.IntOpt("mac_address_lease_size",
+               default=0,
+               help=_("Number of sequential MAC addresses a worker reserves"
+                      " from a MAC range at a time and hands out without"
+                      " touching the range row again. 0 or 1 disables"
+                      " leasing.")),
+    cfg.StrOpt("ipam_reallocate_claim",
+               default="transaction",
+               help=_("How deallocated addresses are claimed for reuse."
+                      " 'transaction' tags the first match with a"
+                      " quark_transactions id and selects it back."
+                      " 'token' does the same with a token generated by"
+                      " the worker, saving the quark_transactions insert."
+                      " 'free_list' claims one of the longest deallocated"
+                      " matches directly.")),
+    cfg.StrOpt("mac_address_reallocate_claim",
+               default="transaction",
+               help=_("How deallocated MAC addresses are claimed for reuse,"
+                      " either 'transaction', 'token' or 'free_list'. See"
+                      " ipam_reallocate_claim.")),
+    cfg.IntOpt("ipam_reallocate_window",
+               default=16,
+               help=_("Number of the longest deallocated addresses a"
+                      " 'free_list' claim considers at once.")),
+    cfg.BoolOpt("ipam_use_skip_locked",
                 default=False,
-                help=_("Configures whether or not to use the experimental"
-                       " semaphore logic around IPAM"))
+                help=_("Lock 'free_list' candidates with SELECT ... FOR"
+                       " UPDATE SKIP LOCKED. Requires MySQL 8.0 or"
+                       " PostgreSQL. Otherwise candidates are claimed with"
+                       " compare-and-swap updates, which works on any"
+                       " database, sqlite included.")),
+    cfg.IntOpt("ipam_subnet_spread_top_k",
+               default=0,
+               help=_("Spread concurrent allocations over this many of the"
+                      " most full subnets of a network instead of sending"
+                      " them all to the most full one. Each allocation"
+                      " picks two of them at random and takes the fuller."
+                      " 0 or 1 disables spreading.")),
+    cfg.StrOpt("ipam_subnet_spread",
+               default="{}",
+               help=_("JSON mapping of network id to the"
+                      " ipam_subnet_spread_top_k to use for that network.")),
+    cfg.FloatOpt("ipam_random_probe_max_fill",
+                 default=0.5,
+                 help=_("The ANY_RANDOM strategy probes random v4 addresses"
+                        " above a subnet's marker until about this fraction"
+                        " of them is in use, then allocates sequentially"
+                        " like ANY."))
 ]
 
 CONF.register_opts(quark_opts, "QUARK")
@@ -70,23 +131,95 @@ CONF.register_opts(quark_opts, "QUARK")
 MAGIC_INT = 144115188075855872
 
 
-def no_synchronization(*args, **kwargs):
-    def wrap(f):
-        @functools.wraps(f)
-        def inner(*args, **kwargs):
-            return f(*args, **kwargs)
-        return inner
-    return wrap
-
-
-def named(sema):
-    return "%s.%s" % (__name__, sema)
-
-
-if CONF.QUARK.ipam_use_synchronization:
-    synchronized = lockutils.synchronized
-else:
-    synchronized = no_synchronization
+IP_LEASES = ipam_leases.LeaseManager()
+MAC_LEASES = ipam_leases.LeaseManager()
+
+# NOTE: A random prefix per worker plus a counter is as unique as a uuid4
+#       per claim without reading urandom on every attempt.
+CLAIM_TOKEN_PREFIX = uuid.uuid4().hex[:16]
+_claim_token_sequence = itertools.count()
+
+
+def claim_token():
+    return "%s-%d" % (CLAIM_TOKEN_PREFIX, next(_claim_token_sequence))
+
+
+_SUBNET_SPREAD = {}
+
+
+def subnet_spread_top_k(net_id):
+    raw = CONF.QUARK.ipam_subnet_spread
+    if raw not in _SUBNET_SPREAD:
+        _SUBNET_SPREAD.clear()
+        _SUBNET_SPREAD[raw] = json.loads(raw)
+    spread = _SUBNET_SPREAD[raw]
+    return int(spread.get(net_id, CONF.QUARK.ipam_subnet_spread_top_k))
+
+
+# NOTE: rfc3041_ip reseeds the module level generator with port ids, which
+#       would make spreading across subnets and candidates predictable.
+_spread_random = random.Random()
+
+
+def spread_subnets(subnets, top_k):
+    """Reorders (subnet, count) pairs, most full first, with power of two
+    choices.
+
+    Within each ip_version, two of the top_k most full subnets are picked
+    at random and the fuller one is moved to the front, the rest keep
+    their order as fallbacks. The versions keep the order they came in, so
+    the spread never changes which address family a port gets. This stays
+    biased toward filling subnets while concurrent allocations mostly land
+    on different subnet rows.
+    """
+    spread = []
+    for _version, group in itertools.groupby(
+            subnets, key=lambda pair: pair[0]["ip_version"]):
+        group = list(group)
+        top = min(top_k, len(group))
+        if top >= 2:
+            first = min(_spread_random.sample(range(top), 2))
+            group = [group[first]] + group[:first] + group[first + 1:]
+        spread.extend(group)
+    return spread
+
+
+# NOTE: rfc3041_ip reseeds the module level generator with port ids, so
+#       probes draw from their own.
+_probe_random = random.Random()
+
+
+def probe_v4_address(subnet, ip_policy, ips_in_subnet):
+    """Picks a random allowed address between the marker and last_ip.
+
+    Addresses below the marker were handed out sequentially and are
+    assumed to be in use, the rest of ips_in_subnet is taken as spread over
+    the space above it. Returns None when that space is fuller than
+    ipam_random_probe_max_fill, so the caller goes on sequentially.
+    """
+    marker = subnet["next_auto_assign_ip"]
+    first, last = subnet["first_ip"], subnet["last_ip"]
+    if not first <= marker <= last:
+        return None
+    # NOTE: Policy exclusions are v6 integers, subnets created outside of
+    #       the Subnet.cidr setter may not be.
+    delta = netaddr.IPAddress(marker).ipv6().value - marker
+    policy = ip_policy_index.for_policy(ip_policy)
+    allowed_below = sum(run_last - run_first + 1 for run_first, run_last in
+                        policy.allowed_ranges(first + delta,
+                                              marker + delta - 1))
+    runs = list(policy.allowed_ranges(marker + delta, last + delta))
+    allowed_above = sum(run_last - run_first + 1
+                        for run_first, run_last in runs)
+    used_above = max(ips_in_subnet - allowed_below, 0)
+    if (not allowed_above or used_above >=
+            allowed_above * CONF.QUARK.ipam_random_probe_max_fill):
+        return None
+    offset = _probe_random.randrange(allowed_above)
+    for run_first, run_last in runs:
+        if offset <= run_last - run_first:
+            return run_first + offset - delta
+        offset -= run_last - run_first + 1
 
 
 def rfc2462_ip(mac, cidr):
@@ -120,9 +253,93 @@ def generate_v6(mac, port_id, cidr):
         yield addr
 
 
+def return_ip_leases(context, leases):
+    """Gives the unused part of leased v4 blocks back to their subnets.
+
+    If the subnet marker hasn't moved since we leased, it is simply rewound.
+    Otherwise the leftovers are recorded as long since deallocated addresses
+    so the reallocation path picks them up instead of them leaking.
+    """
+    for lease in leases:
+        remaining = lease.remaining()
+        if not remaining:
+            continue
+        LOG.info("Returning {0} leased addresses to subnet {1}".format(
+            len(remaining), lease.resource_id))
+        try:
+            with context.session.begin():
+                if db_api.subnet_return_next_auto_assign_ip(
+                        context, lease.resource_id, lease.last, lease.next):
+                    continue
+                subnet = db_api.subnet_find(context, id=lease.resource_id,
+                                            scope=db_api.ONE)
+                if not subnet:
+                    continue
+                policy = ip_policy_index.for_subnet(subnet)
+                for ip in remaining:
+                    addr = netaddr.IPAddress(ip).ipv4()
+                    if addr in policy:
+                        continue
+                    address = db_api.ip_address_create(
+                        context, address=addr, subnet_id=subnet["id"],
+                        version=subnet["ip_version"],
+                        network_id=subnet["network_id"])
+                    db_api.ip_address_update(context, address,
+                                             deallocated=1)
+                    address["deallocated_at"] = datetime.datetime(1970, 1, 1)
+        except Exception:
+            LOG.exception("Couldn't return leased addresses to subnet "
+                          "{0}".format(lease.resource_id))
+
+
+def return_mac_leases(context, leases):
+    """Gives the unused part of leased MAC blocks back to their ranges.
+
+    Works like return_ip_leases.
+    """
+    for lease in leases:
+        remaining = lease.remaining()
+        if not remaining:
+            continue
+        LOG.info("Returning {0} leased MACs to range {1}".format(
+            len(remaining), lease.resource_id))
+        try:
+            with context.session.begin():
+                if db_api.mac_range_return_next_auto_assign_mac(
+                        context, lease.resource_id, lease.last, lease.next):
+                    continue
+                for address in remaining:
+                    mac = db_api.mac_address_create(
+                        context, address=address,
+                        mac_address_range_id=lease.resource_id)
+                    db_api.mac_address_update(
+                        context, mac, deallocated=True,
+                        deallocated_at=datetime.datetime(1970, 1, 1))
+        except Exception:
+            LOG.exception("Couldn't return leased MACs to range "
+                          "{0}".format(lease.resource_id))
+
+
+@atexit.register
+def _return_outstanding_ip_leases():
+    leases = IP_LEASES.drain()
+    if leases:
+        return_ip_leases(neutron_context.get_admin_context(), leases)
+
+
+@atexit.register
+def _return_outstanding_mac_leases():
+    leases = MAC_LEASES.drain()
+    if leases:
+        return_mac_leases(neutron_context.get_admin_context(), leases)
+
+
 def ipam_logged(fx):
     def wrap(self, *args, **kwargs):
-        log = QuarkIPAMLog()
+        strategy = None
+        if hasattr(self, "get_name"):
+            strategy = self.get_name()
+        log = QuarkIPAMLog(strategy)
         kwargs['ipam_log'] = log
         try:
             return fx(self, *args, **kwargs)
@@ -131,10 +348,22 @@ def ipam_logged(fx):
     return wrap
 
 
+@contextlib.contextmanager
+def ipam_timed(ipam_log, phase):
+    if not ipam_log:
+        yield
+        return
+    with ipam_log.timed(phase):
+        yield
+
+
 class QuarkIPAMLog(object):
-    def __init__(self):
+    def __init__(self, strategy=None):
         self.entries = {}
+        self.phases = []
         self.success = True
+        self.strategy = strategy or "unknown"
+        self.start_time = time.time()
 
     def make_entry(self, fx_name):
         if fx_name not in self.entries:
@@ -143,6 +372,15 @@ class QuarkIPAMLog(object):
         self.entries[fx_name].append(entry)
         return entry
 
+    @contextlib.contextmanager
+    def timed(self, phase):
+        """Times a phase of an attempt without counting it as an entry."""
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.phases.append((phase, time.time() - start))
+
     def _output(self, status, time_total, fails, successes):
         status = "SUCCESS"
         if not self.success:
@@ -150,6 +388,28 @@ class QuarkIPAMLog(object):
         LOG.debug("STATUS:%s TIME:%f ATTEMPTS:%d PASS:%d FAIL:%d" %
                   (status, time_total, fails + successes, successes, fails))
 
+    def _record(self, metrics):
+        """Feeds the timings of this log to the IPAM metrics.
+
+        Every entry name gets a latency histogram, a count of the attempts
+        beyond the first and a counter per failure reason.
+        """
+        for fx, entries in self.entries.items():
+            name = "%s.%s" % (self.strategy, fx.lstrip("_"))
+            for entry in entries:
+                metrics.timing(name, entry.get_time())
+                if not entry.success:
+                    metrics.incr("%s.failures.%s" % (
+                        name, entry.reason or "error"))
+            metrics.incr("%s.retries" % name, len(entries) - 1)
+        for phase, seconds in self.phases:
+            metrics.timing("%s.%s" % (self.strategy, phase), seconds)
+        metrics.timing("%s.total" % self.strategy,
+                       time.time() - self.start_time)
+        metrics.incr("%s.%s" % (self.strategy,
+                                "success" if self.success else "failure"))
+        metrics.maybe_flush()
+
     def end(self):
         total = 0
         fails = 0
@@ -162,6 +422,10 @@ class QuarkIPAMLog(object):
                 else:
                     fails += 1
         self._output(self.success, total, fails, successes)
+        try:
+            self._record(ipam_metrics.METRICS)
+        except Exception:
+            LOG.exception("Couldn't record IPAM metrics")
 
     def failed(self):
         self.success = False
@@ -173,9 +437,11 @@ class QuarkIPAMLogEntry(object):
         self.log = log
         self.start_time = time.time()
         self.success = True
+        self.reason = None
 
-    def failed(self):
+    def failed(self, reason=None):
         self.success = False
+        self.reason = reason
 
     def end(self):
         self.end_time = time.time()
@@ -187,30 +453,32 @@ class QuarkIPAMLogEntry(object):
 
 
 class QuarkIpam(object):
-    @synchronized(named("allocate_mac_address"))
+    @ipam_locks.synchronized("allocate_mac_address", per_network=False)
+    @ipam_logged
     def allocate_mac_address(self, context, net_id, port_id, reuse_after,
                              mac_address=None,
-                             use_forbidden_mac_range=False):
+                             use_forbidden_mac_range=False, **kwargs):
         if mac_address:
             mac_address = netaddr.EUI(mac_address).value
 
-        kwargs = {"network_id": net_id, "port_id": port_id,
-                  "mac_address": mac_address,
-                  "use_forbidden_mac_range": use_forbidden_mac_range}
+        ipam_log = kwargs.get('ipam_log', None)
+        log_kwargs = {"network_id": net_id, "port_id": port_id,
+                      "mac_address": mac_address,
+                      "use_forbidden_mac_range": use_forbidden_mac_range}
         LOG.info(("Attempting to allocate a new MAC address "
-                  "[{0}]").format(utils.pretty_kwargs(**kwargs)))
+                  "[{0}]").format(utils.pretty_kwargs(**log_kwargs)))
 
         for retry in xrange(CONF.QUARK.mac_address_retry_max):
             LOG.info("Attemping to reallocate deallocated MAC (step 1 of 3),"
                      " attempt {0} of {1}".format(
                          retry + 1, CONF.QUARK.mac_address_retry_max))
+            attempt = None
+            if ipam_log:
+                attempt = ipam_log.make_entry("mac_reallocate")
             try:
-                with context.session.begin():
-                    transaction = db_api.transaction_create(context)
                 update_kwargs = {
                     "deallocated": False,
-                    "deallocated_at": None,
-                    "transaction_id": transaction.id
+                    "deallocated_at": None
                 }
                 filter_kwargs = {
                     "reuse_after": reuse_after,
@@ -218,13 +486,30 @@ class QuarkIpam(object):
                     "address": mac_address
                 }
                 elevated = context.elevated()
-                result = db_api.mac_address_reallocate(
-                    elevated, update_kwargs, **filter_kwargs)
+                claim_mode = CONF.QUARK.mac_address_reallocate_claim
+                if claim_mode == "free_list":
+                    result, reallocated_mac = (
+                        self._reallocate_mac_from_free_list(
+                            elevated, update_kwargs, filter_kwargs))
+                else:
+                    if claim_mode == "token":
+                        claim = {"claim_token": claim_token()}
+                    else:
+                        with context.session.begin():
+                            transaction = db_api.transaction_create(context)
+                        claim = {"transaction_id": transaction.id}
+                    update_kwargs.update(claim)
+                    result = db_api.mac_address_reallocate(
+                        elevated, update_kwargs, **filter_kwargs)
+                    reallocated_mac = None
+                    if result:
+                        reallocated_mac = db_api.mac_address_reallocate_find(
+                            elevated, **claim)
                 if not result:
+                    if attempt:
+                        attempt.failed("none_reallocatable")
                     break
 
-                reallocated_mac = db_api.mac_address_reallocate_find(
-                    elevated, transaction.id)
                 if reallocated_mac:
                     dealloc = netaddr.EUI(reallocated_mac["address"])
                     LOG.info("Found a suitable deallocated MAC {0}".format(
@@ -232,13 +517,25 @@ class QuarkIpam(object):
                     LOG.info("MAC assignment for port ID {0} completed "
                              "with address {1}".format(port_id, dealloc))
                     return reallocated_mac
+                if attempt:
+                    attempt.failed("claim_lost")
             except Exception:
+                if attempt:
+                    attempt.failed("error")
                 LOG.exception("Error in mac reallocate...")
                 continue
+            finally:
+                if attempt:
+                    attempt.end()
 
         LOG.info("Couldn't find a suitable deallocated MAC, attempting "
                  "to create a new one")
 
+        if not mac_address and CONF.QUARK.mac_address_lease_size > 1:
+            return self._allocate_leased_mac_address(
+                context, net_id, port_id, use_forbidden_mac_range,
+                ipam_log=ipam_log)
+
         # This could fail if a large chunk of MACs were chosen explicitly,
         # but under concurrent load enough MAC creates should iterate without
         # any given thread exhausting its retry count.
@@ -247,7 +544,8 @@ class QuarkIpam(object):
                      "(step 2 of 3), attempt {0} of {1}".format(
                          retry + 1, CONF.QUARK.mac_address_retry_max))
             next_address = None
-            with context.session.begin():
+            select_timer = ipam_timed(ipam_log, "mac_select_range")
+            with select_timer, context.session.begin():
                 try:
                     fn = db_api.mac_address_range_find_allocation_counts
                     mac_range = \
@@ -290,6 +588,9 @@ class QuarkIpam(object):
             # Based on the above, this should only fail if a MAC was
             # was explicitly chosen at some point. As such, fall through
             # here and get in line for a new MAC address to try
+            attempt = None
+            if ipam_log:
+                attempt = ipam_log.make_entry("mac_create")
             try:
                 mac_readable = str(netaddr.EUI(next_address))
                 LOG.info("Attempting to create new MAC {0} "
@@ -302,13 +603,259 @@ class QuarkIpam(object):
                              "address {1}".format(port_id, mac_readable))
                     return address
             except Exception:
+                if attempt:
+                    attempt.failed("conflict")
                 LOG.info("Failed to create new MAC {0}".format(mac_readable))
                 LOG.exception("Error in creating mac. MAC possibly duplicate")
                 continue
+            finally:
+                if attempt:
+                    attempt.end()
 
+        if ipam_log:
+            ipam_log.failed()
         raise exceptions.MacAddressGenerationFailure(net_id=net_id)
 
-    @synchronized(named("reallocate_ip"))
+    def _reallocate_mac_from_free_list(self, elevated, update_kwargs,
+                                       filter_kwargs):
+        """Claims one of the longest deallocated MACs.
+
+        Works like _reallocate_from_free_list, over quark_mac_addresses.
+        """
+        skip_locked = CONF.QUARK.ipam_use_skip_locked
+        with elevated.session.begin():
+            candidates = db_api.mac_address_reallocate_candidates(
+                elevated, CONF.QUARK.ipam_reallocate_window,
+                skip_locked=skip_locked, **filter_kwargs)
+            if not candidates:
+                return False, None
+            if not skip_locked:
+                _spread_random.shuffle(candidates)
+            for address in candidates:
+                if db_api.mac_address_reallocate_claim(
+                        elevated, address, update_kwargs, **filter_kwargs):
+                    return True, db_api.mac_address_reallocate_claimed(
+                        elevated, address)
+            LOG.info("All {0} MAC reallocation candidates were claimed by "
+                     "others".format(len(candidates)))
+            return True, None
+
+    def _take_leased_mac_address(self, context, lease_key,
+                                 use_forbidden_mac_range):
+        expired = MAC_LEASES.reap()
+        if expired:
+            return_mac_leases(context, expired)
+
+        leased = MAC_LEASES.take(lease_key)
+        if not leased:
+            return
+
+        range_id, address = leased
+        mac_range = db_api.mac_address_range_find(
+            context.elevated(), id=range_id, scope=db_api.ONE)
+        if not mac_range or (mac_range["do_not_use"] and
+                             not use_forbidden_mac_range):
+            LOG.info("Leased MAC range {0} is no longer usable, returning "
+                     "lease".format(range_id))
+            return_mac_leases(context, MAC_LEASES.release(lease_key, range_id,
+                                                          address))
+            return
+        return leased
+
+    def _lease_mac_addresses(self, context, lease_key,
+                             use_forbidden_mac_range):
+        """Reserves a block of new MACs and leases all but the first.
+
+        Returns the range id and the first MAC of the block, or None if
+        there's no range left to reserve from.
+        """
+        with context.session.begin():
+            rng = db_api.mac_address_range_find_for_lease(
+                context, use_forbidden_mac_range=use_forbidden_mac_range)
+            if not rng:
+                LOG.info("No MAC ranges could be found given the criteria")
+                return
+
+            start = rng["next_auto_assign_mac"]
+            last = rng["last_address"]
+            count = min(CONF.QUARK.mac_address_lease_size, last - start + 1)
+            if count < 1:
+                LOG.info("MAC range {0} is full".format(rng["cidr"]))
+                db_api.mac_range_update_set_full(context, rng)
+                return rng["id"], None
+            if start + count > last:
+                db_api.mac_range_update_set_full(context, rng)
+            else:
+                db_api.mac_range_update_next_auto_assign_mac(context, rng,
+                                                             count=count)
+
+        MAC_LEASES.grant(lease_key, rng["id"], start + 1, start + count - 1,
+                         CONF.QUARK.ipam_lease_ttl)
+        return rng["id"], start
+
+    def _allocate_leased_mac_address(self, context, net_id, port_id,
+                                     use_forbidden_mac_range=False,
+                                     ipam_log=None):
+        """Creates a new MAC out of a block leased by this worker.
+
+        Ranges are only locked when a new block is reserved, and never
+        have their MACs counted.
+        """
+        lease_key = bool(use_forbidden_mac_range)
+        for retry in xrange(CONF.QUARK.mac_address_retry_max):
+            LOG.info("Attemping to create a new leased MAC, attempt {0} of "
+                     "{1}".format(retry + 1,
+                                  CONF.QUARK.mac_address_retry_max))
+            with ipam_timed(ipam_log, "mac_select_range"):
+                leased = self._take_leased_mac_address(
+                    context, lease_key, use_forbidden_mac_range)
+                if not leased:
+                    try:
+                        leased = self._lease_mac_addresses(
+                            context, lease_key, use_forbidden_mac_range)
+                    except Exception:
+                        LOG.exception("Error in leasing MAC addresses")
+                        continue
+            if not leased:
+                break
+            range_id, next_address = leased
+            if next_address is None:
+                continue
+
+            # NOTE: This only fails if the MAC was explicitly chosen at
+            #       some point, so move on to the next one.
+            attempt = None
+            if ipam_log:
+                attempt = ipam_log.make_entry("mac_create")
+            mac_readable = str(netaddr.EUI(next_address))
+            try:
+                with context.session.begin():
+                    address = db_api.mac_address_create(
+                        context, address=next_address,
+                        mac_address_range_id=range_id)
+                LOG.info("MAC assignment for port ID {0} completed with "
+                         "address {1}".format(port_id, mac_readable))
+                return address
+            except Exception:
+                if attempt:
+                    attempt.failed("conflict")
+                LOG.info("Failed to create new MAC {0}".format(mac_readable))
+                LOG.exception("Error in creating mac. MAC possibly duplicate")
+                continue
+            finally:
+                if attempt:
+                    attempt.end()
+
+        if ipam_log:
+            ipam_log.failed()
+        raise exceptions.MacAddressGenerationFailure(net_id=net_id)
+
+    def allocate_mac_addresses(self, context, net_id, port_ids, reuse_after,
+                               use_forbidden_mac_range=False):
+        """Allocates a MAC for each of port_ids at once.
+
+        Deallocated MACs are claimed with one UPDATE, and the rest are
+        reserved as a block per MAC range and inserted with one
+        executemany. Returns the MACs in port_ids order.
+        """
+        count = len(port_ids)
+        LOG.info("Attempting to allocate {0} MAC addresses - [{1}]".format(
+            count, utils.pretty_kwargs(network_id=net_id)))
+
+        macs = []
+        elevated = context.elevated()
+        try:
+            with elevated.session.begin():
+                macs.extend(db_api.mac_address_reallocate_bulk(
+                    elevated, count, claim_token(),
+                    {"deallocated": False, "deallocated_at": None},
+                    reuse_after=reuse_after, deallocated=True))
+        except Exception:
+            LOG.exception("Error in bulk mac reallocate...")
+        LOG.info("Reallocated {0} deallocated MACs".format(len(macs)))
+
+        for retry in xrange(CONF.QUARK.mac_address_retry_max):
+            if len(macs) >= count:
+                break
+            try:
+                with context.session.begin():
+                    fn = db_api.mac_address_range_find_allocation_counts
+                    mac_range = fn(
+                        context,
+                        use_forbidden_mac_range=use_forbidden_mac_range)
+                    if not mac_range:
+                        LOG.info("No MAC ranges could be found given "
+                                 "the criteria")
+                        break
+
+                    rng, addr_count = mac_range
+                    first = rng["first_address"]
+                    last = rng["last_address"]
+                    if (last - first + 1) <= addr_count:
+                        db_api.mac_range_update_set_full(context, rng)
+                        LOG.info("MAC range {0} is full".format(rng["cidr"]))
+                        continue
+
+                    # NOTE: The range row is locked by the find above, so
+                    #       the block can't overlap another worker's. The
+                    #       marker is committed before the insert, so a
+                    #       conflict can't hand the same block out again.
+                    start = rng["next_auto_assign_mac"]
+                    reserved = min(count - len(macs), last - start + 1)
+                    if start + reserved > last:
+                        db_api.mac_range_update_set_full(context, rng)
+                    else:
+                        db_api.mac_range_update_next_auto_assign_mac(
+                            context, rng, count=reserved)
+            except Exception:
+                LOG.exception("Error in reserving a block of MACs")
+                continue
+            macs.extend(self._create_mac_block(
+                context, rng["id"], range(start, start + reserved)))
+
+        if len(macs) < count:
+            for mac in macs:
+                try:
+                    with context.session.begin():
+                        self.deallocate_mac_address(context, mac["address"])
+                except Exception:
+                    LOG.exception("Couldn't release MAC %s" % mac)
+            raise exceptions.MacAddressGenerationFailure(net_id=net_id)
+        return macs
+
+    def _create_mac_block(self, context, range_id, block):
+        """Creates the MACs of a reserved block that aren't taken.
+
+        MACs can exist above the marker when they were asked for
+        explicitly. If the insert still conflicts, the block is created
+        one MAC at a time.
+        """
+        try:
+            with context.session.begin():
+                taken = db_api.mac_address_find_taken(context, block)
+                if taken:
+                    LOG.info("Skipping {0} taken MACs in range {1}".format(
+                        len(taken), range_id))
+                return db_api.mac_address_create_bulk(
+                    context, [mac for mac in block if mac not in taken],
+                    range_id)
+        except Exception:
+            LOG.exception("Error in bulk creating MACs. MACs possibly "
+                          "duplicate, creating them one at a time")
+
+        created = []
+        for mac in block:
+            try:
+                with context.session.begin():
+                    created.append(db_api.mac_address_create(
+                        context, address=mac,
+                        mac_address_range_id=range_id))
+            except Exception:
+                LOG.info("Failed to create new MAC {0}".format(
+                    str(netaddr.EUI(mac))))
+        return created
+
+    @ipam_locks.synchronized("reallocate_ip")
     def attempt_to_reallocate_ip(self, context, net_id, port_id, reuse_after,
                                  version=None, ip_address=None,
                                  segment_id=None, subnets=None, **kwargs):
@@ -373,31 +920,34 @@ class QuarkIpam(object):
             LOG.info("Attempt {0} of {1}".format(
                 retry + 1, CONF.QUARK.ip_address_retry_max))
             try:
-                with context.session.begin():
-                    transaction = db_api.transaction_create(context)
                 m = models.IPAddress
                 update_kwargs = {
-                    m.transaction_id: transaction.id,
                     m.address_type: kwargs.get("address_type", ip_types.FIXED),
                     m.deallocated: False,
                     m.deallocated_at: None,
                     m.used_by_tenant_id: context.tenant_id,
                     m.allocated_at: timeutils.utcnow(),
                 }
-                result = db_api.ip_address_reallocate(
-                    elevated, update_kwargs, **ip_kwargs)
+                claim = CONF.QUARK.ipam_reallocate_claim
+                if claim == "free_list":
+                    result, updated_address = self._reallocate_from_free_list(
+                        elevated, update_kwargs, ip_kwargs)
+                elif claim == "token":
+                    result, updated_address = self._reallocate_by_token(
+                        elevated, update_kwargs, ip_kwargs)
+                else:
+                    result, updated_address = self._reallocate_by_transaction(
+                        context, elevated, update_kwargs, ip_kwargs)
                 if not result:
                     LOG.info("Couldn't update any reallocatable addresses "
                              "given the criteria")
                     if attempt:
-                        attempt.failed()
+                        attempt.failed("none_reallocatable")
                     break
 
-                updated_address = db_api.ip_address_reallocate_find(
-                    elevated, transaction.id)
                 if not updated_address:
                     if attempt:
-                        attempt.failed()
+                        attempt.failed("claim_lost")
                     continue
 
                 LOG.info("Address {0} is reallocated".format(
@@ -405,13 +955,71 @@ class QuarkIpam(object):
                 return [updated_address]
             except Exception:
                 if attempt:
-                    attempt.failed()
+                    attempt.failed("error")
                 LOG.exception("Error in reallocate ip...")
             finally:
                 if attempt:
                     attempt.end()
         return []
 
+    def _reallocate_by_transaction(self, context, elevated, update_kwargs,
+                                   ip_kwargs):
+        """Claims the first match with UPDATE LIMIT 1 and finds it again.
+
+        Returns whether anything was claimed and the checked address.
+        """
+        with context.session.begin():
+            transaction = db_api.transaction_create(context)
+        update_kwargs[models.IPAddress.transaction_id] = transaction.id
+        if not db_api.ip_address_reallocate(elevated, update_kwargs,
+                                            **ip_kwargs):
+            return False, None
+        return True, db_api.ip_address_reallocate_find(elevated,
+                                                       transaction.id)
+
+    def _reallocate_by_token(self, elevated, update_kwargs, ip_kwargs):
+        """Like _reallocate_by_transaction, tagging with a claim token.
+
+        The token is written by the same UPDATE that claims the row, so
+        this is a single write.
+        """
+        token = claim_token()
+        update_kwargs[models.IPAddress.claim_token] = token
+        if not db_api.ip_address_reallocate(elevated, update_kwargs,
+                                            **ip_kwargs):
+            return False, None
+        return True, db_api.ip_address_reallocate_find(elevated,
+                                                       claim_token=token)
+
+    def _reallocate_from_free_list(self, elevated, update_kwargs, ip_kwargs):
+        """Claims one of the longest deallocated matches.
+
+        With SKIP LOCKED the candidates are already ours and the first one
+        is taken. Otherwise they're shuffled so concurrent workers spread
+        out over the window instead of all racing for the oldest row, and
+        claimed with a compare-and-swap UPDATE. Either way no
+        quark_transactions row is needed.
+
+        Returns whether there was anything to claim and the checked address.
+        """
+        skip_locked = CONF.QUARK.ipam_use_skip_locked
+        with elevated.session.begin():
+            candidates = db_api.ip_address_reallocate_candidates(
+                elevated, CONF.QUARK.ipam_reallocate_window,
+                skip_locked=skip_locked, **ip_kwargs)
+            if not candidates:
+                return False, None
+            if not skip_locked:
+                _spread_random.shuffle(candidates)
+            for address_id in candidates:
+                if db_api.ip_address_reallocate_claim(
+                        elevated, address_id, update_kwargs, **ip_kwargs):
+                    return True, db_api.ip_address_reallocate_claimed(
+                        elevated, address_id)
+            LOG.info("All {0} reallocation candidates were claimed by "
+                     "others".format(len(candidates)))
+            return True, None
+
     def is_strategy_satisfied(self, ip_addresses, allocate_complete=False):
         return ip_addresses
 
@@ -424,21 +1032,29 @@ class QuarkIpam(object):
                                                  port_id=port_id,
                                                  ip_address=ip_address)))
 
-        ip_policy_cidrs = models.IPPolicy.get_ip_policy_cidrs(subnet)
+        policy = ip_policy_index.for_subnet(subnet)
         next_ip = ip_address
+        leased_ip = getattr(subnet, "leased_ip", None)
+        probe_ip = getattr(subnet, "probe_ip", None)
         if not next_ip:
-            if subnet["next_auto_assign_ip"] != -1:
-                next_ip = netaddr.IPAddress(subnet["next_auto_assign_ip"] - 1)
+            if leased_ip is not None:
+                subnet.leased_ip = None
+                next_value = leased_ip
+            elif probe_ip is not None:
+                subnet.probe_ip = None
+                next_value = probe_ip
+            elif subnet["next_auto_assign_ip"] != -1:
+                next_value = subnet["next_auto_assign_ip"] - 1
             else:
-                next_ip = netaddr.IPAddress(subnet["last_ip"])
+                next_value = subnet["last_ip"]
+            if netaddr.IPAddress(next_value) in policy:
+                next_value = self._skip_to_allowed_ip(context, net_id,
+                                                      subnet, next_value)
+            next_ip = netaddr.IPAddress(next_value)
             if subnet["ip_version"] == 4:
                 next_ip = next_ip.ipv4()
 
         LOG.info("Next IP is {0}".format(str(next_ip)))
-        if ip_policy_cidrs and next_ip in ip_policy_cidrs and not ip_address:
-            LOG.info("Next IP {0} violates policy".format(str(next_ip)))
-            raise q_exc.IPAddressPolicyRetryableFailure(ip_addr=next_ip,
-                                                        net_id=net_id)
         try:
             with context.session.begin():
                 address = db_api.ip_address_create(
@@ -491,52 +1107,70 @@ class QuarkIpam(object):
             if mac:
                 mac = kwargs["mac_address"].get("address")
 
-            ip_policy_cidrs = models.IPPolicy.get_ip_policy_cidrs(subnet)
+            policy = ip_policy_index.for_subnet(subnet)
+            candidates = []
             for tries, ip_address in enumerate(
                     generate_v6(mac, port_id, subnet["cidr"])):
-
-                LOG.info("Attempt {0} of {1}".format(
-                    tries + 1, CONF.QUARK.v6_allocation_attempts))
-
                 if tries > CONF.QUARK.v6_allocation_attempts - 1:
-                    LOG.info("Exceeded v6 allocation attempts, bailing")
-                    raise exceptions.IpAddressGenerationFailure(
-                        net_id=net_id)
+                    break
 
                 ip_address = netaddr.IPAddress(ip_address).ipv6()
                 LOG.info("Generated a new v6 address {0}".format(
                     str(ip_address)))
 
-                # NOTE(mdietz): treating the IPSet as a boolean caused netaddr
-                #               to attempt to enumerate the entire set!
-                if (ip_policy_cidrs is not None and
-                        ip_address in ip_policy_cidrs):
+                if ip_address in policy:
                     LOG.info("Address {0} excluded by policy".format(
                         str(ip_address)))
                     continue
+                candidates.append(ip_address)
+
+            if not candidates:
+                LOG.info("Exceeded v6 allocation attempts, bailing")
+                raise exceptions.IpAddressGenerationFailure(net_id=net_id)
+
+            # NOTE: All candidates are looked up at once, so only a claim or
+            #       an insert that loses a race costs another round trip.
+            existing = db_api.ip_address_find(
+                context, network_id=net_id, ip_address=candidates,
+                subnet_id=subnet["id"], scope=db_api.ALL) or []
+            existing = dict((a["address"], a) for a in existing)
+            LOG.info("{0} of {1} v6 candidates already exist".format(
+                len(existing), len(candidates)))
+
+            for tries, ip_address in enumerate(candidates):
+                LOG.info("Attempt {0} of {1}".format(
+                    tries + 1, len(candidates)))
 
-                # TODO(mdietz): replace this with a compare-and-swap loop
-                with context.session.begin():
-                    address = db_api.ip_address_find(
-                        context, network_id=net_id, ip_address=ip_address,
-                        scope=db_api.ONE, reuse_after=reuse_after,
-                        deallocated=True, subnet_id=subnet["id"],
-                        lock_mode=True)
-
-                    if address:
-                        LOG.info("Address {0} exists, claiming".format(
+                found = existing.get(ip_address.value)
+                if found is not None:
+                    if not found["deallocated"]:
+                        LOG.info("Address {0} is allocated, skipping".format(
                             str(ip_address)))
-                        return db_api.ip_address_update(
-                            context, address, deallocated=False,
-                            deallocated_at=None,
-                            used_by_tenant_id=context.tenant_id,
-                            allocated_at=timeutils.utcnow(),
-                            address_type=kwargs.get('address_type',
-                                                    ip_types.FIXED))
+                        continue
+
+                    # TODO(mdietz): replace this with a compare-and-swap loop
+                    with context.session.begin():
+                        address = db_api.ip_address_find(
+                            context, id=found["id"], scope=db_api.ONE,
+                            reuse_after=reuse_after, deallocated=True,
+                            lock_mode=True)
+
+                        if address:
+                            LOG.info("Address {0} exists, claiming".format(
+                                str(ip_address)))
+                            return db_api.ip_address_update(
+                                context, address, deallocated=False,
+                                deallocated_at=None,
+                                used_by_tenant_id=context.tenant_id,
+                                allocated_at=timeutils.utcnow(),
+                                address_type=kwargs.get('address_type',
+                                                        ip_types.FIXED))
+                    LOG.info("Address {0} is not reusable yet".format(
+                        str(ip_address)))
+                    continue
 
-                # This triggers when the IP is allocated to another tenant,
-                # either because we missed it due to our filters above, or
-                # in an extremely unlikely race between the find and here.
+                # This triggers when the IP was allocated since the lookup
+                # above, in a race with another port.
                 try:
                     with context.session.begin():
                         return db_api.ip_address_create(
@@ -551,6 +1185,9 @@ class QuarkIpam(object):
                     LOG.debug("Duplicate entry found when inserting subnet_id"
                               " %s ip_address %s", subnet["id"], ip_address)
 
+            LOG.info("Exceeded v6 allocation attempts, bailing")
+            raise exceptions.IpAddressGenerationFailure(net_id=net_id)
+
     def _allocate_ips_from_subnets(self, context, new_addresses, net_id,
                                    subnets, port_id, reuse_after,
                                    ip_address=None, **kwargs):
@@ -588,14 +1225,9 @@ class QuarkIpam(object):
 
     def _notify_new_addresses(self, context, new_addresses):
         for addr in new_addresses:
-            payload = dict(used_by_tenant_id=addr["used_by_tenant_id"],
-                           ip_block_id=addr["subnet_id"],
-                           ip_address=addr["address_readable"],
-                           device_ids=[p["device_id"] for p in addr["ports"]],
-                           created_at=addr["created_at"])
-            n_rpc.get_notifier("network").info(context,
-                                               "ip_block.address.create",
-                                               payload)
+            ipam_notifications.notify(
+                context, "ip_block.address.create",
+                ipam_notifications.address_payload(addr))
 
     @ipam_logged
     def allocate_ip_address(self, context, new_addresses, net_id, port_id,
@@ -629,29 +1261,31 @@ class QuarkIpam(object):
                     attempt = ipam_log.make_entry("_try_allocate_ip_address")
                 LOG.info("Allocating new IP attempt {0} of {1}".format(
                     retry + 1, CONF.QUARK.ip_address_retry_max))
-                if not sub:
-                    subnets = self._choose_available_subnet(
-                        elevated, net_id, version, segment_id=segment_id,
-                        ip_address=ip_addr, reallocated_ips=new_addresses)
-                else:
-                    subnets = [self.select_subnet(context, net_id,
-                                                  ip_addr, segment_id,
-                                                  subnet_ids=[sub])]
+                with ipam_timed(ipam_log, "select_subnet"):
+                    if not sub:
+                        subnets = self._choose_available_subnet(
+                            elevated, net_id, version, segment_id=segment_id,
+                            ip_address=ip_addr,
+                            reallocated_ips=new_addresses)
+                    else:
+                        subnets = [self.select_subnet(context, net_id,
+                                                      ip_addr, segment_id,
+                                                      subnet_ids=[sub])]
                 LOG.info("Subnet selection returned {0} viable subnet(s) - "
                          "IDs: {1}".format(len(subnets),
                                            ", ".join([str(s["id"])
                                                       for s in subnets if s])))
 
                 try:
-                    self._allocate_ips_from_subnets(context, new_addresses,
-                                                    net_id, subnets,
-                                                    port_id, reuse_after,
-                                                    ip_addr, **kwargs)
+                    with ipam_timed(ipam_log, "create"):
+                        self._allocate_ips_from_subnets(
+                            context, new_addresses, net_id, subnets,
+                            port_id, reuse_after, ip_addr, **kwargs)
                 except q_exc.IPAddressRetryableFailure:
                     LOG.exception("Error in allocating IP")
                     if attempt:
                         LOG.debug("ATTEMPT FAILED")
-                        attempt.failed()
+                        attempt.failed("conflict")
                     remaining = CONF.QUARK.ip_address_retry_max - retry - 1
                     if remaining > 0:
                         LOG.info("{0} retries remain, retrying...".format(
@@ -699,35 +1333,262 @@ class QuarkIpam(object):
 
         raise exceptions.IpAddressGenerationFailure(net_id=net_id)
 
+    def allocate_ip_addresses_bulk(self, context, new_addresses, net_id,
+                                   port_ids, reuse_after, segment_id=None,
+                                   mac_addresses=None, **kwargs):
+        """Allocates addresses for several ports on one network at once.
+
+        v4 addresses are reallocated with one claim and then reserved as
+        blocks of consecutive addresses, each inserted with one
+        executemany. Whatever else the strategy needs is allocated per
+        port, and ports that got no v4 address fall back to
+        allocate_ip_address. Notifications go out as one batch.
+
+        new_addresses is filled in with port_id -> addresses as they are
+        allocated, so the caller can release them on failure.
+        """
+        elevated = context.elevated()
+        mac_addresses = mac_addresses or {}
+        for port_id in port_ids:
+            new_addresses.setdefault(port_id, [])
+
+        LOG.info("Starting a bulk IP address allocation for {0} ports. "
+                 "Strategy is {1} - [{2}]".format(
+                     len(port_ids), self.get_name(),
+                     utils.pretty_kwargs(network_id=net_id,
+                                         segment_id=segment_id)))
+
+        v4 = self._reallocate_v4_bulk(context, net_id, len(port_ids),
+                                      reuse_after, segment_id, **kwargs)
+        reallocated = len(v4)
+        if len(v4) < len(port_ids):
+            v4.extend(self._allocate_v4_blocks(
+                context, net_id, len(port_ids) - len(v4), segment_id,
+                **kwargs))
+        for port_id, address in zip(port_ids, v4):
+            new_addresses[port_id].append(address)
+
+        with_v4 = port_ids[:len(v4)]
+        if with_v4 and not self.is_strategy_satisfied(
+                new_addresses[with_v4[0]]):
+            subnets = self._choose_available_subnet(
+                elevated, net_id, segment_id=segment_id,
+                reallocated_ips=new_addresses[with_v4[0]])
+            for port_id in with_v4:
+                self._allocate_ips_from_subnets(
+                    context, new_addresses[port_id], net_id, subnets,
+                    port_id, reuse_after,
+                    mac_address=mac_addresses.get(port_id), **kwargs)
+                if not self.is_strategy_satisfied(new_addresses[port_id],
+                                                  allocate_complete=True):
+                    raise exceptions.IpAddressGenerationFailure(
+                        net_id=net_id)
+        # NOTE: As in allocate_ip_address, ports that only got reallocated
+        #       addresses aren't notified.
+        notified = []
+        for i, port_id in enumerate(with_v4):
+            if i >= reallocated or len(new_addresses[port_id]) > 1:
+                notified.extend(new_addresses[port_id])
+        self._notify_new_addresses(context, notified)
+
+        for port_id in port_ids[len(v4):]:
+            LOG.info("No bulk v4 address left for port ID {0}, falling back "
+                     "to allocating on its own".format(port_id))
+            self.allocate_ip_address(
+                context, new_addresses[port_id], net_id, port_id,
+                reuse_after, segment_id=segment_id,
+                mac_address=mac_addresses.get(port_id), **kwargs)
+        return new_addresses
+
+    def _reallocate_v4_bulk(self, context, net_id, count, reuse_after,
+                            segment_id=None, **kwargs):
+        elevated = context.elevated()
+        ip_kwargs = {
+            "network_id": net_id,
+            "reuse_after": reuse_after,
+            "deallocated": True,
+            "version": 4,
+        }
+        if segment_id:
+            subnets = db_api.subnet_find(elevated, network_id=net_id,
+                                         segment_id=segment_id)
+            ip_kwargs["subnet_id"] = [s["id"] for s in subnets]
+            if not ip_kwargs["subnet_id"]:
+                return []
+
+        m = models.IPAddress
+        update_kwargs = {
+            m.address_type: kwargs.get("address_type", ip_types.FIXED),
+            m.deallocated: False,
+            m.deallocated_at: None,
+            m.used_by_tenant_id: context.tenant_id,
+            m.allocated_at: timeutils.utcnow(),
+        }
+        try:
+            with elevated.session.begin():
+                addresses = db_api.ip_address_reallocate_bulk(
+                    elevated, count, claim_token(), update_kwargs,
+                    **ip_kwargs)
+        except Exception:
+            LOG.exception("Error in bulk reallocate ip...")
+            return []
+        LOG.info("Reallocated {0} deallocated v4 addresses".format(
+            len(addresses)))
+        return addresses
+
+    def _allocate_v4_blocks(self, context, net_id, count, segment_id=None,
+                            **kwargs):
+        """Creates up to count new v4 addresses in as few blocks as possible.
+
+        Blocks are reserved in a transaction of their own, so the marker
+        stays past them even when inserting one fails, and a retry never
+        reserves the same block again.
+        """
+        address_type = kwargs.get("address_type", ip_types.FIXED)
+        addresses = []
+        for retry in xrange(CONF.QUARK.ip_address_retry_max):
+            if len(addresses) >= count:
+                break
+            LOG.info("Reserving {0} new v4 addresses, attempt {1} of "
+                     "{2}".format(count - len(addresses), retry + 1,
+                                  CONF.QUARK.ip_address_retry_max))
+            blocks = []
+            try:
+                with context.session.begin():
+                    subnets = db_api.subnet_find_ordered_by_most_full(
+                        context, net_id, segment_id=segment_id,
+                        scope=db_api.ALL, ip_version=4)
+                    reserved = 0
+                    for subnet, ips_in_subnet in subnets:
+                        block = self._reserve_v4_block(
+                            context, subnet,
+                            count - len(addresses) - reserved)
+                        if block:
+                            blocks.append((subnet, block))
+                            reserved += len(block)
+                        if len(addresses) + reserved >= count:
+                            break
+            except Exception:
+                LOG.exception("Error in reserving v4 address blocks")
+                continue
+            if not blocks:
+                LOG.info("No v4 subnets found given the search criteria!")
+                break
+            for subnet, block in blocks:
+                addresses.extend(self._create_v4_block(
+                    context, subnet, block, address_type))
+        return addresses
+
+    def _create_v4_block(self, context, subnet, block, address_type):
+        """Creates the addresses of a reserved block that aren't taken.
+
+        Addresses can exist above the marker when they were asked for
+        explicitly or probed at random. If the insert still conflicts, the
+        block is created one address at a time.
+        """
+        ips = [netaddr.IPAddress(ip).ipv4() for ip in block]
+        try:
+            with context.session.begin():
+                taken = db_api.ip_address_find_taken(context, subnet["id"],
+                                                     ips)
+                if taken:
+                    LOG.info("Skipping {0} taken addresses in subnet "
+                             "{1}".format(len(taken), subnet["id"]))
+                return db_api.ip_address_create_bulk(
+                    context, [ip for ip in ips if int(ip.ipv6()) not in taken],
+                    subnet, address_type=address_type)
+        except Exception:
+            LOG.exception("Error in bulk creating IPs. IPs possibly "
+                          "duplicate, creating them one at a time")
+
+        created = []
+        for ip in ips:
+            try:
+                with context.session.begin():
+                    created.append(db_api.ip_address_create(
+                        context, address=ip, subnet_id=subnet["id"],
+                        deallocated=0, version=subnet["ip_version"],
+                        network_id=subnet["network_id"],
+                        address_type=address_type))
+            except Exception:
+                LOG.info("Failed to create new IP {0}".format(ip))
+        return created
+
+    def _reserve_v4_block(self, context, subnet, count):
+        """Moves next_auto_assign_ip past up to count allowed addresses.
+
+        Returns the reserved addresses, in the subnet's integer space.
+        """
+        marker = subnet["next_auto_assign_ip"]
+        last = subnet["last_ip"]
+        if marker < subnet["first_ip"] or marker > last:
+            db_api.subnet_update_set_full(context, subnet)
+            return []
+
+        # NOTE: Policy exclusions are always v6 integers, see
+        #       _skip_policy_exclusions.
+        delta = netaddr.IPAddress(marker).ipv6().value - marker
+        policy = ip_policy_index.for_subnet(subnet)
+        block = []
+        for first, run_last in policy.allowed_ranges(marker + delta,
+                                                     last + delta):
+            taken = min(count - len(block), run_last - first + 1)
+            block.extend(xrange(first - delta, first - delta + taken))
+            if len(block) >= count:
+                break
+
+        if not block or block[-1] >= last:
+            LOG.info("Marking subnet {0} as full".format(subnet["id"]))
+            db_api.subnet_update_set_full(context, subnet)
+        else:
+            db_api.subnet_update_next_auto_assign_ip(
+                context, subnet, count=block[-1] + 1 - marker)
+        return block
+
     def deallocate_ip_address(self, context, address):
-        address["deallocated"] = 1
-        address["address_type"] = None
-        payload = dict(used_by_tenant_id=address["used_by_tenant_id"],
-                       ip_block_id=address["subnet_id"],
-                       ip_address=address["address_readable"],
-                       device_ids=[p["device_id"] for p in address["ports"]],
-                       created_at=address["created_at"],
-                       deleted_at=timeutils.utcnow())
-        n_rpc.get_notifier("network").info(context,
-                                           "ip_block.address.delete",
-                                           payload)
+        # NOTE: Payloads never load the ports themselves, read them while
+        #       the caller's session still has the address.
+        device_ids = [p["device_id"] for p in address["ports"]]
+        db_api.ip_address_update(context, address, deallocated=1,
+                                 address_type=None)
+        ipam_notifications.notify(
+            context, "ip_block.address.delete",
+            ipam_notifications.address_payload(
+                address, device_ids=device_ids,
+                deleted_at=timeutils.utcnow()))
 
     def deallocate_ips_by_port(self, context, port=None, **kwargs):
-        ips_removed = []
-        for addr in port["ip_addresses"]:
-            if "ip_address" in kwargs:
-                ip = kwargs["ip_address"]
-                if ip != netaddr.IPAddress(int(addr["address"])):
-                    continue
+        """Deallocates the port's addresses that no other port uses.
 
-            # Note: only deallocate ip if this is the
-            # only port mapped
-            if len(addr["ports"]) == 1:
-                self.deallocate_ip_address(context, addr)
-            ips_removed.append(addr)
+        They are marked deallocated with one UPDATE and their notifications
+        are sent together, however many addresses the port has.
+        """
+        ip_value = None
+        if kwargs.get("ip_address") is not None:
+            ip_value = int(kwargs["ip_address"])
+        ips_removed = [addr for addr in port["ip_addresses"]
+                       if ip_value is None or int(addr["address"]) == ip_value]
+        if not ips_removed:
+            return
 
-        port["ip_addresses"] = list(
-            set(port["ip_addresses"]) - set(ips_removed))
+        # Note: only deallocate ip if this is the
+        # only port mapped
+        port_counts = db_api.ip_address_port_counts(context, ips_removed)
+        to_deallocate = [addr for addr in ips_removed
+                         if port_counts.get(addr["id"]) == 1]
+        if to_deallocate:
+            db_api.ip_address_deallocate_bulk(context, to_deallocate)
+            deleted_at = timeutils.utcnow()
+            ipam_notifications.notify_many(
+                context, "ip_block.address.delete",
+                [ipam_notifications.address_payload(
+                    addr, device_ids=[port["device_id"]],
+                    deleted_at=deleted_at)
+                 for addr in to_deallocate])
+
+        removed = set(ips_removed)
+        port["ip_addresses"] = [addr for addr in port["ip_addresses"]
+                                if addr not in removed]
 
     def deallocate_mac_address(self, context, address):
         mac = db_api.mac_address_find(context, address=address,
@@ -742,10 +1603,77 @@ class QuarkIpam(object):
             db_api.mac_address_update(context, mac, deallocated=True,
                                       deallocated_at=timeutils.utcnow())
 
+    def _probe_v4_address(self, subnet, ip_policy, ips_in_subnet):
+        return None
+
+    def _skip_policy_exclusions(self, ip, ip_policy):
+        """Moves ip past the policy exclusions it falls into.
+
+        Returns the new ip and the exclusive end of the run of allowed
+        addresses starting there, or None if the run isn't bounded by the
+        policy. Both are in the same integer space as ip.
+        """
+        policy = ip_policy_index.for_policy(ip_policy)
+        if not policy:
+            return ip, None
+        # NOTE: Policy CIDRs are always stored as v6 integers, but subnets
+        #       created outside of the Subnet.cidr setter may not be.
+        mapped = netaddr.IPAddress(ip).ipv6().value
+        skipped, run_end = policy.skip(mapped)
+        if run_end is not None:
+            run_end += ip - mapped
+        return ip + skipped - mapped, run_end
+
+    def _skip_to_allowed_ip(self, context, net_id, subnet, ip):
+        """Moves ip past the policy exclusions it falls into and claims it.
+
+        next_auto_assign_ip is moved past the new ip so nobody else hands it
+        out. Raises IPAddressRetryableFailure when the rest of the subnet is
+        excluded, or when another worker already moved past the new ip.
+        """
+        skipped, run_end = self._skip_policy_exclusions(
+            ip, subnet.get("ip_policy"))
+        if skipped > subnet["last_ip"]:
+            LOG.info("Rest of subnet {0} is excluded by policy, marking it "
+                     "full".format(subnet["id"]))
+            db_api.subnet_update_set_full(context, subnet)
+            raise q_exc.IPAddressRetryableFailure(
+                ip_addr=netaddr.IPAddress(ip), net_id=net_id)
+        LOG.info("Skipping policy exclusions {0} through {1} in subnet "
+                 "{2}".format(ip, skipped - 1, subnet["id"]))
+        if not db_api.subnet_update_next_auto_assign_ip_past(
+                context, subnet, skipped):
+            raise q_exc.IPAddressRetryableFailure(
+                ip_addr=netaddr.IPAddress(skipped), net_id=net_id)
+        return skipped
+
+    def _select_leased_subnet(self, context, lease_key):
+        expired = IP_LEASES.reap()
+        if expired:
+            return_ip_leases(context, expired)
+
+        leased = IP_LEASES.take(lease_key)
+        if not leased:
+            return
+
+        subnet_id, leased_ip = leased
+        subnet = db_api.subnet_find(context, id=subnet_id, scope=db_api.ONE)
+        if not subnet or subnet["do_not_use"]:
+            LOG.info("Leased subnet {0} is no longer usable, returning "
+                     "lease".format(subnet_id))
+            return_ip_leases(context, IP_LEASES.release(lease_key, subnet_id,
+                                                        leased_ip))
+            return
+
+        LOG.info("Using leased address {0} from subnet {1}".format(
+            leased_ip, subnet_id))
+        subnet.leased_ip = leased_ip
+        return subnet
+
     # RM6180(roaet):
     # - removed session.begin due to deadlocks
     # - fix off-by-one error and overflow
-    @synchronized(named("select_subnet"))
+    @ipam_locks.synchronized("select_subnet")
     def select_subnet(self, context, net_id, ip_address, segment_id,
                       subnet_ids=None, **filters):
         LOG.info("Selecting subnet(s) - (Step 2 of 3) [{0}]".format(
@@ -753,71 +1681,193 @@ class QuarkIpam(object):
                                 segment_id=segment_id, subnet_ids=subnet_ids,
                                 ip_version=filters.get("ip_version"))))
 
+        lease_key = None
+        if (CONF.QUARK.ipam_v4_lease_size > 1 and not ip_address and
+                not subnet_ids and filters.get("ip_version", 4) == 4):
+            lease_key = (net_id, segment_id, filters.get("ip_version"))
+            subnet = self._select_leased_subnet(context, lease_key)
+            if subnet:
+                return subnet
+
+        top_k = 0
+        if not ip_address and not subnet_ids:
+            top_k = subnet_spread_top_k(net_id)
+
         with context.session.begin():
             subnets = db_api.subnet_find_ordered_by_most_full(
                 context, net_id, segment_id=segment_id, scope=db_api.ALL,
-                subnet_id=subnet_ids, **filters)
+                subnet_id=subnet_ids, lock_mode=top_k < 2, **filters)
 
             if not subnets:
                 LOG.info("No subnets found given the search criteria!")
 
-            for subnet, ips_in_subnet in subnets:
-                ipnet = netaddr.IPNetwork(subnet["cidr"])
-                LOG.info("Trying subnet ID: {0} - CIDR: {1}".format(
-                    subnet["id"], subnet["_cidr"]))
-                if ip_address:
-                    requested_ip = netaddr.IPAddress(ip_address)
-                    if ipnet.version == 4 and requested_ip.version != 4:
-                        requested_ip = requested_ip.ipv4()
-                    if requested_ip not in ipnet:
-                        if subnet_ids is not None:
-                            LOG.info("Requested IP {0} not in subnet {1}, "
-                                     "retrying".format(str(requested_ip),
-                                                       str(ipnet)))
-                            raise q_exc.IPAddressNotInSubnet(
-                                ip_addr=ip_address, subnet_id=subnet["id"])
-                        continue
+            return self._select_from_subnets(context, subnets, ip_address,
+                                             subnet_ids, lease_key,
+                                             top_k=top_k)
 
-                ip_policy = None
-                if not ip_address:
-                    # Policies don't prevent explicit assignment, so we only
-                    # need to check if we're allocating a new IP
-                    ip_policy = subnet.get("ip_policy")
-
-                policy_size = ip_policy["size"] if ip_policy else 0
-
-                if ipnet.size > (ips_in_subnet + policy_size - 1):
-                    if not ip_address and subnet["ip_version"] == 4:
-                        ip = subnet["next_auto_assign_ip"]
-                        # NOTE(mdietz): When atomically updated, this probably
-                        #               doesn't need the lower bounds check but
-                        #               I'm not comfortable removing it yet.
-                        updated = 0
-                        if ip < subnet["first_ip"] or ip > subnet["last_ip"]:
-                            LOG.info("Marking subnet {0} as full".format(
-                                subnet["id"]))
-                            updated = db_api.subnet_update_set_full(context,
-                                                                    subnet)
-                        else:
-                            auto_inc = db_api.subnet_update_next_auto_assign_ip
-                            updated = auto_inc(context, subnet)
+    @ipam_locks.synchronized("select_subnet")
+    def select_subnets(self, context, net_id, ip_address, segment_id,
+                       versions, subnet_ids=None, **filters):
+        """Selects a subnet for each of versions with one subnet query.
 
-                        if updated:
-                            context.session.refresh(subnet)
-                        else:
-                            # This means the subnet was marked full
-                            # while we were checking out policies.
-                            # Fall out and go back to the outer retry
-                            # loop.
-                            return
-
-                    LOG.info("Subnet {0} - {1} {2} looks viable, "
-                             "returning".format(subnet["id"], subnet["_cidr"],
-                                                subnet["next_auto_assign_ip"]))
+        The markers of every chosen subnet are moved in the same
+        transaction. Returns a dict of version to subnet, leaving out the
+        versions no subnet could be found for.
+        """
+        LOG.info("Selecting subnet(s) - (Step 2 of 3) [{0}]".format(
+            utils.pretty_kwargs(network_id=net_id, ip_address=ip_address,
+                                segment_id=segment_id, subnet_ids=subnet_ids,
+                                ip_version=versions)))
+
+        selected = {}
+        lease_key = None
+        if (4 in versions and CONF.QUARK.ipam_v4_lease_size > 1 and
+                not ip_address and not subnet_ids):
+            lease_key = (net_id, segment_id, 4)
+            subnet = self._select_leased_subnet(context, lease_key)
+            if subnet:
+                selected[4] = subnet
+
+        need_versions = [v for v in versions if v not in selected]
+        if not need_versions:
+            return selected
+        filters.pop("ip_version", None)
+        if len(need_versions) == 1:
+            filters["ip_version"] = need_versions[0]
+
+        top_k = 0
+        if not ip_address and not subnet_ids:
+            top_k = subnet_spread_top_k(net_id)
+
+        with context.session.begin():
+            subnets = db_api.subnet_find_ordered_by_most_full(
+                context, net_id, segment_id=segment_id, scope=db_api.ALL,
+                subnet_id=subnet_ids, lock_mode=top_k < 2, **filters)
+            subnets = list(subnets)
+
+            if not subnets:
+                LOG.info("No subnets found given the search criteria!")
+
+            for ver in need_versions:
+                subnet = self._select_from_subnets(
+                    context, [s for s in subnets if s[0]["ip_version"] == ver],
+                    ip_address, subnet_ids, lease_key if ver == 4 else None,
+                    top_k=top_k)
+                if subnet:
+                    selected[ver] = subnet
+        return selected
+
+    def _select_from_subnets(self, context, subnets, ip_address, subnet_ids,
+                             lease_key, top_k=0):
+        """Claims the next address of the first viable subnet.
+
+        subnets are (subnet, count) pairs, most full first. Must be called
+        in the transaction that locked them, unless top_k spreads the
+        allocation, in which case each subnet is locked as it is tried.
+        """
+        if top_k > 1:
+            subnets = spread_subnets(list(subnets), top_k)
+        for subnet, ips_in_subnet in subnets:
+            if top_k > 1:
+                subnet = db_api.subnet_lock(context, subnet)
+                if not subnet:
+                    continue
+                ips_in_subnet = (subnet["allocated_count"] +
+                                 subnet["deallocated_reusable_count"])
+            ipnet = netaddr.IPNetwork(subnet["cidr"])
+            LOG.info("Trying subnet ID: {0} - CIDR: {1}".format(
+                subnet["id"], subnet["_cidr"]))
+            if ip_address:
+                requested_ip = netaddr.IPAddress(ip_address)
+                if ipnet.version == 4 and requested_ip.version != 4:
+                    requested_ip = requested_ip.ipv4()
+                if requested_ip not in ipnet:
+                    if subnet_ids is not None:
+                        LOG.info("Requested IP {0} not in subnet {1}, "
+                                 "retrying".format(str(requested_ip),
+                                                   str(ipnet)))
+                        raise q_exc.IPAddressNotInSubnet(
+                            ip_addr=ip_address, subnet_id=subnet["id"])
+                    continue
+
+            ip_policy = None
+            if not ip_address:
+                # Policies don't prevent explicit assignment, so we only
+                # need to check if we're allocating a new IP
+                ip_policy = subnet.get("ip_policy")
+
+            policy_size = ip_policy["size"] if ip_policy else 0
+
+            if ipnet.size > (ips_in_subnet + policy_size - 1):
+                probe_ip = None
+                if not ip_address and subnet["ip_version"] == 4:
+                    probe_ip = self._probe_v4_address(subnet, ip_policy,
+                                                      ips_in_subnet)
+                if probe_ip is not None:
+                    LOG.info("Probing {0} in subnet {1}".format(
+                        probe_ip, subnet["id"]))
+                    subnet.probe_ip = probe_ip
                     return subnet
-                else:
-                    LOG.info("Marking subnet {0} as full".format(subnet["id"]))
-                    db_api.subnet_update_set_full(context, subnet)
+                if not ip_address and subnet["ip_version"] == 4:
+                    marker = subnet["next_auto_assign_ip"]
+                    # NOTE: The marker is moved past any policy exclusion
+                    #       it points into as part of the same update,
+                    #       so we never hand out an excluded address and
+                    #       burn a retry on it.
+                    ip, run_end = marker, None
+                    if subnet["first_ip"] <= marker <= subnet["last_ip"]:
+                        ip, run_end = self._skip_policy_exclusions(
+                            marker, ip_policy)
+                    # NOTE(mdietz): When atomically updated, this probably
+                    #               doesn't need the lower bounds check but
+                    #               I'm not comfortable removing it yet.
+                    updated = 0
+                    leased_ip = None
+                    auto_inc = db_api.subnet_update_next_auto_assign_ip
+                    if ip < subnet["first_ip"] or ip > subnet["last_ip"]:
+                        LOG.info("Marking subnet {0} as full".format(
+                            subnet["id"]))
+                        updated = db_api.subnet_update_set_full(context,
+                                                                subnet)
+                    elif lease_key:
+                        count = min(CONF.QUARK.ipam_v4_lease_size,
+                                    subnet["last_ip"] - ip + 1)
+                        if run_end is not None:
+                            count = min(count, run_end - ip)
+                        updated = auto_inc(context, subnet,
+                                           count=ip - marker + count)
+                        if updated:
+                            leased_ip = ip
+                            IP_LEASES.grant(lease_key, subnet["id"],
+                                            ip + 1, ip + count - 1,
+                                            CONF.QUARK.ipam_lease_ttl)
+                    elif ip != marker:
+                        LOG.info("Skipping policy exclusions {0} through "
+                                 "{1} in subnet {2}".format(
+                                     marker, ip - 1, subnet["id"]))
+                        updated = auto_inc(context, subnet,
+                                           count=ip - marker + 1)
+                    else:
+                        updated = auto_inc(context, subnet)
+
+                    if updated:
+                        context.session.refresh(subnet)
+                        if leased_ip is not None:
+                            subnet.leased_ip = leased_ip
+                    else:
+                        # This means the subnet was marked full
+                        # while we were checking out policies.
+                        # Fall out and go back to the outer retry
+                        # loop.
+                        return
+
+                LOG.info("Subnet {0} - {1} {2} looks viable, "
+                         "returning".format(subnet["id"], subnet["_cidr"],
+                                            subnet["next_auto_assign_ip"]))
+                return subnet
+            else:
+                LOG.info("Marking subnet {0} as full".format(subnet["id"]))
+                db_api.subnet_update_set_full(context, subnet)
 
 
 class QuarkIpamANY(QuarkIpam):
@@ -838,6 +1888,21 @@ class QuarkIpamANY(QuarkIpam):
         raise exceptions.IpAddressGenerationFailure(net_id=net_id)
 
 
+class QuarkIpamANYRandom(QuarkIpamANY):
+    """ANY, but v4 addresses are probed at random instead of in order.
+
+    Concurrent allocations on a large subnet otherwise all race for the
+    address at its marker. The marker is left alone until the space above
+    it fills up, see probe_v4_address.
+    """
+    @classmethod
+    def get_name(self):
+        return "ANY_RANDOM"
+
+    def _probe_v4_address(self, subnet, ip_policy, ips_in_subnet):
+        return probe_v4_address(subnet, ip_policy, ips_in_subnet)
+
+
 class QuarkIpamBOTH(QuarkIpam):
     @classmethod
     def get_name(self):
@@ -860,29 +1925,25 @@ class QuarkIpamBOTH(QuarkIpam):
                                  reuse_after, version=None,
                                  ip_address=None, segment_id=None,
                                  subnets=None, **kwargs):
-        both_versions = []
-        for ver in (4, 6):
-            address = super(QuarkIpamBOTH, self).attempt_to_reallocate_ip(
-                context, net_id, port_id, reuse_after, ver, ip_address,
-                segment_id, subnets=subnets, **kwargs)
-            both_versions.extend(address)
-        return both_versions
+        # NOTE: v6 addresses are never reallocated here, they're generated
+        #       from the MAC on the create path, so only v4 is looked up.
+        return super(QuarkIpamBOTH, self).attempt_to_reallocate_ip(
+            context, net_id, port_id, reuse_after, 4, ip_address,
+            segment_id, subnets=subnets, **kwargs)
 
     def _choose_available_subnet(self, context, net_id, version=None,
                                  segment_id=None, ip_address=None,
                                  reallocated_ips=None):
-        both_subnet_versions = []
         need_versions = [4, 6]
         for i in reallocated_ips:
             if i["version"] in need_versions:
                 need_versions.remove(i["version"])
-        filters = {}
-        for ver in need_versions:
-            filters["ip_version"] = ver
-            sub = self.select_subnet(context, net_id, ip_address, segment_id,
-                                     **filters)
-            if sub:
-                both_subnet_versions.append(sub)
+        selected = {}
+        if need_versions:
+            selected = self.select_subnets(context, net_id, ip_address,
+                                           segment_id, need_versions)
+        both_subnet_versions = [selected[ver] for ver in need_versions
+                                if ver in selected]
         if not reallocated_ips and not both_subnet_versions:
             raise exceptions.IpAddressGenerationFailure(net_id=net_id)
 
@@ -920,6 +1981,7 @@ class IpamRegistry(object):
     def __init__(self):
         self.strategies = {
             QuarkIpamANY.get_name(): QuarkIpamANY(),
+            QuarkIpamANYRandom.get_name(): QuarkIpamANYRandom(),
             QuarkIpamBOTH.get_name(): QuarkIpamBOTH(),
             QuarkIpamBOTHREQ.get_name(): QuarkIpamBOTHREQ()}
 
@@ -0,0 +1,123 @@
+# Copyright 2015 Openstack Foundation
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+"""
+In-process leases over contiguous blocks of IPAM values
+"""
+
+import threading
+import time
+
+from oslo_log import log as logging
+
+LOG = logging.getLogger(__name__)
+
+
+class BlockLease(object):
+    """A contiguous, inclusive run of values reserved by this worker.
+
+    The values were already claimed in the database by advancing the
+    owning row's auto assign marker past `last`, so nobody else can
+    hand them out. The lease simply tracks what is left to give away.
+    """
+    def __init__(self, resource_id, first, last, ttl):
+        self.resource_id = resource_id
+        self.next = first
+        self.last = last
+        self.expires_at = time.time() + ttl
+
+    def expired(self):
+        return time.time() >= self.expires_at
+
+    def exhausted(self):
+        return self.next > self.last
+
+    def remaining(self):
+        if self.exhausted():
+            return []
+        return range(self.next, self.last + 1)
+
+    def take(self):
+        value = self.next
+        self.next += 1
+        return value
+
+
+class LeaseManager(object):
+    """Tracks one BlockLease per key and hands out values from it."""
+    def __init__(self):
+        self._leases = {}
+        self._expired = []
+        self._lock = threading.Lock()
+
+    def grant(self, key, resource_id, first, last, ttl):
+        if last < first:
+            return
+        lease = BlockLease(resource_id, first, last, ttl)
+        with self._lock:
+            previous = self._leases.get(key)
+            if previous and not previous.exhausted():
+                self._expired.append(previous)
+            self._leases[key] = lease
+        LOG.info("Leased block {0}-{1} of {2}".format(first, last,
+                                                      resource_id))
+
+    def take(self, key):
+        """Returns a (resource_id, value) tuple or None."""
+        with self._lock:
+            lease = self._leases.get(key)
+            if not lease:
+                return None
+            if lease.expired():
+                del self._leases[key]
+                if not lease.exhausted():
+                    self._expired.append(lease)
+                return None
+            value = lease.take()
+            if lease.exhausted():
+                del self._leases[key]
+            return lease.resource_id, value
+
+    def release(self, key, resource_id, value):
+        """Forgets the lease for key and returns what is left of it.
+
+        value was just taken from the lease but won't be used, so it comes
+        back as a lease of its own, after the values nobody has taken yet.
+        """
+        leftovers = []
+        with self._lock:
+            lease = self._leases.get(key)
+            if lease and lease.resource_id == resource_id:
+                del self._leases[key]
+                if not lease.exhausted():
+                    leftovers.append(lease)
+        leftovers.append(BlockLease(resource_id, value, value, 0))
+        return leftovers
+
+    def reap(self):
+        """Returns leases that expired with values left over."""
+        with self._lock:
+            expired, self._expired = self._expired, []
+            return expired
+
+    def drain(self):
+        """Removes and returns every outstanding lease with values left."""
+        with self._lock:
+            leases = [lease for lease in self._leases.values()
+                      if not lease.exhausted()]
+            leases.extend(self._expired)
+            self._leases = {}
+            self._expired = []
+            return leases
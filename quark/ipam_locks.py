@@ -0,0 +1,193 @@
+# Copyright 2015 Openstack Foundation
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+"""
+Named IPAM locks keyed per network, held in-process, in files or in MySQL
+"""
+
+import contextlib
+import functools
+import hashlib
+import time
+
+from neutron.db import api as neutron_db_api
+from oslo.config import cfg
+from oslo.utils import importutils
+from oslo_concurrency import lockutils
+from oslo_log import log as logging
+import sqlalchemy as sa
+
+from quark import exceptions as q_exc
+from quark import ipam_metrics
+
+CONF = cfg.CONF
+LOG = logging.getLogger(__name__)
+
+quark_opts = [
+    cfg.BoolOpt("ipam_use_synchronization",
+                default=False,
+                help=_("Deprecated, equivalent to an ipam_lock_provider of"
+                       " 'local'.")),
+    cfg.StrOpt("ipam_lock_provider",
+               default="",
+               help=_("Serializes allocations on the same network."
+                      " 'local' locks within a process, 'file' across the"
+                      " processes of a host through files in"
+                      " ipam_lock_path, 'db' across hosts with MySQL"
+                      " GET_LOCK. Anything else is imported as a provider"
+                      " class. Empty disables locking unless"
+                      " ipam_use_synchronization is set, which means"
+                      " 'local'.")),
+    cfg.StrOpt("ipam_lock_path",
+               default="/var/lock/quark",
+               help=_("Directory of the lock files of the 'file' lock"
+                      " provider.")),
+    cfg.IntOpt("ipam_lock_timeout",
+               default=10,
+               help=_("Seconds the 'db' lock provider waits for a lock"
+                      " before failing the allocation."))
+]
+
+CONF.register_opts(quark_opts, "QUARK")
+
+
+class NoLockProvider(object):
+    @contextlib.contextmanager
+    def lock(self, name):
+        yield
+
+
+class LocalLockProvider(object):
+    """Semaphores shared by the greenthreads of one process."""
+    @contextlib.contextmanager
+    def lock(self, name):
+        with lockutils.lock(name):
+            yield
+
+
+class FileLockProvider(object):
+    """Lock files shared by the processes of one host."""
+    def __init__(self, lock_path=None):
+        self.lock_path = lock_path or CONF.QUARK.ipam_lock_path
+
+    @contextlib.contextmanager
+    def lock(self, name):
+        with lockutils.lock(name, external=True, lock_path=self.lock_path):
+            yield
+
+
+class DbLockProvider(object):
+    """MySQL named locks, shared by every host using the database.
+
+    GET_LOCK belongs to a connection, so each lock is taken on a
+    connection of its own rather than the one of the request's session,
+    which may be returned to the pool while the lock is held.
+    """
+    def __init__(self, engine=None, timeout=None):
+        self._engine = engine
+        self.timeout = timeout or CONF.QUARK.ipam_lock_timeout
+
+    @property
+    def engine(self):
+        if self._engine is None:
+            self._engine = neutron_db_api.get_engine()
+        return self._engine
+
+    @staticmethod
+    def _lock_name(name):
+        # NOTE: MySQL 5.7 refuses lock names longer than 64 characters.
+        return "quark.%s" % hashlib.sha1(name).hexdigest()
+
+    @contextlib.contextmanager
+    def lock(self, name):
+        lock_name = self._lock_name(name)
+        connection = self.engine.connect()
+        try:
+            acquired = connection.execute(
+                sa.text("SELECT GET_LOCK(:name, :timeout)"),
+                name=lock_name, timeout=self.timeout).scalar()
+            if acquired != 1:
+                raise q_exc.IpamLockTimeout(name=name, timeout=self.timeout)
+            try:
+                yield
+            finally:
+                connection.execute(sa.text("SELECT RELEASE_LOCK(:name)"),
+                                   name=lock_name)
+        finally:
+            connection.close()
+
+
+PROVIDERS = {"local": LocalLockProvider,
+             "file": FileLockProvider,
+             "db": DbLockProvider}
+
+
+def load_provider(name):
+    if not name:
+        if CONF.QUARK.ipam_use_synchronization:
+            return LocalLockProvider()
+        return NoLockProvider()
+    if name in PROVIDERS:
+        return PROVIDERS[name]()
+    return importutils.import_object(name)
+
+
+_provider = None
+
+
+def get_provider():
+    global _provider
+    if _provider is None:
+        _provider = load_provider(CONF.QUARK.ipam_lock_provider)
+    return _provider
+
+
+def reset_provider():
+    global _provider
+    _provider = None
+
+
+@contextlib.contextmanager
+def lock(name, key):
+    """Holds the lock of name for key, timing how long it took to get."""
+    provider = get_provider()
+    if isinstance(provider, NoLockProvider):
+        yield
+        return
+    start = time.time()
+    try:
+        with provider.lock("%s.%s.%s" % (__name__, name, key)):
+            ipam_metrics.METRICS.timing("lock_wait.%s" % name,
+                                        time.time() - start)
+            yield
+    except q_exc.IpamLockTimeout:
+        ipam_metrics.METRICS.incr("lock_timeout.%s" % name)
+        raise
+
+
+def synchronized(name, per_network=True):
+    """Serializes calls of a method taking (context, net_id, ...) per net_id.
+
+    Calls for different networks never wait for each other, unless
+    per_network is False, for resources like MAC ranges that every network
+    shares. Those calls all hold the same lock.
+    """
+    def wrap(f):
+        @functools.wraps(f)
+        def inner(self, context, net_id, *args, **kwargs):
+            with lock(name, net_id if per_network else "all"):
+                return f(self, context, net_id, *args, **kwargs)
+        return inner
+    return wrap
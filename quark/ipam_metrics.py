@@ -0,0 +1,219 @@
+# Copyright 2015 Openstack Foundation
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+"""
+In-process IPAM timings and counters with pluggable sinks
+"""
+
+import bisect
+import os
+import socket
+import threading
+import time
+
+from oslo.config import cfg
+from oslo.utils import importutils
+from oslo_log import log as logging
+
+CONF = cfg.CONF
+LOG = logging.getLogger(__name__)
+
+quark_opts = [
+    cfg.StrOpt("ipam_metrics_sink",
+               default="",
+               help=_("Where IPAM timings and counters go besides the"
+                      " in-process aggregates. 'statsd' sends every sample"
+                      " to a statsd daemon over UDP, 'text' periodically"
+                      " writes the aggregates to ipam_metrics_text_path."
+                      " Anything else is imported as a sink class. Empty"
+                      " disables the sink.")),
+    cfg.StrOpt("ipam_metrics_prefix",
+               default="quark.ipam",
+               help=_("Prefix of the metric names sent to the sink.")),
+    cfg.StrOpt("ipam_metrics_statsd_host",
+               default="127.0.0.1",
+               help=_("Host of the statsd daemon for the 'statsd' sink.")),
+    cfg.IntOpt("ipam_metrics_statsd_port",
+               default=8125,
+               help=_("UDP port of the statsd daemon for the 'statsd'"
+                      " sink.")),
+    cfg.StrOpt("ipam_metrics_text_path",
+               default="/var/run/quark/ipam_metrics.txt",
+               help=_("File the 'text' sink writes the aggregates to.")),
+    cfg.IntOpt("ipam_metrics_flush_interval",
+               default=60,
+               help=_("Seconds between two flushes of the aggregates to the"
+                      " sink."))
+]
+
+CONF.register_opts(quark_opts, "QUARK")
+
+# Upper bounds of the latency histogram buckets, in milliseconds. Samples
+# above the last one land in an overflow bucket.
+BUCKETS_MS = (1, 2, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000)
+
+
+class Histogram(object):
+    def __init__(self):
+        self.buckets = [0] * (len(BUCKETS_MS) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def observe(self, ms):
+        self.buckets[bisect.bisect_left(BUCKETS_MS, ms)] += 1
+        self.count += 1
+        self.total += ms
+        self.max = max(self.max, ms)
+
+    def percentile(self, pct):
+        """Upper bound of the bucket holding the pct-th percentile."""
+        if not self.count:
+            return 0.0
+        rank = max(1.0, pct / 100.0 * self.count)
+        seen = 0
+        for i, count in enumerate(self.buckets):
+            seen += count
+            if seen >= rank:
+                break
+        if i < len(BUCKETS_MS):
+            return min(float(BUCKETS_MS[i]), self.max)
+        return self.max
+
+
+class StatsdSink(object):
+    """Sends every sample to statsd as it happens, without aggregating."""
+    def __init__(self, host=None, port=None, prefix=None):
+        self.address = (host or CONF.QUARK.ipam_metrics_statsd_host,
+                        port or CONF.QUARK.ipam_metrics_statsd_port)
+        self.prefix = prefix or CONF.QUARK.ipam_metrics_prefix
+        self._socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+
+    def _send(self, stat):
+        try:
+            self._socket.sendto(stat, self.address)
+        except socket.error:
+            LOG.debug("Couldn't send {0} to statsd".format(stat))
+
+    def timing(self, name, ms):
+        self._send("%s.%s:%.3f|ms" % (self.prefix, name, ms))
+
+    def incr(self, name, count):
+        self._send("%s.%s:%d|c" % (self.prefix, name, count))
+
+    def flush(self, metrics):
+        pass
+
+
+class TextFileSink(object):
+    """Periodically replaces a file with the rendered aggregates."""
+    def __init__(self, path=None):
+        self.path = path or CONF.QUARK.ipam_metrics_text_path
+
+    def timing(self, name, ms):
+        pass
+
+    def incr(self, name, count):
+        pass
+
+    def flush(self, metrics):
+        tmp_path = "%s.%d" % (self.path, os.getpid())
+        try:
+            with open(tmp_path, "w") as f:
+                f.write(metrics.render_text())
+            os.rename(tmp_path, self.path)
+        except (IOError, OSError):
+            LOG.exception("Couldn't write IPAM metrics to {0}".format(
+                self.path))
+
+
+SINKS = {"statsd": StatsdSink, "text": TextFileSink}
+
+
+def load_sink(name):
+    if not name:
+        return None
+    if name in SINKS:
+        return SINKS[name]()
+    return importutils.import_object(name)
+
+
+class IpamMetrics(object):
+    """Latency histograms and counters of the IPAM hot paths.
+
+    Samples are aggregated in-process and handed to the sink configured by
+    ipam_metrics_sink, which is loaded on first use.
+    """
+    _unset = object()
+
+    def __init__(self, sink=_unset):
+        self._lock = threading.Lock()
+        self._sink = sink
+        self._flushed_at = time.time()
+        self.histograms = {}
+        self.counters = {}
+
+    @property
+    def sink(self):
+        if self._sink is IpamMetrics._unset:
+            self._sink = load_sink(CONF.QUARK.ipam_metrics_sink)
+        return self._sink
+
+    def timing(self, name, seconds):
+        ms = seconds * 1000.0
+        with self._lock:
+            if name not in self.histograms:
+                self.histograms[name] = Histogram()
+            self.histograms[name].observe(ms)
+        if self.sink:
+            self.sink.timing(name, ms)
+
+    def incr(self, name, count=1):
+        if not count:
+            return
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0) + count
+        if self.sink:
+            self.sink.incr(name, count)
+
+    def maybe_flush(self):
+        interval = CONF.QUARK.ipam_metrics_flush_interval
+        if not self.sink or time.time() - self._flushed_at < interval:
+            return
+        self._flushed_at = time.time()
+        self.sink.flush(self)
+
+    def render_text(self):
+        with self._lock:
+            lines = []
+            for name in sorted(self.histograms):
+                hist = self.histograms[name]
+                lines.append(
+                    "%s count=%d sum_ms=%.3f max_ms=%.3f p50_ms=%.3f "
+                    "p99_ms=%.3f buckets=%s" % (
+                        name, hist.count, hist.total, hist.max,
+                        hist.percentile(50), hist.percentile(99),
+                        ",".join(str(b) for b in hist.buckets)))
+            for name in sorted(self.counters):
+                lines.append("%s %d" % (name, self.counters[name]))
+        return "\n".join(lines) + "\n"
+
+    def reset(self):
+        with self._lock:
+            self.histograms = {}
+            self.counters = {}
+
+
+METRICS = IpamMetrics()
@@ -0,0 +1,172 @@
+# Copyright 2015 Openstack Foundation
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+"""
+IP address notifications, sent inline or batched from a greenthread
+"""
+
+import atexit
+
+from eventlet import greenthread
+from eventlet import queue
+from neutron.common import rpc as n_rpc
+from oslo.config import cfg
+from oslo_log import log as logging
+from sqlalchemy import exc as sa_exc
+from sqlalchemy import inspect as sa_inspect
+
+from quark import ipam_metrics
+
+CONF = cfg.CONF
+LOG = logging.getLogger(__name__)
+
+quark_opts = [
+    cfg.BoolOpt("ipam_async_notifications",
+                default=False,
+                help=_("Queue ip_block.address notifications and send them"
+                       " in batches from a background greenthread instead"
+                       " of inside the request.")),
+    cfg.IntOpt("ipam_notification_queue_size",
+               default=10000,
+               help=_("Number of notifications that may wait to be sent."
+                      " Notifications beyond it are dropped and counted.")),
+    cfg.IntOpt("ipam_notification_batch_size",
+               default=100,
+               help=_("Most notifications sent by one flush."))
+]
+
+CONF.register_opts(quark_opts, "QUARK")
+
+
+def _device_ids(address):
+    # NOTE: Payloads only use ports that are already loaded, building one
+    #       never lazy loads them. Addresses that were just created have
+    #       none yet.
+    try:
+        if "ports" in sa_inspect(address).unloaded:
+            return []
+    except sa_exc.NoInspectionAvailable:
+        pass
+    return [p["device_id"] for p in address["ports"]]
+
+
+def address_payload(address, **kwargs):
+    payload = dict(used_by_tenant_id=address["used_by_tenant_id"],
+                   ip_block_id=address["subnet_id"],
+                   ip_address=address["address_readable"],
+                   device_ids=_device_ids(address),
+                   created_at=address["created_at"])
+    payload.update(kwargs)
+    return payload
+
+
+class NotificationQueue(object):
+    """A bounded queue of notifications drained by a greenthread.
+
+    The greenthread is started by the first notification and sends what is
+    queued in batches of ipam_notification_batch_size. When the queue is
+    full, new notifications are dropped and counted rather than waiting
+    for the message bus.
+    """
+    def __init__(self, maxsize=None, batch_size=None):
+        self._maxsize = maxsize
+        self._batch_size = batch_size
+        self._pending = None
+        self._flusher = None
+        self.dropped = 0
+
+    @property
+    def batch_size(self):
+        return self._batch_size or CONF.QUARK.ipam_notification_batch_size
+
+    @property
+    def _queue(self):
+        if self._pending is None:
+            self._pending = queue.LightQueue(
+                self._maxsize or CONF.QUARK.ipam_notification_queue_size)
+        return self._pending
+
+    def put(self, context, event_type, payload):
+        try:
+            self._queue.put_nowait((context, event_type, payload))
+        except queue.Full:
+            self.dropped += 1
+            ipam_metrics.METRICS.incr("notifications.dropped")
+            LOG.warn("Notification queue full, dropped {0} {1}".format(
+                event_type, payload["ip_address"]))
+            return
+        if self._flusher is None or self._flusher.dead:
+            self._flusher = greenthread.spawn(self._run)
+
+    def _take(self, block=False):
+        batch = []
+        if block:
+            batch.append(self._queue.get())
+        while len(batch) < self.batch_size:
+            try:
+                batch.append(self._queue.get_nowait())
+            except queue.Empty:
+                break
+        return batch
+
+    def _send(self, batch):
+        notifier = n_rpc.get_notifier("network")
+        for context, event_type, payload in batch:
+            try:
+                notifier.info(context, event_type, payload)
+            except Exception:
+                LOG.exception("Couldn't send {0} notification".format(
+                    event_type))
+        ipam_metrics.METRICS.incr("notifications.sent", len(batch))
+
+    def _run(self):
+        while True:
+            self._send(self._take(block=True))
+            greenthread.sleep(0)
+
+    def flush(self):
+        """Sends everything queued from the calling greenthread."""
+        sent = 0
+        batch = self._take()
+        while batch:
+            self._send(batch)
+            sent += len(batch)
+            batch = self._take()
+        return sent
+
+
+NOTIFICATIONS = NotificationQueue()
+
+
+def notify(context, event_type, payload):
+    if CONF.QUARK.ipam_async_notifications:
+        NOTIFICATIONS.put(context, event_type, payload)
+    else:
+        n_rpc.get_notifier("network").info(context, event_type, payload)
+
+
+def notify_many(context, event_type, payloads):
+    if CONF.QUARK.ipam_async_notifications:
+        for payload in payloads:
+            NOTIFICATIONS.put(context, event_type, payload)
+        return
+    notifier = n_rpc.get_notifier("network")
+    for payload in payloads:
+        notifier.info(context, event_type, payload)
+
+
+@atexit.register
+def _flush_outstanding_notifications():
+    NOTIFICATIONS.flush()
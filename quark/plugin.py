@@ -21,9 +21,11 @@ from neutron.extensions import securitygroup as sg_ext
 from neutron import neutron_plugin_base_v2
 from neutron import quota
 from oslo.config import cfg
+from oslo.utils import excutils
 from oslo_log import log as logging
 
 from quark.api import extensions
+from quark.db import replica
 from quark import ip_availability
 from quark.plugin_modules import ip_addresses
 from quark.plugin_modules import ip_policies
@@ -105,9 +107,16 @@ CONF.register_opts(quark_quota_opts, "QUOTAS")
 quota.QUOTAS.register_resources(quark_resources)
 
 
+READ_ONLY_METHODS = ("get_", "diagnose_")
+
+
 def sessioned(func):
+    # NOTE: The finds of read only methods may run on the read replica.
+    read_only = func.__name__.startswith(READ_ONLY_METHODS)
+
     def _wrapped(self, context, *args, **kwargs):
-        res = func(self, context, *args, **kwargs)
+        with replica.request(context, read_only):
+            res = func(self, context, *args, **kwargs)
         context.session.close()
         # NOTE(mdietz): Forces neutron to get a fresh session
         #              if it needs it after our call
@@ -125,9 +134,33 @@ class Plugin(neutron_plugin_base_v2.NeutronPluginBaseV2,
                                    "networks_quark", "router",
                                    "ip_availabilities", "ports_quark"]
 
+    # NOTE: Once this is set neutron hands every bulk request for any
+    #       resource to create_<resource>_bulk, so the resources without a
+    #       native implementation are emulated by _create_bulk.
+    __native_bulk_support = True
+
     def __init__(self):
         LOG.info("Starting quark plugin")
 
+    def _create_bulk(self, resource, context, request_items):
+        """Creates each item in turn, deleting them all if one fails."""
+        create = getattr(self, "create_%s" % resource)
+        delete = getattr(self, "delete_%s" % resource)
+        objects = []
+        try:
+            for item in request_items["%ss" % resource]:
+                objects.append(create(context, item))
+        except Exception:
+            with excutils.save_and_reraise_exception():
+                LOG.info("Rolling back bulk %s create..." % resource)
+                for obj in objects:
+                    try:
+                        delete(context, obj["id"])
+                    except Exception:
+                        LOG.exception("Couldn't rollback %s %s" %
+                                      (resource, obj["id"]))
+        return objects
+
     def _fix_missing_tenant_id(self, context, resource):
         """Will add the tenant_id to the context from body.
 
@@ -159,6 +192,10 @@ class Plugin(neutron_plugin_base_v2.NeutronPluginBaseV2,
         self._fix_missing_tenant_id(context, security_group["security_group"])
         return security_groups.create_security_group(context, security_group)
 
+    def create_security_group_bulk(self, context, security_groups_body):
+        return self._create_bulk("security_group", context,
+                                 security_groups_body)
+
     @sessioned
     def create_security_group_rule(self, context, security_group_rule):
         self._fix_missing_tenant_id(context,
@@ -166,6 +203,11 @@ class Plugin(neutron_plugin_base_v2.NeutronPluginBaseV2,
         return security_groups.create_security_group_rule(context,
                                                           security_group_rule)
 
+    def create_security_group_rule_bulk(self, context,
+                                        security_group_rules_body):
+        return self._create_bulk("security_group_rule", context,
+                                 security_group_rules_body)
+
     @sessioned
     def delete_security_group(self, context, id):
         security_groups.delete_security_group(context, id)
@@ -246,6 +288,12 @@ class Plugin(neutron_plugin_base_v2.NeutronPluginBaseV2,
         self._fix_missing_tenant_id(context, port["port"])
         return ports.create_port(context, port)
 
+    @sessioned
+    def create_port_bulk(self, context, ports_body):
+        for port in ports_body["ports"]:
+            self._fix_missing_tenant_id(context, port["port"])
+        return ports.create_port_bulk(context, ports_body)
+
     @sessioned
     def get_port(self, context, id, fields=None):
         return ports.get_port(context, id, fields)
@@ -298,6 +346,9 @@ class Plugin(neutron_plugin_base_v2.NeutronPluginBaseV2,
         self._fix_missing_tenant_id(context, subnet["subnet"])
         return subnets.create_subnet(context, subnet)
 
+    def create_subnet_bulk(self, context, subnets_body):
+        return self._create_bulk("subnet", context, subnets_body)
+
     @sessioned
     def update_subnet(self, context, id, subnet):
         return subnets.update_subnet(context, id, subnet)
@@ -329,6 +380,9 @@ class Plugin(neutron_plugin_base_v2.NeutronPluginBaseV2,
         self._fix_missing_tenant_id(context, network["network"])
         return networks.create_network(context, network)
 
+    def create_network_bulk(self, context, networks_body):
+        return self._create_bulk("network", context, networks_body)
+
     @sessioned
     def update_network(self, context, id, network):
         return networks.update_network(context, id, network)
@@ -361,6 +415,9 @@ class Plugin(neutron_plugin_base_v2.NeutronPluginBaseV2,
     def create_router(self, context, router):
         pass
 
+    def create_router_bulk(self, context, routers_body):
+        return self._create_bulk("router", context, routers_body)
+
     def update_router(self, context, id, router):
         pass
 
@@ -383,6 +440,9 @@ class Plugin(neutron_plugin_base_v2.NeutronPluginBaseV2,
     def create_floatingip(self, context, floatingip):
         pass
 
+    def create_floatingip_bulk(self, context, floatingips_body):
+        return self._create_bulk("floatingip", context, floatingips_body)
+
     def update_floatingip(self, context, id, floatingip):
         pass
 
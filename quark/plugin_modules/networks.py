@@ -218,7 +218,8 @@ def get_networks(context, limit=None, sorts=None, marker=None,
              (context.tenant_id, filters, fields))
     filters = filters or {}
     nets = db_api.network_find(context, limit, sorts, marker, page_reverse,
-                               join_subnets=True, **filters) or []
+                               fields=fields, join_subnets=True,
+                               **filters) or []
     nets = [v._make_network_dict(net, fields=fields) for net in nets]
     return nets
 
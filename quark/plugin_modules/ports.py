@@ -13,12 +13,15 @@
 #    License for the specific language governing permissions and limitations
 #    under the License.
 
+import itertools
+
 import netaddr
 from neutron.common import exceptions
 from neutron.extensions import securitygroup as sg_ext
 from neutron.openstack.common import uuidutils
 from neutron import quota
 from oslo.config import cfg
+from oslo.utils import excutils
 from oslo_log import log as logging
 
 from quark.db import api as db_api
@@ -263,6 +266,166 @@ def create_port(context, port):
     return v._make_port_dict(new_port)
 
 
+def _bulk_key(port_attrs):
+    """Returns what a port is grouped on for bulk creation.
+
+    That is its network and segment, or None if it asks for anything
+    only create_port handles.
+    """
+    for attr in ("mac_address", "fixed_ips", "security_groups"):
+        value = port_attrs.get(attr)
+        if value is not None and utils.attr_specified(value):
+            return None
+    if port_attrs.get("use_forbidden_mac_range") is True:
+        return None
+    segment_id = port_attrs.get("segment_id")
+    if not utils.attr_specified(segment_id):
+        segment_id = None
+    return port_attrs["network_id"], segment_id
+
+
+def create_port_bulk(context, ports):
+    """Create several ports at once.
+
+    Ports on the same network and segment that don't ask for a MAC
+    address, fixed IPs or security groups have their MACs and IPs
+    allocated in bulk and their rows created in one transaction. The rest
+    go through create_port. If any port fails, all of them are removed.
+    : param context: neutron api request context
+    : param ports: dictionary with a "ports" list of create_port bodies.
+    """
+    port_list = [port["port"] for port in ports["ports"]]
+    LOG.info("create_port_bulk of %d ports for tenant %s" %
+             (len(port_list), context.tenant_id))
+
+    groups = {}
+    for i, port_attrs in enumerate(port_list):
+        key = _bulk_key(port_attrs)
+        if key:
+            groups.setdefault(key, []).append(i)
+
+    new_ports = [None] * len(port_list)
+    try:
+        for (net_id, segment_id), indexes in sorted(groups.items()):
+            created = _create_ports_on_network(
+                context, net_id, segment_id, [port_list[i] for i in indexes])
+            for i, new_port in zip(indexes, created):
+                new_ports[i] = new_port
+        for i, port_attrs in enumerate(port_list):
+            if new_ports[i] is None:
+                new_ports[i] = create_port(context, {"port": port_attrs})
+    except Exception:
+        with excutils.save_and_reraise_exception():
+            LOG.info("Rolling back bulk created ports...")
+            for new_port in new_ports:
+                if not new_port:
+                    continue
+                try:
+                    delete_port(context, new_port["id"])
+                except Exception:
+                    LOG.exception("Couldn't rollback port %s" %
+                                  new_port["id"])
+    return new_ports
+
+
+def _create_ports_on_network(context, net_id, segment_id, port_attrs_list):
+    admin_only = ["mac_address", "device_owner", "bridge", "admin_state_up",
+                  "use_forbidden_mac_range"]
+    for port_attrs in port_attrs_list:
+        utils.filter_body(context, port_attrs, admin_only=admin_only)
+        for attr in ("mac_address", "use_forbidden_mac_range", "segment_id",
+                     "fixed_ips", "security_groups"):
+            utils.pop_param(port_attrs, attr)
+        if "device_id" not in port_attrs:
+            port_attrs["device_id"] = ""
+
+    net = db_api.network_find(context, None, None, None, False, id=net_id,
+                              scope=db_api.ONE)
+    if not net:
+        raise exceptions.NetworkNotFound(net_id=net_id)
+    _raise_if_unauthorized(context.tenant_id, net)
+
+    device_ids = [p["device_id"] for p in port_attrs_list if p["device_id"]]
+    if len(device_ids) != len(set(device_ids)):
+        raise exceptions.BadRequest(
+            resource="port", msg="A device can only be connected to the "
+            "requested network via one port")
+    if device_ids and db_api.port_find(context, network_id=net_id,
+                                       device_id=device_ids,
+                                       scope=db_api.ONE):
+        raise exceptions.BadRequest(
+            resource="port", msg="This device is already connected to the "
+            "requested network via another port")
+
+    if not STRATEGY.is_parent_network(net_id):
+        # We don't honor segmented networks when they aren't "shared"
+        segment_id = None
+        port_count = db_api.port_count_all(context, network_id=[net_id],
+                                           tenant_id=[context.tenant_id])
+        quota.QUOTAS.limit_check(
+            context, context.tenant_id,
+            ports_per_network=port_count + len(port_attrs_list))
+    elif not segment_id:
+        raise q_exc.AmbiguousNetworkId(net_id=net_id)
+
+    ipam_driver = ipam.IPAM_REGISTRY.get_strategy(net["ipam_strategy"])
+    net_driver = registry.DRIVER_REGISTRY.get_driver(net["network_plugin"])
+    port_ids = [uuidutils.generate_uuid() for p in port_attrs_list]
+
+    macs = []
+    addresses = {}
+    backend_ports = []
+    try:
+        macs = ipam_driver.allocate_mac_addresses(
+            context, net["id"], port_ids, CONF.QUARK.ipam_reuse_after)
+        ipam_driver.allocate_ip_addresses_bulk(
+            context, addresses, net["id"], port_ids,
+            CONF.QUARK.ipam_reuse_after, segment_id=segment_id,
+            mac_addresses=dict(zip(port_ids, macs)))
+
+        for port_id, port_attrs in zip(port_ids, port_attrs_list):
+            backend_ports.append(net_driver.create_port(
+                context, net["id"], port_id=port_id, security_groups=[],
+                device_id=port_attrs["device_id"]))
+
+        new_ports = []
+        with context.session.begin():
+            for port_id, port_attrs, mac, backend_port in zip(
+                    port_ids, port_attrs_list, macs, backend_ports):
+                port_attrs["network_id"] = net["id"]
+                port_attrs["id"] = port_id
+                port_attrs["security_groups"] = []
+                port_attrs.update(backend_port)
+                new_ports.append(db_api.port_create(
+                    context, addresses=addresses[port_id],
+                    mac_address=mac["address"],
+                    backend_key=backend_port["uuid"], **port_attrs))
+    except Exception:
+        with excutils.save_and_reraise_exception():
+            LOG.info("Rolling back bulk port allocations...")
+            for backend_port in backend_ports:
+                try:
+                    net_driver.delete_port(context, backend_port["uuid"])
+                except Exception:
+                    LOG.exception(
+                        "Couldn't rollback backend port %s" % backend_port)
+            for address in itertools.chain(*addresses.values()):
+                try:
+                    with context.session.begin():
+                        ipam_driver.deallocate_ip_address(context, address)
+                except Exception:
+                    LOG.exception("Couldn't release IP %s" % address)
+            for mac in macs:
+                try:
+                    with context.session.begin():
+                        ipam_driver.deallocate_mac_address(context,
+                                                           mac["address"])
+                except Exception:
+                    LOG.exception("Couldn't release MAC %s" % mac)
+
+    return [v._make_port_dict(new_port) for new_port in new_ports]
+
+
 def update_port(context, id, port):
     """Update values of a port.
 
@@ -421,7 +584,7 @@ def get_port(context, id, fields=None):
     if not results:
         raise exceptions.PortNotFound(port_id=id, net_id='')
 
-    return v._make_port_dict(results)
+    return v._make_port_dict(results, fields)
 
 
 def get_ports(context, limit=None, sorts=None, marker=None, page_reverse=False,
@@ -533,7 +696,7 @@ def diagnose_port(context, id, fields):
 
     if id == "*":
         return {'ports': [_diag_port(context, port, fields) for
-                port in db_api.port_find(context).all()]}
+                port in db_api.port_find(context, scope=db_api.ALL)]}
     db_port = db_api.port_find(context, id=id, scope=db_api.ONE)
     if not db_port:
         raise exceptions.PortNotFound(port_id=id, net_id='')
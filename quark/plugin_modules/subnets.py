@@ -376,13 +376,15 @@ def get_subnets(context, limit=None, page_reverse=False, sorts=None,
              (context.tenant_id, filters, fields))
     subnets = db_api.subnet_find(context, limit=limit,
                                  page_reverse=page_reverse, sorts=sorts,
-                                 marker=marker,
+                                 marker=marker, fields=fields,
                                  join_dns=True, join_routes=True, **filters)
-    for subnet in subnets:
-        cache = subnet.get("_allocation_pool_cache")
-        if not cache:
-            db_api.subnet_update_set_alloc_pool_cache(
-                context, subnet, subnet.allocation_pools)
+    if utils.field_requested(utils.requested_fields(fields),
+                             "allocation_pools"):
+        for subnet in subnets:
+            cache = subnet.get("_allocation_pool_cache")
+            if not cache:
+                db_api.subnet_update_set_alloc_pool_cache(
+                    context, subnet, subnet.allocation_pools)
     return v._make_subnets_list(subnets, fields=fields)
 
 
@@ -23,6 +23,7 @@ from oslo_log import log as logging
 
 from quark import network_strategy
 from quark import protocols
+from quark import utils
 
 
 CONF = cfg.CONF
@@ -50,18 +51,35 @@ def _is_default_route(route):
     return route.value == 0
 
 
+def _attrs_dict(attrs, model, requested):
+    """The requested attrs of model, from functions of model by key.
+
+    Only the requested ones are called, partially loaded models are never
+    asked for what they don't have.
+    """
+    return dict((key, attr(model)) for key, attr in attrs.items()
+                if utils.field_requested(requested, key))
+
+
+NETWORK_ATTRS = {
+    "id": lambda network: network["id"],
+    "name": lambda network: network.get("name"),
+    "tenant_id": lambda network: network.get("tenant_id"),
+    "admin_state_up": lambda network: True,
+    "status": lambda network: "ACTIVE",
+    "shared": lambda network: STRATEGY.is_parent_network(network["id"])}
+
+
 def _make_network_dict(network, fields=None):
-    shared_net = STRATEGY.is_parent_network(network["id"])
-    res = {"id": network["id"],
-           "name": network.get("name"),
-           "tenant_id": network.get("tenant_id"),
-           "admin_state_up": True,
-           "status": "ACTIVE",
-           "shared": shared_net}
-    if CONF.QUARK.show_ipam_strategy:
+    requested = utils.requested_fields(fields)
+    res = _attrs_dict(NETWORK_ATTRS, network, requested)
+    if (CONF.QUARK.show_ipam_strategy and
+            utils.field_requested(requested, "ipam_strategy")):
         res['ipam_strategy'] = network.get("ipam_strategy")
 
-    if not shared_net:
+    if not utils.field_requested(requested, "subnets"):
+        return res
+    if not STRATEGY.is_parent_network(network["id"]):
         if fields and "all_subnets" in fields:
             res["subnets"] = [_make_subnet_dict(s)
                               for s in network.get("subnets", [])]
@@ -72,29 +90,45 @@ def _make_network_dict(network, fields=None):
     return res
 
 
+SUBNET_ATTRS = {
+    "id": lambda subnet: subnet.get("id"),
+    "name": lambda subnet: subnet.get("name"),
+    "tenant_id": lambda subnet: subnet.get("tenant_id"),
+    "network_id": lambda subnet: STRATEGY.get_parent_network(
+        subnet["network_id"]),
+    "ip_version": lambda subnet: subnet.get("ip_version"),
+    "dns_nameservers": lambda subnet: [
+        str(netaddr.IPAddress(dns["ip"]))
+        for dns in subnet.get("dns_nameservers")],
+    "cidr": lambda subnet: subnet.get("cidr"),
+    "shared": lambda subnet: STRATEGY.is_parent_network(
+        STRATEGY.get_parent_network(subnet["network_id"])),
+    "enable_dhcp": lambda subnet: None}
+
+
 def _make_subnet_dict(subnet, fields=None):
-    dns_nameservers = [str(netaddr.IPAddress(dns["ip"]))
-                       for dns in subnet.get("dns_nameservers")]
-    net_id = STRATEGY.get_parent_network(subnet["network_id"])
-
-    res = {"id": subnet.get("id"),
-           "name": subnet.get("name"),
-           "tenant_id": subnet.get("tenant_id"),
-           "network_id": net_id,
-           "ip_version": subnet.get("ip_version"),
-           "dns_nameservers": dns_nameservers or [],
-           "cidr": subnet.get("cidr"),
-           "shared": STRATEGY.is_parent_network(net_id),
-           "enable_dhcp": None}
-
-    if CONF.QUARK.show_subnet_ip_policy_id:
+    requested = utils.requested_fields(fields)
+    res = _attrs_dict(SUBNET_ATTRS, subnet, requested)
+
+    if (CONF.QUARK.show_subnet_ip_policy_id and
+            utils.field_requested(requested, "ip_policy_id")):
         res['ip_policy_id'] = subnet.get("ip_policy_id")
 
-    if CONF.QUARK.show_allocation_pools:
-        res["allocation_pools"] = subnet.allocation_pools
-    else:
-        res["allocation_pools"] = []
+    if utils.field_requested(requested, "allocation_pools"):
+        if CONF.QUARK.show_allocation_pools:
+            res["allocation_pools"] = subnet.allocation_pools
+        else:
+            res["allocation_pools"] = []
+
+    if utils.field_requested(requested, "gateway_ip", "host_routes"):
+        _add_subnet_routes(subnet, res)
+        if requested is not None:
+            res = dict((key, value) for key, value in res.items()
+                       if key in requested)
+    return res
 
+
+def _add_subnet_routes(subnet, res):
     def _host_route(route):
         return {"destination": route["cidr"],
                 "nexthop": route["gateway"]}
@@ -113,12 +147,13 @@ def _make_subnet_dict(subnet, fields=None):
             #       log it anyway.
             if default_found:
                 LOG.info(_("Default route %(gateway_ip)s already found for "
-                           "subnet %(id)s") % res)
+                           "subnet %(id)s") %
+                         dict(gateway_ip=res["gateway_ip"],
+                              id=subnet.get("id")))
             res["gateway_ip"] = route["gateway"]
             default_found = True
         else:
             res["host_routes"].append(_host_route(route))
-    return res
 
 
 def _make_security_group_dict(security_group, fields=None):
@@ -150,25 +185,34 @@ def _make_security_group_rule_dict(security_rule, fields=None):
     return res
 
 
+def _port_mac_address(port):
+    mac = port.get("mac_address")
+    if mac:
+        mac = str(netaddr.EUI(mac)).replace('-', ':')
+    return mac
+
+
+PORT_ATTRS = {
+    "id": lambda port: port.get("id"),
+    "name": lambda port: port.get("name"),
+    "network_id": lambda port: STRATEGY.get_parent_network(
+        port["network_id"]),
+    "tenant_id": lambda port: port.get("tenant_id"),
+    "mac_address": _port_mac_address,
+    "admin_state_up": lambda port: port.get("admin_state_up"),
+    "status": lambda port: "ACTIVE",
+    "security_groups": lambda port: [
+        group.get("id", None) for group in port.get("security_groups", None)],
+    "device_id": lambda port: port.get("device_id"),
+    "device_owner": lambda port: port.get("device_owner")}
+
+
 def _port_dict(port, fields=None):
-    res = {"id": port.get("id"),
-           "name": port.get("name"),
-           "network_id": STRATEGY.get_parent_network(port["network_id"]),
-           "tenant_id": port.get("tenant_id"),
-           "mac_address": port.get("mac_address"),
-           "admin_state_up": port.get("admin_state_up"),
-           "status": "ACTIVE",
-           "security_groups": [group.get("id", None) for group in
-                               port.get("security_groups", None)],
-           "device_id": port.get("device_id"),
-           "device_owner": port.get("device_owner")}
-
-    if "mac_address" in res and res["mac_address"]:
-        mac = str(netaddr.EUI(res["mac_address"])).replace('-', ':')
-        res["mac_address"] = mac
+    requested = utils.requested_fields(fields)
+    res = _attrs_dict(PORT_ATTRS, port, requested)
 
     # NOTE(mdietz): more pythonic key in dict check fails here. Leave as get
-    if port.get("bridge"):
+    if utils.field_requested(requested, "bridge") and port.get("bridge"):
         res["bridge"] = port["bridge"]
     return res
 
@@ -185,20 +229,15 @@ def _make_port_address_dict(ip, port, fields=None):
 
 
 def _make_port_dict(port, fields=None):
-    res = _port_dict(port)
-    res["fixed_ips"] = [_make_port_address_dict(ip, port, fields)
-                        for ip in port.ip_addresses]
+    res = _port_dict(port, fields)
+    if utils.field_requested(utils.requested_fields(fields), "fixed_ips"):
+        res["fixed_ips"] = [_make_port_address_dict(ip, port, fields)
+                            for ip in port.ip_addresses]
     return res
 
 
 def _make_ports_list(query, fields=None):
-    ports = []
-    for port in query:
-        port_dict = _port_dict(port, fields)
-        port_dict["fixed_ips"] = [_make_port_address_dict(addr, port, fields)
-                                  for addr in port.ip_addresses]
-        ports.append(port_dict)
-    return ports
+    return [_make_port_dict(port, fields) for port in query]
 
 
 def _make_subnets_list(query, fields=None):
@@ -14,12 +14,18 @@
 # limitations under the License.
 
 import contextlib
+import datetime
 
 import mock
 import netaddr
 from neutron.common import rpc
+from neutron.db import api as neutron_db_api
+from oslo.utils import timeutils
+from sqlalchemy import event
+from sqlalchemy import inspect as sa_inspect
 
 from quark.db import api as db_api
+from quark.db import models
 import quark.ipam
 from quark.tests.functional.base import BaseFunctionalTest
 
@@ -188,6 +194,310 @@ class QuarkFindSubnetAllocationCount(QuarkIpamBaseFunctionalTest):
                     netaddr.IPAddress(subnet["next_auto_assign_ip"]).ipv4(),
                     net4[1])
 
+    def test_subnet_update_next_auto_assign_ip_past(self):
+        cidr4 = "0.0.0.0/29"
+        net4 = netaddr.IPNetwork(cidr4)
+        with self._fixtures([
+            self._create_models(cidr4, 4, net4[0])
+        ]) as net:
+            subnet = db_api.subnet_find(self.context, network_id=net['id'],
+                                        scope=db_api.ALL)[0]
+            past = subnet["next_auto_assign_ip"] + 4
+            with self.context.session.begin():
+                self.assertTrue(db_api.subnet_update_next_auto_assign_ip_past(
+                    self.context, subnet, past))
+                self.assertFalse(
+                    db_api.subnet_update_next_auto_assign_ip_past(
+                        self.context, subnet, past - 1))
+                self.context.session.refresh(subnet)
+                self.assertEqual(
+                    netaddr.IPAddress(subnet["next_auto_assign_ip"]).ipv4(),
+                    net4[5])
+
+    def test_subnet_lock(self):
+        cidr4 = "0.0.0.0/30"  # 2 bits
+        net4 = netaddr.IPNetwork(cidr4)
+        with self._fixtures([
+            self._create_models(cidr4, 4, net4[0])
+        ]) as net:
+            subnet = db_api.subnet_find(self.context, network_id=net['id'],
+                                        scope=db_api.ALL)[0]
+            with self.context.session.begin():
+                db_api.subnet_update_next_auto_assign_ip(self.context, subnet)
+                locked = db_api.subnet_lock(self.context, subnet)
+                self.assertEqual(
+                    netaddr.IPAddress(locked["next_auto_assign_ip"]).ipv4(),
+                    net4[1])
+                db_api.subnet_update_set_full(self.context, subnet)
+                self.assertIsNone(db_api.subnet_lock(self.context, subnet))
+
+    def test_subnet_ip_counts_follow_deallocation(self):
+        cidr4 = "2.2.2.0/30"
+        net4 = netaddr.IPNetwork(cidr4)
+        with self._fixtures([
+            self._create_models(cidr4, 4, net4.last)
+        ]) as net:
+            self._create_ip_address("2.2.2.1", 4, cidr4, net["id"])
+            self._create_ip_address("2.2.2.2", 4, cidr4, net["id"])
+            subnet = db_api.subnet_find(self.context, network_id=net['id'],
+                                        scope=db_api.ONE)
+            address = db_api.ip_address_find(
+                self.context, ip_address=netaddr.IPAddress("2.2.2.1"),
+                scope=db_api.ONE)
+            with self.context.session.begin():
+                db_api.ip_address_update(self.context, address,
+                                         deallocated=1)
+            self.context.session.refresh(subnet)
+            self.assertEqual(subnet["allocated_count"], 1)
+            self.assertEqual(subnet["deallocated_reusable_count"], 1)
+
+            with self.context.session.begin():
+                db_api.ip_address_delete(self.context, address)
+            self.context.session.refresh(subnet)
+            self.assertEqual(subnet["allocated_count"], 1)
+            self.assertEqual(subnet["deallocated_reusable_count"], 0)
+
+    def test_subnet_ip_counts_applied_on_commit(self):
+        cidr4 = "2.2.2.0/30"
+        cidr6 = "fe80::/120"
+        with self._fixtures([
+            self._create_models(cidr4, 4, netaddr.IPNetwork(cidr4).last),
+            self._create_models(cidr6, 6, netaddr.IPNetwork(cidr6).last)
+        ]) as net:
+            subnets = dict((s["cidr"], s) for s in db_api.subnet_find(
+                self.context, network_id=net["id"], scope=db_api.ALL))
+            with self.context.session.begin():
+                for ip, version in (("2.2.2.1", 4), ("2.2.2.2", 4),
+                                    ("fe80::1", 6)):
+                    subnet = subnets[cidr4 if version == 4 else cidr6]
+                    db_api.ip_address_create(
+                        self.context, address=netaddr.IPAddress(ip),
+                        subnet_id=subnet["id"], network_id=net["id"],
+                        version=version)
+                self.assertEqual(
+                    {subnets[cidr4]["id"]: [2, 0]},
+                    self.context.session.info[db_api.PENDING_IP_COUNTS])
+            self.assertNotIn(db_api.PENDING_IP_COUNTS,
+                             self.context.session.info)
+            for subnet in subnets.values():
+                self.context.session.refresh(subnet)
+            self.assertEqual(2, subnets[cidr4]["allocated_count"])
+            self.assertEqual(0, subnets[cidr6]["allocated_count"])
+
+    def test_subnet_ip_counts_discarded_on_rollback(self):
+        cidr4 = "2.2.2.0/30"
+        with self._fixtures([
+            self._create_models(cidr4, 4, netaddr.IPNetwork(cidr4).last)
+        ]) as net:
+            subnet = db_api.subnet_find(self.context, network_id=net["id"],
+                                        scope=db_api.ONE)
+            try:
+                with self.context.session.begin():
+                    db_api.subnet_update_ip_counts(
+                        self.context, subnet["id"], allocated=1,
+                        ip_version=4)
+                    raise ValueError()
+            except ValueError:
+                pass
+            self.assertNotIn(db_api.PENDING_IP_COUNTS,
+                             self.context.session.info)
+            self.context.session.refresh(subnet)
+            self.assertEqual(0, subnet["allocated_count"])
+
+    def test_subnet_ip_counts_applied_outside_transaction(self):
+        cidr4 = "2.2.2.0/30"
+        with self._fixtures([
+            self._create_models(cidr4, 4, netaddr.IPNetwork(cidr4).last)
+        ]) as net:
+            subnet = db_api.subnet_find(self.context, network_id=net["id"],
+                                        scope=db_api.ONE)
+            db_api.subnet_update_ip_counts(self.context, subnet["id"],
+                                           allocated=1, ip_version=4)
+            self.assertNotIn(db_api.PENDING_IP_COUNTS,
+                             self.context.session.info)
+            try:
+                with self.context.session.begin():
+                    raise ValueError()
+            except ValueError:
+                pass
+            self.context.session.refresh(subnet)
+            self.assertEqual(1, subnet["allocated_count"])
+
+    def test_subnet_ip_counts_kept_on_inner_rollback(self):
+        session = self.context.session
+        session.info[db_api.PENDING_IP_COUNTS] = {"subnet": [1, 0]}
+        self.addCleanup(session.info.pop, db_api.PENDING_IP_COUNTS, None)
+        db_api._discard_ip_counts(session, mock.Mock(_parent=mock.Mock()))
+        self.assertIn(db_api.PENDING_IP_COUNTS, session.info)
+        db_api._discard_ip_counts(session, mock.Mock(_parent=None))
+        self.assertNotIn(db_api.PENDING_IP_COUNTS, session.info)
+
+    def test_subnet_repair_ip_counts(self):
+        cidr4 = "2.2.2.0/30"
+        net4 = netaddr.IPNetwork(cidr4)
+        with self._fixtures([
+            self._create_models(cidr4, 4, net4.last)
+        ]) as net:
+            self._create_ip_address("2.2.2.1", 4, cidr4, net["id"])
+            subnet = db_api.subnet_find(self.context, network_id=net['id'],
+                                        scope=db_api.ONE)
+            with self.context.session.begin():
+                db_api.subnet_update_ip_counts(self.context, subnet["id"],
+                                               allocated=5, deallocated=2)
+            with self.context.session.begin():
+                counts = db_api.subnet_repair_ip_counts(self.context,
+                                                        subnet["id"])
+            self.assertEqual(counts, (1, 0))
+            self.context.session.refresh(subnet)
+            self.assertEqual(subnet["allocated_count"], 1)
+            self.assertEqual(subnet["deallocated_reusable_count"], 0)
+
+    def test_subnet_repair_ip_counts_v6(self):
+        cidr6 = "fe80::/120"
+        with self._fixtures([
+            self._create_models(cidr6, 6, netaddr.IPNetwork(cidr6).last)
+        ]) as net:
+            self._create_ip_address("fe80::1", 6, cidr6, net["id"])
+            subnet = db_api.subnet_find(self.context, network_id=net['id'],
+                                        scope=db_api.ONE)
+            with self.context.session.begin():
+                db_api.subnet_update_ip_counts(self.context, subnet["id"],
+                                               allocated=5)
+            with self.context.session.begin():
+                counts = db_api.subnet_repair_ip_counts(self.context,
+                                                        subnet["id"])
+            self.assertEqual(counts, (0, 0))
+            self.context.session.refresh(subnet)
+            self.assertEqual(subnet["allocated_count"], 0)
+
+    def test_ip_address_reallocate_candidates_and_claim(self):
+        cidr4 = "2.2.2.0/29"
+        net4 = netaddr.IPNetwork(cidr4)
+        with self._fixtures([
+            self._create_models(cidr4, 4, net4.last)
+        ]) as net:
+            now = timeutils.utcnow()
+            for i, ip in enumerate(("2.2.2.3", "2.2.2.1", "2.2.2.2")):
+                self._create_ip_address(ip, 4, cidr4, net["id"])
+                address = db_api.ip_address_find(
+                    self.context, ip_address=netaddr.IPAddress(ip),
+                    scope=db_api.ONE)
+                with self.context.session.begin():
+                    db_api.ip_address_update(self.context, address,
+                                             deallocated=1)
+                    address["deallocated_at"] = now - datetime.timedelta(
+                        seconds=600 - i)
+            filters = dict(network_id=net["id"], reuse_after=300,
+                           deallocated=True, version=4)
+
+            for skip_locked in (False, True):
+                with self.context.session.begin():
+                    candidates = db_api.ip_address_reallocate_candidates(
+                        self.context, 2, skip_locked=skip_locked, **filters)
+                addresses = [db_api.ip_address_find(
+                    self.context, id=c, scope=db_api.ONE)["address_readable"]
+                    for c in candidates]
+                self.assertEqual(["2.2.2.3", "2.2.2.1"], addresses)
+
+            update_kwargs = {models.IPAddress.deallocated: False,
+                             models.IPAddress.deallocated_at: None}
+            with self.context.session.begin():
+                self.assertTrue(db_api.ip_address_reallocate_claim(
+                    self.context, candidates[1], update_kwargs, **filters))
+            with self.context.session.begin():
+                self.assertFalse(db_api.ip_address_reallocate_claim(
+                    self.context, candidates[1], update_kwargs, **filters))
+                claimed = db_api.ip_address_reallocate_claimed(
+                    self.context, candidates[1])
+            self.assertEqual("2.2.2.1", claimed["address_readable"])
+            self.assertFalse(claimed["_deallocated"])
+
+    def test_ip_address_deallocate_bulk(self):
+        cidr4 = "2.2.2.0/29"
+        net4 = netaddr.IPNetwork(cidr4)
+        with self._fixtures([
+            self._create_models(cidr4, 4, net4.last)
+        ]) as net:
+            for ip in ("2.2.2.1", "2.2.2.2", "2.2.2.3"):
+                self._create_ip_address(ip, 4, cidr4, net["id"])
+            addresses = db_api.ip_address_find(
+                self.context, network_id=net["id"], scope=db_api.ALL)
+            addresses.sort(key=lambda a: a["address"])
+            with self.context.session.begin():
+                db_api.port_create(self.context, network_id=net["id"],
+                                   backend_key="1", device_id="1",
+                                   addresses=addresses)
+                db_api.port_create(self.context, network_id=net["id"],
+                                   backend_key="2", device_id="2",
+                                   addresses=addresses[1:2])
+            self.context.session.expire_all()
+            addresses = db_api.ip_address_find(
+                self.context, network_id=net["id"], scope=db_api.ALL)
+            addresses.sort(key=lambda a: a["address"])
+
+            counts = db_api.ip_address_port_counts(self.context, addresses)
+            self.assertEqual([1, 2, 1], [counts[a["id"]] for a in addresses])
+
+            to_deallocate = [addresses[0], addresses[2]]
+            with self.context.session.begin():
+                self.assertEqual(2, db_api.ip_address_deallocate_bulk(
+                    self.context, to_deallocate))
+            self.assertTrue(addresses[0]["_deallocated"])
+            self.assertIsNone(addresses[0]["allocated_at"])
+            self.assertIsNone(addresses[2]["address_type"])
+            self.assertFalse(addresses[1]["_deallocated"])
+            self.assertIsNotNone(addresses[1]["allocated_at"])
+            self.context.session.expire_all()
+            found = db_api.ip_address_find(
+                self.context, network_id=net["id"], _deallocated=True,
+                scope=db_api.ALL)
+            self.assertEqual(
+                sorted(a["id"] for a in to_deallocate),
+                sorted(a["id"] for a in found))
+            self.assertEqual([None, None], [a["allocated_at"] for a in found])
+            subnet = db_api.subnet_find(self.context, network_id=net['id'],
+                                        scope=db_api.ONE)
+            self.assertEqual(1, subnet["allocated_count"])
+            self.assertEqual(2, subnet["deallocated_reusable_count"])
+
+    def test_ip_address_reap(self):
+        cidr4 = "2.2.2.0/29"
+        net4 = netaddr.IPNetwork(cidr4)
+        with self._fixtures([
+            self._create_models(cidr4, 4, net4.last)
+        ]) as net:
+            for ip in ("2.2.2.1", "2.2.2.2", "2.2.2.3"):
+                self._create_ip_address(ip, 4, cidr4, net["id"])
+            addresses = db_api.ip_address_find(
+                self.context, network_id=net["id"], scope=db_api.ALL)
+            addresses.sort(key=lambda a: a["address"])
+            subnet_id = addresses[0]["subnet_id"]
+            with self.context.session.begin():
+                db_api.port_create(self.context, network_id=net["id"],
+                                   backend_key="1", device_id="1",
+                                   addresses=addresses[2:])
+                db_api.ip_address_deallocate_bulk(self.context, addresses)
+
+            rows = db_api.ip_address_reap_candidates(self.context,
+                                                     subnet_id, 10)
+            self.assertEqual(sorted((a["id"], int(a["address"]))
+                                    for a in addresses[:2]), rows)
+            self.assertEqual(rows[1:], db_api.ip_address_reap_candidates(
+                self.context, subnet_id, 10, marker=rows[0][0]))
+
+            with self.context.session.begin():
+                self.assertEqual(2, db_api.ip_address_reap(
+                    self.context, subnet_id,
+                    [a["id"] for a in addresses]))
+            self.context.session.expire_all()
+            found = db_api.ip_address_find(
+                self.context, network_id=net["id"], scope=db_api.ALL)
+            self.assertEqual([addresses[2]["id"]], [a["id"] for a in found])
+            subnet = db_api.subnet_find(self.context, id=subnet_id,
+                                        scope=db_api.ONE)
+            self.assertEqual(0, subnet["allocated_count"])
+            self.assertEqual(1, subnet["deallocated_reusable_count"])
+
 
 class QuarkFindMacAddressRangeAllocationCount(QuarkIpamBaseFunctionalTest):
     @contextlib.contextmanager
@@ -236,3 +546,233 @@ class QuarkFindMacAddressRangeAllocationCount(QuarkIpamBaseFunctionalTest):
                 ranges = db_api.mac_address_range_find_allocation_counts(
                     self.context, use_forbidden_mac_range=True)
                 self.assertTrue(ranges[0]["cidr"], mr1["cidr"])
+
+    def test_mac_address_range_find_for_lease_most_full(self):
+        mr1_mac = netaddr.EUI("AA:AA:AA:00:00:00")
+        mr1 = {"cidr": "AA:AA:AA/24", "do_not_use": False,
+               "first_address": mr1_mac.value,
+               "last_address": netaddr.EUI("AA:AA:AA:FF:FF:FF").value,
+               "next_auto_assign_mac": mr1_mac.value + 1}
+        mr2_mac = netaddr.EUI("BB:BB:BB:00:00:00")
+        mr2 = {"cidr": "BB:BB:BB/24", "do_not_use": False,
+               "first_address": mr2_mac.value,
+               "last_address": netaddr.EUI("BB:BB:BB:FF:FF:FF").value,
+               "next_auto_assign_mac": mr2_mac.value + 5}
+        mr3_mac = netaddr.EUI("CC:CC:CC:00:00:00")
+        mr3 = {"cidr": "CC:CC:CC/24", "do_not_use": True,
+               "first_address": mr3_mac.value,
+               "last_address": netaddr.EUI("CC:CC:CC:FF:FF:FF").value,
+               "next_auto_assign_mac": mr3_mac.value + 10}
+
+        with self._fixtures([mr1, mr2, mr3]):
+            with self.context.session.begin():
+                mac_range = db_api.mac_address_range_find_for_lease(
+                    self.context)
+                self.assertEqual(mr2["cidr"], mac_range["cidr"])
+                mac_range = db_api.mac_address_range_find_for_lease(
+                    self.context, use_forbidden_mac_range=True)
+                self.assertEqual(mr3["cidr"], mac_range["cidr"])
+
+    def test_mac_range_return_next_auto_assign_mac(self):
+        mr1_mac = netaddr.EUI("AA:AA:AA:00:00:00")
+        mr1 = {"cidr": "AA:AA:AA/24", "do_not_use": False,
+               "first_address": mr1_mac.value,
+               "last_address": netaddr.EUI("AA:AA:AA:FF:FF:FF").value,
+               "next_auto_assign_mac": mr1_mac.value + 8}
+
+        with self._fixtures([mr1]):
+            with self.context.session.begin():
+                mac_range = db_api.mac_address_range_find_for_lease(
+                    self.context)
+                self.assertFalse(db_api.mac_range_return_next_auto_assign_mac(
+                    self.context, mac_range["id"], mr1_mac.value + 3,
+                    mr1_mac.value + 1))
+                self.assertTrue(db_api.mac_range_return_next_auto_assign_mac(
+                    self.context, mac_range["id"], mr1_mac.value + 7,
+                    mr1_mac.value + 4))
+                self.context.session.refresh(mac_range)
+                self.assertEqual(mr1_mac.value + 4,
+                                 mac_range["next_auto_assign_mac"])
+
+    def test_mac_range_counts_follow_deallocation(self):
+        mr1_mac = netaddr.EUI("AA:AA:AA:00:00:00")
+        mr1 = {"cidr": "AA:AA:AA/24", "do_not_use": False,
+               "first_address": mr1_mac.value,
+               "last_address": netaddr.EUI("AA:AA:AA:FF:FF:FF").value,
+               "next_auto_assign_mac": mr1_mac.value}
+
+        with self._fixtures([mr1]):
+            mac_range = db_api.mac_address_range_find(
+                self.context.elevated(), scope=db_api.ONE)
+            with self.context.session.begin():
+                mac = db_api.mac_address_create(
+                    self.context, address=mr1_mac.value,
+                    mac_address_range_id=mac_range["id"])
+                db_api.mac_address_create_bulk(
+                    self.context, [mr1_mac.value + 1, mr1_mac.value + 2],
+                    mac_range["id"])
+            with self.context.session.begin():
+                db_api.mac_address_update(self.context, mac,
+                                          deallocated=True)
+                _rng, count = db_api.mac_address_range_find_allocation_counts(
+                    self.context)
+            self.assertEqual(3, count)
+            self.context.session.refresh(mac_range)
+            self.assertEqual(2, mac_range["allocated_count"])
+            self.assertEqual(1, mac_range["deallocated_count"])
+
+            with self.context.session.begin():
+                db_api.mac_address_delete(self.context, mac)
+            self.context.session.refresh(mac_range)
+            self.assertEqual(2, mac_range["allocated_count"])
+            self.assertEqual(0, mac_range["deallocated_count"])
+
+    def test_mac_range_repair_counts(self):
+        mr1_mac = netaddr.EUI("AA:AA:AA:00:00:00")
+        mr1 = {"cidr": "AA:AA:AA/24", "do_not_use": False,
+               "first_address": mr1_mac.value,
+               "last_address": netaddr.EUI("AA:AA:AA:FF:FF:FF").value,
+               "next_auto_assign_mac": mr1_mac.value}
+
+        with self._fixtures([mr1]):
+            mac_range = db_api.mac_address_range_find(
+                self.context.elevated(), scope=db_api.ONE)
+            with self.context.session.begin():
+                db_api.mac_address_create(
+                    self.context, address=mr1_mac.value,
+                    mac_address_range_id=mac_range["id"])
+                db_api.mac_range_update_counts(self.context, mac_range["id"],
+                                               allocated=4, deallocated=2)
+            with self.context.session.begin():
+                counts = db_api.mac_range_repair_counts(self.context,
+                                                        mac_range["id"])
+            self.assertEqual((1, 0), counts)
+            self.context.session.refresh(mac_range)
+            self.assertEqual(1, mac_range["allocated_count"])
+            self.assertEqual(0, mac_range["deallocated_count"])
+
+    def test_mac_address_reallocate_candidates_and_claim(self):
+        mr1_mac = netaddr.EUI("AA:AA:AA:00:00:00")
+        mr1 = {"cidr": "AA:AA:AA/24", "do_not_use": False,
+               "first_address": mr1_mac.value,
+               "last_address": netaddr.EUI("AA:AA:AA:FF:FF:FF").value,
+               "next_auto_assign_mac": mr1_mac.value}
+
+        with self._fixtures([mr1]):
+            mac_range = db_api.mac_address_range_find(
+                self.context.elevated(), scope=db_api.ONE)
+            now = timeutils.utcnow()
+            with self.context.session.begin():
+                for i, offset in enumerate((3, 1, 2)):
+                    mac = db_api.mac_address_create(
+                        self.context, address=mr1_mac.value + offset,
+                        mac_address_range_id=mac_range["id"])
+                    db_api.mac_address_update(
+                        self.context, mac, deallocated=True,
+                        deallocated_at=now - datetime.timedelta(
+                            seconds=600 - i))
+            filters = dict(reuse_after=300, deallocated=True)
+
+            for skip_locked in (False, True):
+                with self.context.session.begin():
+                    candidates = db_api.mac_address_reallocate_candidates(
+                        self.context, 2, skip_locked=skip_locked, **filters)
+                self.assertEqual([mr1_mac.value + 3, mr1_mac.value + 1],
+                                 candidates)
+
+            update_kwargs = {"deallocated": False, "deallocated_at": None}
+            with self.context.session.begin():
+                self.assertTrue(db_api.mac_address_reallocate_claim(
+                    self.context, candidates[1], update_kwargs, **filters))
+            with self.context.session.begin():
+                self.assertFalse(db_api.mac_address_reallocate_claim(
+                    self.context, candidates[1], update_kwargs, **filters))
+                claimed = db_api.mac_address_reallocate_claimed(
+                    self.context, candidates[1])
+            self.assertEqual(mr1_mac.value + 1, claimed["address"])
+            self.context.session.refresh(claimed)
+            self.assertFalse(claimed["deallocated"])
+
+
+class QuarkPortFindRelations(BaseFunctionalTest):
+    def setUp(self):
+        super(QuarkPortFindRelations, self).setUp()
+        self.statements = []
+        engine = neutron_db_api.get_engine()
+        event.listen(engine, "before_cursor_execute", self._count)
+        self.addCleanup(event.remove, engine, "before_cursor_execute",
+                        self._count)
+
+    def _count(self, conn, cursor, statement, *args):
+        self.statements.append(statement)
+
+    def _create_ports(self, count):
+        with self.context.session.begin():
+            net = db_api.network_create(self.context, name="public",
+                                        tenant_id="fake")
+            subnets = []
+            for i in xrange(2):
+                subnet = db_api.subnet_create(self.context, network=net,
+                                              cidr="10.0.%d.0/24" % i)
+                for j in xrange(2):
+                    db_api.route_create(self.context, subnet_id=subnet["id"],
+                                        cidr="172.16.%d.0/24" % j,
+                                        gateway="10.0.%d.1" % i)
+                db_api.dns_create(self.context, subnet_id=subnet["id"],
+                                  ip=netaddr.IPAddress("8.8.8.8"))
+                subnets.append(subnet)
+            self.context.session.flush()
+            for i in xrange(count):
+                subnet = subnets[i % 2]
+                port = db_api.port_create(self.context, network_id=net["id"],
+                                          backend_key="1", device_id=str(i))
+                address = db_api.ip_address_create(
+                    self.context, subnet_id=subnet["id"],
+                    network_id=net["id"], version=4,
+                    address=netaddr.IPAddress("10.0.%d.%d" % (i % 2, i + 2)))
+                self.context.session.flush()
+                db_api.port_associate_ip(self.context, [port], address)
+            self.context.session.flush()
+        self.context.session.expunge_all()
+
+    def _find(self):
+        del self.statements[:]
+        ports = db_api.port_find(self.context, fields=["port_subnets"],
+                                 join_security_groups=True,
+                                 scope=db_api.ALL)
+        subnets = set()
+        for port in ports:
+            for address in port.ip_addresses:
+                self.assertTrue(address.enabled_for_port(port) is not None)
+                self.assertEqual(2, len(address.subnet.routes))
+                self.assertEqual(1, len(address.subnet.dns_nameservers))
+                subnets.add(address.subnet)
+            self.assertEqual([], port.security_groups)
+        return ports, subnets
+
+    def test_queries_do_not_grow_with_ports(self):
+        self._create_ports(2)
+        ports, subnets = self._find()
+        queries = len(self.statements)
+        self.assertEqual(2, len(ports))
+
+        self.context.session.expunge_all()
+        self._create_ports(8)
+        ports, subnets = self._find()
+        self.assertEqual(10, len(ports))
+        self.assertEqual(queries, len(self.statements))
+        self.assertEqual(4, len(subnets))
+
+    def test_fields_skip_unrequested(self):
+        self._create_ports(2)
+        del self.statements[:]
+        ports = db_api.port_find(self.context, fields=["id", "device_id"],
+                                 join_security_groups=True,
+                                 scope=db_api.ALL)
+        self.assertEqual(1, len(self.statements))
+        for port in ports:
+            unloaded = sa_inspect(port).unloaded
+            self.assertIn("ip_addresses", unloaded)
+            self.assertIn("security_groups", unloaded)
+            self.assertIn("mac_address", unloaded)
+            self.assertNotIn("device_id", unloaded)
@@ -17,6 +17,8 @@ import contextlib
 
 import mock
 import netaddr
+from oslo.config import cfg
+from sqlalchemy import inspect as sa_inspect
 
 from quark.db import api as db_api
 import quark.ipam
@@ -128,3 +130,81 @@ class QuarkPortsPaginationFunctionalTest(BaseFunctionalTest):
             res_ports = port_api.get_ports(self.context, 2, None, None)
             self.assertTrue(res_ports[0]['mac_address'] <
                             res_ports[1]['mac_address'])
+
+
+class QuarkKeysetPaginationFunctionalTest(BaseFunctionalTest):
+    def setUp(self):
+        super(QuarkKeysetPaginationFunctionalTest, self).setUp()
+        cfg.CONF.set_override("db_keyset_pagination", True, "QUARK")
+        self.addCleanup(cfg.CONF.clear_override, "db_keyset_pagination",
+                        "QUARK")
+
+    def _create_networks(self, count):
+        with self.context.session.begin():
+            nets = [db_api.network_create(self.context, name="net%d" % i,
+                                          tenant_id="fake")
+                    for i in xrange(count)]
+            for net in nets:
+                db_api.subnet_create(self.context, network=net,
+                                     cidr="10.0.0.0/24")
+        return nets
+
+    def _pages(self, limit, sorts=None):
+        pages = []
+        marker = None
+        while True:
+            page = db_api.network_find(self.context, limit, sorts, marker,
+                                       False, join_subnets=True,
+                                       scope=db_api.ALL)
+            if not page:
+                return pages
+            pages.append([net["id"] for net in page])
+            marker = page[-1]["id"]
+
+    def test_pages_cover_every_row_once(self):
+        nets = self._create_networks(7)
+        pages = self._pages(3)
+        self.assertEqual([3, 3, 1], [len(page) for page in pages])
+        ids = [net_id for page in pages for net_id in page]
+        self.assertEqual(sorted(net["id"] for net in nets), sorted(ids))
+
+    def test_pages_ordered_by_sort_keys(self):
+        self._create_networks(5)
+        for direction in (True, False):
+            ids = [net_id for page in self._pages(2, [("id", direction)])
+                   for net_id in page]
+            self.assertEqual(sorted(ids, reverse=not direction), ids)
+
+    def test_ties_broken_by_id(self):
+        nets = self._create_networks(4)
+        with self.context.session.begin():
+            for net in nets:
+                net["created_at"] = nets[0]["created_at"]
+        ids = [net_id for page in self._pages(1) for net_id in page]
+        self.assertEqual(sorted(net["id"] for net in nets), ids)
+
+    def test_unknown_marker_is_empty_page(self):
+        self._create_networks(2)
+        self.assertEqual([], db_api.network_find(
+            self.context, 1, None, "missing", False, scope=db_api.ALL))
+
+    def test_collections_loaded_per_page(self):
+        self._create_networks(3)
+        self.context.session.flush()
+        self.context.session.expunge_all()
+        page = db_api.network_find(self.context, 2, None, None, False,
+                                   join_subnets=True, scope=db_api.ALL)
+        for net in page:
+            self.assertNotIn("subnets", sa_inspect(net).unloaded)
+            self.assertEqual(1, len(net["subnets"]))
+
+    def test_subnets_paged_by_marker_filter(self):
+        nets = self._create_networks(3)
+        first = db_api.subnet_find(self.context, limit=2, join_dns=True,
+                                   join_routes=True, scope=db_api.ALL)
+        rest = db_api.subnet_find(self.context, limit=2,
+                                  marker=first[-1]["id"], scope=db_api.ALL)
+        self.assertEqual(3, len(first) + len(rest))
+        self.assertEqual(
+            sorted(subnet["network_id"] for subnet in first + rest),
+            sorted(net["id"] for net in nets))
@@ -1,14 +1,23 @@
 import os
+import threading
+import time
 
+import mock
+import netaddr
+from neutron.common import rpc
 from neutron import context
 from neutron.db import api as neutron_db_api
 from oslo.config import cfg
+from oslo_log import log as logging
 from sqlalchemy.orm import configure_mappers
 
+from quark.db import api as db_api
 from quark.db import models
 from quark import quota_driver
 from quark.tests import test_base
 
+LOG = logging.getLogger(__name__)
+
 
 class MySqlBaseFunctionalTest(test_base.TestBase):
     @classmethod
@@ -36,3 +45,82 @@ class MySqlBaseFunctionalTest(test_base.TestBase):
         engine = neutron_db_api.get_engine()
         models.BASEV2.metadata.drop_all(engine)
         quota_driver.quota_db.Quota.metadata.drop_all(engine)
+
+
+class MySqlBenchmarkTest(MySqlBaseFunctionalTest):
+    """Runs IPAM calls from concurrent workers against MySQL.
+
+    The measurements are logged for comparison rather than asserted on,
+    the tests only check that every worker got what it asked for.
+    """
+    def setUp(self):
+        super(MySqlBenchmarkTest, self).setUp()
+        patcher = mock.patch("neutron.common.rpc.oslo_messaging")
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        rpc.init(mock.MagicMock())
+
+    def _create_network(self, *cidrs):
+        """Creates a network with an empty v4 subnet per cidr."""
+        subnets = []
+        with self.context.session.begin():
+            network = db_api.network_create(
+                self.context, name="public", tenant_id="fake")
+            for cidr in cidrs:
+                cidr = netaddr.IPNetwork(cidr)
+                subnets.append(db_api.subnet_create(
+                    self.context, network=network, cidr=str(cidr),
+                    ip_version=4, tenant_id="fake", do_not_use=False,
+                    first_ip=cidr.ipv6().first, last_ip=cidr.ipv6().last,
+                    next_auto_assign_ip=cidr.ipv6().first + 1))
+        return network, subnets
+
+    def _require_skip_locked(self):
+        version = self.context.session.execute(
+            "SELECT VERSION()").scalar()
+        if "MariaDB" in version or int(version.split(".")[0]) < 8:
+            self.skipTest("SKIP LOCKED needs MySQL 8.0, have %s" % version)
+
+    def _run_workers(self, workers, work, calls=None):
+        """Calls work(context, n, i) from workers threads at once.
+
+        work returns a list of what it got. Each worker calls it calls
+        times, or without calls until it returns None or raises.
+
+        Returns everything the workers got, the errors they raised and the
+        seconds it took.
+        """
+        results = []
+        errors = []
+        lock = threading.Lock()
+
+        def worker(n):
+            ctx = context.Context("fake", "fake", is_admin=False)
+            i = 0
+            while calls is None or i < calls:
+                i += 1
+                try:
+                    got = work(ctx, n, i)
+                except Exception as e:
+                    with lock:
+                        errors.append(e)
+                    if calls is None:
+                        return
+                    continue
+                if got is None:
+                    return
+                with lock:
+                    results.extend(got)
+
+        threads = [threading.Thread(target=worker, args=(n,))
+                   for n in xrange(workers)]
+        start = time.time()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        return results, errors, time.time() - start
+
+    def _report(self, name, **measures):
+        LOG.info("%s %s" % (name, " ".join(
+            "%s=%s" % (key, measures[key]) for key in sorted(measures))))
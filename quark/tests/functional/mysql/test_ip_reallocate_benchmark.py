@@ -0,0 +1,77 @@
+import datetime
+
+import netaddr
+from oslo.config import cfg
+from oslo.utils import timeutils
+
+from quark.db import api as db_api
+from quark.db import models
+import quark.ipam
+from quark.tests.functional.mysql.base import MySqlBenchmarkTest
+
+
+class QuarkIPReallocateBenchmark(MySqlBenchmarkTest):
+    """Compares the reallocation claim modes under concurrent workers.
+
+    Every worker drains the same pool of deallocated addresses. Each run
+    must hand out every address exactly once.
+    """
+    ADDRESSES = 256
+    WORKERS = (1, 8, 32)
+
+    def setUp(self):
+        super(QuarkIPReallocateBenchmark, self).setUp()
+        self.network, (self.subnet,) = self._create_network("10.0.0.0/22")
+        with self.context.session.begin():
+            for ip in netaddr.IPNetwork("10.0.0.0/22")[1:self.ADDRESSES + 1]:
+                db_api.ip_address_create(
+                    self.context, address=ip, version=4,
+                    subnet_id=self.subnet["id"],
+                    network_id=self.network["id"])
+
+    def _deallocate_all(self):
+        reusable_at = timeutils.utcnow() - datetime.timedelta(
+            seconds=cfg.CONF.QUARK.ipam_reuse_after + 1)
+        with self.context.session.begin():
+            self.context.session.query(models.IPAddress).update(
+                {models.IPAddress._deallocated: True,
+                 models.IPAddress.deallocated_at: reusable_at,
+                 models.IPAddress.transaction_id: None},
+                synchronize_session=False)
+            db_api.subnet_repair_ip_counts(self.context, self.subnet["id"])
+
+    def _reallocate(self, ctx, n, i):
+        addresses = self.ipam.attempt_to_reallocate_ip(
+            ctx, self.network["id"], "port-%d" % n,
+            cfg.CONF.QUARK.ipam_reuse_after, version=4)
+        return [a["id"] for a in addresses] or None
+
+    def _run(self, claim, skip_locked=False):
+        cfg.CONF.set_override("ipam_reallocate_claim", claim, "QUARK")
+        cfg.CONF.set_override("ipam_use_skip_locked", skip_locked, "QUARK")
+        self.addCleanup(cfg.CONF.clear_override, "ipam_reallocate_claim",
+                        "QUARK")
+        self.addCleanup(cfg.CONF.clear_override, "ipam_use_skip_locked",
+                        "QUARK")
+        self.ipam = quark.ipam.QuarkIpamANY()
+        for workers in self.WORKERS:
+            self._deallocate_all()
+            claimed, errors, elapsed = self._run_workers(workers,
+                                                         self._reallocate)
+            self._report("reallocate", claim=claim, skip_locked=skip_locked,
+                         workers=workers, addresses=len(claimed),
+                         seconds="%.3f" % elapsed,
+                         per_second="%.1f" % (len(claimed) / elapsed))
+            self.assertEqual([], errors)
+            self.assertEqual(self.ADDRESSES, len(claimed))
+            self.assertEqual(self.ADDRESSES, len(set(claimed)))
+
+    def test_transaction_claim(self):
+        self._run("transaction")
+
+    def test_free_list_claim(self):
+        self._run("free_list")
+
+    def test_free_list_skip_locked_claim(self):
+        self._require_skip_locked()
+        self._run("free_list", skip_locked=True)
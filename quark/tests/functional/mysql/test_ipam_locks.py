@@ -0,0 +1,17 @@
+from quark import exceptions as q_exc
+from quark import ipam_locks
+from quark.tests.functional.mysql.base import MySqlBaseFunctionalTest
+
+
+class QuarkDbLockProvider(MySqlBaseFunctionalTest):
+    def test_same_name_excluded_across_connections(self):
+        provider = ipam_locks.DbLockProvider(timeout=1)
+        other = ipam_locks.DbLockProvider(timeout=1)
+        with provider.lock("quark.ipam_locks.select_subnet.net1"):
+            with self.assertRaises(q_exc.IpamLockTimeout):
+                with other.lock("quark.ipam_locks.select_subnet.net1"):
+                    pass
+            with other.lock("quark.ipam_locks.select_subnet.net2"):
+                pass
+        with other.lock("quark.ipam_locks.select_subnet.net1"):
+            pass
@@ -0,0 +1,84 @@
+import datetime
+
+import netaddr
+from neutron.common import exceptions
+from oslo.config import cfg
+from oslo.utils import timeutils
+
+from quark.db import api as db_api
+from quark.db import models
+import quark.ipam
+from quark.tests.functional.mysql.base import MySqlBenchmarkTest
+
+
+class QuarkMacReallocateBenchmark(MySqlBenchmarkTest):
+    """Compares the MAC reallocation claim modes under concurrent workers.
+
+    Every worker drains the same pool of deallocated MACs. Each run must
+    hand out every MAC exactly once.
+    """
+    MACS = 256
+    WORKERS = (1, 8, 32)
+
+    def setUp(self):
+        super(QuarkMacReallocateBenchmark, self).setUp()
+        first = netaddr.EUI("AA:BB:CC:00:00:00").value
+        with self.context.session.begin():
+            self.mac_range = db_api.mac_address_range_create(
+                self.context, cidr="AA:BB:CC/24", do_not_use=False,
+                first_address=first, last_address=first + self.MACS - 1,
+                next_auto_assign_mac=-1)
+        with self.context.session.begin():
+            db_api.mac_address_create_bulk(
+                self.context, range(first, first + self.MACS),
+                self.mac_range["id"])
+
+    def _deallocate_all(self):
+        reusable_at = timeutils.utcnow() - datetime.timedelta(
+            seconds=cfg.CONF.QUARK.ipam_reuse_after + 1)
+        with self.context.session.begin():
+            self.context.session.query(models.MacAddress).update(
+                {models.MacAddress.deallocated: True,
+                 models.MacAddress.deallocated_at: reusable_at,
+                 models.MacAddress.transaction_id: None},
+                synchronize_session=False)
+            db_api.mac_range_repair_counts(self.context,
+                                           self.mac_range["id"])
+
+    def _reallocate(self, ctx, n, i):
+        try:
+            mac = self.ipam.allocate_mac_address(
+                ctx, "net", "port-%d" % n, cfg.CONF.QUARK.ipam_reuse_after)
+        except exceptions.MacAddressGenerationFailure:
+            return None
+        return [mac["address"]]
+
+    def _run(self, claim, skip_locked=False):
+        cfg.CONF.set_override("mac_address_reallocate_claim", claim, "QUARK")
+        cfg.CONF.set_override("ipam_use_skip_locked", skip_locked, "QUARK")
+        self.addCleanup(cfg.CONF.clear_override,
+                        "mac_address_reallocate_claim", "QUARK")
+        self.addCleanup(cfg.CONF.clear_override, "ipam_use_skip_locked",
+                        "QUARK")
+        self.ipam = quark.ipam.QuarkIpamANY()
+        for workers in self.WORKERS:
+            self._deallocate_all()
+            claimed, errors, elapsed = self._run_workers(workers,
+                                                         self._reallocate)
+            self._report("mac reallocate", claim=claim,
+                         skip_locked=skip_locked, workers=workers,
+                         macs=len(claimed), seconds="%.3f" % elapsed,
+                         per_second="%.1f" % (len(claimed) / elapsed))
+            self.assertEqual([], errors)
+            self.assertEqual(self.MACS, len(claimed))
+            self.assertEqual(self.MACS, len(set(claimed)))
+
+    def test_transaction_claim(self):
+        self._run("transaction")
+
+    def test_free_list_claim(self):
+        self._run("free_list")
+
+    def test_free_list_skip_locked_claim(self):
+        self._require_skip_locked()
+        self._run("free_list", skip_locked=True)
@@ -1,7 +1,9 @@
 import mock
 import netaddr
+from oslo_log import log as logging
 
 import contextlib
+import time
 
 from quark import exceptions
 import quark.ipam
@@ -12,6 +14,8 @@ import quark.plugin_modules.ports as port_api
 import quark.plugin_modules.subnets as subnet_api
 from quark.tests.functional.mysql.base import MySqlBaseFunctionalTest
 
+LOG = logging.getLogger(__name__)
+
 
 class QuarkUpdatePorts(MySqlBaseFunctionalTest):
     @contextlib.contextmanager
@@ -67,3 +71,54 @@ class QuarkUpdatePorts(MySqlBaseFunctionalTest):
             ip = "192.168.1.50"
             port = port_api.update_port(self.context, id, _make_body(ip))
             self.assertEqual(ip, port['fixed_ips'][0]['ip_address'])
+
+
+class QuarkCreatePortsBulkBenchmark(MySqlBaseFunctionalTest):
+    """Compares 100 create_port calls against one create_port_bulk."""
+    PORTS = 100
+
+    @contextlib.contextmanager
+    def _stubs(self):
+        with contextlib.nested(
+                mock.patch("neutron.common.rpc.get_notifier"),
+                mock.patch("neutron.quota.QUOTAS.limit_check")):
+            network = dict(name="public", tenant_id="fake",
+                           network_plugin="BASE")
+            net = network_api.create_network(self.context,
+                                             {"network": network})
+            mac = {'mac_address_range': dict(cidr="AA:BB:CC")}
+            self.context.is_admin = True
+            macrng_api.create_mac_address_range(self.context, mac)
+            self.context.is_admin = False
+            subnet = dict(ip_version=4, cidr="10.0.0.0/22",
+                          network_id=net["id"], tenant_id="fake")
+            subnet_api.create_subnet(self.context, {"subnet": subnet})
+            yield net
+
+    def _port_bodies(self, net_id, prefix):
+        return [{"port": dict(network_id=net_id, tenant_id="fake",
+                              device_id="%s-%d" % (prefix, i))}
+                for i in xrange(self.PORTS)]
+
+    def test_create_port_bulk_faster_than_sequential(self):
+        with self._stubs() as net:
+            start = time.time()
+            sequential = [port_api.create_port(self.context, body)
+                          for body in self._port_bodies(net["id"], "seq")]
+            sequential_elapsed = time.time() - start
+
+            start = time.time()
+            bulk = port_api.create_port_bulk(
+                self.context, {"ports": self._port_bodies(net["id"], "bulk")})
+            bulk_elapsed = time.time() - start
+
+        LOG.info("create ports=%d sequential_seconds=%.3f "
+                 "bulk_seconds=%.3f" % (self.PORTS, sequential_elapsed,
+                                        bulk_elapsed))
+        ports = sequential + bulk
+        self.assertEqual(2 * self.PORTS, len(ports))
+        self.assertEqual(2 * self.PORTS,
+                         len(set(p["mac_address"] for p in ports)))
+        ips = [ip["ip_address"] for p in ports for ip in p["fixed_ips"]]
+        self.assertEqual(2 * self.PORTS, len(set(ips)))
+        self.assertTrue(bulk_elapsed < sequential_elapsed)
@@ -0,0 +1,54 @@
+import mock
+from oslo.config import cfg
+
+import quark.ipam
+from quark import ipam_metrics
+from quark.tests.functional.mysql.base import MySqlBenchmarkTest
+
+
+class QuarkRandomProbeBenchmark(MySqlBenchmarkTest):
+    """Compares collision retries of sequential and random v4 allocation.
+
+    Every worker allocates new v4 addresses from one large subnet. The
+    retry and conflict counters of the IPAM metrics are logged with each
+    run.
+    """
+    CIDR = "10.0.0.0/20"
+    WORKERS = 16
+    ALLOCATIONS = 16
+
+    def setUp(self):
+        super(QuarkRandomProbeBenchmark, self).setUp()
+        self.metrics = ipam_metrics.IpamMetrics(sink=None)
+        patcher = mock.patch("quark.ipam_metrics.METRICS", self.metrics)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def _allocate(self, ctx, n, i):
+        addresses = []
+        self.ipam.allocate_ip_address(
+            ctx, addresses, self.network["id"], "port-%d-%d" % (n, i),
+            cfg.CONF.QUARK.ipam_reuse_after, version=4)
+        return [a["address"] for a in addresses]
+
+    def _run(self, ipam):
+        self.ipam = ipam
+        self.network, subnets = self._create_network(self.CIDR)
+        allocated, errors, elapsed = self._run_workers(
+            self.WORKERS, self._allocate, calls=self.ALLOCATIONS)
+        name = "%s.try_allocate_ip_address" % ipam.get_name()
+        counters = self.metrics.counters
+        self._report("random probe", strategy=ipam.get_name(),
+                     workers=self.WORKERS, allocated=len(allocated),
+                     errors=len(errors), seconds="%.3f" % elapsed,
+                     retries=counters.get("%s.retries" % name, 0),
+                     conflicts=counters.get("%s.failures.conflict" % name, 0))
+        self.assertEqual(len(allocated), len(set(allocated)))
+        self.assertEqual(self.WORKERS * self.ALLOCATIONS,
+                         len(allocated) + len(errors))
+
+    def test_sequential(self):
+        self._run(quark.ipam.QuarkIpamANY())
+
+    def test_random_probe(self):
+        self._run(quark.ipam.QuarkIpamANYRandom())
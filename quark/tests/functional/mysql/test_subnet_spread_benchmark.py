@@ -0,0 +1,57 @@
+from oslo.config import cfg
+
+import quark.ipam
+from quark.tests.functional.mysql.base import MySqlBenchmarkTest
+
+
+class QuarkSubnetSpreadBenchmark(MySqlBenchmarkTest):
+    """Compares row lock waits with and without subnet spreading.
+
+    Every worker allocates new v4 addresses from a network of several
+    subnets. The InnoDB row lock counters are sampled around each run.
+    """
+    SUBNETS = 4
+    WORKERS = 16
+    ALLOCATIONS = 16
+
+    def setUp(self):
+        super(QuarkSubnetSpreadBenchmark, self).setUp()
+        self.addCleanup(cfg.CONF.clear_override, "ipam_subnet_spread_top_k",
+                        "QUARK")
+
+    def _row_lock_status(self):
+        status = dict(self.context.session.execute(
+            "SHOW GLOBAL STATUS LIKE 'Innodb_row_lock_%'").fetchall())
+        return (int(status["Innodb_row_lock_time"]),
+                int(status["Innodb_row_lock_waits"]))
+
+    def _allocate(self, ctx, n, i):
+        addresses = []
+        self.ipam.allocate_ip_address(
+            ctx, addresses, self.network["id"], "port-%d-%d" % (n, i),
+            cfg.CONF.QUARK.ipam_reuse_after, version=4)
+        return [a["address"] for a in addresses]
+
+    def _run(self, top_k):
+        cfg.CONF.set_override("ipam_subnet_spread_top_k", top_k, "QUARK")
+        self.ipam = quark.ipam.QuarkIpamANY()
+        self.network, subnets = self._create_network(
+            *["10.0.%d.0/24" % i for i in xrange(self.SUBNETS)])
+        lock_time, lock_waits = self._row_lock_status()
+        allocated, errors, elapsed = self._run_workers(
+            self.WORKERS, self._allocate, calls=self.ALLOCATIONS)
+        end_lock_time, end_lock_waits = self._row_lock_status()
+        self._report("subnet spread", top_k=top_k, workers=self.WORKERS,
+                     allocated=len(allocated), errors=len(errors),
+                     seconds="%.3f" % elapsed,
+                     row_lock_waits=end_lock_waits - lock_waits,
+                     row_lock_ms=end_lock_time - lock_time)
+        self.assertEqual(len(allocated), len(set(allocated)))
+        self.assertEqual(self.WORKERS * self.ALLOCATIONS,
+                         len(allocated) + len(errors))
+
+    def test_most_full(self):
+        self._run(0)
+
+    def test_spread(self):
+        self._run(self.SUBNETS)
@@ -1,4 +1,5 @@
 from quark.db import api as quark_db_api
+from quark.db import models
 from quark.tests.functional.mysql.base import MySqlBaseFunctionalTest
 
 
@@ -13,3 +14,24 @@ class QuarkTransactionFunctionalTest(MySqlBaseFunctionalTest):
         with self.context.session.begin():
             transaction = quark_db_api.transaction_create(self.context)
         self.assertEqual(transaction.id, 3)
+
+    def test_transaction_prune(self):
+        for i in range(3):
+            with self.context.session.begin():
+                transaction = quark_db_api.transaction_create(self.context)
+        ip = models.IPAddress(address=0, address_readable="0",
+                              transaction_id=2)
+        with self.context.session.begin():
+            self.context.session.add(ip)
+        self.assertEqual((1, 3),
+                         tuple(quark_db_api.transaction_id_range(
+                             self.context)))
+
+        with self.context.session.begin():
+            pruned = quark_db_api.transaction_prune(self.context, 1, 2)
+        self.assertEqual(2, pruned)
+        self.context.session.refresh(ip)
+        self.assertIsNone(ip["transaction_id"])
+        self.assertEqual((transaction.id, transaction.id),
+                         tuple(quark_db_api.transaction_id_range(
+                             self.context)))
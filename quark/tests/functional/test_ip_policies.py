@@ -53,3 +53,15 @@ class QuarkIPPoliciesFirstLastIPTest(BaseFunctionalTest):
                              ippc["first_ip"])
             self.assertEqual(new_exclude_first_last[ippc["cidr"]],
                              ippc["last_ip"])
+
+
+class QuarkIPPoliciesRevisionTest(BaseFunctionalTest):
+    def test_ip_policies_update_bumps_revision(self):
+        with self.context.session.begin():
+            ip_policy = db_api.ip_policy_create(
+                self.context, exclude=["192.168.10.0/32"])
+        self.assertEqual(ip_policy["revision"], 0)
+        with self.context.session.begin():
+            db_api.ip_policy_update(self.context, ip_policy,
+                                    exclude=["192.168.10.0/31"])
+        self.assertEqual(ip_policy["revision"], 1)
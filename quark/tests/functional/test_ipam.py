@@ -182,3 +182,53 @@ class QuarkIPAddressAllocateWithFullSubnetsNotMarkedAsFull(
                 self.assertEqual(available_subnets[0].cidr, "2.2.2.0/30")
                 self.assertEqual(available_subnets[0].next_auto_assign_ip,
                                  netaddr.IPAddress("2.2.2.2").ipv6().value)
+
+
+class QuarkBulkAllocateSkipsTaken(QuarkIpamBaseFunctionalTest):
+    @contextlib.contextmanager
+    def _stubs(self):
+        self.ipam = quark.ipam.QuarkIpamANY()
+        with self.context.session.begin():
+            net_mod = db_api.network_create(
+                self.context, name="public", tenant_id="fake")
+            sub_mod = db_api.subnet_create(
+                self.context, network=net_mod, cidr="0.0.0.0/24",
+                ip_policy=None, tenant_id="fake")
+            db_api.subnet_update(
+                self.context, sub_mod,
+                next_auto_assign_ip=netaddr.IPAddress("0.0.0.2").ipv6().value)
+            first_mac = netaddr.EUI("AA:BB:CC:00:00:00").value
+            mac_range = db_api.mac_address_range_create(
+                self.context, cidr="AA:BB:CC/24", do_not_use=False,
+                first_address=first_mac,
+                last_address=netaddr.EUI("AA:BB:CC:FF:FF:FF").value,
+                next_auto_assign_mac=first_mac)
+        yield net_mod, sub_mod, mac_range
+
+    def test_allocate_v4_blocks_skips_taken_address(self):
+        with self._stubs() as (net, subnet, _mac_range):
+            with self.context.session.begin():
+                db_api.ip_address_create(
+                    self.context, address=netaddr.IPAddress("0.0.0.3"),
+                    subnet_id=subnet["id"], network_id=net["id"], version=4)
+            addresses = self.ipam._allocate_v4_blocks(self.context,
+                                                      net["id"], 3)
+            self.assertEqual(["0.0.0.2", "0.0.0.4", "0.0.0.5"],
+                             [a["address_readable"] for a in addresses])
+            self.context.session.refresh(subnet)
+            self.assertEqual(netaddr.IPAddress("0.0.0.6").ipv6().value,
+                             subnet["next_auto_assign_ip"])
+
+    def test_allocate_mac_addresses_skips_taken_mac(self):
+        with self._stubs() as (net, _subnet, mac_range):
+            first = mac_range["first_address"]
+            with self.context.session.begin():
+                db_api.mac_address_create(
+                    self.context, address=first + 1,
+                    mac_address_range_id=mac_range["id"])
+            macs = self.ipam.allocate_mac_addresses(
+                self.context, net["id"], ["a", "b", "c"], 0)
+            self.assertEqual([first, first + 2, first + 3],
+                             [m["address"] for m in macs])
+            self.context.session.refresh(mac_range)
+            self.assertEqual(first + 4, mac_range["next_auto_assign_mac"])
@@ -107,6 +107,25 @@ class TestQuarkGetPorts(test_quark_plugin.TestQuarkPlugin):
             self.assertEqual(fixed_ips[0]["ip_address"],
                              ip["address_readable"])
 
+    def test_port_list_with_fields(self):
+        port = dict(mac_address="AA:BB:CC:DD:EE:FF", network_id=1,
+                    tenant_id=self.context.tenant_id, device_id=2)
+        with self._stubs(ports=[port]):
+            ports = self.plugin.get_ports(self.context, filters=None,
+                                          fields=["id", "device_id"])
+            self.assertEqual(1, len(ports))
+            self.assertEqual(set(["id", "device_id"]), set(ports[0]))
+            self.assertEqual(2, ports[0]["device_id"])
+
+    def test_port_list_with_port_subnets_only(self):
+        port = dict(mac_address="AA:BB:CC:DD:EE:FF", network_id=1,
+                    tenant_id=self.context.tenant_id, device_id=2)
+        with self._stubs(ports=[port]):
+            ports = self.plugin.get_ports(self.context, filters=None,
+                                          fields=["port_subnets"])
+            self.assertEqual([], ports[0]["fixed_ips"])
+            self.assertEqual("AA:BB:CC:DD:EE:FF", ports[0]["mac_address"])
+
     def test_port_show(self):
         ip = dict(id=1, address=netaddr.IPAddress("192.168.1.100").value,
                   address_readable="192.168.1.100", subnet_id=1, network_id=2,
@@ -397,6 +416,97 @@ class TestQuarkCreatePortFailure(test_quark_plugin.TestQuarkPlugin):
                 self.plugin.create_port(self.context, port_2)
 
 
+class TestQuarkCreatePortBulk(test_quark_plugin.TestQuarkPlugin):
+    @contextlib.contextmanager
+    def _stubs(self, fail_create=False):
+        network = {"network_plugin": "BASE",
+                   "ipam_strategy": "ANY",
+                   "id": 1,
+                   "tenant_id": self.context.tenant_id}
+
+        def allocate_macs(context, net_id, port_ids, reuse_after, **kwargs):
+            return [dict(address=i) for i in xrange(len(port_ids))]
+
+        def allocate_ips(context, addresses, net_id, port_ids, *args,
+                         **kwargs):
+            for port_id in port_ids:
+                addresses[port_id] = []
+
+        def port_create(context, addresses=None, mac_address=None,
+                        backend_key=None, **attrs):
+            if fail_create and mac_address == 1:
+                raise Exception("port create failed")
+            return models.Port(id=attrs["id"], network_id=1,
+                               device_id=attrs["device_id"],
+                               mac_address=mac_address, ip_addresses=[])
+
+        with contextlib.nested(
+            mock.patch("quark.db.api.network_find"),
+            mock.patch("quark.db.api.port_count_all"),
+            mock.patch("quark.db.api.port_create"),
+            mock.patch("quark.db.api.port_find"),
+            mock.patch("quark.ipam.QuarkIpam.allocate_mac_addresses"),
+            mock.patch("quark.ipam.QuarkIpam.allocate_ip_addresses_bulk"),
+            mock.patch("quark.ipam.QuarkIpam.deallocate_mac_address"),
+            mock.patch("quark.plugin_modules.ports.create_port")
+        ) as (network_find, port_count, port_create_mock, port_find,
+              alloc_macs, alloc_ips, dealloc_mac, create_port):
+            network_find.return_value = network
+            port_count.return_value = 0
+            port_find.return_value = None
+            port_create_mock.side_effect = port_create
+            alloc_macs.side_effect = allocate_macs
+            alloc_ips.side_effect = allocate_ips
+            create_port.return_value = {"id": "single"}
+            yield alloc_macs, alloc_ips, dealloc_mac, create_port
+
+    def _port(self, **kwargs):
+        kwargs.setdefault("network_id", 1)
+        kwargs.setdefault("tenant_id", self.context.tenant_id)
+        kwargs.setdefault("device_id", "")
+        return {"port": kwargs}
+
+    def test_create_port_bulk(self):
+        body = {"ports": [self._port(device_id=str(i)) for i in xrange(3)]}
+        with self._stubs() as (alloc_macs, alloc_ips, dealloc_mac,
+                               create_port):
+            result = self.plugin.create_port_bulk(self.context, body)
+        self.assertEqual(1, alloc_macs.call_count)
+        self.assertEqual(3, len(alloc_macs.call_args[0][2]))
+        self.assertEqual(1, alloc_ips.call_count)
+        self.assertEqual(["0", "1", "2"], [p["device_id"] for p in result])
+        self.assertEqual(3, len(set(p["id"] for p in result)))
+        self.assertFalse(create_port.called)
+
+    def test_create_port_bulk_falls_back_for_fixed_ips(self):
+        fixed_ips = [dict(subnet_id=1, ip_address="192.168.0.1")]
+        body = {"ports": [self._port(device_id="0"),
+                          self._port(device_id="1", fixed_ips=fixed_ips)]}
+        with self._stubs() as (alloc_macs, alloc_ips, dealloc_mac,
+                               create_port):
+            result = self.plugin.create_port_bulk(self.context, body)
+        self.assertEqual(1, len(alloc_macs.call_args[0][2]))
+        create_port.assert_called_once_with(self.context, body["ports"][1])
+        self.assertEqual("single", result[1]["id"])
+
+    def test_create_port_bulk_same_device_bad_request(self):
+        body = {"ports": [self._port(device_id="0"),
+                          self._port(device_id="0")]}
+        with self._stubs() as (alloc_macs, alloc_ips, dealloc_mac,
+                               create_port):
+            with self.assertRaises(exceptions.BadRequest):
+                self.plugin.create_port_bulk(self.context, body)
+        self.assertFalse(alloc_macs.called)
+
+    def test_create_port_bulk_failure_releases_macs(self):
+        body = {"ports": [self._port(device_id=str(i)) for i in xrange(2)]}
+        with self._stubs(fail_create=True) as (alloc_macs, alloc_ips,
+                                               dealloc_mac, create_port):
+            with self.assertRaises(Exception):
+                self.plugin.create_port_bulk(self.context, body)
+        self.assertEqual(2, dealloc_mac.call_count)
+
+
 class TestQuarkCreatePortRM9305(test_quark_plugin.TestQuarkPlugin):
     def setUp(self):
         super(TestQuarkCreatePortRM9305, self).setUp()
@@ -1260,9 +1370,7 @@ class TestPortDiagnose(test_quark_plugin.TestQuarkPlugin):
             port_mod.network = network_mod
             port_res = port_mod
             if list_format:
-                ports = mock.MagicMock()
-                ports.all.return_value = [port_mod]
-                port_res = ports
+                port_res = [port_mod]
 
         with mock.patch("quark.db.api.port_find") as port_find:
             port_find.return_value = port_res
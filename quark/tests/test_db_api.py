@@ -30,10 +30,10 @@ class TestDBAPI(BaseFunctionalTest):
 
     def test_port_find_ip_address_id(self):
         self.context.session.query = mock.Mock()
-        db_api.port_find(self.context, ip_address_id="fake")
         query_obj = self.context.session.query.return_value
-        filter_fn = query_obj.options.return_value.filter
-        self.assertEqual(filter_fn.call_count, 1)
+        query_obj.filter.return_value.all.return_value = []
+        db_api.port_find(self.context, ip_address_id="fake")
+        self.assertEqual(query_obj.filter.call_count, 1)
 
     def test_ip_address_find_device_id(self):
         query_mock = mock.Mock()
@@ -197,6 +197,43 @@ class TestDBAPI(BaseFunctionalTest):
         result = db_api._model_query(self.context, test_model, bad_filter)
         self.assertEqual(len(result), 1)
 
+    def test_model_query_plan_cached(self):
+        with mock.patch("quark.db.api.class_mapper",
+                        wraps=db_api.class_mapper) as class_mapper:
+            with mock.patch.dict("quark.db.api._FILTER_PLANS", clear=True):
+                db_api._model_query(self.context, models.Port,
+                                    {"device_id": [1]})
+                db_api._model_query(self.context, models.Port,
+                                    {"network_id": [2]})
+        self.assertEqual(1, class_mapper.call_count)
+
+    def test_model_query_tenant_id(self):
+        test_model = models.Network
+        result = db_api._model_query(self.context, test_model,
+                                     {"tenant_id": ["other"]})
+        self.assertEqual(len(result), 1)
+        self.assertIn("other", str(result[0].compile(
+            compile_kwargs={"literal_binds": True})))
+        admin = self.context.elevated()
+        self.assertEqual([], db_api._model_query(admin, test_model, {}))
+        self.assertEqual([], db_api._model_query(admin, models.Port,
+                                                 {"tenant_id": None}))
+
+    def test_model_query_tenant_id_IPAddress(self):
+        result = db_api._model_query(self.context, models.IPAddress, {})
+        self.assertEqual(len(result), 1)
+        self.assertIn("used_by_tenant_id", str(result[0]))
+
+    def test_model_query_reuse_after(self):
+        admin = self.context.elevated()
+        result = db_api._model_query(admin, models.MacAddress,
+                                     {"reuse_after": 60})
+        self.assertEqual(len(result), 1)
+        self.assertIn("deallocated_at", str(result[0]))
+        result = db_api._model_query(admin, models.Network,
+                                     {"reuse_after": 60})
+        self.assertEqual([], result)
+
     def test_port_associate_ip(self):
         self.context.session.add = mock.Mock()
         mock_ports = [models.Port(id=str(x), network_id="2", ip_addresses=[])
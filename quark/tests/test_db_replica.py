@@ -0,0 +1,111 @@
+# Copyright (c) 2015 OpenStack Foundation
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import mock
+from oslo.config import cfg
+
+from quark.db import replica
+from quark import plugin
+from quark.tests import test_base
+
+
+class TestReplicaSession(test_base.TestBase):
+    def setUp(self):
+        super(TestReplicaSession, self).setUp()
+        cfg.CONF.set_override("db_replica_connection", "sqlite://", "QUARK")
+        self.addCleanup(cfg.CONF.clear_override, "db_replica_connection",
+                        "QUARK")
+        self.addCleanup(replica.reset)
+        patcher = mock.patch("quark.db.replica._make_session")
+        self.make_session = patcher.start()
+        self.addCleanup(patcher.stop)
+        self.writer = self.context.session
+        self.writer.transaction = None
+
+    def test_no_replica_configured(self):
+        cfg.CONF.set_override("db_replica_connection", "", "QUARK")
+        with replica.request(self.context, True):
+            self.assertIs(self.writer, replica.get_session(self.context))
+        self.assertFalse(self.make_session.called)
+
+    def test_read_only_request(self):
+        with replica.request(self.context, True):
+            session = replica.get_session(self.context)
+            self.assertIs(self.make_session.return_value, session)
+            self.assertIs(session, replica.get_session(self.context))
+        session.close.assert_called_once_with()
+        self.assertEqual(1, self.make_session.call_count)
+
+    def test_outside_requests(self):
+        self.assertIs(self.writer, replica.get_session(self.context))
+
+    def test_write_request(self):
+        with replica.request(self.context, False):
+            self.assertIs(self.writer, replica.get_session(self.context))
+
+    def test_nested_request_keeps_mode(self):
+        with replica.request(self.context, False):
+            with replica.request(self.context, True):
+                self.assertIs(self.writer,
+                              replica.get_session(self.context))
+
+    def test_inside_transaction(self):
+        self.writer.transaction = mock.Mock()
+        with replica.request(self.context, True):
+            self.assertIs(self.writer, replica.get_session(self.context))
+
+    def test_pending_changes(self):
+        with mock.patch.object(type(self.writer), "dirty",
+                               new_callable=mock.PropertyMock) as dirty:
+            dirty.return_value = set([mock.Mock()])
+            with replica.request(self.context, True):
+                self.assertIs(self.writer,
+                              replica.get_session(self.context))
+
+    def test_read_after_write(self):
+        with replica.request(self.context, False):
+            pass
+        with replica.request(self.context, True):
+            self.assertIs(self.writer, replica.get_session(self.context))
+
+    def test_write_grace_expires(self):
+        with mock.patch("quark.db.replica.time.time") as now:
+            now.return_value = 100.0
+            with replica.request(self.context, False):
+                pass
+            now.return_value = 106.0
+            with replica.request(self.context, True):
+                self.assertIs(self.make_session.return_value,
+                              replica.get_session(self.context))
+
+
+class TestSessioned(test_base.TestBase):
+    def test_read_only_methods(self):
+        modes = []
+
+        class Plugin(object):
+            @plugin.sessioned
+            def get_ports(self, context):
+                modes.append(context._quark_read_only)
+
+            @plugin.sessioned
+            def create_port(self, context):
+                modes.append(context._quark_read_only)
+                self.get_ports(context)
+
+        Plugin().get_ports(self.context)
+        Plugin().create_port(self.context)
+        self.assertEqual([True, False, False], modes)
+        self.assertIsNone(self.context._quark_read_only)
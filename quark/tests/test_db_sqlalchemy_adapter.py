@@ -0,0 +1,45 @@
+# Copyright 2015 Openstack Foundation
+# All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+#  under the License.
+
+import sqlalchemy as sa
+from sqlalchemy.dialects import mysql, sqlite
+from sqlalchemy.sql.expression import Select
+
+from quark.db import models
+from quark.db import sqlalchemy_adapter as quark_sa
+from quark.tests import test_base
+
+
+class TestSkipLocked(test_base.TestBase):
+    def _compile(self, select, dialect):
+        return str(select.compile(dialect=dialect))
+
+    def test_skip_locked(self):
+        select = quark_sa.skip_locked(sa.select([models.IPAddress.id]))
+        self.assertTrue(self._compile(select, mysql.dialect()).endswith(
+            "FOR UPDATE SKIP LOCKED"))
+
+    def test_skip_locked_sqlite(self):
+        select = quark_sa.skip_locked(sa.select([models.IPAddress.id]))
+        self.assertNotIn("SKIP LOCKED",
+                         self._compile(select, sqlite.dialect()))
+
+    def test_ordinary_select_unchanged(self):
+        select = sa.select([models.IPAddress.id]).with_for_update()
+        compiled = self._compile(select, mysql.dialect())
+        self.assertTrue(compiled.endswith("FOR UPDATE"))
+        quark_sa.skip_locked(select)
+        self.assertEqual(compiled, self._compile(select, mysql.dialect()))
+        self.assertNotIn("_compiler_dispatcher", Select.__dict__)
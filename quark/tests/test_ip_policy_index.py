@@ -0,0 +1,121 @@
+# Copyright (c) 2015 OpenStack Foundation
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import netaddr
+from oslo.config import cfg
+
+from quark.db import models
+from quark import ip_policy_index
+from quark.tests import test_base
+
+V6_ZERO = netaddr.IPAddress("::ffff:0.0.0.0").value
+
+
+def _policy(cidrs, **kwargs):
+    return models.IPPolicy(
+        exclude=[models.IPPolicyCIDR(cidr=cidr) for cidr in cidrs], **kwargs)
+
+
+class TestIPPolicyIndex(test_base.TestBase):
+    def test_intervals_merged_and_sized(self):
+        index = ip_policy_index.IPPolicyIndex([(10, 12), (0, 3), (4, 7),
+                                               (11, 20)])
+        self.assertEqual([(0, 7), (10, 20)], list(index))
+        self.assertEqual(19, index.size)
+        self.assertEqual(2, len(index))
+
+    def test_contains(self):
+        index = ip_policy_index.IPPolicyIndex.from_policy(
+            _policy(["0.0.0.0/31", "0.0.0.8/30"]))
+        self.assertIn(netaddr.IPAddress("0.0.0.1"), index)
+        self.assertIn(netaddr.IPAddress("0.0.0.10"), index)
+        self.assertIn(V6_ZERO + 11, index)
+        self.assertNotIn(netaddr.IPAddress("0.0.0.2"), index)
+        self.assertNotIn(netaddr.IPAddress("0.0.0.12"), index)
+        self.assertNotIn(netaddr.IPAddress("feed::1"), index)
+
+    def test_contains_empty(self):
+        self.assertNotIn(netaddr.IPAddress("0.0.0.1"),
+                         ip_policy_index.IPPolicyIndex.from_policy(None))
+
+    def test_stored_first_last_preferred_over_cidr(self):
+        policy = models.IPPolicy(exclude=[models.IPPolicyCIDR(
+            cidr="0.0.0.0/24", first_ip=V6_ZERO + 1, last_ip=V6_ZERO + 1)])
+        index = ip_policy_index.IPPolicyIndex.from_policy(policy)
+        self.assertEqual([(V6_ZERO + 1, V6_ZERO + 1)], list(index))
+
+    def test_skip(self):
+        index = ip_policy_index.IPPolicyIndex([(0, 3), (4, 7), (10, 10)])
+        self.assertEqual((8, 10), index.skip(0))
+        self.assertEqual((8, 10), index.skip(5))
+        self.assertEqual((9, 10), index.skip(9))
+        self.assertEqual((11, None), index.skip(10))
+        self.assertEqual((3, None),
+                         ip_policy_index.IPPolicyIndex().skip(3))
+
+    def test_allowed_ranges(self):
+        index = ip_policy_index.IPPolicyIndex([(0, 0), (5, 6), (9, 12)])
+        self.assertEqual([(1, 4), (7, 8)], list(index.allowed_ranges(0, 10)))
+        self.assertEqual([(13, 15)], list(index.allowed_ranges(13, 15)))
+        self.assertEqual([], list(index.allowed_ranges(5, 6)))
+
+    def test_subnet_allocation_pools(self):
+        subnet = models.Subnet(cidr="192.168.1.0/24")
+        subnet["ip_policy"] = _policy(["192.168.1.0/32", "192.168.1.255/32",
+                                       "192.168.1.10/31"])
+        self.assertEqual([dict(start="192.168.1.1", end="192.168.1.9"),
+                          dict(start="192.168.1.12", end="192.168.1.254")],
+                         subnet.allocation_pools)
+
+
+class TestIPPolicyIndexCache(test_base.TestBase):
+    def setUp(self):
+        super(TestIPPolicyIndexCache, self).setUp()
+        self.cache = ip_policy_index.IPPolicyIndexCache()
+
+    def test_cached_per_revision(self):
+        policy = _policy(["0.0.0.0/32"], id="1", revision=0)
+        index = self.cache.get(policy)
+        self.assertIs(index, self.cache.get(policy))
+
+        policy["exclude"].append(models.IPPolicyCIDR(cidr="0.0.0.1/32"))
+        self.assertIs(index, self.cache.get(policy))
+        policy["revision"] = 1
+        self.assertEqual(2, self.cache.get(policy).size)
+
+    def test_unsaved_policy_not_cached(self):
+        policy = _policy(["0.0.0.0/32"], id="1")
+        self.assertIsNot(self.cache.get(policy), self.cache.get(policy))
+        policy["revision"] = models.IPPolicy.revision + 1
+        self.assertIsNot(self.cache.get(policy), self.cache.get(policy))
+
+    def test_invalidate(self):
+        policy = _policy(["0.0.0.0/32"], id="1", revision=0)
+        index = self.cache.get(policy)
+        self.cache.invalidate("1")
+        self.assertIsNot(index, self.cache.get(policy))
+
+    def test_eviction(self):
+        cfg.CONF.set_override("ip_policy_index_cache_size", 2, "QUARK")
+        self.addCleanup(cfg.CONF.clear_override,
+                        "ip_policy_index_cache_size", "QUARK")
+        policies = [_policy(["0.0.0.0/32"], id=str(i), revision=0)
+                    for i in range(3)]
+        first = self.cache.get(policies[0])
+        second = self.cache.get(policies[1])
+        self.cache.get(policies[0])
+        self.cache.get(policies[2])
+        self.assertIs(first, self.cache.get(policies[0]))
+        self.assertIsNot(second, self.cache.get(policies[1]))
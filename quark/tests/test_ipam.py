@@ -14,6 +14,7 @@
 # limitations under the License.
 
 import contextlib
+import itertools
 import time
 
 import mock
@@ -25,7 +26,9 @@ from oslo.db import exception as db_exc
 
 from quark.db import models
 from quark import exceptions as q_exc
+from quark import ip_policy_index
 import quark.ipam
+from quark import ipam_metrics
 from quark.tests import test_base
 
 
@@ -84,6 +87,13 @@ class QuarkIpamBaseTest(test_base.TestBase):
         self.addCleanup(patcher.stop)
         rpc.init(mock.MagicMock())
 
+        counts_patcher = mock.patch("quark.db.api.subnet_update_ip_counts")
+        self.subnet_update_ip_counts = counts_patcher.start()
+        self.addCleanup(counts_patcher.stop)
+        mac_counts_patcher = mock.patch("quark.db.api.mac_range_update_counts")
+        self.mac_range_update_counts = mac_counts_patcher.start()
+        self.addCleanup(mac_counts_patcher.stop)
+
         self.ipam = quark.ipam.QuarkIpamANY()
         self.reuse_after = cfg.CONF.QUARK.ipam_reuse_after
 
@@ -353,88 +363,90 @@ class QuarkMacAddressDeallocation(QuarkIpamBaseTest):
 
 
 class QuarkIPAddressDeallocation(QuarkIpamBaseTest):
-    def test_deallocate_ips_by_port(self):
-        port_dict = dict(ip_addresses=[], device_id="foo")
-        addr_dict = dict(subnet_id=1, address_readable=None,
-                         created_at=None, used_by_tenant_id=1)
-
+    @contextlib.contextmanager
+    def _stubs(self, port_counts):
+        with contextlib.nested(
+            mock.patch("quark.db.api.ip_address_port_counts"),
+            mock.patch("quark.db.api.ip_address_deallocate_bulk"),
+            mock.patch("quark.ipam_notifications.notify_many")
+        ) as (counts, deallocate, notify):
+            counts.return_value = port_counts
+            yield counts, deallocate, notify
+
+    def _port(self, *addr_dicts):
         port = models.Port()
-        port.update(port_dict)
+        port.update(dict(ip_addresses=[], device_id="foo"))
+        for addr_dict in addr_dicts:
+            addr = models.IPAddress()
+            addr.update(addr_dict)
+            port["ip_addresses"].append(addr)
+        return port
 
-        addr = models.IPAddress()
-        addr.update(addr_dict)
-
-        port["ip_addresses"].append(addr)
-        self.ipam.deallocate_ips_by_port(self.context, port)
-        # ORM takes care of other model if one model is modified
-        self.assertTrue(len(addr["ports"]) == 0 or
-                        len(port["ip_addresses"]) == 0)
-        self.assertTrue(addr["deallocated"])
-        self.assertEqual(addr["address_type"], None)
+    def test_deallocate_ips_by_port(self):
+        port = self._port(dict(id=1, subnet_id=1, address_readable=None,
+                               created_at=None, used_by_tenant_id=1))
+        addr = port["ip_addresses"][0]
+        with self._stubs({1: 1}) as (counts, deallocate, notify):
+            self.ipam.deallocate_ips_by_port(self.context, port)
+        counts.assert_called_once_with(self.context, [addr])
+        deallocate.assert_called_once_with(self.context, [addr])
+        self.assertEqual(1, notify.call_count)
+        self.assertEqual("ip_block.address.delete", notify.call_args[0][1])
+        self.assertEqual(1, len(notify.call_args[0][2]))
+        self.assertEqual([], port["ip_addresses"])
+
+    def test_deallocate_ips_by_port_many_addresses_one_update(self):
+        port = self._port(*[dict(id=i, subnet_id=1, address=i,
+                                 address_readable=str(i), created_at=None,
+                                 used_by_tenant_id=1) for i in xrange(4)])
+        addrs = list(port["ip_addresses"])
+        with self._stubs({0: 1, 1: 2, 2: 1, 3: 1}) as (counts, deallocate,
+                                                       notify):
+            self.ipam.deallocate_ips_by_port(self.context, port)
+        self.assertEqual(1, counts.call_count)
+        deallocate.assert_called_once_with(
+            self.context, [addrs[0], addrs[2], addrs[3]])
+        self.assertEqual(1, notify.call_count)
+        self.assertEqual(
+            ["0", "2", "3"],
+            [payload["ip_address"] for payload in notify.call_args[0][2]])
+        self.assertEqual([], port["ip_addresses"])
 
     def test_deallocate_ip_address_specific_ip(self):
-        port_dict = dict(ip_addresses=[], device_id="foo")
-        addr_dict = dict(subnet_id=1, address_readable="0.0.0.0",
-                         created_at=None, used_by_tenant_id=1,
-                         address=0)
-
-        port = models.Port()
-        port.update(port_dict)
-
-        addr = models.IPAddress()
-        addr.update(addr_dict)
-
-        port["ip_addresses"].append(addr)
+        port = self._port(dict(id=1, subnet_id=1, address_readable="0.0.0.0",
+                               created_at=None, used_by_tenant_id=1,
+                               address=0),
+                          dict(id=2, subnet_id=1, address_readable="0.0.0.1",
+                               created_at=None, used_by_tenant_id=1,
+                               address=1))
+        addr, other = port["ip_addresses"]
         to_delete = netaddr.IPAddress(addr["address"])
-        self.ipam.deallocate_ips_by_port(self.context, port,
-                                         ip_address=to_delete)
-        # ORM takes care of other model if one model is modified
-        self.assertTrue(len(addr["ports"]) == 0 or
-                        len(port["ip_addresses"]) == 0)
-        self.assertTrue(addr["deallocated"])
-        self.assertEqual(addr["address_type"], None)
+        with self._stubs({1: 1}) as (counts, deallocate, notify):
+            self.ipam.deallocate_ips_by_port(self.context, port,
+                                             ip_address=to_delete)
+        deallocate.assert_called_once_with(self.context, [addr])
+        self.assertEqual([other], port["ip_addresses"])
 
     def test_deallocate_ip_address_specific_ip_not_on_port_noop(self):
-        port_dict = dict(ip_addresses=[], device_id="foo")
-        addr_dict = dict(subnet_id=1, address_readable="0.0.0.0",
-                         created_at=None, used_by_tenant_id=1,
-                         address=0)
-
-        port = models.Port()
-        port.update(port_dict)
-
-        addr = models.IPAddress()
-        addr.update(addr_dict)
-
-        port["ip_addresses"].append(addr)
+        port = self._port(dict(id=1, subnet_id=1, address_readable="0.0.0.0",
+                               created_at=None, used_by_tenant_id=1,
+                               address=0))
         to_delete = netaddr.IPAddress(1)
-        self.ipam.deallocate_ips_by_port(self.context, port,
-                                         ip_address=to_delete)
-        # ORM takes care of other model if one model is modified
-        self.assertTrue(len(addr["ports"]) == 1 or
-                        len(port["ip_addresses"]) == 1)
-        self.assertFalse(addr["deallocated"])
-        self.assertEqual(addr["address_type"], None)
+        with self._stubs({}) as (counts, deallocate, notify):
+            self.ipam.deallocate_ips_by_port(self.context, port,
+                                             ip_address=to_delete)
+        self.assertFalse(counts.called)
+        self.assertFalse(deallocate.called)
+        self.assertFalse(notify.called)
+        self.assertEqual(1, len(port["ip_addresses"]))
 
     def test_deallocate_ip_address_multiple_ports_no_deallocation(self):
-        port_dict = dict(ip_addresses=[])
-        addr_dict = dict(deallocated=False)
-
-        port = models.Port()
-        port.update(port_dict)
-
-        addr = models.IPAddress()
-        addr.update(addr_dict)
-
-        port["ip_addresses"].append(addr)
-        addr["ports"].append(port)
-
-        self.ipam.deallocate_ips_by_port(self.context, port)
-        # ORM takes care of other model if one model is modified
-        self.assertTrue(len(addr["ports"]) == 1 or
-                        len(port["ip_addresses"]) == 0)
-        self.assertFalse(addr["deallocated"])
-        self.assertEqual(addr["address_type"], None)
+        port = self._port(dict(id=1, deallocated=False))
+        with self._stubs({1: 2}) as (counts, deallocate, notify):
+            self.ipam.deallocate_ips_by_port(self.context, port)
+        self.assertFalse(deallocate.called)
+        self.assertFalse(notify.called)
+        self.assertEqual([], port["ip_addresses"])
 
 
 class QuarkIpamTestBothIpAllocation(QuarkIpamBaseTest):
@@ -484,7 +496,10 @@ class QuarkIpamTestBothIpAllocation(QuarkIpamBaseTest):
             addr_find.side_effect = addr_mods[1:]
             if sub_mods and len(sub_mods[0]):
                 subnet_find.return_value = [sub_mods[0][0][0]]
-            subnet_alloc_find.side_effect = sub_mods
+            # NOTE: Both versions are selected with one query
+            subnet_alloc_find.side_effect = [
+                [s for sub_list in sub_mods for s in sub_list]
+            ] if sub_mods else []
             subnet_update.return_value = 1
 
             def refresh_mock(sub):
@@ -845,11 +860,13 @@ class QuarkIpamTestBothIpAllocation(QuarkIpamBaseTest):
         address1["version"] = 4
         address1["subnet"] = models.Subnet(cidr="0.0.0.0/24")
         address2 = models.IPAddress()
-        address2["address"] = netaddr.IPAddress(42).ipv6()
+        address2["address"] = netaddr.IPAddress("feed::200:ff:fe00:0").value
         address2["version"] = 6
         address2["subnet"] = models.Subnet(cidr="::ffff:0:0/96")
+        address2["deallocated"] = True
         with self._stubs(subnets=[[(subnet6, 1)]],
-                         addresses=[address1, address2]) as addr_realloc:
+                         addresses=[address1, [address2],
+                                    address2]) as addr_realloc:
             address = []
             self.ipam.allocate_ip_address(self.context, address, 0, 0, 0,
                                           mac_address=mac_address)
@@ -906,7 +923,10 @@ class QuarkIpamTestBothRequiredIpAllocation(QuarkIpamBaseTest):
                         sub_mod_list.append(sub)
 
                 sub_mods.append(sub_mod_list)
-            subnet_find.side_effect = sub_mods
+            # NOTE: Both versions are selected with one query
+            subnet_find.side_effect = [
+                [s for sub_list in sub_mods for s in sub_list]
+            ] if sub_mods else []
             subnet_update.return_value = 1
 
             def refresh_mock(sub):
@@ -1035,12 +1055,14 @@ class QuarkIpamTestBothRequiredIpAllocation(QuarkIpamBaseTest):
         address1["version"] = 4
         address1["subnet"] = models.Subnet(cidr="0.0.0.0/24")
         address2 = models.IPAddress()
-        address2["address"] = 42
+        address2["address"] = netaddr.IPAddress("feed::200:ff:fe00:0").value
         address2["version"] = 6
         address2["subnet"] = subnet6["cidr"]
+        address2["deallocated"] = True
 
         with self._stubs(subnets=[[(subnet6, 0)]],
-                         addresses=[address1, address2]) as addr_realloc:
+                         addresses=[address1, [address2],
+                                    address2]) as addr_realloc:
             address = []
             self.ipam.allocate_ip_address(self.context, address, 0, 0, 0,
                                           mac_address=mac_address)
@@ -1087,6 +1109,273 @@ class QuarkIpamTestBothRequiredIpAllocation(QuarkIpamBaseTest):
         cfg.CONF.set_override('ip_address_retry_max', old_override, 'QUARK')
 
 
+class QuarkIpamTestSelectSubnets(QuarkIpamBaseTest):
+    def setUp(self):
+        super(QuarkIpamTestSelectSubnets, self).setUp()
+        self.ipam = quark.ipam.QuarkIpamBOTH()
+
+    @contextlib.contextmanager
+    def _stubs(self, subnets):
+        with contextlib.nested(
+            mock.patch("quark.db.api.subnet_find_ordered_by_most_full"),
+            mock.patch("quark.db.api.subnet_update_next_auto_assign_ip"),
+            mock.patch("sqlalchemy.orm.session.Session.refresh")
+        ) as (subnet_find, subnet_update, refresh):
+            subnet_find.return_value = [(subnet_helper(sub), count)
+                                        for sub, count in subnets]
+            subnet_update.return_value = 1
+            yield subnet_find
+
+    def _subnets(self):
+        subnet4 = dict(id=1, first_ip=0, last_ip=255,
+                       cidr="0.0.0.0/24", ip_version=4,
+                       next_auto_assign_ip=1, ip_policy=None)
+        subnet6 = dict(id=2, first_ip=netaddr.IPAddress("feed::").value,
+                       last_ip=netaddr.IPAddress("feed::ff:ffff").value,
+                       cidr="feed::/104", ip_version=6,
+                       next_auto_assign_ip=0, ip_policy=None)
+        return [(subnet4, 0), (subnet6, 0)]
+
+    def test_select_subnets_one_query(self):
+        with self._stubs(self._subnets()) as subnet_find:
+            selected = self.ipam.select_subnets(self.context, 0, None, None,
+                                                [4, 6])
+        self.assertEqual(1, selected[4]["id"])
+        self.assertEqual(2, selected[6]["id"])
+        self.assertEqual(1, subnet_find.call_count)
+        self.assertNotIn("ip_version", subnet_find.call_args[1])
+
+    def test_select_subnets_one_version(self):
+        with self._stubs(self._subnets()[1:]) as subnet_find:
+            selected = self.ipam.select_subnets(self.context, 0, None, None,
+                                                [6])
+        self.assertEqual([6], selected.keys())
+        self.assertEqual(6, subnet_find.call_args[1]["ip_version"])
+
+    def test_select_subnets_missing_version(self):
+        with self._stubs(self._subnets()[:1]):
+            selected = self.ipam.select_subnets(self.context, 0, None, None,
+                                                [4, 6])
+        self.assertEqual([4], selected.keys())
+
+    def test_choose_available_subnet_uses_select_subnets(self):
+        with contextlib.nested(
+            mock.patch("quark.ipam.QuarkIpam.select_subnets"),
+            mock.patch("quark.ipam.QuarkIpam.select_subnet")
+        ) as (select_subnets, select_subnet):
+            select_subnets.return_value = {6: "v6"}
+            subnets = self.ipam._choose_available_subnet(
+                self.context, 0, reallocated_ips=[dict(version=4)])
+        self.assertEqual(["v6"], subnets)
+        select_subnets.assert_called_once_with(self.context, 0, None, None,
+                                               [6])
+        self.assertFalse(select_subnet.called)
+
+
+class QuarkIpamTestSubnetSpread(QuarkIpamBaseTest):
+    def setUp(self):
+        super(QuarkIpamTestSubnetSpread, self).setUp()
+        self.addCleanup(cfg.CONF.clear_override, "ipam_subnet_spread_top_k",
+                        "QUARK")
+        self.addCleanup(cfg.CONF.clear_override, "ipam_subnet_spread",
+                        "QUARK")
+
+    def _pairs(self, *ids, **kwargs):
+        version = kwargs.get("version", 4)
+        return [(dict(id=i, ip_version=version), 0) for i in ids]
+
+    def _ids(self, pairs):
+        return [subnet["id"] for subnet, _count in pairs]
+
+    def test_spread_subnets_disabled(self):
+        self.assertEqual([1, 2, 3], self._ids(
+            quark.ipam.spread_subnets(self._pairs(1, 2, 3), 1)))
+        self.assertEqual([1], self._ids(
+            quark.ipam.spread_subnets(self._pairs(1), 4)))
+
+    def test_spread_subnets_takes_fuller_choice(self):
+        with mock.patch("quark.ipam._spread_random.sample") as sample:
+            sample.return_value = [2, 1]
+            self.assertEqual([2, 1, 3, 4], self._ids(
+                quark.ipam.spread_subnets(self._pairs(1, 2, 3, 4), 3)))
+            sample.assert_called_once_with(range(3), 2)
+
+    def test_spread_subnets_within_each_version(self):
+        subnets = self._pairs(1, 2, 3) + self._pairs(4, 5, 6, version=6)
+        with mock.patch("quark.ipam._spread_random.sample") as sample:
+            sample.return_value = [2, 1]
+            self.assertEqual([2, 1, 3, 5, 4, 6], self._ids(
+                quark.ipam.spread_subnets(subnets, 8)))
+            self.assertEqual([mock.call(range(3), 2)] * 2,
+                             sample.call_args_list)
+
+    def test_subnet_spread_top_k_per_network(self):
+        cfg.CONF.set_override("ipam_subnet_spread_top_k", 2, "QUARK")
+        cfg.CONF.set_override("ipam_subnet_spread", '{"hot": 8}', "QUARK")
+        self.assertEqual(8, quark.ipam.subnet_spread_top_k("hot"))
+        self.assertEqual(2, quark.ipam.subnet_spread_top_k("cold"))
+
+    @contextlib.contextmanager
+    def _stubs(self, subnets):
+        with contextlib.nested(
+            mock.patch("quark.db.api.subnet_find_ordered_by_most_full"),
+            mock.patch("quark.db.api.subnet_lock"),
+            mock.patch("quark.db.api.subnet_update_next_auto_assign_ip"),
+            mock.patch("quark.ipam.spread_subnets"),
+            mock.patch("sqlalchemy.orm.session.Session.refresh")
+        ) as (subnet_find, subnet_lock, subnet_update, spread, refresh):
+            subnet_find.return_value = [(subnet_helper(sub), count)
+                                        for sub, count in subnets]
+            subnet_lock.side_effect = lambda ctx, sub: sub
+            subnet_update.return_value = 1
+            spread.side_effect = lambda subs, top_k: list(reversed(subs))
+            yield subnet_find, subnet_lock
+
+    def _subnets(self):
+        return [(dict(id=i, first_ip=0, last_ip=255, cidr="0.0.0.0/24",
+                      ip_version=4, next_auto_assign_ip=1, ip_policy=None,
+                      allocated_count=0, deallocated_reusable_count=0), 0)
+                for i in xrange(3)]
+
+    def test_select_subnet_spreads(self):
+        cfg.CONF.set_override("ipam_subnet_spread_top_k", 3, "QUARK")
+        with self._stubs(self._subnets()) as (subnet_find, subnet_lock):
+            subnet = self.ipam.select_subnet(self.context, "net", None, None)
+        self.assertEqual(2, subnet["id"])
+        self.assertFalse(subnet_find.call_args[1]["lock_mode"])
+        self.assertEqual(1, subnet_lock.call_count)
+
+    def test_select_subnet_spread_skips_full(self):
+        cfg.CONF.set_override("ipam_subnet_spread_top_k", 3, "QUARK")
+        with self._stubs(self._subnets()) as (subnet_find, subnet_lock):
+            subnet_lock.side_effect = [None, None, mock.DEFAULT]
+            subnet_lock.return_value = subnet_find.return_value[0][0]
+            subnet = self.ipam.select_subnet(self.context, "net", None, None)
+        self.assertEqual(0, subnet["id"])
+        self.assertEqual(3, subnet_lock.call_count)
+
+    def test_select_subnet_explicit_ip_not_spread(self):
+        cfg.CONF.set_override("ipam_subnet_spread_top_k", 3, "QUARK")
+        with self._stubs(self._subnets()) as (subnet_find, subnet_lock):
+            self.ipam.select_subnet(self.context, "net", "0.0.0.5", None)
+        self.assertTrue(subnet_find.call_args[1]["lock_mode"])
+        self.assertFalse(subnet_lock.called)
+
+
+class QuarkIpamTestRandomProbe(QuarkIpamBaseTest):
+    def setUp(self):
+        super(QuarkIpamTestRandomProbe, self).setUp()
+        self.ipam = quark.ipam.QuarkIpamANYRandom()
+        self.addCleanup(cfg.CONF.clear_override,
+                        "ipam_random_probe_max_fill", "QUARK")
+
+    def _v6(self, ip):
+        return netaddr.IPAddress(ip).ipv6().value
+
+    def _subnet(self, marker="192.168.0.1", exclude=None):
+        cidr = netaddr.IPNetwork("192.168.0.0/24").ipv6()
+        subnet = dict(id=1, first_ip=cidr.first, last_ip=cidr.last,
+                      cidr="192.168.0.0/24", ip_version=4,
+                      next_auto_assign_ip=self._v6(marker))
+        policy = None
+        if exclude:
+            policy = dict(exclude=[
+                dict(cidr=c, first_ip=netaddr.IPNetwork(c).ipv6().first,
+                     last_ip=netaddr.IPNetwork(c).ipv6().last)
+                for c in exclude])
+        return subnet, policy
+
+    def test_registered(self):
+        self.assertIsInstance(
+            quark.ipam.IPAM_REGISTRY.get_strategy("ANY_RANDOM"),
+            quark.ipam.QuarkIpamANYRandom)
+
+    def test_probe_above_marker(self):
+        subnet, policy = self._subnet(marker="192.168.0.100")
+        with mock.patch("quark.ipam._probe_random.randrange") as randrange:
+            randrange.return_value = 0
+            self.assertEqual(self._v6("192.168.0.100"),
+                             quark.ipam.probe_v4_address(subnet, policy, 100))
+            randrange.assert_called_once_with(156)
+            randrange.return_value = 155
+            self.assertEqual(self._v6("192.168.0.255"),
+                             quark.ipam.probe_v4_address(subnet, policy, 100))
+
+    def test_probe_skips_policy(self):
+        subnet, policy = self._subnet(
+            marker="192.168.0.0", exclude=["192.168.0.0/31",
+                                           "192.168.0.4/30"])
+        with mock.patch("quark.ipam._probe_random.randrange") as randrange:
+            randrange.return_value = 2
+            self.assertEqual(self._v6("192.168.0.8"),
+                             quark.ipam.probe_v4_address(subnet, policy, 0))
+            randrange.assert_called_once_with(250)
+
+    def test_probe_falls_back_when_full(self):
+        cfg.CONF.set_override("ipam_random_probe_max_fill", 0.5, "QUARK")
+        subnet, policy = self._subnet(marker="192.168.0.56")
+        self.assertIsNotNone(quark.ipam.probe_v4_address(subnet, policy, 155))
+        self.assertIsNone(quark.ipam.probe_v4_address(subnet, policy, 156))
+
+    def test_probe_marker_past_end(self):
+        subnet, policy = self._subnet()
+        subnet["next_auto_assign_ip"] = -1
+        self.assertIsNone(quark.ipam.probe_v4_address(subnet, policy, 0))
+
+    @contextlib.contextmanager
+    def _stubs(self, subnet, count):
+        with contextlib.nested(
+            mock.patch("quark.db.api.subnet_find_ordered_by_most_full"),
+            mock.patch("quark.db.api.subnet_update_next_auto_assign_ip"),
+            mock.patch("quark.ipam.probe_v4_address"),
+            mock.patch("sqlalchemy.orm.session.Session.refresh")
+        ) as (subnet_find, subnet_update, probe, refresh):
+            subnet_find.return_value = [(subnet_helper(subnet), count)]
+            subnet_update.return_value = 1
+            yield subnet_update, probe
+
+    def test_select_subnet_probes(self):
+        subnet, _policy = self._subnet()
+        subnet["ip_policy"] = None
+        with self._stubs(subnet, 0) as (subnet_update, probe):
+            probe.return_value = self._v6("192.168.0.77")
+            selected = self.ipam.select_subnet(self.context, "net", None,
+                                               None)
+        self.assertEqual(self._v6("192.168.0.77"), selected.probe_ip)
+        self.assertFalse(subnet_update.called)
+
+    def test_select_subnet_falls_back_to_marker(self):
+        subnet, _policy = self._subnet()
+        subnet["ip_policy"] = None
+        with self._stubs(subnet, 0) as (subnet_update, probe):
+            probe.return_value = None
+            selected = self.ipam.select_subnet(self.context, "net", None,
+                                               None)
+        self.assertIsNone(getattr(selected, "probe_ip", None))
+        self.assertEqual(1, subnet_update.call_count)
+
+    def test_any_does_not_probe(self):
+        self.ipam = quark.ipam.QuarkIpamANY()
+        subnet, _policy = self._subnet()
+        subnet["ip_policy"] = None
+        with self._stubs(subnet, 0) as (subnet_update, probe):
+            self.ipam.select_subnet(self.context, "net", None, None)
+        self.assertFalse(probe.called)
+        self.assertEqual(1, subnet_update.call_count)
+
+    def test_allocate_from_subnet_uses_probe(self):
+        subnet, _policy = self._subnet()
+        subnet["ip_policy"] = None
+        subnet = subnet_helper(subnet)
+        subnet.probe_ip = self._v6("192.168.0.77")
+        with mock.patch("quark.db.api.ip_address_create") as create:
+            self.ipam._allocate_from_subnet(self.context, "net", subnet,
+                                            "port", self.reuse_after)
+        self.assertEqual(netaddr.IPAddress("192.168.0.77"),
+                         create.call_args[1]["address"])
+        self.assertIsNone(subnet.probe_ip)
+
+
 class QuarkIpamBoth(QuarkIpamBaseTest):
     def setUp(self):
         super(QuarkIpamBoth, self).setUp()
@@ -1141,13 +1430,19 @@ class QuarkIpamAllocateFromV6Subnet(QuarkIpamBaseTest):
             ip_mod["address"] = ip_address.value
             ip_mod["deallocated"] = deallocated
 
+        intervals = []
+        if isinstance(policies, netaddr.IPSet):
+            intervals = [(cidr.ipv6().first, cidr.ipv6().last)
+                         for cidr in policies.iter_cidrs()]
+
         with contextlib.nested(
-            mock.patch("quark.db.models.IPPolicy.get_ip_policy_cidrs"),
+            mock.patch("quark.ip_policy_index.for_subnet"),
             mock.patch("quark.db.api.ip_address_find"),
             mock.patch("quark.db.api.ip_address_create"),
             mock.patch("quark.db.api.ip_address_update")
         ) as (policy_find, ip_address_find, ip_create, ip_update):
-            policy_find.return_value = policies
+            policy_find.return_value = ip_policy_index.IPPolicyIndex(
+                intervals)
             ip_address_find.return_value = ip_mod
             ip_create.return_value = ip_mod
             ip_update.return_value = ip_mod
@@ -1189,16 +1484,20 @@ class QuarkIpamAllocateFromV6Subnet(QuarkIpamBaseTest):
 
         old_override = cfg.CONF.QUARK.v6_allocation_attempts
         cfg.CONF.set_override('v6_allocation_attempts', 1, 'QUARK')
-        ip_address = netaddr.IPAddress("fe80::")
+        ip_address = netaddr.IPAddress("feed::a8bb:ccff:fedd:eeff")
 
         with self._stubs(policies=[], ip_address=ip_address) as (
                 policy_find, ip_find, ip_create, ip_update):
+            ip_find.side_effect = [[ip_find.return_value],
+                                   ip_find.return_value]
             a = self.ipam._allocate_from_v6_subnet(self.context, 0, subnet6,
                                                    port_id, self.reuse_after,
                                                    mac_address=mac)
             self.assertEqual(ip_address.value, a["address"])
             self.assertEqual(1, ip_update.call_count)
             self.assertEqual(0, ip_create.call_count)
+            self.assertEqual([ip_address],
+                             ip_find.call_args_list[0][1]["ip_address"])
 
         cfg.CONF.set_override('v6_allocation_attempts', old_override, 'QUARK')
 
@@ -1237,12 +1536,18 @@ class QuarkIpamAllocateV6IPGeneration(QuarkIpamBaseTest):
             mock.patch("quark.db.api.ip_address_create"),
             mock.patch("quark.db.api.ip_address_update")
         ) as (ip_address_find, ip_create, ip_update):
-            ip_address_find.side_effect = ip_mods
+            ip_address_find.side_effect = [ip_mods] + [
+                ip for ip in ip_mods if ip["deallocated"]]
             ip_create.return_value = create_ip_return
             ip_update.return_value = update_ip_return
             yield ip_address_find, ip_create, ip_update
         cfg.CONF.set_override('v6_allocation_attempts', old_override, 'QUARK')
 
+    def _candidates(self, mac, port_id, subnet):
+        gen = quark.ipam.generate_v6(mac["address"], port_id, subnet["cidr"])
+        # NOTE: _stubs allows two attempts
+        return [netaddr.IPAddress(gen.next()).ipv6() for i in xrange(2)]
+
     def test_reallocate_v6_with_mac_already_exists(self):
         port_id = "945af340-ed34-4fec-8c87-853a2df492b4"
         subnet6 = dict(id=1, first_ip=0, last_ip=0,
@@ -1250,13 +1555,12 @@ class QuarkIpamAllocateV6IPGeneration(QuarkIpamBaseTest):
                        next_auto_assign_ip=0,
                        ip_policy=None)
 
-        ip1 = {"address": netaddr.IPAddress("fe80::").value,
-               "deallocated": False}
-        ip2 = {"address": netaddr.IPAddress("fe81::").value,
-               "deallocated": True}
-
         mac = models.MacAddress()
         mac["address"] = netaddr.EUI("AA:BB:CC:DD:EE:FF")
+        candidates = self._candidates(mac, port_id, subnet6)
+
+        ip1 = {"address": candidates[0].value, "deallocated": False}
+        ip2 = {"address": candidates[1].value, "deallocated": True}
 
         with self._stubs([ip1, ip2], ip2, ip2) as (
                 ip_find, ip_create, ip_update):
@@ -1265,6 +1569,55 @@ class QuarkIpamAllocateV6IPGeneration(QuarkIpamBaseTest):
                                                mac_address=mac)
             self.assertEqual(1, ip_update.call_count)
             self.assertEqual(0, ip_create.call_count)
+            self.assertEqual(2, ip_find.call_count)
+            self.assertEqual(candidates,
+                             ip_find.call_args_list[0][1]["ip_address"])
+
+    def test_allocate_v6_probes_candidates_at_once(self):
+        port_id = "945af340-ed34-4fec-8c87-853a2df492b4"
+        subnet6 = dict(id=1, first_ip=0, last_ip=0,
+                       cidr="feed::/104", ip_version=6,
+                       next_auto_assign_ip=0,
+                       ip_policy=None)
+
+        mac = models.MacAddress()
+        mac["address"] = netaddr.EUI("AA:BB:CC:DD:EE:FF")
+        candidates = self._candidates(mac, port_id, subnet6)
+
+        ip1 = {"address": candidates[0].value, "deallocated": False}
+
+        with self._stubs([ip1], ip1, None) as (
+                ip_find, ip_create, ip_update):
+            self.ipam._allocate_from_v6_subnet(self.context, 0, subnet6,
+                                               port_id, self.reuse_after,
+                                               mac_address=mac)
+            self.assertEqual(1, ip_find.call_count)
+            self.assertEqual(0, ip_update.call_count)
+            self.assertEqual(candidates[1],
+                             ip_create.call_args[1]["address"])
+
+    def test_allocate_v6_all_candidates_allocated_raises(self):
+        port_id = "945af340-ed34-4fec-8c87-853a2df492b4"
+        subnet6 = dict(id=1, first_ip=0, last_ip=0,
+                       cidr="feed::/104", ip_version=6,
+                       next_auto_assign_ip=0,
+                       ip_policy=None)
+
+        mac = models.MacAddress()
+        mac["address"] = netaddr.EUI("AA:BB:CC:DD:EE:FF")
+        candidates = self._candidates(mac, port_id, subnet6)
+
+        ips = [{"address": c.value, "deallocated": False} for c in candidates]
+
+        with self._stubs(ips, None, None) as (
+                ip_find, ip_create, ip_update):
+            with self.assertRaises(exceptions.IpAddressGenerationFailure):
+                self.ipam._allocate_from_v6_subnet(
+                    self.context, 0, subnet6, port_id, self.reuse_after,
+                    mac_address=mac)
+            self.assertEqual(1, ip_find.call_count)
+            self.assertEqual(0, ip_update.call_count)
+            self.assertEqual(0, ip_create.call_count)
 
 
 class QuarkNewIPAddressAllocation(QuarkIpamBaseTest):
@@ -1871,8 +2224,9 @@ class QuarkIPAddressAllocationNotifications(QuarkIpamBaseTest):
             mock.patch("sqlalchemy.orm.session.Session.refresh"),
             mock.patch("neutron.common.rpc.get_notifier"),
             mock.patch("oslo.utils.timeutils.utcnow"),
+            mock.patch("quark.db.api.ip_address_deallocate_bulk"),
         ) as (addr_find, addr_create, subnet_find, subnet_update, refresh,
-              notify, timeutils):
+              notify, timeutils, deallocate):
             addrs_found = []
             for a in addresses:
                 if a:
@@ -1918,17 +2272,22 @@ class QuarkIPAddressAllocationNotifications(QuarkIpamBaseTest):
                      used_by_tenant_id=1))
 
     def test_deallocation_notification(self):
-        addr_dict = dict(address=0, created_at="123", subnet_id=1,
+        addr_dict = dict(id=1, address=0, created_at="123", subnet_id=1,
                          address_readable="0.0.0.0", used_by_tenant_id=1)
         address = models.IPAddress()
         address.update(addr_dict)
 
+        # NOTE: port_find loads ip_addresses without filling their ports
+        #       backref, so the addresses never have ports loaded here.
         port_dict = dict(ip_addresses=[address], device_id="foo")
         port = models.Port()
         port.update(port_dict)
-        address["ports"] = [port]
 
-        with self._stubs(dict(), deleted_at="456") as notify:
+        with contextlib.nested(
+            self._stubs(dict(), deleted_at="456"),
+            mock.patch("quark.db.api.ip_address_port_counts")
+        ) as (notify, port_counts):
+            port_counts.return_value = {1: 1}
             self.ipam.deallocate_ips_by_port(self.context, port)
             notify.assert_called_once_with("network")
             notify.return_value.info.assert_called_once_with(
@@ -1942,6 +2301,28 @@ class QuarkIPAddressAllocationNotifications(QuarkIpamBaseTest):
                      used_by_tenant_id=1))
 
 
+    def test_deallocate_ip_address_notification(self):
+        addr_dict = dict(id=1, address=0, created_at="123", subnet_id=1,
+                         address_readable="0.0.0.0", used_by_tenant_id=1)
+        address = models.IPAddress()
+        address.update(addr_dict)
+        address["ports"] = [models.Port(device_id="foo")]
+
+        with contextlib.nested(
+            self._stubs(dict(), deleted_at="456"),
+            mock.patch("quark.db.api.ip_address_update")
+        ) as (notify, addr_update):
+            self.ipam.deallocate_ip_address(self.context, address)
+            notify.return_value.info.assert_called_once_with(
+                self.context,
+                "ip_block.address.delete",
+                dict(ip_block_id=address["subnet_id"],
+                     ip_address="0.0.0.0",
+                     device_ids=["foo"],
+                     created_at=address["created_at"],
+                     deleted_at="456",
+                     used_by_tenant_id=1))
+
 class QuarkIpamTestV6IpGeneration(QuarkIpamBaseTest):
     def test_rfc2462_generates_valid_ip(self):
         mac = netaddr.EUI("AA:BB:CC:DD:EE:FF")
@@ -2073,6 +2454,667 @@ class QuarkIpamTestSelectSubnet(QuarkIpamBaseTest):
             self.assertEqual(subnets[0][0]["next_auto_assign_ip"], -1)
 
 
+class QuarkIpamTestReallocateFreeList(QuarkIpamBaseTest):
+    def setUp(self):
+        super(QuarkIpamTestReallocateFreeList, self).setUp()
+        cfg.CONF.set_override("ipam_reallocate_claim", "free_list", "QUARK")
+        self.addCleanup(cfg.CONF.clear_override, "ipam_reallocate_claim",
+                        "QUARK")
+
+    @contextlib.contextmanager
+    def _stubs(self, candidates, claims=None):
+        with contextlib.nested(
+            mock.patch("quark.db.api.transaction_create"),
+            mock.patch("quark.db.api.ip_address_reallocate_candidates"),
+            mock.patch("quark.db.api.ip_address_reallocate_claim"),
+            mock.patch("quark.db.api.ip_address_reallocate_claimed"),
+            mock.patch("quark.ipam._spread_random.shuffle")
+        ) as (transaction_create, find_candidates, claim, claimed, shuffle):
+            find_candidates.return_value = candidates
+            claim.side_effect = claims
+            claimed.side_effect = lambda context, address_id: dict(
+                id=address_id, address_readable=str(address_id))
+            yield transaction_create, find_candidates, claim, shuffle
+
+    def test_reallocate_claims_candidate(self):
+        with self._stubs(["1", "2"], claims=[False, True]) as (
+                transaction_create, find_candidates, claim, shuffle):
+            addresses = self.ipam.attempt_to_reallocate_ip(
+                self.context, 1, 1, self.reuse_after, version=4)
+            self.assertEqual("2", addresses[0]["id"])
+            self.assertEqual(2, claim.call_count)
+            self.assertTrue(shuffle.called)
+            self.assertFalse(transaction_create.called)
+            self.assertFalse(find_candidates.call_args[1]["skip_locked"])
+
+    def test_reallocate_no_candidates(self):
+        with self._stubs([]) as (transaction_create, find_candidates, claim,
+                                 shuffle):
+            addresses = self.ipam.attempt_to_reallocate_ip(
+                self.context, 1, 1, self.reuse_after, version=4)
+            self.assertEqual([], addresses)
+            self.assertEqual(1, find_candidates.call_count)
+            self.assertFalse(claim.called)
+
+    def test_reallocate_all_candidates_taken_retries(self):
+        with self._stubs(["1"], claims=[False, True]) as (
+                transaction_create, find_candidates, claim, shuffle):
+            addresses = self.ipam.attempt_to_reallocate_ip(
+                self.context, 1, 1, self.reuse_after, version=4)
+            self.assertEqual("1", addresses[0]["id"])
+            self.assertEqual(2, find_candidates.call_count)
+
+    def test_reallocate_skip_locked_takes_first(self):
+        cfg.CONF.set_override("ipam_use_skip_locked", True, "QUARK")
+        self.addCleanup(cfg.CONF.clear_override, "ipam_use_skip_locked",
+                        "QUARK")
+        with self._stubs(["1", "2"], claims=[True]) as (
+                transaction_create, find_candidates, claim, shuffle):
+            addresses = self.ipam.attempt_to_reallocate_ip(
+                self.context, 1, 1, self.reuse_after, version=4)
+            self.assertEqual("1", addresses[0]["id"])
+            self.assertFalse(shuffle.called)
+            self.assertTrue(find_candidates.call_args[1]["skip_locked"])
+
+
+class QuarkIpamTestMacReallocateFreeList(QuarkIpamBaseTest):
+    def setUp(self):
+        super(QuarkIpamTestMacReallocateFreeList, self).setUp()
+        cfg.CONF.set_override("mac_address_reallocate_claim", "free_list",
+                              "QUARK")
+        self.addCleanup(cfg.CONF.clear_override,
+                        "mac_address_reallocate_claim", "QUARK")
+
+    @contextlib.contextmanager
+    def _stubs(self, candidates, claims=None):
+        with contextlib.nested(
+            mock.patch("quark.db.api.transaction_create"),
+            mock.patch("quark.db.api.mac_address_reallocate"),
+            mock.patch("quark.db.api.mac_address_reallocate_candidates"),
+            mock.patch("quark.db.api.mac_address_reallocate_claim"),
+            mock.patch("quark.db.api.mac_address_reallocate_claimed"),
+            mock.patch("quark.db.api."
+                       "mac_address_range_find_allocation_counts"),
+            mock.patch("quark.ipam._spread_random.shuffle")
+        ) as (transaction_create, mac_realloc, find_candidates, claim,
+              claimed, range_find, shuffle):
+            find_candidates.return_value = candidates
+            claim.side_effect = claims
+            claimed.side_effect = lambda context, address: dict(
+                address=address)
+            range_find.return_value = None
+            yield (transaction_create, mac_realloc, find_candidates, claim,
+                   shuffle)
+
+    def test_reallocate_claims_candidate(self):
+        with self._stubs([1, 2], claims=[False, True]) as (
+                transaction_create, mac_realloc, find_candidates, claim,
+                shuffle):
+            mac = self.ipam.allocate_mac_address(self.context, 0, 0, 0)
+            self.assertEqual(2, mac["address"])
+            self.assertEqual(2, claim.call_count)
+            self.assertTrue(shuffle.called)
+            self.assertFalse(transaction_create.called)
+            self.assertFalse(mac_realloc.called)
+            self.assertFalse(find_candidates.call_args[1]["skip_locked"])
+
+    def test_reallocate_no_candidates_creates_new_mac(self):
+        with self._stubs([]) as (transaction_create, mac_realloc,
+                                 find_candidates, claim, shuffle):
+            with self.assertRaises(exceptions.MacAddressGenerationFailure):
+                self.ipam.allocate_mac_address(self.context, 0, 0, 0)
+            self.assertEqual(1, find_candidates.call_count)
+            self.assertFalse(claim.called)
+
+    def test_reallocate_all_candidates_taken_retries(self):
+        with self._stubs([1, 2], claims=[False, False, True]) as (
+                transaction_create, mac_realloc, find_candidates, claim,
+                shuffle):
+            mac = self.ipam.allocate_mac_address(self.context, 0, 0, 0)
+            self.assertEqual(1, mac["address"])
+            self.assertEqual(2, find_candidates.call_count)
+            self.assertEqual(3, claim.call_count)
+
+    def test_reallocate_claims_always_taken_fails(self):
+        with self._stubs([1], claims=itertools.repeat(False)) as (
+                transaction_create, mac_realloc, find_candidates, claim,
+                shuffle):
+            with self.assertRaises(exceptions.MacAddressGenerationFailure):
+                self.ipam.allocate_mac_address(self.context, 0, 0, 0)
+            self.assertEqual(cfg.CONF.QUARK.mac_address_retry_max,
+                             find_candidates.call_count)
+
+    def test_reallocate_skip_locked_takes_first(self):
+        cfg.CONF.set_override("ipam_use_skip_locked", True, "QUARK")
+        self.addCleanup(cfg.CONF.clear_override, "ipam_use_skip_locked",
+                        "QUARK")
+        with self._stubs([1, 2], claims=[True]) as (
+                transaction_create, mac_realloc, find_candidates, claim,
+                shuffle):
+            mac = self.ipam.allocate_mac_address(self.context, 0, 0, 0)
+            self.assertEqual(1, mac["address"])
+            self.assertFalse(shuffle.called)
+            self.assertTrue(find_candidates.call_args[1]["skip_locked"])
+
+
+class QuarkIpamTestReallocateClaimToken(QuarkIpamBaseTest):
+    def setUp(self):
+        super(QuarkIpamTestReallocateClaimToken, self).setUp()
+        for opt in ("ipam_reallocate_claim", "mac_address_reallocate_claim"):
+            cfg.CONF.set_override(opt, "token", "QUARK")
+            self.addCleanup(cfg.CONF.clear_override, opt, "QUARK")
+
+    def test_claim_tokens_unique(self):
+        tokens = set(quark.ipam.claim_token() for i in xrange(100))
+        self.assertEqual(100, len(tokens))
+        for token in tokens:
+            self.assertTrue(token.startswith(quark.ipam.CLAIM_TOKEN_PREFIX))
+            self.assertTrue(len(token) <= 36)
+
+    def test_reallocate_ip_writes_token(self):
+        with contextlib.nested(
+            mock.patch("quark.db.api.transaction_create"),
+            mock.patch("quark.db.api.ip_address_reallocate"),
+            mock.patch("quark.db.api.ip_address_reallocate_find")
+        ) as (transaction_create, reallocate, reallocate_find):
+            reallocate.return_value = True
+            reallocate_find.return_value = dict(id=1, address_readable="1")
+            addresses = self.ipam.attempt_to_reallocate_ip(
+                self.context, 1, 1, self.reuse_after, version=4)
+            self.assertEqual(1, addresses[0]["id"])
+            self.assertFalse(transaction_create.called)
+            token = reallocate.call_args[0][1][models.IPAddress.claim_token]
+            self.assertNotIn(models.IPAddress.transaction_id,
+                             reallocate.call_args[0][1])
+            reallocate_find.assert_called_once_with(mock.ANY,
+                                                    claim_token=token)
+
+    def test_allocate_mac_address_writes_token(self):
+        with contextlib.nested(
+            mock.patch("quark.db.api.transaction_create"),
+            mock.patch("quark.db.api.mac_address_reallocate"),
+            mock.patch("quark.db.api.mac_address_reallocate_find")
+        ) as (transaction_create, reallocate, reallocate_find):
+            reallocate.return_value = True
+            reallocate_find.return_value = models.MacAddress(address=0)
+            self.ipam.allocate_mac_address(self.context, 0, 0, 0)
+            self.assertFalse(transaction_create.called)
+            token = reallocate.call_args[0][1]["claim_token"]
+            self.assertNotIn("transaction_id", reallocate.call_args[0][1])
+            reallocate_find.assert_called_once_with(mock.ANY,
+                                                    claim_token=token)
+
+
+class QuarkIpamTestBulkAllocation(QuarkIpamBaseTest):
+    def _v4_subnet(self, next_ip, last_ip, exclude=None):
+        return dict(id=1, cidr="0.0.0.0/24", ip_version=4,
+                    first_ip=netaddr.IPAddress("0.0.0.0").ipv6().value,
+                    last_ip=last_ip, next_auto_assign_ip=next_ip,
+                    network_id=1, tenant_id="foo",
+                    ip_policy=dict(id=None, exclude=exclude or []))
+
+    def _ip(self, value):
+        return netaddr.IPAddress(value).ipv6().value
+
+    def test_allocate_mac_addresses_reallocates_then_reserves(self):
+        mac_range = dict(id=1, cidr="AA:BB:CC/24", first_address=0,
+                         last_address=255, next_auto_assign_mac=10)
+        with contextlib.nested(
+            mock.patch("quark.db.api.mac_address_reallocate_bulk"),
+            mock.patch("quark.db.api."
+                       "mac_address_range_find_allocation_counts"),
+            mock.patch("quark.db.api.mac_range_update_next_auto_assign_mac"),
+            mock.patch("quark.db.api.mac_range_update_set_full"),
+            mock.patch("quark.db.api.mac_address_find_taken"),
+            mock.patch("quark.db.api.mac_address_create_bulk")
+        ) as (reallocate, range_find, update_next, set_full, find_taken,
+              create_bulk):
+            reallocate.return_value = [dict(address=1)]
+            range_find.return_value = (mac_range, 0)
+            find_taken.return_value = set()
+            create_bulk.side_effect = lambda ctx, addrs, rng_id: [
+                dict(address=a) for a in addrs]
+            macs = self.ipam.allocate_mac_addresses(
+                self.context, 1, ["a", "b", "c"], self.reuse_after)
+        self.assertEqual([1, 10, 11], [m["address"] for m in macs])
+        update_next.assert_called_once_with(self.context, mac_range, count=2)
+        create_bulk.assert_called_once_with(self.context, [10, 11], 1)
+        self.assertFalse(set_full.called)
+
+    def test_allocate_mac_addresses_range_full_releases(self):
+        mac_range = dict(id=1, cidr="AA:BB:CC/24", first_address=0,
+                         last_address=255, next_auto_assign_mac=-1)
+        with contextlib.nested(
+            mock.patch("quark.db.api.mac_address_reallocate_bulk"),
+            mock.patch("quark.db.api."
+                       "mac_address_range_find_allocation_counts"),
+            mock.patch("quark.db.api.mac_range_update_set_full"),
+            mock.patch("quark.db.api.mac_address_create_bulk"),
+            mock.patch("quark.ipam.QuarkIpam.deallocate_mac_address")
+        ) as (reallocate, range_find, set_full, create_bulk, dealloc):
+            reallocate.return_value = [dict(address=1)]
+            range_find.side_effect = [(mac_range, 256), None]
+            with self.assertRaises(exceptions.MacAddressGenerationFailure):
+                self.ipam.allocate_mac_addresses(
+                    self.context, 1, ["a", "b"], self.reuse_after)
+        set_full.assert_called_once_with(self.context, mac_range)
+        self.assertFalse(create_bulk.called)
+        dealloc.assert_called_once_with(self.context, 1)
+
+    def test_reserve_v4_block_skips_policy(self):
+        subnet = self._v4_subnet(
+            self._ip("0.0.0.1"), self._ip("0.0.0.255"),
+            exclude=[dict(cidr="0.0.0.2/31", first_ip=self._ip("0.0.0.2"),
+                          last_ip=self._ip("0.0.0.3"))])
+        with contextlib.nested(
+            mock.patch("quark.db.api.subnet_update_next_auto_assign_ip"),
+            mock.patch("quark.db.api.subnet_update_set_full")
+        ) as (update_next, set_full):
+            block = self.ipam._reserve_v4_block(self.context, subnet, 3)
+        self.assertEqual([self._ip("0.0.0.1"), self._ip("0.0.0.4"),
+                          self._ip("0.0.0.5")], block)
+        update_next.assert_called_once_with(self.context, subnet, count=5)
+        self.assertFalse(set_full.called)
+
+    def test_reserve_v4_block_marks_full(self):
+        subnet = self._v4_subnet(self._ip("0.0.0.254"),
+                                 self._ip("0.0.0.255"))
+        with contextlib.nested(
+            mock.patch("quark.db.api.subnet_update_next_auto_assign_ip"),
+            mock.patch("quark.db.api.subnet_update_set_full")
+        ) as (update_next, set_full):
+            block = self.ipam._reserve_v4_block(self.context, subnet, 5)
+        self.assertEqual([self._ip("0.0.0.254"), self._ip("0.0.0.255")],
+                         block)
+        set_full.assert_called_once_with(self.context, subnet)
+        self.assertFalse(update_next.called)
+
+    def test_allocate_ip_addresses_bulk_falls_back(self):
+        reallocated = dict(id=1, address_readable="0.0.0.1", version=4)
+        created = dict(id=2, address_readable="0.0.0.2", version=4)
+        with contextlib.nested(
+            mock.patch("quark.ipam.QuarkIpam._reallocate_v4_bulk"),
+            mock.patch("quark.ipam.QuarkIpam._allocate_v4_blocks"),
+            mock.patch("quark.ipam.QuarkIpam._notify_new_addresses"),
+            mock.patch("quark.ipam.QuarkIpam.allocate_ip_address")
+        ) as (reallocate, blocks, notify, allocate):
+            reallocate.return_value = [reallocated]
+            blocks.return_value = [created]
+            new_addresses = {}
+            self.ipam.allocate_ip_addresses_bulk(
+                self.context, new_addresses, 1, ["a", "b", "c"],
+                self.reuse_after)
+        self.assertEqual([reallocated], new_addresses["a"])
+        self.assertEqual([created], new_addresses["b"])
+        # NOTE: Like a single port, a reallocated address isn't notified.
+        notify.assert_called_once_with(self.context, [created])
+        allocate.assert_called_once_with(
+            self.context, [], 1, "c", self.reuse_after, segment_id=None,
+            mac_address=None)
+
+
+class QuarkIpamTestSelectSubnetLeasing(QuarkIpamBaseTest):
+    def setUp(self):
+        super(QuarkIpamTestSelectSubnetLeasing, self).setUp()
+        cfg.CONF.set_override("ipam_v4_lease_size", 4, "QUARK")
+        self.addCleanup(cfg.CONF.clear_override, "ipam_v4_lease_size",
+                        "QUARK")
+        quark.ipam.IP_LEASES.drain()
+        self.addCleanup(quark.ipam.IP_LEASES.drain)
+
+    @contextlib.contextmanager
+    def _stubs(self, subnet):
+        with contextlib.nested(
+            mock.patch("quark.db.api.subnet_find_ordered_by_most_full"),
+            mock.patch("quark.db.api.subnet_update_next_auto_assign_ip"),
+            mock.patch("quark.db.api.subnet_find"),
+            mock.patch("sqlalchemy.orm.session.Session.refresh"),
+        ) as (subnet_find_full, subnet_incr, subnet_find, refresh):
+            sub_mod = subnet_helper(subnet)
+
+            def subnet_increment(context, sub, count=1):
+                sub["next_auto_assign_ip"] += count
+                return True
+
+            subnet_find_full.return_value = [(sub_mod, 0)]
+            subnet_find.return_value = sub_mod
+            subnet_incr.side_effect = subnet_increment
+            yield sub_mod, subnet_find_full, subnet_incr
+
+    def test_select_subnet_leases_block(self):
+        subnet = dict(id=1, first_ip=0, last_ip=255,
+                      cidr="0.0.0.0/24", ip_version=4,
+                      next_auto_assign_ip=1, do_not_use=False,
+                      ip_policy=None, network_id=1)
+        with self._stubs(subnet) as (sub_mod, find_full, incr):
+            s = self.ipam.select_subnet(self.context, 1, None, None)
+            self.assertEqual(sub_mod, s)
+            self.assertEqual(1, s.leased_ip)
+            self.assertEqual(5, sub_mod["next_auto_assign_ip"])
+            incr.assert_called_once_with(self.context, sub_mod, count=4)
+
+            for expected in (2, 3, 4):
+                s.leased_ip = None
+                s = self.ipam.select_subnet(self.context, 1, None, None)
+                self.assertEqual(expected, s.leased_ip)
+            self.assertEqual(1, find_full.call_count)
+            self.assertEqual(1, incr.call_count)
+
+            s.leased_ip = None
+            self.ipam.select_subnet(self.context, 1, None, None)
+            self.assertEqual(2, find_full.call_count)
+
+    def test_select_subnet_returns_unusable_lease(self):
+        subnet = dict(id=1, first_ip=0, last_ip=255,
+                      cidr="0.0.0.0/24", ip_version=4,
+                      next_auto_assign_ip=1, do_not_use=False,
+                      ip_policy=None, network_id=1)
+        with contextlib.nested(
+            self._stubs(subnet),
+            mock.patch("quark.ipam.return_ip_leases")
+        ) as ((sub_mod, find_full, incr), return_leases):
+            s = self.ipam.select_subnet(self.context, 1, None, None)
+            self.assertEqual(1, s.leased_ip)
+            s.leased_ip = None
+            sub_mod["do_not_use"] = True
+            self.ipam.select_subnet(self.context, 1, None, None)
+            leftovers = return_leases.call_args_list[0][0][1]
+            self.assertEqual([[3, 4], [2]],
+                             [lease.remaining() for lease in leftovers])
+            self.assertEqual([1, 1],
+                             [lease.resource_id for lease in leftovers])
+
+    def test_select_subnet_lease_clamped_to_subnet(self):
+        subnet = dict(id=1, first_ip=0, last_ip=255,
+                      cidr="0.0.0.0/24", ip_version=4,
+                      next_auto_assign_ip=254, do_not_use=False,
+                      ip_policy=None, network_id=1)
+        with self._stubs(subnet) as (sub_mod, find_full, incr):
+            self.ipam.select_subnet(self.context, 1, None, None)
+            incr.assert_called_once_with(self.context, sub_mod, count=2)
+            self.assertEqual(256, sub_mod["next_auto_assign_ip"])
+
+    def test_select_subnet_explicit_ip_does_not_lease(self):
+        subnet = dict(id=1, first_ip=0, last_ip=255,
+                      cidr="0.0.0.0/24", ip_version=4,
+                      next_auto_assign_ip=1, do_not_use=False,
+                      ip_policy=None, network_id=1)
+        with self._stubs(subnet) as (sub_mod, find_full, incr):
+            self.ipam.select_subnet(self.context, 1, "0.0.0.5", None)
+            self.assertFalse(incr.called)
+            self.assertIsNone(quark.ipam.IP_LEASES.take((1, None, None)))
+
+    def test_allocate_from_subnet_uses_leased_ip(self):
+        subnet = subnet_helper(dict(id=1, first_ip=0, last_ip=255,
+                                    cidr="0.0.0.0/24", ip_version=4,
+                                    next_auto_assign_ip=10,
+                                    ip_policy=None, network_id=1))
+        subnet.leased_ip = netaddr.IPAddress("0.0.0.3").ipv6().value
+        with mock.patch("quark.db.api.ip_address_create") as create:
+            self.ipam._allocate_from_subnet(self.context, 1, subnet, 2, 0)
+            self.assertEqual(netaddr.IPAddress("0.0.0.3"),
+                             create.call_args[1]["address"])
+            self.assertIsNone(subnet.leased_ip)
+
+    def test_select_subnet_lease_stops_at_policy_exclusion(self):
+        subnet = dict(id=1, first_ip=0, last_ip=255,
+                      cidr="0.0.0.0/24", ip_version=4,
+                      next_auto_assign_ip=0, do_not_use=False,
+                      ip_policy=dict(size=2, exclude=[
+                          models.IPPolicyCIDR(cidr="0.0.0.0/32"),
+                          models.IPPolicyCIDR(cidr="0.0.0.3/32")]),
+                      network_id=1)
+        with self._stubs(subnet) as (sub_mod, find_full, incr):
+            s = self.ipam.select_subnet(self.context, 1, None, None)
+            self.assertEqual(1, s.leased_ip)
+            incr.assert_called_once_with(self.context, sub_mod, count=3)
+            s.leased_ip = None
+            s = self.ipam.select_subnet(self.context, 1, None, None)
+            self.assertEqual(2, s.leased_ip)
+            self.assertEqual(1, find_full.call_count)
+
+
+class QuarkIpamTestMacAddressLeasing(QuarkIpamBaseTest):
+    def setUp(self):
+        super(QuarkIpamTestMacAddressLeasing, self).setUp()
+        cfg.CONF.set_override("mac_address_lease_size", 4, "QUARK")
+        self.addCleanup(cfg.CONF.clear_override, "mac_address_lease_size",
+                        "QUARK")
+        quark.ipam.MAC_LEASES.drain()
+        self.addCleanup(quark.ipam.MAC_LEASES.drain)
+
+    @contextlib.contextmanager
+    def _stubs(self, mac_range):
+        with contextlib.nested(
+            mock.patch("quark.db.api.mac_address_reallocate"),
+            mock.patch("quark.db.api.mac_address_range_find_for_lease"),
+            mock.patch("quark.db.api."
+                       "mac_address_range_find_allocation_counts"),
+            mock.patch("quark.db.api.mac_address_range_find"),
+            mock.patch("quark.db.api.mac_range_update_next_auto_assign_mac"),
+            mock.patch("quark.db.api.mac_range_update_set_full"),
+            mock.patch("quark.db.api.mac_address_create")
+        ) as (reallocate, find_for_lease, find_counts, range_find,
+              update_next, set_full, mac_create):
+            range_mod = range_helper(mac_range)
+            reallocate.return_value = False
+            find_for_lease.return_value = range_mod
+            range_find.return_value = range_mod
+            mac_create.side_effect = lambda ctx, **kw: kw
+            yield find_for_lease, find_counts, update_next, set_full
+
+    def _allocate(self):
+        return self.ipam.allocate_mac_address(self.context, 0, 0, 0)
+
+    def test_allocate_mac_address_leases_block(self):
+        mac_range = dict(id=1, first_address=0, last_address=255,
+                         next_auto_assign_mac=10, do_not_use=False)
+        with self._stubs(mac_range) as (find_for_lease, find_counts,
+                                        update_next, set_full):
+            addresses = [self._allocate()["address"] for i in xrange(5)]
+        self.assertEqual([10, 11, 12, 13, 10], addresses)
+        self.assertEqual(2, find_for_lease.call_count)
+        self.assertEqual(2, update_next.call_count)
+        update_next.assert_called_with(self.context, mock.ANY, count=4)
+        self.assertFalse(find_counts.called)
+        self.assertFalse(set_full.called)
+
+    def test_allocate_mac_address_lease_clamped_to_range(self):
+        mac_range = dict(id=1, first_address=0, last_address=255,
+                         next_auto_assign_mac=254, do_not_use=False)
+        with self._stubs(mac_range) as (find_for_lease, find_counts,
+                                        update_next, set_full):
+            addresses = [self._allocate()["address"] for i in xrange(2)]
+        self.assertEqual([254, 255], addresses)
+        self.assertEqual(1, find_for_lease.call_count)
+        self.assertFalse(update_next.called)
+        self.assertEqual(1, set_full.call_count)
+
+    def test_allocate_mac_address_returns_unusable_lease(self):
+        mac_range = dict(id=1, first_address=0, last_address=255,
+                         next_auto_assign_mac=10, do_not_use=False)
+        with contextlib.nested(
+            self._stubs(mac_range),
+            mock.patch("quark.ipam.return_mac_leases")
+        ) as ((find_for_lease, find_counts, update_next, set_full),
+              return_leases):
+            self._allocate()
+            find_for_lease.return_value["do_not_use"] = True
+            find_for_lease.return_value = None
+            with self.assertRaises(exceptions.MacAddressGenerationFailure):
+                self._allocate()
+        self.assertIsNone(quark.ipam.MAC_LEASES.take(False))
+        leftovers = return_leases.call_args[0][1]
+        self.assertEqual([[12, 13], [11]],
+                         [lease.remaining() for lease in leftovers])
+
+    def test_allocate_mac_address_leased_records_metrics(self):
+        mac_range = dict(id=1, first_address=0, last_address=255,
+                         next_auto_assign_mac=10, do_not_use=False)
+        metrics = ipam_metrics.IpamMetrics(sink=None)
+        with contextlib.nested(
+            self._stubs(mac_range),
+            mock.patch("quark.ipam_metrics.METRICS", metrics)
+        ):
+            self._allocate()
+        self.assertEqual(1, metrics.histograms["ANY.mac_create"].count)
+        self.assertEqual(
+            1, metrics.histograms["ANY.mac_select_range"].count)
+
+    def test_allocate_explicit_mac_address_does_not_lease(self):
+        mac_range = dict(id=1, first_address=0, last_address=255,
+                         next_auto_assign_mac=10, do_not_use=False)
+        with self._stubs(mac_range) as (find_for_lease, find_counts,
+                                        update_next, set_full):
+            find_counts.return_value = (range_helper(mac_range), 0)
+            self.ipam.allocate_mac_address(self.context, 0, 0, 0,
+                                           mac_address=5)
+        self.assertFalse(find_for_lease.called)
+        self.assertTrue(find_counts.called)
+
+    def test_return_mac_leases_rewinds(self):
+        quark.ipam.MAC_LEASES.grant(False, 1, 11, 13, 60)
+        with contextlib.nested(
+            mock.patch("quark.db.api.mac_range_return_next_auto_assign_mac"),
+            mock.patch("quark.db.api.mac_address_create")
+        ) as (rewind, mac_create):
+            rewind.return_value = 1
+            quark.ipam.return_mac_leases(self.context,
+                                         quark.ipam.MAC_LEASES.drain())
+        rewind.assert_called_once_with(self.context, 1, 13, 11)
+        self.assertFalse(mac_create.called)
+
+    def test_return_mac_leases_records_deallocated(self):
+        quark.ipam.MAC_LEASES.grant(False, 1, 11, 12, 60)
+        with contextlib.nested(
+            mock.patch("quark.db.api.mac_range_return_next_auto_assign_mac"),
+            mock.patch("quark.db.api.mac_address_create"),
+            mock.patch("quark.db.api.mac_address_update")
+        ) as (rewind, mac_create, mac_update):
+            rewind.return_value = 0
+            mac_create.side_effect = lambda ctx, **kw: kw
+            quark.ipam.return_mac_leases(self.context,
+                                         quark.ipam.MAC_LEASES.drain())
+        self.assertEqual([mock.call(self.context, address=11,
+                                    mac_address_range_id=1),
+                          mock.call(self.context, address=12,
+                                    mac_address_range_id=1)],
+                         mac_create.call_args_list)
+        self.assertEqual(2, mac_update.call_count)
+        for call in mac_update.call_args_list:
+            self.assertTrue(call[1]["deallocated"])
+
+
+class QuarkIpamTestSelectSubnetPolicySkip(QuarkIpamBaseTest):
+    @contextlib.contextmanager
+    def _stubs(self, subnet):
+        with contextlib.nested(
+            mock.patch("quark.db.api.subnet_find_ordered_by_most_full"),
+            mock.patch("quark.db.api.subnet_update_next_auto_assign_ip"),
+            mock.patch("quark.db.api.subnet_update_set_full"),
+            mock.patch("sqlalchemy.orm.session.Session.refresh"),
+        ) as (subnet_find_full, subnet_incr, set_full, refresh):
+            sub_mod = subnet_helper(subnet)
+
+            def subnet_increment(context, sub, count=1):
+                sub["next_auto_assign_ip"] += count
+                return True
+
+            subnet_find_full.return_value = [(sub_mod, 0)]
+            subnet_incr.side_effect = subnet_increment
+            set_full.return_value = 1
+            yield sub_mod, subnet_incr, set_full
+
+    def test_select_subnet_skips_leading_exclusion(self):
+        subnet = dict(id=1, first_ip=0, last_ip=255,
+                      cidr="0.0.0.0/24", ip_version=4,
+                      next_auto_assign_ip=0, do_not_use=False,
+                      ip_policy=dict(size=64, exclude=[
+                          models.IPPolicyCIDR(cidr="0.0.0.0/26")]),
+                      network_id=1)
+        with self._stubs(subnet) as (sub_mod, incr, set_full):
+            self.ipam.select_subnet(self.context, 1, None, None)
+            incr.assert_called_once_with(self.context, sub_mod, count=65)
+            self.assertEqual(65, sub_mod["next_auto_assign_ip"])
+            with mock.patch("quark.db.api.ip_address_create") as create:
+                self.ipam._allocate_from_subnet(self.context, 1, sub_mod,
+                                                2, 0)
+            self.assertEqual(netaddr.IPAddress("0.0.0.64"),
+                             create.call_args[1]["address"])
+
+    def test_allocate_from_subnet_skips_exclusion(self):
+        sub_mod = subnet_helper(dict(
+            id=1, first_ip=0, last_ip=255, cidr="0.0.0.0/24", ip_version=4,
+            next_auto_assign_ip=1, network_id=1,
+            ip_policy=dict(size=4, exclude=[
+                models.IPPolicyCIDR(cidr="0.0.0.0/30")])))
+        with contextlib.nested(
+            mock.patch("quark.db.api.ip_address_create"),
+            mock.patch("quark.db.api.subnet_update_next_auto_assign_ip_past")
+        ) as (create, update_past):
+            update_past.return_value = 1
+            self.ipam._allocate_from_subnet(self.context, 1, sub_mod, 2, 0)
+            update_past.assert_called_once_with(self.context, sub_mod, 4)
+            self.assertEqual(netaddr.IPAddress("0.0.0.4"),
+                             create.call_args[1]["address"])
+
+    def test_allocate_from_subnet_excluded_to_the_end(self):
+        sub_mod = subnet_helper(dict(
+            id=1, first_ip=0, last_ip=255, cidr="0.0.0.0/24", ip_version=4,
+            next_auto_assign_ip=-1, network_id=1,
+            ip_policy=dict(size=1, exclude=[
+                models.IPPolicyCIDR(cidr="0.0.0.255/32")])))
+        with contextlib.nested(
+            mock.patch("quark.db.api.ip_address_create"),
+            mock.patch("quark.db.api.subnet_update_set_full")
+        ) as (create, set_full):
+            with self.assertRaises(q_exc.IPAddressRetryableFailure) as ctx:
+                self.ipam._allocate_from_subnet(self.context, 1, sub_mod,
+                                                2, 0)
+            self.assertNotIsInstance(
+                ctx.exception, q_exc.IPAddressPolicyRetryableFailure)
+            self.assertFalse(create.called)
+
+    def test_select_subnet_skips_adjacent_exclusions(self):
+        v6_first = netaddr.IPAddress("::ffff:0.0.0.0").value
+        subnet = dict(id=1, first_ip=v6_first, last_ip=v6_first + 255,
+                      cidr="0.0.0.0/24", ip_version=4,
+                      next_auto_assign_ip=v6_first + 4, do_not_use=False,
+                      ip_policy=dict(size=8, exclude=[
+                          models.IPPolicyCIDR(cidr="0.0.0.6/31"),
+                          models.IPPolicyCIDR(cidr="0.0.0.4/31",
+                                              first_ip=v6_first + 4,
+                                              last_ip=v6_first + 5)]),
+                      network_id=1)
+        with self._stubs(subnet) as (sub_mod, incr, set_full):
+            self.ipam.select_subnet(self.context, 1, None, None)
+            incr.assert_called_once_with(self.context, sub_mod, count=5)
+            self.assertEqual(v6_first + 9, sub_mod["next_auto_assign_ip"])
+
+    def test_select_subnet_no_skip_outside_exclusion(self):
+        subnet = dict(id=1, first_ip=0, last_ip=255,
+                      cidr="0.0.0.0/24", ip_version=4,
+                      next_auto_assign_ip=5, do_not_use=False,
+                      ip_policy=dict(size=1, exclude=[
+                          models.IPPolicyCIDR(cidr="0.0.0.0/32")]),
+                      network_id=1)
+        with self._stubs(subnet) as (sub_mod, incr, set_full):
+            self.ipam.select_subnet(self.context, 1, None, None)
+            incr.assert_called_once_with(self.context, sub_mod)
+
+    def test_select_subnet_trailing_exclusion_marks_full(self):
+        subnet = dict(id=1, first_ip=0, last_ip=255,
+                      cidr="0.0.0.0/24", ip_version=4,
+                      next_auto_assign_ip=255, do_not_use=False,
+                      ip_policy=dict(size=1, exclude=[
+                          models.IPPolicyCIDR(cidr="0.0.0.255/32")]),
+                      network_id=1)
+        with self._stubs(subnet) as (sub_mod, incr, set_full):
+            self.ipam.select_subnet(self.context, 1, None, None)
+            set_full.assert_called_once_with(self.context, sub_mod)
+            self.assertFalse(incr.called)
+
+
 class QuarkIpamTestLog(test_base.TestBase):
     def test_ipam_log_entry_success_flagging(self):
         log = quark.ipam.QuarkIPAMLog()
@@ -2159,3 +3201,35 @@ class QuarkIpamTestLog(test_base.TestBase):
         except Exception:
             self.assertTrue(output.called)
             output.assert_called_with(False, 0, 0, 0)
+
+    def test_ipam_log_records_metrics(self):
+        metrics = ipam_metrics.IpamMetrics(sink=None)
+        log = quark.ipam.QuarkIPAMLog("ANY")
+        entry1 = log.make_entry("_try_allocate_ip_address")
+        entry1.failed("policy")
+        entry1.end()
+        entry2 = log.make_entry("_try_allocate_ip_address")
+        entry2.end()
+        with log.timed("select_subnet"):
+            pass
+        log._record(metrics)
+        self.assertEqual(
+            2, metrics.histograms["ANY.try_allocate_ip_address"].count)
+        self.assertEqual(1, metrics.histograms["ANY.select_subnet"].count)
+        self.assertEqual(1, metrics.histograms["ANY.total"].count)
+        self.assertEqual(
+            {"ANY.try_allocate_ip_address.retries": 1,
+             "ANY.try_allocate_ip_address.failures.policy": 1,
+             "ANY.success": 1},
+            metrics.counters)
+
+    def test_ipam_logged_decorator_names_strategy(self):
+        patcher = mock.patch("quark.ipam.QuarkIPAMLog._record")
+        record = patcher.start()
+        self.addCleanup(patcher.stop)
+
+        def ok(not_self, **kwargs):
+            self.assertEqual("BOTH", kwargs["ipam_log"].strategy)
+
+        quark.ipam.ipam_logged(ok)(quark.ipam.QuarkIpamBOTH())
+        self.assertTrue(record.called)
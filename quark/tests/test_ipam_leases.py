@@ -0,0 +1,88 @@
+# Copyright (c) 2015 OpenStack Foundation
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import mock
+
+from quark import ipam_leases
+from quark.tests import test_base
+
+
+class TestLeaseManager(test_base.TestBase):
+    def setUp(self):
+        super(TestLeaseManager, self).setUp()
+        self.leases = ipam_leases.LeaseManager()
+
+    def test_take_no_lease(self):
+        self.assertIsNone(self.leases.take("net"))
+
+    def test_take_hands_out_in_order_until_exhausted(self):
+        self.leases.grant("net", "sub", 10, 12, 60)
+        self.assertEqual(("sub", 10), self.leases.take("net"))
+        self.assertEqual(("sub", 11), self.leases.take("net"))
+        self.assertEqual(("sub", 12), self.leases.take("net"))
+        self.assertIsNone(self.leases.take("net"))
+        self.assertEqual([], self.leases.drain())
+
+    def test_grant_empty_block_is_ignored(self):
+        self.leases.grant("net", "sub", 10, 9, 60)
+        self.assertIsNone(self.leases.take("net"))
+
+    def test_expired_lease_is_reaped(self):
+        with mock.patch("quark.ipam_leases.time.time") as now:
+            now.return_value = 100
+            self.leases.grant("net", "sub", 10, 19, 60)
+            self.assertEqual(("sub", 10), self.leases.take("net"))
+            now.return_value = 161
+            self.assertIsNone(self.leases.take("net"))
+        expired = self.leases.reap()
+        self.assertEqual(1, len(expired))
+        self.assertEqual(range(11, 20), expired[0].remaining())
+        self.assertEqual([], self.leases.reap())
+
+    def test_regrant_keeps_previous_leftovers(self):
+        self.leases.grant("net", "sub", 10, 19, 60)
+        self.leases.grant("net", "sub", 20, 29, 60)
+        self.assertEqual(("sub", 20), self.leases.take("net"))
+        self.assertEqual(range(10, 20), self.leases.reap()[0].remaining())
+
+    def test_drain_returns_outstanding(self):
+        self.leases.grant("net1", "sub1", 10, 19, 60)
+        self.leases.grant("net2", "sub2", 30, 30, 60)
+        self.leases.take("net2")
+        drained = self.leases.drain()
+        self.assertEqual(1, len(drained))
+        self.assertEqual("sub1", drained[0].resource_id)
+        self.assertIsNone(self.leases.take("net1"))
+
+    def test_release(self):
+        self.leases.grant("net", "sub", 10, 19, 60)
+        self.assertEqual(("sub", 10), self.leases.take("net"))
+        leftovers = self.leases.release("net", "sub", 10)
+        self.assertEqual([range(11, 20), [10]],
+                         [lease.remaining() for lease in leftovers])
+        self.assertIsNone(self.leases.take("net"))
+        self.assertEqual([], self.leases.drain())
+
+    def test_release_exhausted(self):
+        self.leases.grant("net", "sub", 10, 10, 60)
+        self.leases.take("net")
+        leftovers = self.leases.release("net", "sub", 10)
+        self.assertEqual([[10]], [lease.remaining() for lease in leftovers])
+
+    def test_release_keeps_other_resource(self):
+        self.leases.grant("net", "sub2", 20, 29, 60)
+        leftovers = self.leases.release("net", "sub1", 10)
+        self.assertEqual([[10]], [lease.remaining() for lease in leftovers])
+        self.assertEqual(("sub2", 20), self.leases.take("net"))
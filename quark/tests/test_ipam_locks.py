@@ -0,0 +1,195 @@
+# Copyright (c) 2015 OpenStack Foundation
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import contextlib
+import shutil
+import tempfile
+
+import mock
+from oslo.config import cfg
+
+from quark import exceptions as q_exc
+from quark import ipam_locks
+from quark import ipam_metrics
+from quark.tests import test_base
+
+
+class RecordingLockProvider(object):
+    def __init__(self):
+        self.held = []
+        self.names = []
+
+    @contextlib.contextmanager
+    def lock(self, name):
+        self.names.append(name)
+        self.held.append(name)
+        try:
+            yield
+        finally:
+            self.held.remove(name)
+
+
+class Allocator(object):
+    def __init__(self):
+        self.held = None
+
+    @ipam_locks.synchronized("select_subnet")
+    def select_subnet(self, context, net_id, ip_address=None):
+        self.held = list(ipam_locks.get_provider().held)
+        return net_id, ip_address
+
+    @ipam_locks.synchronized("allocate_mac_address", per_network=False)
+    def allocate_mac_address(self, context, net_id):
+        self.held = list(ipam_locks.get_provider().held)
+
+
+class TestLoadProvider(test_base.TestBase):
+    def tearDown(self):
+        super(TestLoadProvider, self).tearDown()
+        cfg.CONF.clear_override("ipam_use_synchronization", "QUARK")
+        ipam_locks.reset_provider()
+
+    def test_no_provider(self):
+        self.assertIsInstance(ipam_locks.load_provider(""),
+                              ipam_locks.NoLockProvider)
+
+    def test_deprecated_synchronization(self):
+        cfg.CONF.set_override("ipam_use_synchronization", True, "QUARK")
+        self.assertIsInstance(ipam_locks.load_provider(""),
+                              ipam_locks.LocalLockProvider)
+
+    def test_named_providers(self):
+        self.assertIsInstance(ipam_locks.load_provider("local"),
+                              ipam_locks.LocalLockProvider)
+        self.assertIsInstance(ipam_locks.load_provider("file"),
+                              ipam_locks.FileLockProvider)
+        self.assertIsInstance(ipam_locks.load_provider("db"),
+                              ipam_locks.DbLockProvider)
+
+    def test_imported_provider(self):
+        provider = ipam_locks.load_provider(
+            "quark.tests.test_ipam_locks.RecordingLockProvider")
+        self.assertIsInstance(provider, RecordingLockProvider)
+
+    def test_provider_loaded_once(self):
+        self.assertIs(ipam_locks.get_provider(), ipam_locks.get_provider())
+
+
+class TestSynchronized(test_base.TestBase):
+    def setUp(self):
+        super(TestSynchronized, self).setUp()
+        self.provider = RecordingLockProvider()
+        patcher = mock.patch("quark.ipam_locks._provider", self.provider)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.metrics = ipam_metrics.IpamMetrics(sink=None)
+        patcher = mock.patch("quark.ipam_metrics.METRICS", self.metrics)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_locks_per_network(self):
+        allocator = Allocator()
+        self.assertEqual(("net1", "1.1.1.1"),
+                         allocator.select_subnet(None, "net1", "1.1.1.1"))
+        self.assertEqual(["quark.ipam_locks.select_subnet.net1"],
+                         allocator.held)
+        allocator.select_subnet(None, "net2")
+        self.assertEqual(["quark.ipam_locks.select_subnet.net2"],
+                         allocator.held)
+        self.assertEqual([], self.provider.held)
+
+    def test_locks_across_networks(self):
+        allocator = Allocator()
+        for net_id in ("net1", "net2"):
+            allocator.allocate_mac_address(None, net_id)
+            self.assertEqual(["quark.ipam_locks.allocate_mac_address.all"],
+                             allocator.held)
+
+    def test_lock_wait_timed(self):
+        Allocator().select_subnet(None, "net1")
+        Allocator().select_subnet(None, "net2")
+        self.assertEqual(
+            2, self.metrics.histograms["lock_wait.select_subnet"].count)
+
+    def test_lock_timeout_counted(self):
+        def _timeout(name):
+            raise q_exc.IpamLockTimeout(name=name, timeout=1)
+
+        self.provider.lock = _timeout
+        self.assertRaises(q_exc.IpamLockTimeout,
+                          Allocator().select_subnet, None, "net1")
+        self.assertEqual(
+            1, self.metrics.counters["lock_timeout.select_subnet"])
+
+    def test_no_provider_skips_metrics(self):
+        with mock.patch("quark.ipam_locks._provider",
+                        ipam_locks.NoLockProvider()):
+            with ipam_locks.lock("select_subnet", "net1"):
+                pass
+        self.assertEqual({}, self.metrics.histograms)
+
+
+class TestFileLockProvider(test_base.TestBase):
+    def setUp(self):
+        super(TestFileLockProvider, self).setUp()
+        self.lock_path = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.lock_path)
+
+    def test_lock(self):
+        provider = ipam_locks.FileLockProvider(lock_path=self.lock_path)
+        with provider.lock("quark.ipam_locks.select_subnet.net1"):
+            with provider.lock("quark.ipam_locks.select_subnet.net2"):
+                pass
+
+
+class TestDbLockProvider(test_base.TestBase):
+    def _provider(self, acquired):
+        engine = mock.MagicMock()
+        connection = engine.connect.return_value
+        connection.execute.return_value.scalar.return_value = acquired
+        return ipam_locks.DbLockProvider(engine=engine, timeout=5), connection
+
+    def test_lock_name_fits_mysql(self):
+        name = ipam_locks.DbLockProvider._lock_name(
+            "quark.ipam_locks.select_subnet.%s" % ("x" * 36))
+        self.assertTrue(len(name) <= 64)
+
+    def test_lock_released(self):
+        provider, connection = self._provider(1)
+        with provider.lock("net1"):
+            self.assertEqual(1, connection.execute.call_count)
+        self.assertEqual(2, connection.execute.call_count)
+        lock_name = provider._lock_name("net1")
+        self.assertEqual({"name": lock_name, "timeout": 5},
+                         connection.execute.call_args_list[0][1])
+        self.assertEqual({"name": lock_name},
+                         connection.execute.call_args_list[1][1])
+        connection.close.assert_called_once_with()
+
+    def test_lock_released_on_error(self):
+        provider, connection = self._provider(1)
+        with self.assertRaises(ValueError):
+            with provider.lock("net1"):
+                raise ValueError()
+        self.assertEqual(2, connection.execute.call_count)
+        connection.close.assert_called_once_with()
+
+    def test_lock_timeout(self):
+        provider, connection = self._provider(0)
+        with self.assertRaises(q_exc.IpamLockTimeout):
+            with provider.lock("net1"):
+                pass
+        self.assertEqual(1, connection.execute.call_count)
+        connection.close.assert_called_once_with()
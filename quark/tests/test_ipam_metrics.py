@@ -0,0 +1,128 @@
+# Copyright (c) 2015 OpenStack Foundation
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os
+import shutil
+import tempfile
+
+import mock
+from oslo.config import cfg
+
+from quark import ipam_metrics
+from quark.tests import test_base
+
+
+class TestHistogram(test_base.TestBase):
+    def test_observe(self):
+        hist = ipam_metrics.Histogram()
+        for ms in (0.5, 3, 3, 40, 20000):
+            hist.observe(ms)
+        self.assertEqual(5, hist.count)
+        self.assertEqual(20046.5, hist.total)
+        self.assertEqual(20000, hist.max)
+        self.assertEqual(1, hist.buckets[0])
+        self.assertEqual(2, hist.buckets[2])
+        self.assertEqual(1, hist.buckets[-1])
+
+    def test_percentile(self):
+        hist = ipam_metrics.Histogram()
+        self.assertEqual(0.0, hist.percentile(50))
+        for ms in [3] * 98 + [40, 20000]:
+            hist.observe(ms)
+        self.assertEqual(5.0, hist.percentile(50))
+        self.assertEqual(50.0, hist.percentile(99))
+        self.assertEqual(20000, hist.percentile(100))
+
+    def test_percentile_capped_by_max(self):
+        hist = ipam_metrics.Histogram()
+        hist.observe(3)
+        self.assertEqual(3.0, hist.percentile(99))
+
+
+class TestIpamMetrics(test_base.TestBase):
+    def test_aggregates_without_sink(self):
+        metrics = ipam_metrics.IpamMetrics(sink=None)
+        metrics.timing("ANY.create", 0.002)
+        metrics.timing("ANY.create", 0.004)
+        metrics.incr("ANY.create.retries", 2)
+        metrics.incr("ANY.create.retries", 0)
+        metrics.incr("ANY.success")
+        self.assertEqual(2, metrics.histograms["ANY.create"].count)
+        self.assertEqual({"ANY.create.retries": 2, "ANY.success": 1},
+                         metrics.counters)
+        text = metrics.render_text()
+        self.assertIn("ANY.create count=2 sum_ms=6.000", text)
+        self.assertIn("ANY.create.retries 2\n", text)
+        metrics.reset()
+        self.assertEqual({}, metrics.counters)
+
+    def test_forwards_to_sink(self):
+        sink = mock.Mock()
+        metrics = ipam_metrics.IpamMetrics(sink=sink)
+        metrics.timing("ANY.create", 0.5)
+        metrics.incr("ANY.failure")
+        sink.timing.assert_called_once_with("ANY.create", 500.0)
+        sink.incr.assert_called_once_with("ANY.failure", 1)
+
+    def test_maybe_flush_waits_for_interval(self):
+        cfg.CONF.set_override("ipam_metrics_flush_interval", 60, "QUARK")
+        self.addCleanup(cfg.CONF.clear_override,
+                        "ipam_metrics_flush_interval", "QUARK")
+        sink = mock.Mock()
+        metrics = ipam_metrics.IpamMetrics(sink=sink)
+        metrics.maybe_flush()
+        self.assertFalse(sink.flush.called)
+        metrics._flushed_at -= 61
+        metrics.maybe_flush()
+        sink.flush.assert_called_once_with(metrics)
+
+    def test_sink_loaded_from_config(self):
+        cfg.CONF.set_override("ipam_metrics_sink", "text", "QUARK")
+        self.addCleanup(cfg.CONF.clear_override, "ipam_metrics_sink",
+                        "QUARK")
+        metrics = ipam_metrics.IpamMetrics()
+        self.assertIsInstance(metrics.sink, ipam_metrics.TextFileSink)
+
+    def test_no_sink_by_default(self):
+        self.assertIsNone(ipam_metrics.IpamMetrics().sink)
+
+
+class TestSinks(test_base.TestBase):
+    def test_load_sink_by_class_path(self):
+        sink = ipam_metrics.load_sink("quark.ipam_metrics.TextFileSink")
+        self.assertIsInstance(sink, ipam_metrics.TextFileSink)
+
+    def test_statsd_sink(self):
+        with mock.patch("socket.socket") as sock:
+            sink = ipam_metrics.StatsdSink("localhost", 8125, "quark.ipam")
+            sink.timing("ANY.create", 1.5)
+            sink.incr("ANY.failure", 2)
+        send = sock.return_value.sendto
+        self.assertEqual(
+            [mock.call("quark.ipam.ANY.create:1.500|ms",
+                       ("localhost", 8125)),
+             mock.call("quark.ipam.ANY.failure:2|c", ("localhost", 8125))],
+            send.call_args_list)
+
+    def test_text_file_sink(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        path = os.path.join(directory, "metrics.txt")
+        metrics = ipam_metrics.IpamMetrics(sink=None)
+        metrics.incr("ANY.success")
+        ipam_metrics.TextFileSink(path).flush(metrics)
+        with open(path) as f:
+            self.assertEqual("ANY.success 1\n", f.read())
+        self.assertEqual(["metrics.txt"], os.listdir(directory))
@@ -0,0 +1,134 @@
+# Copyright (c) 2015 OpenStack Foundation
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import contextlib
+
+import mock
+from oslo.config import cfg
+
+from quark.db import models
+from quark import ipam_notifications
+from quark.tests import test_base
+
+
+def _payload(ip):
+    return dict(ip_address=ip)
+
+
+class TestAddressPayload(test_base.TestBase):
+    def _address(self):
+        address = models.IPAddress()
+        address.update(dict(used_by_tenant_id=1, subnet_id=2,
+                            address_readable="1.1.1.1", created_at="123"))
+        return address
+
+    def test_payload_skips_unloaded_ports(self):
+        payload = ipam_notifications.address_payload(self._address(),
+                                                     deleted_at="456")
+        self.assertEqual(dict(used_by_tenant_id=1, ip_block_id=2,
+                              ip_address="1.1.1.1", device_ids=[],
+                              created_at="123", deleted_at="456"), payload)
+
+    def test_payload_uses_loaded_ports(self):
+        address = self._address()
+        address["ports"] = [models.Port(device_id="foo")]
+        payload = ipam_notifications.address_payload(address)
+        self.assertEqual(["foo"], payload["device_ids"])
+
+
+class TestNotificationQueue(test_base.TestBase):
+    @contextlib.contextmanager
+    def _stubs(self):
+        with contextlib.nested(
+            mock.patch("neutron.common.rpc.get_notifier"),
+            mock.patch("eventlet.greenthread.spawn")
+        ) as (get_notifier, spawn):
+            yield get_notifier.return_value, spawn
+
+    def test_put_starts_one_flusher(self):
+        notifications = ipam_notifications.NotificationQueue(maxsize=10)
+        with self._stubs() as (notifier, spawn):
+            spawn.return_value.dead = False
+            notifications.put("ctx", "ip_block.address.create",
+                              _payload("1.1.1.1"))
+            notifications.put("ctx", "ip_block.address.create",
+                              _payload("1.1.1.2"))
+            self.assertEqual(1, spawn.call_count)
+            self.assertFalse(notifier.info.called)
+
+    def test_flush_sends_batches(self):
+        notifications = ipam_notifications.NotificationQueue(maxsize=10,
+                                                             batch_size=2)
+        with self._stubs() as (notifier, spawn):
+            for i in xrange(5):
+                notifications.put("ctx", "ip_block.address.create",
+                                  _payload("1.1.1.%d" % i))
+            self.assertEqual(2, len(notifications._take()))
+            self.assertEqual(3, notifications.flush())
+            self.assertEqual(0, notifications.flush())
+        self.assertEqual(
+            [mock.call("ctx", "ip_block.address.create",
+                       _payload("1.1.1.%d" % i)) for i in xrange(2, 5)],
+            notifier.info.call_args_list)
+
+    def test_overflow_dropped_and_counted(self):
+        notifications = ipam_notifications.NotificationQueue(maxsize=2)
+        with contextlib.nested(
+            mock.patch("eventlet.greenthread.spawn"),
+            mock.patch("quark.ipam_metrics.METRICS")
+        ) as (spawn, metrics):
+            for i in xrange(3):
+                notifications.put("ctx", "ip_block.address.delete",
+                                  _payload("1.1.1.%d" % i))
+        self.assertEqual(1, notifications.dropped)
+        metrics.incr.assert_called_once_with("notifications.dropped")
+
+    def test_send_survives_notifier_errors(self):
+        notifications = ipam_notifications.NotificationQueue(maxsize=10)
+        with self._stubs() as (notifier, spawn):
+            notifier.info.side_effect = [Exception("boom"), None]
+            notifications.put("ctx", "ip_block.address.create",
+                              _payload("1.1.1.1"))
+            notifications.put("ctx", "ip_block.address.create",
+                              _payload("1.1.1.2"))
+            self.assertEqual(2, notifications.flush())
+        self.assertEqual(2, notifier.info.call_count)
+
+
+class TestNotify(test_base.TestBase):
+    def test_notify_inline_by_default(self):
+        with contextlib.nested(
+            mock.patch("neutron.common.rpc.get_notifier"),
+            mock.patch("quark.ipam_notifications.NOTIFICATIONS")
+        ) as (get_notifier, notifications):
+            ipam_notifications.notify("ctx", "ip_block.address.create",
+                                      _payload("1.1.1.1"))
+        get_notifier.return_value.info.assert_called_once_with(
+            "ctx", "ip_block.address.create", _payload("1.1.1.1"))
+        self.assertFalse(notifications.put.called)
+
+    def test_notify_async_queues(self):
+        cfg.CONF.set_override("ipam_async_notifications", True, "QUARK")
+        self.addCleanup(cfg.CONF.clear_override, "ipam_async_notifications",
+                        "QUARK")
+        with contextlib.nested(
+            mock.patch("neutron.common.rpc.get_notifier"),
+            mock.patch("quark.ipam_notifications.NOTIFICATIONS")
+        ) as (get_notifier, notifications):
+            ipam_notifications.notify("ctx", "ip_block.address.create",
+                                      _payload("1.1.1.1"))
+        self.assertFalse(get_notifier.called)
+        notifications.put.assert_called_once_with(
+            "ctx", "ip_block.address.create", _payload("1.1.1.1"))
@@ -842,3 +842,99 @@ class Test4fc07b41d45c(BaseMigrationTest):
                 self.ip_addresses_table.c.id)).fetchall()
         expected_results = []
         self.assertEqual(results, expected_results)
+
+
+class Test59b03336714d(BaseMigrationTest):
+    def setUp(self):
+        super(Test59b03336714d, self).setUp()
+        self.previous_revision = "356d6c0623c8"
+        self.current_revision = "59b03336714d"
+        self.metadata = sa.MetaData(bind=self.engine)
+        self.subnets_table = sa.Table(
+            'quark_subnets', self.metadata,
+            sa.Column('id', sa.String(length=36), primary_key=True),
+            sa.Column('network_id', sa.String(length=36)),
+            sa.Column('ip_version', sa.Integer()))
+        self.ip_addresses_table = sa.Table(
+            'quark_ip_addresses', self.metadata,
+            sa.Column('id', sa.String(length=36), primary_key=True),
+            sa.Column('subnet_id', sa.String(length=36)),
+            sa.Column('_deallocated', sa.Boolean()))
+        self.metadata.create_all()
+        alembic_command.stamp(self.config, self.previous_revision)
+
+    def _counts(self):
+        subnets = table('quark_subnets',
+                        column('id', sa.String(length=36)),
+                        column('allocated_count', sa.BigInteger()),
+                        column('deallocated_reusable_count', sa.BigInteger()))
+        return self.connection.execute(
+            select([subnets]).order_by(subnets.c.id)).fetchall()
+
+    def test_upgrade_empty(self):
+        alembic_command.upgrade(self.config, self.current_revision)
+        self.assertEqual(self._counts(), [])
+
+    def test_upgrade(self):
+        self.connection.execute(self.subnets_table.insert(), [
+            dict(id="1", network_id="n", ip_version=4),
+            dict(id="2", network_id="n", ip_version=4)])
+        self.connection.execute(self.ip_addresses_table.insert(), [
+            dict(id="1", subnet_id="1", _deallocated=False),
+            dict(id="2", subnet_id="1", _deallocated=None),
+            dict(id="3", subnet_id="1", _deallocated=True),
+            dict(id="4", subnet_id="2", _deallocated=True)])
+        alembic_command.upgrade(self.config, self.current_revision)
+        self.assertEqual(self._counts(), [(u'1', 2, 1), (u'2', 0, 1)])
+
+    def test_upgrade_skips_v6(self):
+        self.connection.execute(self.subnets_table.insert(), [
+            dict(id="1", network_id="n", ip_version=6)])
+        self.connection.execute(self.ip_addresses_table.insert(), [
+            dict(id="1", subnet_id="1", _deallocated=False),
+            dict(id="2", subnet_id="1", _deallocated=True)])
+        alembic_command.upgrade(self.config, self.current_revision)
+        self.assertEqual(self._counts(), [(u'1', 0, 0)])
+
+
+class Test3a47813ce501(BaseMigrationTest):
+    def setUp(self):
+        super(Test3a47813ce501, self).setUp()
+        self.previous_revision = "2e9cf60b0ef6"
+        self.current_revision = "3a47813ce501"
+        self.metadata = sa.MetaData(bind=self.engine)
+        self.mac_ranges_table = sa.Table(
+            'quark_mac_address_ranges', self.metadata,
+            sa.Column('id', sa.String(length=36), primary_key=True),
+            sa.Column('do_not_use', sa.Boolean()))
+        self.macs_table = sa.Table(
+            'quark_mac_addresses', self.metadata,
+            sa.Column('address', sa.BigInteger(), primary_key=True),
+            sa.Column('mac_address_range_id', sa.String(length=36)),
+            sa.Column('deallocated', sa.Boolean()))
+        self.metadata.create_all()
+        alembic_command.stamp(self.config, self.previous_revision)
+
+    def _counts(self):
+        mac_ranges = table('quark_mac_address_ranges',
+                           column('id', sa.String(length=36)),
+                           column('allocated_count', sa.BigInteger()),
+                           column('deallocated_count', sa.BigInteger()))
+        return self.connection.execute(
+            select([mac_ranges]).order_by(mac_ranges.c.id)).fetchall()
+
+    def test_upgrade_empty(self):
+        alembic_command.upgrade(self.config, self.current_revision)
+        self.assertEqual(self._counts(), [])
+
+    def test_upgrade(self):
+        self.connection.execute(self.mac_ranges_table.insert(), [
+            dict(id="1", do_not_use=False),
+            dict(id="2", do_not_use=False)])
+        self.connection.execute(self.macs_table.insert(), [
+            dict(address=1, mac_address_range_id="1", deallocated=False),
+            dict(address=2, mac_address_range_id="1", deallocated=None),
+            dict(address=3, mac_address_range_id="1", deallocated=True),
+            dict(address=4, mac_address_range_id="2", deallocated=True)])
+        alembic_command.upgrade(self.config, self.current_revision)
+        self.assertEqual(self._counts(), [(u'1', 2, 1), (u'2', 0, 1)])
@@ -47,3 +47,18 @@ class TestQuarkAPIExtensions(TestQuarkPlugin):
             conf.set_override.assert_called_once_with(
                 "api_extensions_path",
                 "apple:banana:carrot")
+
+
+class TestQuarkNativeBulk(TestQuarkPlugin):
+    def test_every_bulk_resource_has_a_bulk_create(self):
+        for resource in ("network", "subnet", "port", "security_group",
+                         "security_group_rule", "router", "floatingip"):
+            self.assertTrue(hasattr(self.plugin, "create_%s_bulk" % resource))
+
+    def test_create_router_bulk_creates_each(self):
+        body = {"routers": [{"router": {}}, {"router": {}}]}
+        with mock.patch.object(self.plugin, "create_router") as create:
+            create.side_effect = [dict(id=1), dict(id=2)]
+            routers = self.plugin.create_router_bulk(self.context, body)
+        self.assertEqual([dict(id=1), dict(id=2)], routers)
+        self.assertEqual(2, create.call_count)
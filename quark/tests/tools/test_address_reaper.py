@@ -0,0 +1,146 @@
+# Copyright 2015 Rackspace Hosting
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+
+import contextlib
+
+import mock
+import netaddr
+
+from quark.tests import test_base
+from quark.tools import address_reaper
+
+TOOL_MOD = "quark.tools.address_reaper.QuarkAddressReaperTool"
+
+
+def reaper_tool(args=None):
+    args = args or {}
+    return address_reaper.QuarkAddressReaperTool(args)
+
+
+def _ip(address):
+    return netaddr.IPAddress(address).ipv6().value
+
+
+class QuarkAddressReaperToolBase(test_base.TestBase):
+    def setUp(self):
+        super(QuarkAddressReaperToolBase, self).setUp()
+        neutron_cfg_patch = mock.patch("neutron.common.config.init")
+        oslo_cfg_patch = mock.patch("oslo.config.cfg.CONF")
+        neutron_cfg_patch.start()
+        oslo_cfg_patch.start()
+        self.addCleanup(neutron_cfg_patch.stop)
+        self.addCleanup(oslo_cfg_patch.stop)
+
+
+class QuarkAddressReaperToolTestDispatch(QuarkAddressReaperToolBase):
+    @mock.patch("%s.reap" % TOOL_MOD)
+    def test_dispatch_scan(self, reap):
+        reaper_tool({"<command>": "scan", "--yarly": True}).dispatch()
+        reap.assert_called_with(dryrun=True)
+
+    @mock.patch("%s.reap" % TOOL_MOD)
+    def test_dispatch_reap(self, reap):
+        reaper_tool({"<command>": "reap"}).dispatch()
+        reap.assert_called_with(True)
+
+    @mock.patch("%s.reap" % TOOL_MOD)
+    def test_dispatch_reap_yarly(self, reap):
+        reaper_tool({"<command>": "reap", "--yarly": True}).dispatch()
+        reap.assert_called_with(False)
+
+
+class QuarkAddressReaperToolReap(QuarkAddressReaperToolBase):
+    @contextlib.contextmanager
+    def _stubs(self, subnets, rows):
+        with contextlib.nested(
+            mock.patch("neutron.context.get_admin_context"),
+            mock.patch("quark.db.api.subnet_find"),
+            mock.patch("quark.db.api.ip_address_reap_candidates"),
+            mock.patch("quark.db.api.ip_address_reap"),
+            mock.patch("time.sleep")
+        ) as (get_admin_ctxt, subnet_find, candidates, reap, sleep):
+            subnet_find.return_value = subnets
+
+            def _candidates(ctx, subnet_id, limit, marker=None):
+                subnet_rows = rows.get(subnet_id, [])
+                if marker:
+                    subnet_rows = [r for r in subnet_rows if r[0] > marker]
+                return subnet_rows[:limit]
+
+            candidates.side_effect = _candidates
+            reap.side_effect = lambda ctx, subnet_id, ids, ip_version: len(ids)
+            yield candidates, reap, sleep
+
+    def _subnet(self, id, cidr="192.168.0.0/24", do_not_use=False,
+                exclude=None):
+        policy = None
+        if exclude:
+            policy = dict(exclude=[dict(cidr=c, first_ip=None, last_ip=None)
+                                   for c in exclude])
+        return dict(id=id, cidr=cidr, do_not_use=do_not_use,
+                    ip_policy=policy, ip_version=4)
+
+    def test_reap_nothing_reapable(self):
+        subnets = [self._subnet(1)]
+        rows = {1: [("a", _ip("192.168.0.10")), ("b", _ip("192.168.0.11"))]}
+        with self._stubs(subnets, rows) as (candidates, reap, sleep):
+            self.assertEqual(0, reaper_tool().reap())
+        self.assertFalse(reap.called)
+
+    def test_reap_policy_and_outside_cidr(self):
+        subnets = [self._subnet(1, exclude=["192.168.0.0/30"])]
+        rows = {1: [("a", _ip("192.168.0.1")), ("b", _ip("192.168.0.10")),
+                    ("c", _ip("10.0.0.1"))]}
+        with self._stubs(subnets, rows) as (candidates, reap, sleep):
+            self.assertEqual(2, reaper_tool().reap())
+        reap.assert_called_once_with(mock.ANY, 1, ["a", "c"], ip_version=4)
+
+    def test_reap_do_not_use_subnet(self):
+        subnets = [self._subnet(1, do_not_use=True)]
+        rows = {1: [("a", _ip("192.168.0.10")), ("b", _ip("192.168.0.11"))]}
+        with self._stubs(subnets, rows) as (candidates, reap, sleep):
+            self.assertEqual(2, reaper_tool().reap())
+        reap.assert_called_once_with(mock.ANY, 1, ["a", "b"], ip_version=4)
+
+    def test_reap_dry_run(self):
+        subnets = [self._subnet(1, do_not_use=True)]
+        rows = {1: [("a", _ip("192.168.0.10"))]}
+        with self._stubs(subnets, rows) as (candidates, reap, sleep):
+            self.assertEqual(0, reaper_tool().reap(dryrun=True))
+        self.assertFalse(reap.called)
+
+    def test_reap_batches(self):
+        subnets = [self._subnet(1, do_not_use=True)]
+        rows = {1: [(str(i), _ip("192.168.0.%d" % i)) for i in range(1, 6)]}
+        args = {"--batch": "2", "--delay": "0.5"}
+        with self._stubs(subnets, rows) as (candidates, reap, sleep):
+            self.assertEqual(5, reaper_tool(args).reap())
+        self.assertEqual([mock.call(mock.ANY, 1, ["1", "2"], ip_version=4),
+                          mock.call(mock.ANY, 1, ["3", "4"], ip_version=4),
+                          mock.call(mock.ANY, 1, ["5"], ip_version=4)],
+                         reap.call_args_list)
+        self.assertEqual([None, "2", "4"],
+                         [c[1]["marker"] for c in candidates.call_args_list])
+        self.assertEqual(2, sleep.call_count)
+        sleep.assert_called_with(0.5)
+
+    def test_reap_one_subnet(self):
+        subnets = [self._subnet(1, do_not_use=True)]
+        with self._stubs(subnets, {}) as (candidates, reap, sleep):
+            reaper_tool({"--subnet": "1"}).reap()
+            subnet_find = address_reaper.db_api.subnet_find
+            subnet_find.assert_called_once_with(mock.ANY, id="1",
+                                                scope=mock.ANY)
@@ -0,0 +1,149 @@
+# Copyright 2015 Rackspace Hosting
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+
+import contextlib
+
+import mock
+
+from quark.tests import test_base
+from quark.tools import allocation_counts
+
+TOOL_MOD = "quark.tools.allocation_counts.QuarkAllocationCountsTool"
+
+
+def counts_tool(args=None):
+    args = args or {}
+    return allocation_counts.QuarkAllocationCountsTool(args)
+
+
+class QuarkAllocationCountsToolBase(test_base.TestBase):
+    def setUp(self):
+        super(QuarkAllocationCountsToolBase, self).setUp()
+        neutron_cfg_patch = mock.patch("neutron.common.config.init")
+        oslo_cfg_patch = mock.patch("oslo.config.cfg.CONF")
+        neutron_cfg_patch.start()
+        oslo_cfg_patch.start()
+        self.addCleanup(neutron_cfg_patch.stop)
+        self.addCleanup(oslo_cfg_patch.stop)
+
+
+class QuarkAllocationCountsToolTestDispatch(QuarkAllocationCountsToolBase):
+    @mock.patch("%s.verify_subnets" % TOOL_MOD)
+    def test_dispatch_verify_subnets(self, verify):
+        counts_tool({"<command>": "verify-subnets"}).dispatch()
+        verify.assert_called_with()
+
+    @mock.patch("%s.repair_subnets" % TOOL_MOD)
+    def test_dispatch_repair_subnets(self, repair):
+        counts_tool({"<command>": "repair-subnets"}).dispatch()
+        repair.assert_called_with(True)
+
+    @mock.patch("%s.repair_subnets" % TOOL_MOD)
+    def test_dispatch_repair_subnets_yarly(self, repair):
+        counts_tool({"<command>": "repair-subnets",
+                     "--yarly": True}).dispatch()
+        repair.assert_called_with(False)
+
+    @mock.patch("%s.verify_mac_ranges" % TOOL_MOD)
+    def test_dispatch_verify_mac_ranges(self, verify):
+        counts_tool({"<command>": "verify-mac-ranges"}).dispatch()
+        verify.assert_called_with()
+
+    @mock.patch("%s.repair_mac_ranges" % TOOL_MOD)
+    def test_dispatch_repair_mac_ranges_yarly(self, repair):
+        counts_tool({"<command>": "repair-mac-ranges",
+                     "--yarly": True}).dispatch()
+        repair.assert_called_with(False)
+
+
+class QuarkAllocationCountsToolSubnets(QuarkAllocationCountsToolBase):
+    @contextlib.contextmanager
+    def _stubs(self, subnets, counts):
+        with contextlib.nested(
+            mock.patch("neutron.context.get_admin_context"),
+            mock.patch("quark.db.api.subnet_find"),
+            mock.patch("quark.db.api.subnet_count_ips"),
+            mock.patch("quark.db.api.subnet_repair_ip_counts")
+        ) as (get_admin_ctxt, subnet_find, count_ips, repair):
+            subnet_find.return_value = subnets
+            count_ips.return_value = counts
+            yield repair
+
+    def _subnet(self, id, allocated, deallocated, ip_version=4):
+        return dict(id=id, ip_version=ip_version, allocated_count=allocated,
+                    deallocated_reusable_count=deallocated)
+
+    def test_verify_subnets(self):
+        subnets = [self._subnet(1, 2, 1), self._subnet(2, 0, 0),
+                   self._subnet(3, 5, 0)]
+        counts = {1: (2, 1), 3: (4, 1)}
+        with self._stubs(subnets, counts):
+            drifted = counts_tool().verify_subnets()
+        self.assertEqual([(3, (5, 0), (4, 1))], drifted)
+
+    def test_verify_subnets_skips_v6(self):
+        subnets = [self._subnet(1, 0, 0, ip_version=6)]
+        with self._stubs(subnets, {1: (4, 1)}):
+            drifted = counts_tool().verify_subnets()
+        self.assertEqual([], drifted)
+
+    def test_repair_subnets_dry_run(self):
+        subnets = [self._subnet(1, 3, 0)]
+        with self._stubs(subnets, {}) as repair:
+            counts_tool().repair_subnets(dryrun=True)
+        self.assertFalse(repair.called)
+
+    def test_repair_subnets(self):
+        subnets = [self._subnet(1, 3, 0), self._subnet(2, 1, 1)]
+        with self._stubs(subnets, {2: (1, 1)}) as repair:
+            counts_tool().repair_subnets(dryrun=False)
+        self.assertEqual(1, repair.call_count)
+        self.assertEqual(1, repair.call_args[0][1])
+
+
+class QuarkAllocationCountsToolMacRanges(QuarkAllocationCountsToolBase):
+    @contextlib.contextmanager
+    def _stubs(self, mac_ranges, counts):
+        with contextlib.nested(
+            mock.patch("neutron.context.get_admin_context"),
+            mock.patch("quark.db.api.mac_address_range_find"),
+            mock.patch("quark.db.api.mac_range_count_macs"),
+            mock.patch("quark.db.api.mac_range_repair_counts")
+        ) as (get_admin_ctxt, range_find, count_macs, repair):
+            range_find.return_value = mac_ranges
+            count_macs.return_value = counts
+            yield repair
+
+    def test_verify_mac_ranges(self):
+        mac_ranges = [dict(id=1, allocated_count=2, deallocated_count=1),
+                      dict(id=2, allocated_count=1, deallocated_count=0)]
+        with self._stubs(mac_ranges, {1: (2, 1)}):
+            drifted = counts_tool().verify_mac_ranges()
+        self.assertEqual([(2, (1, 0), (0, 0))], drifted)
+
+    def test_repair_mac_ranges_dry_run(self):
+        mac_ranges = [dict(id=1, allocated_count=3, deallocated_count=0)]
+        with self._stubs(mac_ranges, {}) as repair:
+            counts_tool().repair_mac_ranges(dryrun=True)
+        self.assertFalse(repair.called)
+
+    def test_repair_mac_ranges(self):
+        mac_ranges = [dict(id=1, allocated_count=3, deallocated_count=0),
+                      dict(id=2, allocated_count=1, deallocated_count=1)]
+        with self._stubs(mac_ranges, {2: (1, 1)}) as repair:
+            counts_tool().repair_mac_ranges(dryrun=False)
+        self.assertEqual(1, repair.call_count)
+        self.assertEqual(1, repair.call_args[0][1])
@@ -0,0 +1,136 @@
+# Copyright 2015 Rackspace Hosting
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+
+import contextlib
+
+import mock
+from oslo.db import exception as db_exception
+
+from quark import ipam
+from quark import ipam_metrics
+from quark.tests import test_base
+from quark.tools import ipam_benchmark
+
+TOOL_MOD = "quark.tools.ipam_benchmark.QuarkIpamBenchmarkTool"
+
+
+def benchmark_tool(args=None):
+    args = args or {}
+    return ipam_benchmark.QuarkIpamBenchmarkTool(args)
+
+
+class QuarkIpamBenchmarkToolBase(test_base.TestBase):
+    def setUp(self):
+        super(QuarkIpamBenchmarkToolBase, self).setUp()
+        neutron_cfg_patch = mock.patch("neutron.common.config.init")
+        oslo_cfg_patch = mock.patch("oslo.config.cfg.CONF")
+        rpc_patch = mock.patch("neutron.common.rpc.init")
+        monkey_patch = mock.patch("eventlet.monkey_patch")
+        neutron_cfg_patch.start()
+        oslo_cfg_patch.start()
+        rpc_patch.start()
+        self.monkey_patch = monkey_patch.start()
+        self.addCleanup(neutron_cfg_patch.stop)
+        self.addCleanup(oslo_cfg_patch.stop)
+        self.addCleanup(rpc_patch.stop)
+        self.addCleanup(monkey_patch.stop)
+
+
+class QuarkIpamBenchmarkToolTestDispatch(QuarkIpamBenchmarkToolBase):
+    @mock.patch("%s.run" % TOOL_MOD)
+    def test_dispatch_run(self, run):
+        benchmark_tool({"<command>": "run"}).dispatch()
+        run.assert_called_with()
+
+    def test_options(self):
+        tool = benchmark_tool({"--strategies": "ANY,BOTH",
+                               "--workers": "4", "--prefix": "24"})
+        self.assertEqual(["ANY", "BOTH"], tool._strategies)
+        self.assertEqual(4, tool._workers)
+        self.assertEqual("10.0.1.0/24", str(tool._v4_cidr(1)))
+
+    def test_default_strategies_registered(self):
+        for name in benchmark_tool()._strategies:
+            self.assertTrue(ipam.IPAM_REGISTRY.is_valid_strategy(name))
+
+    def test_sqlite_not_monkey_patched(self):
+        benchmark_tool()
+        self.assertFalse(self.monkey_patch.called)
+        benchmark_tool({"--connection": "mysql://root@localhost/bench"})
+        self.monkey_patch.assert_called_once_with()
+
+
+class QuarkIpamBenchmarkToolRun(QuarkIpamBenchmarkToolBase):
+    def setUp(self):
+        super(QuarkIpamBenchmarkToolRun, self).setUp()
+        metrics = ipam_metrics.IpamMetrics(sink=None)
+        patcher = mock.patch("quark.ipam_metrics.METRICS", metrics)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_percentile(self):
+        samples = range(1, 101)
+        self.assertEqual(0.0, ipam_benchmark.percentile([], 50))
+        self.assertEqual(50, ipam_benchmark.percentile(samples, 50))
+        self.assertEqual(99, ipam_benchmark.percentile(samples, 99))
+        self.assertEqual(1, ipam_benchmark.percentile(samples, 0))
+
+    @contextlib.contextmanager
+    def _stubs(self, side_effects):
+        strategy = mock.Mock()
+        calls = iter(side_effects)
+
+        def _allocate(ctx, addresses, net_id, port_id, reuse_after,
+                      **kwargs):
+            effect = next(calls)
+            if isinstance(effect, Exception):
+                raise effect
+            ipam_metrics.METRICS.incr("ANY.try_allocate_ip_address.retries",
+                                      effect)
+            addresses.append(dict(address=1))
+
+        strategy.allocate_ip_address.side_effect = _allocate
+        with contextlib.nested(
+            mock.patch("neutron.context.Context"),
+            mock.patch.dict("quark.ipam.IPAM_REGISTRY.strategies",
+                            {"ANY": strategy})
+        ):
+            yield strategy
+
+    def test_run_strategy(self):
+        args = {"--workers": "1", "--allocations": "4"}
+        effects = [0, 2, db_exception.DBDeadlock(), ValueError()]
+        with self._stubs(effects) as strategy:
+            result = benchmark_tool(args).run_strategy("ANY", ["net"])
+        self.assertEqual(4, strategy.allocate_ip_address.call_count)
+        self.assertEqual("ANY", result["strategy"])
+        self.assertEqual(2, result["ports"])
+        self.assertEqual(2, result["addresses"])
+        self.assertEqual(2, result["retries"])
+        self.assertEqual(1, result["deadlocks"])
+        self.assertEqual(1, result["errors"])
+        for key in ("allocs_per_sec", "p50_ms", "p99_ms", "seconds"):
+            self.assertIn(key, result)
+
+    @mock.patch("%s.run_strategy" % TOOL_MOD)
+    @mock.patch("%s.seed" % TOOL_MOD)
+    def test_run_reseeds_per_strategy(self, seed, run_strategy):
+        seed.return_value = ["net"]
+        run_strategy.side_effect = lambda name, nets: dict(strategy=name)
+        with mock.patch("neutron.context.Context"):
+            results = benchmark_tool({"--strategies": "ANY,BOTH"}).run()
+        self.assertEqual(["ANY", "BOTH"], [r["strategy"] for r in results])
+        self.assertEqual(2, seed.call_count)
@@ -0,0 +1,97 @@
+# Copyright 2015 Rackspace Hosting
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+
+import contextlib
+
+import mock
+
+from quark.tests import test_base
+from quark.tools import transactions
+
+TOOL_MOD = "quark.tools.transactions.QuarkTransactionsTool"
+
+
+def transactions_tool(args=None):
+    args = args or {}
+    return transactions.QuarkTransactionsTool(args)
+
+
+class QuarkTransactionsToolBase(test_base.TestBase):
+    def setUp(self):
+        super(QuarkTransactionsToolBase, self).setUp()
+        neutron_cfg_patch = mock.patch("neutron.common.config.init")
+        oslo_cfg_patch = mock.patch("oslo.config.cfg.CONF")
+        neutron_cfg_patch.start()
+        oslo_cfg_patch.start()
+        self.addCleanup(neutron_cfg_patch.stop)
+        self.addCleanup(oslo_cfg_patch.stop)
+
+
+class QuarkTransactionsToolTestDispatch(QuarkTransactionsToolBase):
+    @mock.patch("%s.count" % TOOL_MOD)
+    def test_dispatch_count(self, count):
+        transactions_tool({"<command>": "count"}).dispatch()
+        count.assert_called_with()
+
+    @mock.patch("%s.prune" % TOOL_MOD)
+    def test_dispatch_prune(self, prune):
+        transactions_tool({"<command>": "prune"}).dispatch()
+        prune.assert_called_with(True)
+
+    @mock.patch("%s.prune" % TOOL_MOD)
+    def test_dispatch_prune_yarly(self, prune):
+        transactions_tool({"<command>": "prune", "--yarly": True}).dispatch()
+        prune.assert_called_with(False)
+
+
+class QuarkTransactionsToolPrune(QuarkTransactionsToolBase):
+    @contextlib.contextmanager
+    def _stubs(self, id_range):
+        with contextlib.nested(
+            mock.patch("neutron.context.get_admin_context"),
+            mock.patch("quark.db.api.transaction_id_range"),
+            mock.patch("quark.db.api.transaction_prune"),
+            mock.patch("time.sleep")
+        ) as (get_admin_ctxt, id_range_mock, prune, sleep):
+            id_range_mock.return_value = id_range
+            prune.side_effect = lambda ctx, first, last: last - first + 1
+            yield prune, sleep
+
+    def test_prune_empty(self):
+        with self._stubs((None, None)) as (prune, sleep):
+            self.assertEqual(0, transactions_tool().prune())
+        self.assertFalse(prune.called)
+
+    def test_prune_keeps_newest(self):
+        with self._stubs((1, 50)) as (prune, sleep):
+            self.assertEqual(0, transactions_tool({"--keep": "50"}).prune())
+        self.assertFalse(prune.called)
+
+    def test_prune_dry_run(self):
+        with self._stubs((1, 100)) as (prune, sleep):
+            transactions_tool({"--keep": "10"}).prune(dryrun=True)
+        self.assertFalse(prune.called)
+
+    def test_prune_batches(self):
+        args = {"--keep": "10", "--batch": "40", "--delay": "0.5"}
+        with self._stubs((1, 100)) as (prune, sleep):
+            self.assertEqual(90, transactions_tool(args).prune())
+        self.assertEqual([mock.call(mock.ANY, 1, 40),
+                          mock.call(mock.ANY, 41, 80),
+                          mock.call(mock.ANY, 81, 90)],
+                         prune.call_args_list)
+        self.assertEqual(2, sleep.call_count)
+        sleep.assert_called_with(0.5)
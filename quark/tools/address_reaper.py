@@ -0,0 +1,188 @@
+#!/usr/bin/python
+# Copyright 2015 Openstack Foundation
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+"""Quark address reaper CLI tool.
+
+Deletes deallocated rows from quark_ip_addresses that can never be
+reallocated: addresses excluded by their subnet's current IP policy,
+addresses outside their subnet's CIDR and every deallocated address of a
+do_not_use subnet. Otherwise they are only removed when a reallocation
+happens to claim them, and slow down every scan until then.
+
+Each subnet is walked --batch rows at a time. Every batch is deleted in
+its own transaction, with --delay seconds between batches, and the subnet
+counters are updated along with it. Rows reallocated or associated with a
+port in the meantime are skipped.
+
+Usage: address_reaper_tool [-h] [--config-file=PATH] [--batch=<batch>]
+                           [--delay=<delay>] [--subnet=<subnet>] <command>
+                           [--yarly]
+
+Options:
+    -h --help  Show this screen.
+    --version  Show version.
+    --config-file=PATH  Use a different config file path
+    --batch=<batch>  Number of deallocated addresses to examine at a time
+    --delay=<delay>  Seconds to wait between batches
+    --subnet=<subnet>  Only reap the subnet with this id
+
+Available commands are:
+    address_reaper_tool scan
+    address_reaper_tool reap [--yarly]
+    address_reaper_tool -h | --help
+    address_reaper_tool --version
+
+"""
+
+VERSION = 0.1
+BATCH = 1000
+DELAY = 0.1
+
+import sys
+import time
+
+import docopt
+import netaddr
+from neutron.common import config
+import neutron.context
+from oslo.config import cfg
+
+from quark.db import api as db_api
+from quark import ip_policy_index
+
+
+class QuarkAddressReaperTool(object):
+    def __init__(self, arguments):
+        self._args = arguments
+
+        self._batch = BATCH
+        self._delay = DELAY
+
+        if self._args.get("--batch"):
+            self._batch = int(self._args["--batch"])
+
+        if self._args.get("--delay"):
+            self._delay = float(self._args["--delay"])
+
+        self._subnet_id = self._args.get("--subnet")
+
+        config_args = []
+        if self._args.get("--config-file"):
+            config_args.append("--config-file=%s" %
+                               self._args.pop("--config-file"))
+
+        self._dryrun = not self._args.get("--yarly")
+
+        config.init(config_args)
+        if not cfg.CONF.config_file:
+            sys.exit(_("ERROR: Unable to find configuration file via the "
+                       "default search paths (~/.neutron/, ~/, /etc/neutron/, "
+                       "/etc/) and the '--config-file' option!"))
+
+    def dispatch(self):
+        command = self._args.get("<command>")
+        if command == "scan":
+            self.reap(dryrun=True)
+        elif command == "reap":
+            self.reap(self._dryrun)
+        else:
+            print("Address reaper tool. Re-run with -h/--help for options")
+
+    def _subnets(self, ctx):
+        if self._subnet_id:
+            return db_api.subnet_find(ctx, id=self._subnet_id,
+                                      scope=db_api.ALL) or []
+        return db_api.subnet_find(ctx, scope=db_api.ALL) or []
+
+    def _reapable(self, subnet, rows):
+        if subnet["do_not_use"]:
+            return [address_id for address_id, _address in rows]
+        # NOTE: Addresses are stored as v6 integers, v4 included, and so are
+        #       the policy exclusions.
+        cidr = netaddr.IPNetwork(subnet["cidr"]).ipv6()
+        policy = ip_policy_index.for_subnet(subnet)
+        return [address_id for address_id, address in rows
+                if address < cidr.first or address > cidr.last or
+                address in policy]
+
+    def _reap_subnet(self, ctx, subnet, dryrun):
+        found = reclaimed = 0
+        marker = None
+        while True:
+            rows = db_api.ip_address_reap_candidates(
+                ctx, subnet["id"], self._batch, marker=marker)
+            if not rows:
+                break
+            marker = rows[-1][0]
+            address_ids = self._reapable(subnet, rows)
+            found += len(address_ids)
+            if address_ids and not dryrun:
+                with ctx.session.begin():
+                    reclaimed += db_api.ip_address_reap(
+                        ctx, subnet["id"], address_ids,
+                        ip_version=subnet["ip_version"])
+            if len(rows) < self._batch:
+                break
+            if self._delay:
+                time.sleep(self._delay)
+        return found, reclaimed
+
+    def reap(self, dryrun=False):
+        if dryrun:
+            print()
+            print("Reaping in dry run mode. Deallocated addresses that can "
+                  "never be reallocated will be counted per subnet.\n\nTo "
+                  "actually delete them, re-run the reap command with the "
+                  "--yarly flag.")
+            print()
+
+        ctx = neutron.context.get_admin_context()
+        total_found = total_reclaimed = subnets_reaped = 0
+        for subnet in self._subnets(ctx):
+            found, reclaimed = self._reap_subnet(ctx, subnet, dryrun)
+            if not found:
+                continue
+            subnets_reaped += 1
+            total_found += found
+            total_reclaimed += reclaimed
+            if dryrun:
+                print("Subnet %s - %d reapable addresses" %
+                      (subnet["id"], found))
+            else:
+                print("Subnet %s - reclaimed %d of %d reapable addresses" %
+                      (subnet["id"], reclaimed, found))
+
+        if dryrun:
+            print("Found %d reapable addresses in %d subnets" %
+                  (total_found, subnets_reaped))
+            print('=' * 80)
+            print("Re-run with --yarly to apply changes")
+            return 0
+        print("Reclaimed %d addresses from %d subnets" %
+              (total_reclaimed, subnets_reaped))
+        print("Done!")
+        return total_reclaimed
+
+
+def main():
+    arguments = docopt.docopt(
+        __doc__, version="Quark Address Reaper CLI %.2f" % VERSION)
+    tool = QuarkAddressReaperTool(arguments)
+    tool.dispatch()
+
+
+if __name__ == "__main__":
+    main()
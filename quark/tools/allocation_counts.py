@@ -0,0 +1,188 @@
+#!/usr/bin/python
+# Copyright 2015 Openstack Foundation
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+"""Quark allocation counters CLI tool.
+
+Compares the denormalized allocation counters against the rows they count
+and optionally rewrites the ones that drifted. Repairs lock one row at a
+time, so it is safe to run against a live database.
+
+Usage: allocation_counts_tool [-h] [--config-file=PATH] <command> [--yarly]
+
+Options:
+    -h --help  Show this screen.
+    --version  Show version.
+    --config-file=PATH  Use a different config file path
+
+Available commands are:
+    allocation_counts_tool verify-subnets
+    allocation_counts_tool repair-subnets [--yarly]
+    allocation_counts_tool verify-mac-ranges
+    allocation_counts_tool repair-mac-ranges [--yarly]
+    allocation_counts_tool -h | --help
+    allocation_counts_tool --version
+
+"""
+
+VERSION = 0.1
+
+import sys
+
+import docopt
+from neutron.common import config
+import neutron.context
+from oslo.config import cfg
+
+from quark.db import api as db_api
+
+
+class QuarkAllocationCountsTool(object):
+    def __init__(self, arguments):
+        self._args = arguments
+
+        config_args = []
+        if self._args.get("--config-file"):
+            config_args.append("--config-file=%s" %
+                               self._args.pop("--config-file"))
+
+        self._dryrun = not self._args.get("--yarly")
+
+        config.init(config_args)
+        if not cfg.CONF.config_file:
+            sys.exit(_("ERROR: Unable to find configuration file via the "
+                       "default search paths (~/.neutron/, ~/, /etc/neutron/, "
+                       "/etc/) and the '--config-file' option!"))
+
+    def dispatch(self):
+        command = self._args.get("<command>")
+        if command == "verify-subnets":
+            self.verify_subnets()
+        elif command == "repair-subnets":
+            self.repair_subnets(self._dryrun)
+        elif command == "verify-mac-ranges":
+            self.verify_mac_ranges()
+        elif command == "repair-mac-ranges":
+            self.repair_mac_ranges(self._dryrun)
+        else:
+            print("Allocation counters tool. Re-run with -h/--help for "
+                  "options")
+
+    def _drifted_subnets(self, ctx):
+        counts = db_api.subnet_count_ips(ctx)
+        drifted = []
+        subnets = db_api.subnet_find(ctx, scope=db_api.ALL) or []
+        for subnet in subnets:
+            # NOTE: v6 subnets aren't counted, see subnet_update_ip_counts.
+            if subnet["ip_version"] == 6:
+                continue
+            stored = (subnet["allocated_count"],
+                      subnet["deallocated_reusable_count"])
+            actual = counts.get(subnet["id"], (0, 0))
+            if stored != actual:
+                drifted.append((subnet["id"], stored, actual))
+        return drifted
+
+    def verify_subnets(self):
+        ctx = neutron.context.get_admin_context()
+        drifted = self._drifted_subnets(ctx)
+        for subnet_id, stored, actual in drifted:
+            print("Subnet %s - stored (allocated:%d, deallocated:%d) - "
+                  "actual (allocated:%d, deallocated:%d)" %
+                  ((subnet_id,) + stored + actual))
+        print("Found %d subnets with drifted counters" % len(drifted))
+        return drifted
+
+    def repair_subnets(self, dryrun=False):
+        if dryrun:
+            print()
+            print("Repairing subnet counters in dry run mode. Subnets whose "
+                  "counters disagree with quark_ip_addresses will be "
+                  "listed.\n\nTo actually repair them, re-run with the "
+                  "--yarly flag.")
+            print()
+        drifted = self.verify_subnets()
+        if dryrun:
+            print('=' * 80)
+            print("Re-run with --yarly to apply changes")
+            return
+
+        ctx = neutron.context.get_admin_context()
+        repaired = 0
+        for subnet_id, _stored, _actual in drifted:
+            # NOTE: the counters may have moved since the scan above, so
+            # each subnet is recounted under its own row lock.
+            with ctx.session.begin():
+                if db_api.subnet_repair_ip_counts(ctx, subnet_id):
+                    repaired += 1
+        print("Repaired %d subnets" % repaired)
+        print("Done!")
+
+    def _drifted_mac_ranges(self, ctx):
+        counts = db_api.mac_range_count_macs(ctx)
+        drifted = []
+        mac_ranges = db_api.mac_address_range_find(ctx,
+                                                   scope=db_api.ALL) or []
+        for mac_range in mac_ranges:
+            stored = (mac_range["allocated_count"],
+                      mac_range["deallocated_count"])
+            actual = counts.get(mac_range["id"], (0, 0))
+            if stored != actual:
+                drifted.append((mac_range["id"], stored, actual))
+        return drifted
+
+    def verify_mac_ranges(self):
+        ctx = neutron.context.get_admin_context()
+        drifted = self._drifted_mac_ranges(ctx)
+        for mac_range_id, stored, actual in drifted:
+            print("MAC range %s - stored (allocated:%d, deallocated:%d) - "
+                  "actual (allocated:%d, deallocated:%d)" %
+                  ((mac_range_id,) + stored + actual))
+        print("Found %d MAC ranges with drifted counters" % len(drifted))
+        return drifted
+
+    def repair_mac_ranges(self, dryrun=False):
+        if dryrun:
+            print()
+            print("Repairing MAC range counters in dry run mode. Ranges "
+                  "whose counters disagree with quark_mac_addresses will be "
+                  "listed.\n\nTo actually repair them, re-run with the "
+                  "--yarly flag.")
+            print()
+        drifted = self.verify_mac_ranges()
+        if dryrun:
+            print('=' * 80)
+            print("Re-run with --yarly to apply changes")
+            return
+
+        ctx = neutron.context.get_admin_context()
+        repaired = 0
+        for mac_range_id, _stored, _actual in drifted:
+            with ctx.session.begin():
+                if db_api.mac_range_repair_counts(ctx, mac_range_id):
+                    repaired += 1
+        print("Repaired %d MAC ranges" % repaired)
+        print("Done!")
+
+
+def main():
+    arguments = docopt.docopt(
+        __doc__, version="Quark Allocation Counts CLI %.2f" % VERSION)
+    tool = QuarkAllocationCountsTool(arguments)
+    tool.dispatch()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,274 @@
+#!/usr/bin/python
+# Copyright 2015 Openstack Foundation
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+"""Quark IPAM benchmark CLI tool.
+
+Seeds a scratch database with networks, each with --subnets v4 subnets and
+one v6 subnet. Every v4 subnet gets an IP policy excluding its first
+--excluded addresses and its broadcast address, and a history of
+--deallocated addresses ready for reallocation. Then --workers greenthreads
+each allocate --allocations ports' worth of addresses with every strategy
+in turn, on a freshly seeded database.
+
+One JSON object per strategy is printed on its own line, with the
+allocations per second, the p50 and p99 latency of a port's allocation in
+milliseconds, the retries counted by the IPAM metrics, and the deadlocks
+and other errors raised.
+
+ALL TABLES OF THE DATABASE GIVEN WITH --connection ARE DROPPED. The
+default is an in-memory sqlite database, which serializes the workers;
+point it at a local MySQL schema to measure lock contention.
+
+Usage: ipam_benchmark_tool [-h] [--config-file=PATH] [--connection=<url>]
+                           [--networks=<networks>] [--subnets=<subnets>]
+                           [--prefix=<prefix>] [--excluded=<excluded>]
+                           [--deallocated=<deallocated>]
+                           [--workers=<workers>]
+                           [--allocations=<allocations>]
+                           [--strategies=<strategies>] <command>
+
+Options:
+    -h --help  Show this screen.
+    --version  Show version.
+    --config-file=PATH  Use a different config file path
+    --connection=<url>  SQLAlchemy URL of the scratch database
+    --networks=<networks>  Number of networks to seed
+    --subnets=<subnets>  Number of v4 subnets to seed per network
+    --prefix=<prefix>  Prefix length of the seeded v4 subnets
+    --excluded=<excluded>  Addresses excluded by policy per v4 subnet
+    --deallocated=<deallocated>  Deallocated addresses per v4 subnet
+    --workers=<workers>  Number of concurrent greenthreads
+    --allocations=<allocations>  Ports each greenthread allocates for
+    --strategies=<strategies>  Comma separated strategies to run
+
+Available commands are:
+    ipam_benchmark_tool run
+    ipam_benchmark_tool -h | --help
+    ipam_benchmark_tool --version
+
+"""
+
+VERSION = 0.1
+CONNECTION = "sqlite://"
+NETWORKS = 4
+SUBNETS = 2
+PREFIX = 22
+EXCLUDED = 4
+DEALLOCATED = 64
+WORKERS = 16
+ALLOCATIONS = 32
+STRATEGIES = "ANY,BOTH,BOTH_REQUIRED"
+
+import datetime
+import json
+import math
+import random
+import sys
+import time
+
+import docopt
+import eventlet
+import netaddr
+from neutron.common import config
+from neutron.common import rpc as n_rpc
+import neutron.context
+from neutron.db import api as neutron_db_api
+from neutron.openstack.common import uuidutils
+from oslo.config import cfg
+from oslo.db import exception as db_exception
+from oslo.utils import timeutils
+
+from quark.db import api as db_api
+from quark.db import models
+from quark import ipam
+from quark import ipam_metrics
+
+
+def percentile(samples, pct):
+    """Nearest-rank percentile of samples, which must be sorted."""
+    if not samples:
+        return 0.0
+    rank = int(math.ceil(pct / 100.0 * len(samples)))
+    return samples[max(rank, 1) - 1]
+
+
+class QuarkIpamBenchmarkTool(object):
+    def __init__(self, arguments):
+        self._args = arguments
+
+        self._connection = self._args.get("--connection") or CONNECTION
+        self._networks = int(self._args.get("--networks") or NETWORKS)
+        self._subnets = int(self._args.get("--subnets") or SUBNETS)
+        self._prefix = int(self._args.get("--prefix") or PREFIX)
+        self._excluded = int(self._args.get("--excluded") or EXCLUDED)
+        self._deallocated = int(self._args.get("--deallocated") or
+                                DEALLOCATED)
+        self._workers = int(self._args.get("--workers") or WORKERS)
+        self._allocations = int(self._args.get("--allocations") or
+                                ALLOCATIONS)
+        self._strategies = (self._args.get("--strategies") or
+                            STRATEGIES).split(",")
+
+        config_args = []
+        if self._args.get("--config-file"):
+            config_args.append("--config-file=%s" %
+                               self._args.pop("--config-file"))
+
+        # NOTE: Unlike the other tools a config file is optional, the
+        #       benchmark brings its own database.
+        config.init(config_args)
+        cfg.CONF.set_override("connection", self._connection, "database")
+        n_rpc.init(cfg.CONF)
+
+        # NOTE: Once threading is patched every greenthread gets its own
+        #       connection, which for in-memory sqlite is an empty database.
+        if not self._connection.startswith("sqlite"):
+            eventlet.monkey_patch()
+
+    def dispatch(self):
+        command = self._args.get("<command>")
+        if command == "run":
+            self.run()
+        else:
+            print("IPAM benchmark tool. Re-run with -h/--help for options")
+
+    def _reset_database(self):
+        engine = neutron_db_api.get_engine()
+        models.BASEV2.metadata.drop_all(engine)
+        models.BASEV2.metadata.create_all(engine)
+
+    def _v4_cidr(self, index):
+        size = 2 ** (32 - self._prefix)
+        first = netaddr.IPAddress("10.0.0.0").value + index * size
+        return netaddr.IPNetwork("%s/%d" % (netaddr.IPAddress(first),
+                                            self._prefix))
+
+    def _seed_v4_subnet(self, ctx, network, cidr):
+        excluded = netaddr.IPSet([cidr.broadcast])
+        if self._excluded:
+            excluded.add(netaddr.IPRange(cidr.first,
+                                         cidr.first + self._excluded - 1))
+        policy = db_api.ip_policy_create(
+            ctx, exclude=[str(c) for c in excluded.iter_cidrs()])
+        subnet = db_api.subnet_create(ctx, network=network, cidr=str(cidr),
+                                      ip_policy=policy, do_not_use=False)
+        ctx.session.flush()
+
+        deallocated_at = timeutils.utcnow() - datetime.timedelta(days=1)
+        rows = []
+        for i in xrange(self._deallocated):
+            address = netaddr.IPAddress(cidr.first + self._excluded + i)
+            rows.append(dict(id=uuidutils.generate_uuid(),
+                             address=address.ipv6().value,
+                             address_readable=str(address),
+                             subnet_id=subnet["id"],
+                             network_id=network["id"], version=4,
+                             used_by_tenant_id=ctx.tenant_id,
+                             _deallocated=True,
+                             deallocated_at=deallocated_at))
+        if rows:
+            ctx.session.execute(models.IPAddress.__table__.insert(), rows)
+        subnet["next_auto_assign_ip"] = (subnet["first_ip"] +
+                                         self._excluded + len(rows))
+        subnet["deallocated_reusable_count"] = len(rows)
+
+    def seed(self, ctx):
+        self._reset_database()
+        network_ids = []
+        with ctx.session.begin():
+            for n in xrange(self._networks):
+                network = db_api.network_create(
+                    ctx, id=uuidutils.generate_uuid(),
+                    name="benchmark-%d" % n, tenant_id=ctx.tenant_id)
+                for s in xrange(self._subnets):
+                    self._seed_v4_subnet(
+                        ctx, network, self._v4_cidr(n * self._subnets + s))
+                db_api.subnet_create(ctx, network=network,
+                                     cidr="fd00:%x::/64" % n,
+                                     do_not_use=False)
+                network_ids.append(network["id"])
+        return network_ids
+
+    def _worker(self, strategy, network_ids, result):
+        ctx = neutron.context.Context("benchmark", "benchmark")
+        for i in xrange(self._allocations):
+            addresses = []
+            mac = dict(address=random.getrandbits(40))
+            start = time.time()
+            try:
+                strategy.allocate_ip_address(
+                    ctx, addresses, random.choice(network_ids),
+                    uuidutils.generate_uuid(), 0, mac_address=mac)
+            except db_exception.DBDeadlock:
+                result["deadlocks"] += 1
+                continue
+            except Exception:
+                result["errors"] += 1
+                continue
+            result["latencies"].append(time.time() - start)
+            result["addresses"] += len(addresses)
+
+    def run_strategy(self, name, network_ids):
+        strategy = ipam.IPAM_REGISTRY.strategies[name]
+        ipam_metrics.METRICS.reset()
+        result = dict(latencies=[], addresses=0, deadlocks=0, errors=0)
+        pool = eventlet.GreenPool(self._workers)
+        start = time.time()
+        for _ in xrange(self._workers):
+            pool.spawn(self._worker, strategy, network_ids, result)
+        pool.waitall()
+        elapsed = time.time() - start
+
+        latencies = sorted(result["latencies"])
+        counters = ipam_metrics.METRICS.counters
+        retries = sum(count for counter, count in counters.items()
+                      if counter.startswith(name + ".") and
+                      counter.endswith(".retries"))
+        return dict(strategy=name,
+                    workers=self._workers,
+                    ports=len(latencies),
+                    addresses=result["addresses"],
+                    seconds=round(elapsed, 3),
+                    allocs_per_sec=round(len(latencies) / elapsed, 2)
+                    if elapsed else 0.0,
+                    p50_ms=round(percentile(latencies, 50) * 1000, 3),
+                    p99_ms=round(percentile(latencies, 99) * 1000, 3),
+                    retries=retries,
+                    deadlocks=result["deadlocks"],
+                    errors=result["errors"])
+
+    def run(self):
+        ctx = neutron.context.Context("benchmark", "benchmark")
+        results = []
+        for name in self._strategies:
+            if not ipam.IPAM_REGISTRY.is_valid_strategy(name):
+                sys.exit("ERROR: Unknown IPAM strategy %s" % name)
+            network_ids = self.seed(ctx)
+            result = self.run_strategy(name, network_ids)
+            print(json.dumps(result, sort_keys=True))
+            results.append(result)
+        return results
+
+
+def main():
+    arguments = docopt.docopt(
+        __doc__, version="Quark IPAM Benchmark CLI %.2f" % VERSION)
+    tool = QuarkIpamBenchmarkTool(arguments)
+    tool.dispatch()
+
+
+if __name__ == "__main__":
+    main()
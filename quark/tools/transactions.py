@@ -0,0 +1,157 @@
+#!/usr/bin/python
+# Copyright 2015 Openstack Foundation
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+"""Quark transactions CLI tool.
+
+Prunes quark_transactions, which gains a row for every IPAM claim made in
+'transaction' mode and is never cleaned up otherwise. The newest --keep
+rows are left alone so claims in flight can still read back their rows.
+Deletes happen in batches of --batch ids, each in its own transaction,
+with --delay seconds between them.
+
+Usage: transactions_tool [-h] [--config-file=PATH] [--keep=<keep>]
+                         [--batch=<batch>] [--delay=<delay>] <command>
+                         [--yarly]
+
+Options:
+    -h --help  Show this screen.
+    --version  Show version.
+    --config-file=PATH  Use a different config file path
+    --keep=<keep>  Number of the newest transactions to keep
+    --batch=<batch>  Number of transaction ids to prune at a time
+    --delay=<delay>  Seconds to wait between batches
+
+Available commands are:
+    transactions_tool count
+    transactions_tool prune [--yarly]
+    transactions_tool -h | --help
+    transactions_tool --version
+
+"""
+
+VERSION = 0.1
+KEEP = 10000
+BATCH = 1000
+DELAY = 0.1
+
+import sys
+import time
+
+import docopt
+from neutron.common import config
+import neutron.context
+from oslo.config import cfg
+
+from quark.db import api as db_api
+
+
+class QuarkTransactionsTool(object):
+    def __init__(self, arguments):
+        self._args = arguments
+
+        self._keep = KEEP
+        self._batch = BATCH
+        self._delay = DELAY
+
+        if self._args.get("--keep"):
+            self._keep = int(self._args["--keep"])
+
+        if self._args.get("--batch"):
+            self._batch = int(self._args["--batch"])
+
+        if self._args.get("--delay"):
+            self._delay = float(self._args["--delay"])
+
+        config_args = []
+        if self._args.get("--config-file"):
+            config_args.append("--config-file=%s" %
+                               self._args.pop("--config-file"))
+
+        self._dryrun = not self._args.get("--yarly")
+
+        config.init(config_args)
+        if not cfg.CONF.config_file:
+            sys.exit(_("ERROR: Unable to find configuration file via the "
+                       "default search paths (~/.neutron/, ~/, /etc/neutron/, "
+                       "/etc/) and the '--config-file' option!"))
+
+    def dispatch(self):
+        command = self._args.get("<command>")
+        if command == "count":
+            self.count()
+        elif command == "prune":
+            self.prune(self._dryrun)
+        else:
+            print("Transactions tool. Re-run with -h/--help for options")
+
+    def _prunable_range(self, ctx):
+        first, last = db_api.transaction_id_range(ctx)
+        if first is None:
+            return None
+        if last - self._keep < first:
+            return None
+        return first, last - self._keep
+
+    def count(self):
+        ctx = neutron.context.get_admin_context()
+        first, last = db_api.transaction_id_range(ctx)
+        if first is None:
+            print("quark_transactions is empty")
+            return
+        print("quark_transactions spans ids %d to %d" % (first, last))
+        prunable = self._prunable_range(ctx)
+        if prunable:
+            print("Ids %d to %d can be pruned" % prunable)
+
+    def prune(self, dryrun=False):
+        ctx = neutron.context.get_admin_context()
+        prunable = self._prunable_range(ctx)
+        if not prunable:
+            print("Nothing to prune")
+            return 0
+
+        first, last = prunable
+        if dryrun:
+            print()
+            print("Pruning in dry run mode. Transactions %d to %d would be "
+                  "deleted, keeping the newest %d." % (first, last,
+                                                       self._keep))
+            print('=' * 80)
+            print("Re-run with --yarly to apply changes")
+            return 0
+
+        pruned = 0
+        while first <= last:
+            batch_last = min(first + self._batch - 1, last)
+            with ctx.session.begin():
+                pruned += db_api.transaction_prune(ctx, first, batch_last)
+            first = batch_last + 1
+            if first <= last and self._delay:
+                time.sleep(self._delay)
+        print("Pruned %d transactions" % pruned)
+        print("Done!")
+        return pruned
+
+
+def main():
+    arguments = docopt.docopt(
+        __doc__, version="Quark Transactions CLI %.2f" % VERSION)
+    tool = QuarkTransactionsTool(arguments)
+    tool.dispatch()
+
+
+if __name__ == "__main__":
+    main()
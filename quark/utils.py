@@ -44,6 +44,23 @@ def attr_specified(param):
     return param is not attributes.ATTR_NOT_SPECIFIED
 
 
+# NOTE: Fields that ask for more of a resource rather than for one of its
+#       attributes.
+EXPANSION_FIELDS = ("all_subnets", "port_subnets")
+
+
+def requested_fields(fields):
+    """The attributes fields asks for, None when it asks for all of them."""
+    if not fields:
+        return None
+    requested = set(fields).difference(EXPANSION_FIELDS)
+    return requested or None
+
+
+def field_requested(requested, *keys):
+    return requested is None or any(key in requested for key in keys)
+
+
 def timed(fn):
     def _wrapped(*args, **kwargs):
         began = time.time()